@@ -26,6 +26,7 @@ from os.path import dirname
 cwd = dirname(dirname(dirname(os.path.abspath(__file__))))
 sys.path.append(os.path.join(cwd, "build", "lib.linux-x86_64-2.6"))
 import pyFAI
+import pyFAI.distortion
 try:
     from pyFAI.fastcrc import crc32
 except ImportError:
@@ -47,12 +48,15 @@ class SinkPyFAI(Core.Processlib.SinkTaskBase):
     """
     This is a processlib Sink: it takes an image as input and writes a file to disk but returns nothing
     """
-    def __init__(self, splinefile=None, darkfile=None, flatfile=None, extraheader=None):
+    def __init__(self, splinefile=None, darkfile=None, flatfile=None, extraheader=None, cachedir=None):
         """
         :param splinefile: File with the description of the distortion as a cubic spline
         :param darkfile: image with the dark current
         :param flatfile: image with the flat field correction
         :param extraheader: dictionary with additional static header for EDF files
+        :param cachedir: directory where the distortion correction matrices are
+                         stored, to be reloaded instantly at restart. By default
+                         the one of the PYFAI_SPARSE_CACHE environment variable.
         """
         Core.Processlib.SinkTaskBase.__init__(self)
 
@@ -68,6 +72,7 @@ class SinkPyFAI(Core.Processlib.SinkTaskBase):
         self.extension = ".cor"
         self.binning = (1,1)
         self.shape = (None, None)
+        self.cachedir = cachedir
         self.setSplineFile(splinefile)
         self.setDarkcurrentFile(darkfile)
         self.setFlatfieldFile(flatfile)
@@ -183,7 +188,9 @@ class SinkPyFAI(Core.Processlib.SinkTaskBase):
             else:
                 logger.info("start config ...")
                 self.det = pyFAI.detectors.FReLoN(splineFile)
-                self.dis = pyFAI._distortion.Distortion(self.det)
+                self.dis = pyFAI.distortion.Distortion(self.det, method="lut",
+                                                       mask=numpy.zeros(self.det.shape, numpy.int8),
+                                                       cache=self.cachedir)
                 self.reset()
                 self.header["splinefile"] = splineFile
 
@@ -205,14 +212,15 @@ class SinkPyFAI(Core.Processlib.SinkTaskBase):
     def calc_LUT(self):
         """
         This is the "slow" calculation of the Look-up table that can be spown in another thread
-        (especially to avoid Tango from timing out)
+        (especially to avoid Tango from timing out).
+        The table is loaded from the sparse cache when it was already calculated.
         """
         with self._sem:
             if self.dis:
-                self.dis.calc_LUT_size()
-                self.dis.calc_LUT()
+                self.dis.calc_init()
                 if pyopencl:
-                    self.ocl_integrator = pyFAI.ocl_azim_lut.OCL_LUT_Integrator(self.dis.LUT, self.dis.shape[0] * self.dis.shape[1])
+                    shape_out = self.dis.shape_out
+                    self.ocl_integrator = pyFAI.ocl_azim_lut.OCL_LUT_Integrator(self.dis.lut, shape_out[0] * shape_out[1])
             else:
                 self.splinefile = None
                 self.det = None
@@ -267,7 +275,8 @@ class DistortionCorrectionDeviceServer(BasePostProcess) :
                     if not self.__pyFAISink:
                         self.__pyFAISink = SinkPyFAI(splinefile=self.__spline_filename,
                                                      darkfile=self.__darkcurrent_filename,
-                                                     flatfile=self.__flatfield_filename)
+                                                     flatfile=self.__flatfield_filename,
+                                                     cachedir=self.SparseCache or None)
                     self.__Task.setSinkTask(self.__pyFAISink)
                 except:
                     import traceback
@@ -326,7 +335,8 @@ class DistortionCorrectionDeviceServer(BasePostProcess) :
         """
         self.__pyFAISink = SinkPyFAI(splinefile=self.__spline_filename,
                                      darkfile=self.__darkcurrent_filename,
-                                     flatfile=self.__flatfield_filename)
+                                     flatfile=self.__flatfield_filename,
+                                     cachedir=self.SparseCache or None)
         self.__Task.setSinkTask(self.__pyFAISink)
 
     def read_Parameters(self, attr):
@@ -356,6 +366,10 @@ class DistortionCorrectionDeviceServerClass(PyTango.DeviceClass) :
 
     #    Device Properties
     device_property_list = {
+        'SparseCache':
+        [PyTango.DevString,
+         "Directory where distortion correction matrices are stored to be reloaded at restart",
+         [""]],
         }
 
 
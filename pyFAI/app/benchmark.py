@@ -32,7 +32,7 @@ __author__ = "Jérôme Kieffer, Picca Frédéric-Emmanuel"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "09/10/2018"
+__date__ = "18/02/2019"
 __status__ = "development"
 
 import logging
@@ -84,6 +84,16 @@ def main():
                         action="store_false", dest="onedim", default=True,
                         help="Do not benchmark algorithms for 1D-regrouping")
 
+    parser.add_argument("-t", "--threads",
+                        dest="threads", default=None, nargs="*", type=int,
+                        help="Benchmark the scaling of the OpenMP CSR integrator with the number of threads, "
+                             "by default 1, 2, 4 ... up to the number of cores")
+    parser.add_argument("--corners",
+                        action="store_true", dest="corners", default=False,
+                        help="Benchmark the calculation of the pixel corner positions")
+    parser.add_argument("--distortion",
+                        action="store_true", dest="distortion", default=False,
+                        help="Benchmark the distortion correction of a stack of frames")
     parser.add_argument("-m", "--memprof",
                         action="store_true", dest="memprof", default=False,
                         help="Perfrom memory profiling (Linux only)")
@@ -108,7 +118,10 @@ def main():
                         max_size=options.size,
                         do_1d=options.onedim,
                         do_2d=options.twodim,
-                        devices=devices)
+                        devices=devices,
+                        nthreads=options.threads,
+                        do_corners=options.corners,
+                        do_distortion=options.distortion)
 
     pyFAI.benchmark.pylab.ion()
     six.moves.input("Enter to quit")
@@ -34,7 +34,7 @@ __author__ = "Jerome Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "09/10/2018"
+__date__ = "18/02/2019"
 __satus__ = "Production"
 
 import logging
@@ -133,6 +133,15 @@ user interface.
                             help="process using OpenCL on GPU ", default=False)
         parser.add_argument("-S", "--stats", dest="stats", action="store_true",
                             help="show statistics at the end", default=False)
+        parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=0,
+                            help="number of processes integrating frames in parallel, default: none")
+        parser.add_argument("--threads", dest="threads", type=int, default=0,
+                            help="number of threads integrating frames in parallel, default: none")
+        parser.add_argument("--resume", dest="resume", action="store_true", default=False,
+                            help="resume a processing: positions already in the output file are skipped")
+        parser.add_argument("--journal", dest="journal", metavar="FILE", default=None,
+                            help="journal recording the frames processed: if it exists, "
+                                 "the processing is resumed where it stopped")
 
         options = parser.parse_args()
         args = options.args
@@ -196,6 +205,10 @@ user interface.
         else:
             self.offset = 0
         self.stats = options.stats
+        self.njobs = options.jobs
+        self.nthreads = options.threads
+        self.resume = options.resume
+        self.journal = options.journal
         return options
 
 
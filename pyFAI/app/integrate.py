@@ -34,11 +34,12 @@ __author__ = "Jerome Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "04/02/2019"
+__date__ = "18/02/2019"
 __satus__ = "production"
 
 import sys
 import logging
+import threading
 import time
 import numpy
 import os.path
@@ -53,8 +54,10 @@ logger = logging.getLogger("pyFAI")
 import pyFAI.utils
 import pyFAI.worker
 from pyFAI.io import DefaultAiWriter
-from pyFAI.io import HDF5Writer
+from pyFAI.io.sources import open_source
+from pyFAI.io.journal import Journal
 from pyFAI.utils.shell import ProgressBar
+from pyFAI.utils import parallel
 from pyFAI import average
 
 from argparse import ArgumentParser
@@ -260,15 +263,374 @@ class ShellIntegrationObserver(IntegrationObserver):
         self._progress_bar.clear()
 
 
-def process(input_data, output, config, monitor_name, observer):
+def _get_output_path(output, filename, iitem, multiframe, do_2D):
+    """
+    Path of the file where the result of the integration of an input is saved
+
+    :param str output: Filename of directory output
+    :param str filename: Filename of the input data, if any
+    :param int iitem: Index of the input data
+    :param bool multiframe: True if the input contains several frames
+    :param bool do_2D: True for 2D integration
+    :rtype: str
+    """
+    if filename:
+        output_name = os.path.splitext(filename)[0]
+    else:
+        output_name = "array_%d" % iitem
+
+    if multiframe:
+        extension = "_pyFAI.h5"
+    else:
+        if do_2D:
+            extension = ".azim"
+        else:
+            extension = ".dat"
+    output_name = "%s%s" % (output_name, extension)
+
+    if output:
+        if os.path.isdir(output):
+            basename = os.path.basename(output_name)
+            outpath = os.path.join(output, basename)
+        else:
+            outpath = os.path.abspath(output)
+    else:
+        outpath = output_name
+    return outpath
+
+
+def _get_input_name(filename, iitem):
+    """Name of an input in the journal
+
+    :param str filename: Filename of the input data, if any
+    :param int iitem: Index of the input data
+    """
+    return filename if filename else "array_%d" % iitem
+
+
+def _iter_frames(valid_data, output, do_2D, journal=None):
+    """
+    Describe all frames of all inputs, in order
+
+    :param List valid_data: List of input filenames, fabio images or arrays
+    :param str output: Filename of directory output
+    :param bool do_2D: True for 2D integration
+    :param Journal journal: Journal of the processing, recorded frames are skipped
+    :return: iterator of dict describing each frame, to be read with `_FrameReader`
+    """
+    for iitem, item in enumerate(valid_data):
+        if isinstance(item, six.string_types):
+            try:
+                # only the header: frames are decompressed by the readers
+                fabio_image = fabio.openheader(item)
+            except Exception:
+                fabio_image = fabio.open(item)
+            filename = fabio_image.filename
+            nframes = fabio_image.nframes
+        elif isinstance(item, fabio.fabioimage.FabioImage):
+            filename = item.filename
+            nframes = item.nframes
+        else:
+            filename = None
+            nframes = len(item) if item.ndim == 3 else 1
+        multiframe = (nframes > 1) or (filename is None and item.ndim == 3)
+        outpath = _get_output_path(output, filename, iitem, multiframe, do_2D)
+        for iframe in range(nframes):
+            if (journal is not None) and journal.is_done(_get_input_name(filename, iitem), iframe):
+                continue
+            yield {"iitem": iitem,
+                   "filename": filename,
+                   "iframe": iframe,
+                   "nframes": nframes,
+                   "multiframe": multiframe,
+                   "outpath": outpath}
+
+
+class _FrameReader(object):
+    """
+    Read the frames described by `_iter_frames`, from several threads.
+    """
+
+    def __init__(self, valid_data, monitor_name):
+        """
+        :param List valid_data: List of input filenames, fabio images or arrays
+        :param str monitor_name: Name of the monitor in the headers, if any
+        """
+        self.valid_data = valid_data
+        self.monitor_name = monitor_name
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def read(self, description):
+        """
+        :param dict description: description of the frame
+        :return: the description completed with data, normalization_factor and metadata
+        :rtype: dict
+        """
+        item = self.valid_data[description["iitem"]]
+        iframe = description["iframe"]
+        frame = dict(description)
+        if isinstance(item, numpy.ndarray):
+            frame["data"] = item[iframe] if description["multiframe"] else item
+            return frame
+        if isinstance(item, six.string_types):
+            # each thread has its own source to decompress in parallel
+            opened = getattr(self._local, "opened", None)
+            if (opened is None) or (opened[0] != item):
+                opened = self._local.opened = (item, open_source(item))
+            fabio_image = opened[1].getframe(iframe)
+            frame["data"] = fabio_image.data
+        else:
+            # fabio images provided by the caller are not shared between threads
+            with self._lock:
+                fabio_image = item
+                if description["nframes"] > 1:
+                    fabio_image = fabio_image.getframe(iframe)
+                frame["data"] = fabio_image.data
+        frame["normalization_factor"] = get_monitor_value(fabio_image, self.monitor_name)
+        if description["multiframe"]:
+            frame["metadata"] = fabio_image.header
+        return frame
+
+
+class _ResultWriter(object):
+    """
+    Write the results of the frames described by `_iter_frames`, received in
+    order, in the output file of each input.
+
+    With a journal, frames are recorded once their result is on disk: HDF5
+    outputs are flushed every `checkpoint` frames, other outputs are recorded
+    when closed. HDF5 outputs of a resumed processing are completed from the
+    offset recorded in the journal.
+    """
+
+    def __init__(self, config, worker, observer, journal=None, checkpoint=16):
+        """
+        :param dict config: Configuration of the worker, saved in HDF5 outputs
+        :param Worker worker: Configured worker
+        :param IntegrationObserver observer: Observer of the processing
+        :param Journal journal: Journal of the processing, if any
+        :param int checkpoint: Number of frames between two flushes of HDF5 outputs
+        """
+        self.config = config
+        self.worker = worker
+        self.observer = observer
+        self.journal = journal
+        self.checkpoint = max(1, checkpoint)
+        self.iitem = None
+        self.writer = None
+        self._pending = []
+
+    def write(self, frame, result):
+        """
+        :param dict frame: description of the frame
+        :param result: result of the integration of this frame
+        """
+        if frame["iitem"] != self.iitem:
+            self.close()
+            self.iitem = frame["iitem"]
+            if self.observer is not None:
+                self.observer.processing_data(frame["iitem"] + 1, filename=frame["filename"])
+            if frame["multiframe"]:
+                start_frame = 0 if self.journal is None else self.journal.get_offset(frame["outpath"])
+                self.writer = self.worker.get_hdf5_writer(frame["outpath"], append_frames=True,
+                                                          start_frame=start_frame)
+                self.writer.init(fai_cfg=self.config)
+            else:
+                self.writer = DefaultAiWriter(frame["outpath"], self.worker.ai)
+        if frame["multiframe"]:
+            self.writer.write(result, index=frame["iframe"])
+        else:
+            self.writer.write(result)
+        if self.journal is not None:
+            self._pending.append((_get_input_name(frame["filename"], frame["iitem"]),
+                                  frame["iframe"], frame["outpath"], frame["iframe"]))
+            if frame["multiframe"] and len(self._pending) >= self.checkpoint:
+                self.writer.flush()
+                self._record()
+        if self.observer is not None:
+            self.observer.data_result(frame["iitem"], result)
+
+    def _record(self):
+        if self._pending:
+            self.journal.record_many(self._pending)
+            self._pending = []
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.journal is not None:
+            self._record()
+
+
+def _process_frames(valid_data, output, config, worker, monitor_name, observer,
+                    journal=None):
+    """
+    Integrate a set of data frame by frame, in a single thread.
+
+    :param List valid_data: List of input filenames, fabio images or arrays
+    :param str output: Filename of directory output
+    :param dict config: Configuration of the worker, saved in HDF5 outputs
+    :param Worker worker: Configured worker
+    :param str monitor_name: Name of the monitor in the headers, if any
+    :param IntegrationObserver observer: Observer of the processing
+    :param Journal journal: Journal of the processing, if any
+    """
+    reader = _FrameReader(valid_data, monitor_name)
+    writer = _ResultWriter(config, worker, observer, journal)
+    try:
+        for description in _iter_frames(valid_data, output, worker.do_2D(), journal):
+            frame = reader.read(description)
+            result = worker._integrate(frame["data"],
+                                       normalization_factor=frame.get("normalization_factor", 1.0),
+                                       metadata=frame.get("metadata"))
+            writer.write(description, result)
+            if (observer is not None) and observer.is_interruption_requested():
+                break
+    finally:
+        writer.close()
+
+
+def _process_pipeline(valid_data, output, config, worker, monitor_name, observer,
+                      nreader=1, nintegrator=1, queue_size=4, journal=None):
+    """
+    Integrate a set of data with `Worker.process_pipeline`: all frames of all
+    inputs are processed as a single stream, so that the reading of the next
+    frames (or files) overlaps the integration and the writing of the
+    current ones.
+
+    :param List valid_data: List of input filenames, fabio images or arrays
+    :param str output: Filename of directory output
+    :param dict config: Configuration of the worker, saved in HDF5 outputs
+    :param Worker worker: Configured worker
+    :param str monitor_name: Name of the monitor in the headers, if any
+    :param IntegrationObserver observer: Observer of the processing
+    :param int nreader: Number of reading threads
+    :param int nintegrator: Number of integration threads
+    :param int queue_size: Number of frames in flight per thread
+    :param Journal journal: Journal of the processing, if any
+    :rtype: pyFAI.worker.PipelineStatistics
+    """
+    reader = _FrameReader(valid_data, monitor_name)
+    writer = _ResultWriter(config, worker, observer, journal)
+    is_interrupted = None if observer is None else observer.is_interruption_requested
+    try:
+        statistics = worker.process_pipeline(_iter_frames(valid_data, output, worker.do_2D(), journal),
+                                             read=reader.read,
+                                             callback=lambda index, frame, result: writer.write(frame, result),
+                                             nreader=nreader, nintegrator=nintegrator,
+                                             queue_size=queue_size,
+                                             is_interrupted=is_interrupted)
+    finally:
+        writer.close()
+    return statistics
+
+
+def _integrate_job(description):
+    """
+    Integrate a frame in a worker of the pool
+
+    :param dict description: description of the frame, from `_iter_frames`
+    :return: description and result of the integration
+    """
+    worker, reader = parallel.get_context()
+    frame = reader.read(description)
+    result = worker._integrate(frame["data"],
+                               normalization_factor=frame.get("normalization_factor", 1.0),
+                               metadata=frame.get("metadata"))
+    return description, result
+
+
+def _process_jobs(valid_data, output, config, worker, monitor_name, observer, njobs,
+                  journal=None, start_method=None):
+    """
+    Integrate a set of data with a pool of `njobs` processes.
+
+    The first frame is integrated before starting the pool, so the
+    integration engine (i.e. the sparse matrix) is built once: with the fork
+    start method, it is inherited by all processes and pages are shared
+    (copy-on-write), not duplicated. With other start methods, the worker and
+    the reader are pickled and each process builds its own engine.
+    Frames are distributed to the processes and the results are written by
+    the calling process, in order.
+
+    :param List valid_data: List of input filenames, fabio images or arrays
+    :param str output: Filename of directory output
+    :param dict config: Configuration of the worker, saved in HDF5 outputs
+    :param Worker worker: Configured worker
+    :param str monitor_name: Name of the monitor in the headers, if any
+    :param IntegrationObserver observer: Observer of the processing
+    :param int njobs: Number of processes
+    :param Journal journal: Journal of the processing, if any
+    :param str start_method: Start method of the processes, see `pyFAI.utils.parallel`
+    """
+    reader = _FrameReader(valid_data, monitor_name)
+    writer = _ResultWriter(config, worker, observer, journal)
+    frames = _iter_frames(valid_data, output, worker.do_2D(), journal)
+    try:
+        first = next(frames, None)
+        if first is None:
+            return
+        frame = reader.read(first)
+        result = worker._integrate(frame["data"],
+                                   normalization_factor=frame.get("normalization_factor", 1.0),
+                                   metadata=frame.get("metadata"))
+        writer.write(first, result)
+
+        pool = parallel.create_pool(njobs, (worker, reader), start_method)
+        try:
+            for description, result in pool.imap(_integrate_job, frames):
+                writer.write(description, result)
+                if (observer is not None) and observer.is_interruption_requested():
+                    pool.terminate()
+                    break
+            else:
+                pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        writer.close()
+
+
+def process(input_data, output, config, monitor_name, observer,
+            nreader=0, nintegrator=0, queue_size=4, njobs=0, journal=None,
+            start_method=None):
     """
     Integrate a set of data.
 
+    When a number of reading or integration threads is provided, frames are
+    processed in a pipeline where reading, integration and writing overlap.
+    When a number of jobs is provided, frames are integrated by a pool of
+    processes.
+    When a journal is provided, the frames processed are recorded in it and
+    a processing interrupted is resumed where it stopped: frames already
+    recorded are skipped and HDF5 outputs are completed.
+
     :param List[str] input_data: List of input filenames
     :param str output: Filename of directory output
     :param dict config: Dictionary to configure `pyFAI.worker.Worker`
     :param IntegrationObserver observer: Observer of the processing
-    :param:
+    :param int nreader: Number of reading threads, 0 for sequential processing
+    :param int nintegrator: Number of integration threads, 0 for sequential processing
+    :param int queue_size: Number of frames in flight per thread in the pipeline
+    :param int njobs: Number of processes, 0 for a single process
+    :param str journal: Filename of the journal of the processing, if any
+    :param str start_method: Start method of the processes, see `pyFAI.utils.parallel`
     """
     worker = pyFAI.worker.Worker()
     worker_config = config.copy()
@@ -319,16 +681,41 @@ def process(input_data, output, config, monitor_name, observer):
     if observer is not None:
         observer.processing_started(len(valid_data))
 
+    if journal is not None:
+        journal = Journal(journal, config={"config": config, "output": output})
+
+    try:
+        if njobs:
+            worker.output = "raw"
+            _process_jobs(valid_data, output, config, worker, monitor_name, observer, njobs,
+                          journal=journal, start_method=start_method)
+            valid_data = []
+        elif nreader or nintegrator:
+            worker.output = "raw"
+            statistics = _process_pipeline(valid_data, output, config, worker, monitor_name, observer,
+                                           nreader=nreader or 1, nintegrator=nintegrator or 1,
+                                           queue_size=queue_size, journal=journal)
+            logger.info("Throughput of the processing stages:\n%s", statistics)
+            valid_data = []
+        elif journal is not None:
+            worker.output = "raw"
+            _process_frames(valid_data, output, config, worker, monitor_name, observer,
+                            journal=journal)
+            valid_data = []
+    finally:
+        if journal is not None:
+            journal.close()
+
     # Integrate files one by one
     for iitem, item in enumerate(valid_data):
         logger.debug("Processing %s", item)
 
-        # TODO rework it as source
         if isinstance(item, six.string_types):
             kind = "filename"
-            fabio_image = fabio.open(item)
-            filename = fabio_image.filename
-            multiframe = fabio_image.nframes > 1
+            source = open_source(item)
+            filename = source.filename
+            multiframe = source.nframes > 1
+            fabio_image = source if multiframe else source.getframe(0)
         elif isinstance(item, fabio.fabioimage.FabioImage):
             kind = "fabio-image"
             fabio_image = item
@@ -343,32 +730,11 @@ def process(input_data, output, config, monitor_name, observer):
         if observer is not None:
             observer.processing_data(iitem + 1, filename=filename)
 
-        if filename:
-            output_name = os.path.splitext(filename)[0]
-        else:
-            output_name = "array_%d" % iitem
-
-        if multiframe:
-            extension = "_pyFAI.h5"
-        else:
-            if worker.do_2D():
-                extension = ".azim"
-            else:
-                extension = ".dat"
-        output_name = "%s%s" % (output_name, extension)
-
-        if output:
-            if os.path.isdir(output):
-                basename = os.path.basename(output_name)
-                outpath = os.path.join(output, basename)
-            else:
-                outpath = os.path.abspath(output)
-        else:
-            outpath = output_name
+        outpath = _get_output_path(output, filename, iitem, multiframe, worker.do_2D())
 
         if fabio_image is None:
             if item.ndim == 3:
-                writer = HDF5Writer(outpath)
+                writer = worker.get_hdf5_writer(outpath, append_frames=True)
                 writer.init(fai_cfg=config)
                 for iframe, data in enumerate(item):
                     result = worker.process(data=data,
@@ -377,6 +743,7 @@ def process(input_data, output, config, monitor_name, observer):
                         if observer.is_interruption_requested():
                             break
                         observer.data_result(iitem, result)
+                writer.close()
             else:
                 data = item
                 writer = DefaultAiWriter(outpath, worker.ai)
@@ -386,7 +753,7 @@ def process(input_data, output, config, monitor_name, observer):
                     observer.data_result(iitem, result)
         else:
             if multiframe:
-                writer = HDF5Writer(outpath, append_frames=True)
+                writer = worker.get_hdf5_writer(outpath, append_frames=True)
                 writer.init(fai_cfg=config)
 
                 for iframe in range(fabio_image.nframes):
@@ -434,11 +801,19 @@ def integrate_shell(options, args):
     with open(options.json) as f:
         config = json.load(f)
 
+    for key in ("nthread", "chunk_frames", "compression", "buffer_frames"):
+        value = getattr(options, key)
+        if value is not None:
+            config[key] = value
+
     observer = ShellIntegrationObserver()
     monitor_name = options.monitor_key
     filenames = args
     output = options.output
-    return process(filenames, output, config, monitor_name, observer)
+    return process(filenames, output, config, monitor_name, observer,
+                   nreader=options.readers, nintegrator=options.integrators,
+                   queue_size=options.queue_size, njobs=options.jobs,
+                   journal=options.journal)
 
 
 def _main(args):
@@ -487,6 +862,39 @@ http://bugs.debian.org/cgi-bin/bugreport.cgi?bug=697348"""
     parser.add_argument("-j", "--json",
                         dest="json", default=".azimint.json",
                         help="Configuration file containing the processing to be done")
+    parser.add_argument("--jobs", dest="jobs", type=int, default=0,
+                        help="Number of processes integrating the frames in \
+                        parallel (only without GUI). The integration engine \
+                        is built once and shared by all processes.")
+    parser.add_argument("--readers", dest="readers", type=int, default=0,
+                        help="Number of threads reading the frames. When this \
+                        or --integrators is set, reading, integration and \
+                        writing are pipelined (only without GUI).")
+    parser.add_argument("--integrators", dest="integrators", type=int, default=0,
+                        help="Number of threads integrating the frames in the \
+                        pipelined mode.")
+    parser.add_argument("--queue-size", dest="queue_size", type=int, default=4,
+                        help="Maximum number of frames in flight per thread in \
+                        the pipelined mode, limits the memory used.")
+    parser.add_argument("--nthread", dest="nthread", type=int, default=None,
+                        help="Number of OpenMP threads used by each CSR \
+                        integration, by default all cores (or \
+                        OMP_NUM_THREADS). Use 1 with --jobs or --integrators \
+                        to avoid oversubscribing the cores.")
+    parser.add_argument("--chunk-frames", dest="chunk_frames", type=int, default=None,
+                        help="Number of frames per chunk of the HDF5 outputs.")
+    parser.add_argument("--compression", dest="compression", default=None,
+                        help="Compression of the HDF5 outputs: gzip, lzf, \
+                        lz4 or bitshuffle (the latter need hdf5plugin).")
+    parser.add_argument("--buffer-frames", dest="buffer_frames", type=int, default=None,
+                        help="Number of frames written at once in the HDF5 \
+                        outputs, from a background thread. 0 to write each \
+                        frame synchronously.")
+    parser.add_argument("--journal", dest="journal", default=None,
+                        help="Journal file recording the frames processed \
+                        (only without GUI). If it exists, an interrupted \
+                        processing is resumed: frames already processed are \
+                        skipped and HDF5 outputs are completed.")
     parser.add_argument("args", metavar='FILE', type=str, nargs='*',
                         help="Files to be integrated")
     parser.add_argument("--monitor-name", dest="monitor_key", default=None,
@@ -32,7 +32,7 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "05/02/2019"
+__date__ = "18/02/2019"
 __status__ = "stable"
 __docformat__ = 'restructuredtext'
 
@@ -42,7 +42,7 @@ logger = logging.getLogger(__name__)
 import warnings
 import tempfile
 import threading
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 import gc
 from math import pi, log
 import numpy
@@ -51,7 +51,7 @@ from .geometry import Geometry
 from . import units
 from .utils import EPS32, deg2rad, crc32
 from .utils.decorators import deprecated, deprecated_warning
-from .containers import Integrate1dResult, Integrate2dResult
+from .containers import Integrate1dResult, Integrate2dResult, SparseFrame
 from .io import DefaultAiWriter
 error = None
 
@@ -271,7 +271,8 @@ if ocl:
 else:
     ocl_azim = ocl_azim_csr = ocl_azim_lut = None
 
-from .engines import Engine
+from .engines import Engine, EngineRegistry
+from .engines.sparse_cache import get_default_cache
 
 # Few constants for engine names:
 OCL_CSR_ENGINE = "ocl_csr_integr"
@@ -281,6 +282,10 @@ OCL_SORT_ENGINE = "ocl_sorter"
 EXT_LUT_ENGINE = "lut_integrator"
 EXT_CSR_ENGINE = "csr_integrator"
 
+SparseFilterSetup = namedtuple("SparseFilterSetup", ["radial", "unit", "compute_engine",
+                                                     "has_mask_applied", "has_dark_correction",
+                                                     "has_flat_correction"])
+
 
 PREFERED_METHODS_1D = IntegrationMethod.select_method(1, split="full", algo="histogram") + \
                       IntegrationMethod.select_method(1, split="pseudo", algo="histogram") + \
@@ -372,6 +377,10 @@ class AzimuthalIntegrator(Geometry):
 
         self._lock = threading.Semaphore()
         self.engines = {}  # key: name of the engine,
+        self.engine_registry = EngineRegistry()  # key: signature of the integration
+        self.sparse_cache = get_default_cache()  # persistent storage for CSR/LUT
+        self.compact_csr = False  # use compact CSR matrices with integrate1d_ng
+        self.nthread = 0  # number of OpenMP threads of the CSR integrators, 0 for the default
 
         self._empty = 0.0
 
@@ -386,6 +395,7 @@ class AzimuthalIntegrator(Geometry):
         with self._lock:
             for key in list(self.engines.keys()):  # explicit copy
                 self.engines.pop(key).reset()
+            self.engine_registry.clear()
         gc.collect()
 
     def create_mask(self, data, mask=None,
@@ -760,14 +770,6 @@ class AzimuthalIntegrator(Geometry):
             int2d = True
         else:
             int2d = False
-        pos0 = self.array_from_unit(shape, "center", unit, scale=False)
-        dpos0 = self.array_from_unit(shape, "delta", unit, scale=False)
-        if (pos1_range is None) and (not int2d):
-            pos1 = None
-            dpos1 = None
-        else:
-            pos1 = self.chiArray(shape)
-            dpos1 = self.deltaChi(shape)
         if ("__len__" in dir(pos0_range)) and (len(pos0_range) > 1):
             pos0_min = min(pos0_range)
             pos0_maxin = max(pos0_range)
@@ -784,27 +786,54 @@ class AzimuthalIntegrator(Geometry):
             mask_checksum = None
         else:
             assert mask.shape == shape
+            if not mask_checksum:
+                mask_checksum = crc32(mask)
+
+        signature = ("LUT", "bbox", tuple(shape), npt, str(unit), pos0Range, pos1Range, mask_checksum)
+        integr = self.engine_registry.get(signature)
+        if integr is not None:
+            return integr
+        if self.sparse_cache is not None:
+            key = self._get_sparse_key("LUT", shape, npt, mask_checksum, pos0Range, pos1Range, unit, "bbox")
+            integr = self.sparse_cache.load(key)
+            if integr is not None:
+                self.engine_registry.add(signature, integr)
+                return integr
+
+        pos0 = self.array_from_unit(shape, "center", unit, scale=False)
+        dpos0 = self.array_from_unit(shape, "delta", unit, scale=False)
+        if (pos1_range is None) and (not int2d):
+            pos1 = None
+            dpos1 = None
+        else:
+            pos1 = self.chiArray(shape)
+            dpos1 = self.deltaChi(shape)
 
         if int2d:
-            return splitBBoxLUT.HistoBBox2d(pos0, dpos0, pos1, dpos1,
-                                            bins=npt,
-                                            pos0Range=pos0Range,
-                                            pos1Range=pos1Range,
-                                            mask=mask,
-                                            mask_checksum=mask_checksum,
-                                            allow_pos0_neg=False,
-                                            unit=unit)
+            integr = splitBBoxLUT.HistoBBox2d(pos0, dpos0, pos1, dpos1,
+                                              bins=npt,
+                                              pos0Range=pos0Range,
+                                              pos1Range=pos1Range,
+                                              mask=mask,
+                                              mask_checksum=mask_checksum,
+                                              allow_pos0_neg=False,
+                                              unit=unit)
         else:
-            return splitBBoxLUT.HistoBBox1d(pos0, dpos0, pos1, dpos1,
-                                            bins=npt,
-                                            pos0Range=pos0Range,
-                                            pos1Range=pos1Range,
-                                            mask=mask,
-                                            mask_checksum=mask_checksum,
-                                            allow_pos0_neg=False,
-                                            unit=unit)
-
-    def setup_CSR(self, shape, npt, mask=None, pos0_range=None, pos1_range=None, mask_checksum=None, unit=units.TTH, split="bbox"):
+            integr = splitBBoxLUT.HistoBBox1d(pos0, dpos0, pos1, dpos1,
+                                              bins=npt,
+                                              pos0Range=pos0Range,
+                                              pos1Range=pos1Range,
+                                              mask=mask,
+                                              mask_checksum=mask_checksum,
+                                              allow_pos0_neg=False,
+                                              unit=unit)
+        if self.sparse_cache is not None:
+            self.sparse_cache.save(key, integr)
+        self.engine_registry.add(signature, integr)
+        return integr
+
+    def setup_CSR(self, shape, npt, mask=None, pos0_range=None, pos1_range=None, mask_checksum=None, unit=units.TTH, split="bbox",
+                  compact=False):
         """
         Prepare a look-up-table
 
@@ -823,6 +852,9 @@ class AzimuthalIntegrator(Geometry):
         :param unit: use to propagate the LUT object for further checkings
         :type unit: pyFAI.units.Unit
         :param split: Splitting scheme: valid options are "no", "bbox", "full"
+        :param compact: set to True to get a `CsrIntegrator1d/2d` storing the
+            matrix as `CompactCSR`, which saves memory. The full matrix is
+            converted as soon as it is built and is not kept.
 
         This method is called when a look-up table needs to be set-up.
         The *shape* parameter, correspond to the shape of the original
@@ -842,6 +874,10 @@ class AzimuthalIntegrator(Geometry):
         re-calculation of the mask. When the mask changes, its
         checksum is used to reset (or not) the LUT (which is a very
         time consuming operation !)
+        The unmasked CSR integrator is built once and kept in the engine
+        registry: when the mask does not change the range of the bins, the
+        masked one is derived from it by dropping the masked pixels, which
+        is much faster than a full rebuild.
 
         It is also possible to restrain the range of the 1D or 2D
         pattern with the *pos1_range* and *pos2_range*.
@@ -851,6 +887,143 @@ class AzimuthalIntegrator(Geometry):
         be performed in 2th-space when the LUT was setup in q space.
         """
 
+        if "__len__" in dir(npt) and len(npt) == 2:
+            int2d = True
+        else:
+            int2d = False
+        if ("__len__" in dir(pos0_range)) and (len(pos0_range) > 1):
+            pos0_min = min(pos0_range)
+            pos0_maxin = max(pos0_range)
+            pos0Range = (pos0_min, pos0_maxin * EPS32)
+        else:
+            pos0Range = None
+        if ("__len__" in dir(pos1_range)) and (len(pos1_range) > 1):
+            pos1_min = min(pos1_range)
+            pos1_maxin = max(pos1_range)
+            pos1Range = (pos1_min, pos1_maxin * EPS32)
+        else:
+            pos1Range = None
+        if mask is None:
+            mask_checksum = None
+        else:
+            assert mask.shape == shape
+            if not mask_checksum:
+                mask_checksum = crc32(mask)
+
+        signature = ("CSR", split, tuple(shape), npt, str(unit), pos0Range, pos1Range, mask_checksum)
+        if compact:
+            compact_signature = signature + ("compact",)
+            integr = self.engine_registry.get(compact_signature)
+            if integr is None:
+                full = self.engine_registry.get(signature)
+                if full is None:
+                    full = self._setup_CSR(shape, npt, mask, pos0_range, pos1_range,
+                                           pos0Range, pos1Range, mask_checksum, unit, split)
+                integr = self._compact_CSR(full, int2d)
+                self.engine_registry.add(compact_signature, integr)
+            return integr
+        integr = self.engine_registry.get(signature)
+        if integr is not None:
+            return integr
+        if mask_checksum is not None:
+            # Masked matrices are derived from the unmasked one when it is already
+            # available, or when the ranges are fixed so the mask cannot change them
+            unmasked_signature = signature[:-1] + (None,)
+            unmasked = self.engine_registry.get(unmasked_signature)
+            if (unmasked is None) and (self.sparse_cache is not None):
+                key = self._get_sparse_key("CSR", shape, npt, None, pos0Range, pos1Range, unit, split)
+                unmasked = self.sparse_cache.load(key) if key in self.sparse_cache else None
+                if unmasked is not None:
+                    self.engine_registry.add(unmasked_signature, unmasked)
+            built = False
+            if (unmasked is None) and (pos0Range is not None) and ((pos1Range is not None) or not int2d):
+                unmasked = self._setup_CSR(shape, npt, None, pos0_range, pos1_range,
+                                           pos0Range, pos1Range, None, unit, split)
+                built = True
+            if (unmasked is not None) and ("derive_mask" in dir(unmasked)):
+                integr = unmasked.derive_mask(mask, mask_checksum)
+                if integr is not None:
+                    logger.debug("CSR integrator derived from the unmasked one")
+                    if built:
+                        # kept for the next masks
+                        if self.sparse_cache is not None:
+                            key = self._get_sparse_key("CSR", shape, npt, None, pos0Range, pos1Range, unit, split)
+                            self.sparse_cache.save(key, unmasked)
+                        self.engine_registry.add(unmasked_signature, unmasked)
+                    self.engine_registry.add(signature, integr)
+                    return integr
+            # an unmasked matrix built for nothing is never registered
+        if self.sparse_cache is not None:
+            key = self._get_sparse_key("CSR", shape, npt, mask_checksum, pos0Range, pos1Range, unit, split)
+            integr = self.sparse_cache.load(key)
+            if integr is None:
+                integr = self._setup_CSR(shape, npt, mask, pos0_range, pos1_range,
+                                         pos0Range, pos1Range, mask_checksum, unit, split)
+                self.sparse_cache.save(key, integr)
+        else:
+            integr = self._setup_CSR(shape, npt, mask, pos0_range, pos1_range,
+                                     pos0Range, pos1Range, mask_checksum, unit, split)
+        self.engine_registry.add(signature, integr)
+        return integr
+
+    def _get_sparse_key(self, algo, shape, npt, mask_checksum, pos0Range, pos1Range, unit, split):
+        """Key of a sparse matrix integrator in the sparse cache
+
+        :return: key as a string
+        """
+        from .distortion import get_distortion_checksum
+        geometry = self.getPyFAI()
+        for key in ("dist", "poni1", "poni2", "rot1", "rot2", "rot3",
+                    "pixel1", "pixel2", "wavelength"):
+            if geometry.get(key) is not None:
+                geometry[key] = float(geometry[key])
+        # The distortion is described by its content, not by the name of the spline file
+        geometry.pop("splineFile", None)
+        detector = self.detector
+        config = dict(detector.get_config())
+        config.pop("splineFile", None)
+        distortion = None if detector.uniform_pixel else get_distortion_checksum(detector)
+        return self.sparse_cache.get_key(algo=algo,
+                                         geometry=geometry,
+                                         detector=detector.__class__.__name__,
+                                         detector_config=config,
+                                         binning=tuple(detector.binning),
+                                         distortion=distortion,
+                                         chiDiscAtPi=self.chiDiscAtPi,
+                                         shape=tuple(shape),
+                                         npt=npt,
+                                         mask=mask_checksum,
+                                         pos0Range=pos0Range,
+                                         pos1Range=pos1Range,
+                                         unit=str(unit),
+                                         split=split)
+
+    def _compact_CSR(self, integr, int2d):
+        """Convert a Cython CSR integrator to the compact storage
+
+        :param integr: integrator built by `_setup_CSR`
+        :param int2d: True for a 2D integrator
+        :return: CsrIntegrator1d or CsrIntegrator2d with a CompactCSR matrix
+        """
+        from .engines.CSR_engine import CsrIntegrator1d, CsrIntegrator2d
+        if int2d:
+            compact = CsrIntegrator2d(integr.size, integr.data, integr.indices, integr.indptr,
+                                      empty=self._empty,
+                                      bin_centers0=integr.bin_centers0,
+                                      bin_centers1=integr.bin_centers1,
+                                      compact=True)
+        else:
+            compact = CsrIntegrator1d(integr.size, integr.data, integr.indices, integr.indptr,
+                                      empty=self._empty,
+                                      bin_centers=integr.bin_centers,
+                                      compact=True)
+        compact.unit = integr.unit
+        compact.mask_checksum = integr.mask_checksum
+        return compact
+
+    def _setup_CSR(self, shape, npt, mask, pos0_range, pos1_range,
+                   pos0Range, pos1Range, mask_checksum, unit, split):
+        """Actually build the CSR integrator, see setup_CSR"""
         if "__len__" in dir(npt) and len(npt) == 2:
             int2d = True
         else:
@@ -872,22 +1045,6 @@ class AzimuthalIntegrator(Geometry):
                     dpos1 = None
                 else:
                     dpos1 = self.deltaChi(shape)
-        if ("__len__" in dir(pos0_range)) and (len(pos0_range) > 1):
-            pos0_min = min(pos0_range)
-            pos0_maxin = max(pos0_range)
-            pos0Range = (pos0_min, pos0_maxin * EPS32)
-        else:
-            pos0Range = None
-        if ("__len__" in dir(pos1_range)) and (len(pos1_range) > 1):
-            pos1_min = min(pos1_range)
-            pos1_maxin = max(pos1_range)
-            pos1Range = (pos1_min, pos1_maxin * EPS32)
-        else:
-            pos1Range = None
-        if mask is None:
-            mask_checksum = None
-        else:
-            assert mask.shape == shape
         if split == "full":
 
             if int2d:
@@ -1002,7 +1159,7 @@ class AzimuthalIntegrator(Geometry):
         if mask is None:
             has_mask = "from detector"
             mask = self.mask
-            mask_crc = self.detector.get_mask_crc
+            mask_crc = self.detector.get_mask_crc()
             if mask is None:
                 has_mask = False
                 mask_crc = None
@@ -1138,11 +1295,15 @@ class AzimuthalIntegrator(Geometry):
                             ocl_integr = ocl_engine.engine
                             if (ocl_integr is None) or \
                                     (ocl_integr.on_device["lut"] != integr.lut_checksum):
-                                ocl_integr = ocl_azim_lut.OCL_LUT_Integrator(integr.lut,
-                                                                             integr.size,
-                                                                             platformid=platformid,
-                                                                             deviceid=deviceid,
-                                                                             checksum=integr.lut_checksum)
+                                signature = (OCL_LUT_ENGINE, integr.lut_checksum, platformid, deviceid)
+                                ocl_integr = self.engine_registry.get(signature)
+                                if ocl_integr is None:
+                                    ocl_integr = ocl_azim_lut.OCL_LUT_Integrator(integr.lut,
+                                                                                 integr.size,
+                                                                                 platformid=platformid,
+                                                                                 deviceid=deviceid,
+                                                                                 checksum=integr.lut_checksum)
+                                    self.engine_registry.add(signature, ocl_integr)
                                 ocl_engine.set_engine(ocl_integr)
                             if ocl_integr is not None:
                                 I, sum_, count = ocl_integr.integrate(data, dark=dark, flat=flat,
@@ -1258,13 +1419,17 @@ class AzimuthalIntegrator(Geometry):
                             ocl_integr = ocl_engine.engine
                             if (ocl_integr is None) or \
                                     (ocl_integr.on_device["data"] != integr.lut_checksum):
-                                ocl_integr = ocl_azim_csr.OCL_CSR_Integrator(integr.lut,
-                                                                             integr.size,
-                                                                             platformid=platformid,
-                                                                             deviceid=deviceid,
-                                                                             checksum=integr.lut_checksum,
-                                                                             block_size=block_size,
-                                                                             profile=profile)
+                                signature = (OCL_CSR_ENGINE, integr.lut_checksum, platformid, deviceid)
+                                ocl_integr = self.engine_registry.get(signature)
+                                if ocl_integr is None:
+                                    ocl_integr = ocl_azim_csr.OCL_CSR_Integrator(integr.lut,
+                                                                                 integr.size,
+                                                                                 platformid=platformid,
+                                                                                 deviceid=deviceid,
+                                                                                 checksum=integr.lut_checksum,
+                                                                                 block_size=block_size,
+                                                                                 profile=profile)
+                                    self.engine_registry.add(signature, ocl_integr)
                                 ocl_engine.set_engine(ocl_integr)
                             I, sum_, count = ocl_integr.integrate(data, dark=dark, flat=flat,
                                                                   solidangle=solidangle,
@@ -1291,7 +1456,8 @@ class AzimuthalIntegrator(Geometry):
                                                                  dummy=dummy,
                                                                  delta_dummy=delta_dummy,
                                                                  polarization=polarization,
-                                                                 normalization_factor=normalization_factor)
+                                                                 normalization_factor=normalization_factor,
+                                                                 nthread=self.nthread)
 
                         if error_model == "azimuthal":
                             variance = (data - self.calcfrom1d(qAxis * pos0_scale, I, dim1_unit=unit, shape=shape)) ** 2
@@ -1300,7 +1466,8 @@ class AzimuthalIntegrator(Geometry):
                                                               solidAngle=None,
                                                               dummy=dummy,
                                                               delta_dummy=delta_dummy,
-                                                              normalization_factor=1.0)
+                                                              normalization_factor=1.0,
+                                                              nthread=self.nthread)
                             with numpy.errstate(divide='ignore'):
                                 sigma = numpy.sqrt(a) / (b * normalization_factor)
                             sigma[b == 0] = dummy if dummy is not None else self._empty
@@ -1499,6 +1666,11 @@ class AzimuthalIntegrator(Geometry):
         """Demonstrator for the new azimuthal integrator taking care of the normalization,
 
         Early stage prototype
+
+        With Cython CSR methods, preprocessing and integration are performed
+        in a single pass over the pixels, see `CsrPreprocIntegrator.integrate_ng`.
+        Other methods integrate separately the normalization, the signal and
+        the variance.
         """
 
         if variance is not None:
@@ -1511,6 +1683,18 @@ class AzimuthalIntegrator(Geometry):
                 else:
                     variance = abs(data) + abs(dark)
 
+        method = self._normalize_method(method, dim=1, default=self.DEFAULT_METHOD_1D)
+        if (method.algo_lower == "csr") and (method.impl_lower == "cython"):
+            return self._integrate1d_ng_csr(data, npt, method, unit,
+                                            correctSolidAngle=correctSolidAngle,
+                                            variance=variance,
+                                            radial_range=radial_range,
+                                            azimuth_range=azimuth_range,
+                                            mask=mask, dummy=dummy, delta_dummy=delta_dummy,
+                                            polarization_factor=polarization_factor,
+                                            dark=dark, flat=flat,
+                                            normalization_factor=normalization_factor)
+
         kwargs = {"npt": npt,
                   "error_model": None,
                   "variance": None,
@@ -1538,19 +1722,123 @@ class AzimuthalIntegrator(Geometry):
 
         norm = self.integrate1d(normalization_image, **kwargs)
         signal = self.integrate1d(data, dark=dark, ** kwargs)
-        sigma2 = self.integrate1d(variance, **kwargs)
+        if variance is None:
+            sigma2 = None
+            error = None
+        else:
+            sigma2 = self.integrate1d(variance, **kwargs).sum
+            error = numpy.sqrt(sigma2) / norm.sum
         result = Integrate1dResult(norm.radial,
                                    signal.sum / norm.sum,
-                                   numpy.sqrt(sigma2.sum) / norm.sum)
+                                   error)
         result._set_method_called("integrate1d_ng")
         result._set_compute_engine(norm.compute_engine)
         result._set_unit(signal.unit)
         result._set_sum_signal(signal.sum)
         result._set_sum_normalization(norm.sum)
-        result._set_sum_variance(sigma2.sum)
+        result._set_sum_variance(sigma2)
         result._set_count(signal.count)
         return result
 
+    def _integrate1d_ng_csr(self, data, npt, method, unit,
+                            correctSolidAngle=True, variance=None,
+                            radial_range=None, azimuth_range=None,
+                            mask=None, dummy=None, delta_dummy=None,
+                            polarization_factor=None, dark=None, flat=None,
+                            normalization_factor=1.0):
+        """Fused preprocessing and CSR integration used by `_integrate1d_ng`
+
+        Signal, variance, normalization and count are accumulated in a single
+        sweep over the pixels, without any intermediate image.
+
+        :param method: IntegrationMethod with a Cython CSR implementation
+        :return: Integrate1dResult
+        """
+        unit = units.to_unit(unit)
+        shape = data.shape
+        pos0_scale = unit.scale
+        if mask is None:
+            mask = self.mask
+            mask_crc = self.detector.get_mask_crc() if mask is not None else None
+        else:
+            mask = numpy.ascontiguousarray(mask)
+            mask_crc = crc32(mask)
+        if radial_range:
+            radial_range = tuple([i / pos0_scale for i in radial_range])
+        if azimuth_range is not None:
+            azimuth_range = tuple(deg2rad(azimuth_range[i]) for i in (0, -1))
+            if azimuth_range[1] <= azimuth_range[0]:
+                azimuth_range = (azimuth_range[0], azimuth_range[1] + 2 * pi)
+            self.check_chi_disc(azimuth_range)
+
+        split = method.split_lower
+        if split == "pseudo":
+            split = "full"
+        if EXT_CSR_ENGINE not in self.engines:
+            engine = self.engines[EXT_CSR_ENGINE] = Engine()
+        else:
+            engine = self.engines[EXT_CSR_ENGINE]
+        with engine.lock:
+            integr = self.setup_CSR(shape, npt, mask, radial_range, azimuth_range,
+                                    mask_checksum=mask_crc, unit=unit, split=split,
+                                    compact=self.compact_csr)
+            engine.set_engine(integr)
+
+        solidangle = self.solidAngleArray(shape, correctSolidAngle) if correctSolidAngle else None
+        polarization = None
+        if polarization_factor is not None:
+            polarization = self.polarization(shape, polarization_factor)
+        if dark is None:
+            dark = self.detector.darkcurrent
+        if flat is None:
+            flat = self.detector.flatfield
+
+        if "integrate_ng" in dir(integr):
+            signal, sum_variance, normalization, count = integr.integrate_ng(data,
+                                                                             variance=variance,
+                                                                             dark=dark,
+                                                                             flat=flat,
+                                                                             solidangle=solidangle,
+                                                                             polarization=polarization,
+                                                                             dummy=dummy,
+                                                                             delta_dummy=delta_dummy,
+                                                                             normalization_factor=normalization_factor,
+                                                                             nthread=self.nthread)
+        else:
+            # Compact CSR matrix: the columns are signal, variance, normalization and count
+            propagated = integr.integrate(data,
+                                          variance=variance,
+                                          dummy=dummy,
+                                          delta_dummy=delta_dummy,
+                                          dark=dark,
+                                          flat=flat,
+                                          solidangle=solidangle,
+                                          polarization=polarization,
+                                          normalization_factor=normalization_factor).propagated
+            signal, sum_variance, normalization, count = propagated.T
+        empty = dummy if dummy is not None else self._empty
+        valid = normalization != 0
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            intensity = numpy.where(valid, signal / normalization, empty)
+            if variance is None:
+                sum_variance = error = None
+            else:
+                error = numpy.where(valid, numpy.sqrt(sum_variance) / normalization, empty)
+
+        result = Integrate1dResult(integr.bin_centers * pos0_scale, intensity, error)
+        result._set_method_called("integrate1d_ng")
+        result._set_compute_engine(str(method))
+        result._set_unit(unit)
+        result._set_sum_signal(signal)
+        result._set_sum_normalization(normalization)
+        result._set_sum_variance(sum_variance)
+        result._set_count(count)
+        result._set_has_dark_correction(dark is not None)
+        result._set_has_flat_correction(flat is not None)
+        result._set_polarization_factor(polarization_factor)
+        result._set_normalization_factor(normalization_factor)
+        return result
+
     def integrate_radial(self, data, npt, npt_rad=100,
                          correctSolidAngle=True,
                          radial_range=None, azimuth_range=None,
@@ -1800,11 +2088,15 @@ class AzimuthalIntegrator(Geometry):
                             ocl_integr = ocl_engine.engine
                             if (ocl_integr is None) or \
                                     (ocl_integr.on_device["lut"] != integr.lut_checksum):
-                                ocl_integr = ocl_azim_lut.OCL_LUT_Integrator(integr.lut,
-                                                                             integr.size,
-                                                                             platformid=platformid,
-                                                                             deviceid=deviceid,
-                                                                             checksum=integr.lut_checksum)
+                                signature = (OCL_LUT_ENGINE, integr.lut_checksum, platformid, deviceid)
+                                ocl_integr = self.engine_registry.get(signature)
+                                if ocl_integr is None:
+                                    ocl_integr = ocl_azim_lut.OCL_LUT_Integrator(integr.lut,
+                                                                                 integr.size,
+                                                                                 platformid=platformid,
+                                                                                 deviceid=deviceid,
+                                                                                 checksum=integr.lut_checksum)
+                                    self.engine_registry.add(signature, ocl_integr)
                                 ocl_engine.set_engine(ocl_integr)
 
                             if (not error) and (ocl_integr is not None):
@@ -1891,11 +2183,15 @@ class AzimuthalIntegrator(Geometry):
                             platformid, deviceid = method.target
                             ocl_integr = ocl_engine.engine
                             if (ocl_integr is None) or (ocl_integr.on_device["data"] != integr.lut_checksum):
-                                ocl_integr = ocl_azim_csr.OCL_CSR_Integrator(integr.lut,
-                                                                             integr.size,
-                                                                             platformid=platformid,
-                                                                             deviceid=deviceid,
-                                                                             checksum=integr.lut_checksum)
+                                signature = (OCL_CSR_ENGINE, integr.lut_checksum, platformid, deviceid)
+                                ocl_integr = self.engine_registry.get(signature)
+                                if ocl_integr is None:
+                                    ocl_integr = ocl_azim_csr.OCL_CSR_Integrator(integr.lut,
+                                                                                 integr.size,
+                                                                                 platformid=platformid,
+                                                                                 deviceid=deviceid,
+                                                                                 checksum=integr.lut_checksum)
+                                    self.engine_registry.add(signature, ocl_integr)
                                 ocl_engine.set_engine(ocl_integr)
                         if (not error) and (ocl_integr is not None):
                                 I, sum_, count = ocl_integr.integrate(data, dark=dark, flat=flat,
@@ -1917,7 +2213,8 @@ class AzimuthalIntegrator(Geometry):
                                                                                dummy=dummy,
                                                                                delta_dummy=delta_dummy,
                                                                                polarization=polarization,
-                                                                               normalization_factor=normalization_factor)
+                                                                               normalization_factor=normalization_factor,
+                                                                               nthread=self.nthread)
 
         if method.method[1:4] in (("pseudo", "histogram", "cython"), ("full", "histogram", "cython")):
             logger.debug("integrate2d uses SplitPixel implementation")
@@ -2241,11 +2538,15 @@ class AzimuthalIntegrator(Geometry):
                             ocl_integr = ocl_engine.engine
                             if (ocl_integr is None) or \
                                     (ocl_integr.on_device["lut"] != integr.lut_checksum):
-                                ocl_integr = ocl_azim_lut.OCL_LUT_Integrator(integr.lut,
-                                                                             integr.size,
-                                                                             platformid=platformid,
-                                                                             deviceid=deviceid,
-                                                                             checksum=integr.lut_checksum)
+                                signature = (OCL_LUT_ENGINE, integr.lut_checksum, platformid, deviceid)
+                                ocl_integr = self.engine_registry.get(signature)
+                                if ocl_integr is None:
+                                    ocl_integr = ocl_azim_lut.OCL_LUT_Integrator(integr.lut,
+                                                                                 integr.size,
+                                                                                 platformid=platformid,
+                                                                                 deviceid=deviceid,
+                                                                                 checksum=integr.lut_checksum)
+                                    self.engine_registry.add(signature, ocl_integr)
                                 ocl_engine.set_engine(ocl_integr)
 
                             if (not error) and (ocl_integr is not None):
@@ -2336,11 +2637,15 @@ class AzimuthalIntegrator(Geometry):
                                 platformid, deviceid = method.target
                             ocl_integr = ocl_engine.engine
                             if (ocl_integr is None) or (ocl_integr.on_device["data"] != integr.lut_checksum):
-                                ocl_integr = ocl_azim_csr.OCL_CSR_Integrator(integr.lut,
-                                                                             integr.size,
-                                                                             platformid=platformid,
-                                                                             deviceid=deviceid,
-                                                                             checksum=integr.lut_checksum)
+                                signature = (OCL_CSR_ENGINE, integr.lut_checksum, platformid, deviceid)
+                                ocl_integr = self.engine_registry.get(signature)
+                                if ocl_integr is None:
+                                    ocl_integr = ocl_azim_csr.OCL_CSR_Integrator(integr.lut,
+                                                                                 integr.size,
+                                                                                 platformid=platformid,
+                                                                                 deviceid=deviceid,
+                                                                                 checksum=integr.lut_checksum)
+                                    self.engine_registry.add(signature, ocl_integr)
                                 ocl_engine.set_engine(ocl_integr)
                         if (not error) and (ocl_integr is not None):
                                 I, sum_, count = ocl_integr.integrate(data, dark=dark, flat=flat,
@@ -2362,7 +2667,8 @@ class AzimuthalIntegrator(Geometry):
                                                                                dummy=dummy,
                                                                                delta_dummy=delta_dummy,
                                                                                polarization=polarization,
-                                                                               normalization_factor=normalization_factor)
+                                                                               normalization_factor=normalization_factor,
+                                                                               nthread=self.nthread)
 
         if (I is None) and ("splitpix" in method):
             if splitPixel is None:
@@ -2567,6 +2873,748 @@ class AzimuthalIntegrator(Geometry):
 
         return result
 
+    def setup_distortion_CSR(self, npt, radial_range=None, azimuth_range=None,
+                             unit=units.Q, split="bbox", correctSolidAngle=True,
+                             polarization_factor=None):
+        """Prepare the integration of the raw frames of a distorted detector
+        (i.e. with `detector.splineFile` set) with a single sparse matrix.
+
+        The matrix of the distortion correction (see
+        :class:`pyFAI.distortion.Distortion`) is multiplied with the CSR matrix
+        integrating the corrected image, i.e. an image of a regular detector
+        with the same pixel size and geometry. This is a resampled
+        integration: the raw frame is integrated as if it had been
+        resampled on the regular grid, in a single pass and without
+        intermediate image. It matches `Distortion.correct` followed by
+        `integrate1d_ng` of the corrected image (to a few 1e-8, relative), not the
+        integration of the raw frame with the actual pixel positions done by
+        `integrate1d`.
+
+        The fused matrix is only used by `integrate1d_distorted` and
+        `integrate2d_distorted`: other integration methods are unaffected.
+
+        :param npt: number of points in the output pattern, 2-tuple (radial, azimuthal) in 2D
+        :param radial_range: range in radial dimension, in internal units
+        :param azimuth_range: range in azimuthal dimension, in radians
+        :param unit: radial unit
+        :param split: Splitting scheme of the integration: "no" or "bbox"
+        :param correctSolidAngle: correct for solid angle of each corrected pixel if True
+        :param polarization_factor: polarization factor or None for no correction
+        :return: integrator of the raw frames
+        :rtype: pyFAI.engines.CSR_engine.DistortionCSRIntegrator
+        """
+        from scipy.sparse import csr_matrix
+        from .engines.CSR_engine import DistortionCSRIntegrator
+        if split not in ("no", "bbox"):
+            raise RuntimeError("Splitting scheme %s not available for distorted detectors" % split)
+        from .distortion import Distortion, get_distortion_checksum
+        unit = units.to_unit(unit)
+        mask_crc = self.detector.get_mask_crc() if self.detector.mask is not None else None
+        dis_signature = ("Distortion", get_distortion_checksum(self.detector),
+                         tuple(self.detector.shape), mask_crc)
+        signature = ("DistortionCSR", split, npt, str(unit), radial_range, azimuth_range,
+                     bool(correctSolidAngle), polarization_factor) + dis_signature[1:]
+        integr = self.engine_registry.get(signature)
+        if integr is not None:
+            return integr
+
+        correction = self.engine_registry.get(dis_signature)
+        if correction is None:
+            mask = self.detector.mask
+            if mask is None:
+                mask = numpy.zeros(self.detector.shape, dtype=numpy.int8)
+            dis = Distortion(self.detector, method="csr", mask=mask, cache=self.sparse_cache)
+            data, indices, indptr = dis.calc_LUT()
+            correction = csr_matrix((data, indices, indptr),
+                                    shape=(len(indptr) - 1, dis.shape_in[0] * dis.shape_in[1]))
+            correction.shape_out = tuple(dis.shape_out)
+            self.engine_registry.add(dis_signature, correction)
+
+        from .detectors import Detector
+        regular = AzimuthalIntegrator(dist=self._dist, poni1=self._poni1, poni2=self._poni2,
+                                      rot1=self._rot1, rot2=self._rot2, rot3=self._rot3,
+                                      detector=Detector(self.detector.pixel1, self.detector.pixel2,
+                                                        max_shape=correction.shape_out),
+                                      wavelength=self._wavelength)
+        regular.chiDiscAtPi = self.chiDiscAtPi
+        regular.sparse_cache = None
+        shape = correction.shape_out
+        csr = regular.setup_CSR(shape, npt, None, radial_range, azimuth_range, unit=unit, split=split)
+        integration = csr_matrix((csr.data, csr.indices, csr.indptr),
+                                 shape=(len(csr.indptr) - 1, correction.shape[0]))
+        normalization = None
+        if correctSolidAngle:
+            normalization = regular.solidAngleArray(shape, correctSolidAngle)
+        if polarization_factor is not None:
+            polarization = regular.polarization(shape, polarization_factor)
+            normalization = polarization if normalization is None else normalization * polarization
+        if "__len__" in dir(npt) and len(npt) == 2:
+            integr = DistortionCSRIntegrator(integration, correction, normalization,
+                                             bin_centers=csr.bin_centers0,
+                                             bin_centers1=csr.bin_centers1,
+                                             empty=self._empty)
+        else:
+            integr = DistortionCSRIntegrator(integration, correction, normalization,
+                                             bin_centers=csr.bin_centers,
+                                             empty=self._empty)
+        self.engine_registry.add(signature, integr)
+        return integr
+
+    def _integrate_distorted(self, data, npt, correctSolidAngle=True, variance=None,
+                             radial_range=None, azimuth_range=None,
+                             mask=None, dummy=None, delta_dummy=None,
+                             polarization_factor=None, dark=None, flat=None,
+                             unit=units.Q, split="bbox", normalization_factor=1.0):
+        """Common part of `integrate1d_distorted` and `integrate2d_distorted`
+
+        :return: integrator, sum of signal, of variance, of normalization and count, intensity and error
+        """
+        unit = units.to_unit(unit)
+        if radial_range:
+            radial_range = tuple(i / unit.scale for i in radial_range)
+        if azimuth_range is not None:
+            azimuth_range = tuple(deg2rad(azimuth_range[i]) for i in (0, -1))
+            if azimuth_range[1] <= azimuth_range[0]:
+                azimuth_range = (azimuth_range[0], azimuth_range[1] + 2 * pi)
+            self.check_chi_disc(azimuth_range)
+        integr = self.setup_distortion_CSR(npt, radial_range, azimuth_range, unit, split,
+                                           correctSolidAngle, polarization_factor)
+        if dark is None:
+            dark = self.detector.darkcurrent
+        if flat is None:
+            flat = self.detector.flatfield
+        signal, sum_variance, normalization, count = integr.integrate(data, variance=variance,
+                                                                      dummy=dummy,
+                                                                      delta_dummy=delta_dummy,
+                                                                      dark=dark, flat=flat,
+                                                                      mask=mask,
+                                                                      normalization_factor=normalization_factor)
+        empty = dummy if dummy is not None else self._empty
+        valid = normalization != 0
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            intensity = numpy.where(valid, signal / normalization, empty)
+            if sum_variance is None:
+                error = None
+            else:
+                error = numpy.where(valid, numpy.sqrt(sum_variance) / normalization, empty)
+        return integr, signal, sum_variance, normalization, count, intensity, error, dark, flat
+
+    def integrate1d_distorted(self, data, npt, correctSolidAngle=True,
+                              variance=None, error_model=None,
+                              radial_range=None, azimuth_range=None,
+                              mask=None, dummy=None, delta_dummy=None,
+                              polarization_factor=None, dark=None, flat=None,
+                              unit=units.Q, split="bbox",
+                              normalization_factor=1.0, metadata=None):
+        """Azimuthal integration of a raw frame of a distorted detector
+
+        Resampled integration: the frame is integrated as if it had been
+        corrected with :class:`pyFAI.distortion.Distortion`, then integrated
+        with CSR (normalized like `integrate1d_ng`), in a single pass over
+        the raw pixels, see `setup_distortion_CSR`.
+        Dark-current, flat-field, mask and dummy values apply to raw pixels,
+        solid-angle and polarization to corrected pixels.
+
+        :param data: raw 2D frame from the detector
+        :param npt: number of points in the output pattern
+        :param correctSolidAngle: correct for solid angle of each pixel if True
+        :param variance: array containing the variance of the data
+        :param error_model: When the variance is unknown, an error model can be given: "poisson" (variance = I)
+        :param radial_range: The lower and upper range of the radial unit.
+        :param azimuth_range: The lower and upper range of the azimuthal angle in degree.
+        :param mask: array (same size as data) with 1 for masked pixels, and 0 for valid pixels
+        :param dummy: value for dead/masked pixels
+        :param delta_dummy: precision for dummy value
+        :param polarization_factor: polarization factor between -1 (vertical) and +1 (horizontal).
+        :param dark: dark noise image
+        :param flat: flat field image
+        :param unit: Output units, can be "q_nm^-1", "q_A^-1", "2th_deg", "2th_rad", "r_mm" for now
+        :param split: pixel splitting of the integration, "no" or "bbox"
+        :param normalization_factor: Value of a normalization monitor
+        :param metadata: JSON serializable object containing the metadata, usually a dictionary.
+        :return: Integrate1dResult
+        """
+        if (variance is None) and error_model and error_model.lower() == "poisson":
+            variance = numpy.maximum(data, 0)
+        unit = units.to_unit(unit)
+        integr, signal, sum_variance, normalization, count, intensity, error, dark, flat = \
+            self._integrate_distorted(data, npt, correctSolidAngle, variance,
+                                      radial_range, azimuth_range, mask, dummy, delta_dummy,
+                                      polarization_factor, dark, flat, unit, split,
+                                      normalization_factor)
+        result = Integrate1dResult(integr.bin_centers * unit.scale, intensity, error)
+        result._set_method_called("integrate1d_distorted")
+        result._set_compute_engine(integr.__class__.__name__)
+        result._set_unit(unit)
+        result._set_sum_signal(signal)
+        result._set_sum_normalization(normalization)
+        result._set_sum_variance(sum_variance)
+        result._set_count(count)
+        result._set_has_dark_correction(dark is not None)
+        result._set_has_flat_correction(flat is not None)
+        result._set_has_mask_applied(mask is not None)
+        result._set_polarization_factor(polarization_factor)
+        result._set_normalization_factor(normalization_factor)
+        result._set_metadata(metadata)
+        return result
+
+    def integrate2d_distorted(self, data, npt_rad, npt_azim=360,
+                              correctSolidAngle=True,
+                              variance=None, error_model=None,
+                              radial_range=None, azimuth_range=None,
+                              mask=None, dummy=None, delta_dummy=None,
+                              polarization_factor=None, dark=None, flat=None,
+                              unit=units.Q, split="bbox",
+                              normalization_factor=1.0, metadata=None):
+        """2D regrouping of a raw frame of a distorted detector
+
+        Same as `integrate1d_distorted` with `npt_azim` azimuthal bins.
+
+        :param npt_rad: number of points in the radial direction
+        :param npt_azim: number of points in the azimuthal direction
+        :return: Integrate2dResult with the intensity of shape (npt_azim, npt_rad)
+        """
+        if (variance is None) and error_model and error_model.lower() == "poisson":
+            variance = numpy.maximum(data, 0)
+        unit = units.to_unit(unit)
+        integr, signal, sum_variance, normalization, count, intensity, error, dark, flat = \
+            self._integrate_distorted(data, (npt_rad, npt_azim), correctSolidAngle, variance,
+                                      radial_range, azimuth_range, mask, dummy, delta_dummy,
+                                      polarization_factor, dark, flat, unit, split,
+                                      normalization_factor)
+        result = Integrate2dResult(intensity.T,
+                                   integr.bin_centers * unit.scale,
+                                   integr.bin_centers1 * 180.0 / pi,
+                                   None if error is None else error.T)
+        result._set_method_called("integrate2d_distorted")
+        result._set_compute_engine(integr.__class__.__name__)
+        result._set_unit(unit)
+        result._set_sum_signal(signal.T)
+        result._set_sum_normalization(normalization.T)
+        result._set_sum_variance(None if sum_variance is None else sum_variance.T)
+        result._set_count(count.T)
+        result._set_has_dark_correction(dark is not None)
+        result._set_has_flat_correction(flat is not None)
+        result._set_has_mask_applied(mask is not None)
+        result._set_polarization_factor(polarization_factor)
+        result._set_normalization_factor(normalization_factor)
+        result._set_metadata(metadata)
+        return result
+
+    def _setup_sparse_engine(self, method, shape, npt, radial_range=None,
+                             azimuth_range=None, mask=None, unit=units.Q):
+        """Set up the Cython CSR or LUT engine used by method, without
+        integrating any frame.
+
+        Ranges and mask are handled as in `integrate1d` and `integrate2d`
+        and the engine is registered as they do.
+
+        :param method: IntegrationMethod with a "CSR" or "LUT" algorithm
+        :param shape: shape of the frames
+        :param npt: number of bins, 2-tuple (radial, azimuthal) for 2D integration
+        :param radial_range: range in radial unit
+        :param azimuth_range: range of the azimuthal angle in degree
+        :param mask: mask of the frames, by default the one of the detector
+        :param unit: radial unit
+        :return: the sparse integrator or None if it cannot be built
+        """
+        unit = units.to_unit(unit)
+        if mask is None:
+            mask = self.mask
+            mask_crc = None if mask is None else self.detector.get_mask_crc()
+        else:
+            mask = numpy.ascontiguousarray(mask)
+            mask_crc = crc32(mask)
+        if radial_range:
+            radial_range = tuple([i / unit.scale for i in radial_range])
+        if azimuth_range is not None:
+            azimuth_range = tuple(deg2rad(azimuth_range[i]) for i in (0, -1))
+            if azimuth_range[1] <= azimuth_range[0]:
+                azimuth_range = (azimuth_range[0], azimuth_range[1] + 2 * pi)
+            self.check_chi_disc(azimuth_range)
+
+        name = EXT_CSR_ENGINE if method.algo_lower == "csr" else EXT_LUT_ENGINE
+        if name not in self.engines:
+            engine = self.engines[name] = Engine()
+        else:
+            engine = self.engines[name]
+        with engine.lock:
+            try:
+                if method.algo_lower == "csr":
+                    split = method.split_lower
+                    if split == "pseudo":
+                        split = "full"
+                    integr = self.setup_CSR(shape, npt, mask, radial_range, azimuth_range,
+                                            mask_checksum=mask_crc, unit=unit, split=split)
+                else:
+                    integr = self.setup_LUT(shape, npt, mask, radial_range, azimuth_range,
+                                            mask_checksum=mask_crc, unit=unit)
+            except MemoryError:
+                logger.warning("MemoryError: falling back on frame per frame integration")
+                self.reset_engines()
+                return None
+            engine.set_engine(integr)
+        return integr
+
+    def _correction_flags(self, mask=None, dark=None, flat=None):
+        """Describe the corrections applied, as the integrators do
+
+        :param mask: mask provided by the user
+        :param dark: dark-current provided by the user
+        :param flat: flat-field provided by the user
+        :return: has_mask_applied, has_dark_correction, has_flat_correction
+        """
+        flags = []
+        for provided, default in ((mask, self.mask),
+                                  (dark, self.detector.darkcurrent),
+                                  (flat, self.detector.flatfield)):
+            if provided is not None:
+                flags.append("provided")
+            elif default is not None:
+                flags.append("from detector")
+            else:
+                flags.append(False)
+        return tuple(flags)
+
+    def _get_sparse_matrix(self, method, size):
+        """Retrieve the sparse matrix of the Cython engine used by method
+
+        :param method: IntegrationMethod with a "CSR" or "LUT" algorithm
+        :param size: size of the input image
+        :return: scipy.sparse.csr_matrix of shape (nbins, size) or None if no engine is available
+        """
+        from scipy.sparse import csr_matrix
+        name = EXT_CSR_ENGINE if method.algo_lower == "csr" else EXT_LUT_ENGINE
+        engine = self.engines.get(name)
+        if engine is None:
+            return None
+        with engine.lock:
+            integr = engine.engine
+            if (integr is None) or (integr.size != size):
+                return None
+            if method.algo_lower == "csr":
+                data, indices, indptr = integr.data, integr.indices, integr.indptr
+            else:
+                from .ext import sparse_utils
+                data, indices, indptr = sparse_utils.LUT_to_CSR(integr.lut)
+        return csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, size))
+
+    def _get_main_bin(self, method, csr):
+        """Flag, for each pixel, the element of the sparse matrix of the bin
+        it contributes the most to. Cached with the engine used by method.
+
+        :param method: IntegrationMethod with a "CSR" or "LUT" algorithm
+        :param csr: scipy.sparse.csr_matrix of this engine, as given by `_get_sparse_matrix`
+        :return: array of uint8, 1 for the main element of each pixel
+        """
+        from .ext import sparse_filter
+        engine = self.engines[EXT_CSR_ENGINE if method.algo_lower == "csr" else EXT_LUT_ENGINE]
+        with engine.lock:
+            if (engine.main_bin is None) or (engine.main_bin[0] is not engine.engine):
+                main = sparse_filter._main_bin(csr.data, csr.indices, csr.indptr, csr.shape[1])
+                engine.main_bin = (engine.engine, main)
+            return engine.main_bin[1]
+
+    def _normalization_image(self, shape, correctSolidAngle=True,
+                             polarization_factor=None, flat=None):
+        """Product of all multiplicative corrections applied to each pixel
+
+        :param shape: shape of the image
+        :param correctSolidAngle: correct for solid angle of each pixel if True
+        :param polarization_factor: polarization factor or None for no correction
+        :param flat: flat field image, by default the one of the detector
+        :return: normalization image or None if there is no correction
+        """
+        if flat is None:
+            flat = self.detector.flatfield
+        normalization = None
+        if polarization_factor is not None:
+            polarization = self.polarization(shape, polarization_factor)
+        else:
+            polarization = None
+        if correctSolidAngle:
+            solidangle = self.solidAngleArray(shape, correctSolidAngle)
+        else:
+            solidangle = None
+        for correction in (flat, polarization, solidangle):
+            if correction is not None:
+                if normalization is None:
+                    normalization = numpy.array(correction, dtype=numpy.float64)
+                else:
+                    normalization *= correction
+        return normalization
+
+    def _integrate_sparse_stack(self, csr, frames, variance=None,
+                                dummy=None, delta_dummy=None,
+                                dark=None, normalization=None):
+        """Integrate a stack of frames with a single sparse-matrix/dense-matrix product.
+
+        Processing follows the Cython CSR/LUT integrators: each pixel is
+        corrected for the dark-current and divided by the normalization image,
+        dummy pixels are discarded, then values are averaged within each bin.
+
+        :param csr: scipy.sparse.csr_matrix of shape (nbins, npix)
+        :param frames: 3D array with the stack of frames
+        :param variance: 3D array with the variance of each frame (or None)
+        :param dummy: value for dead pixels
+        :param delta_dummy: precision for dead-pixel value
+        :param dark: dark-current image to be subtracted
+        :param normalization: product of flat, polarization and solid-angle images
+        :return: sum of signal, sum of coefficients and sum of variance as (nframes, nbins) arrays
+        """
+        nframes = len(frames)
+        signal = numpy.array(frames, dtype=numpy.float64).reshape(nframes, -1)
+        if dummy is None:
+            invalid = None
+        elif delta_dummy is None:
+            invalid = (signal == dummy)
+        else:
+            invalid = (abs(signal - dummy) <= delta_dummy)
+        if dark is not None:
+            signal -= dark.ravel()
+        if normalization is not None:
+            signal /= normalization.ravel()
+
+        if invalid is None:
+            count = csr.dot(numpy.ones(signal.shape[1], dtype=numpy.float64))
+            count = numpy.repeat(count[numpy.newaxis, :], nframes, axis=0)
+        else:
+            signal[invalid] = 0.0
+            count = csr.dot(numpy.logical_not(invalid).T.astype(numpy.float64)).T
+        sum_ = csr.dot(signal.T).T
+
+        if variance is None:
+            sum_variance = None
+        else:
+            var = numpy.array(variance, dtype=numpy.float64).reshape(nframes, -1)
+            if invalid is not None:
+                var[invalid] = 0.0
+            sum_variance = csr.dot(var.T).T
+        return sum_, count, sum_variance
+
+    def _iter_batch(self, frames, variance, chunk):
+        """Split a stack of frames (and of their variance) into chunks
+
+        :param frames: 3D array or iterable of 2D frames
+        :param variance: 3D array or iterable of 2D variance arrays, or None
+        :param chunk: maximum number of frames per chunk
+        :return: iterator over 2-tuple (frames, variance) of 3D arrays
+        """
+        chunk = max(1, int(chunk))
+
+        def blocks(stack):
+            if isinstance(stack, numpy.ndarray):
+                if stack.ndim == 2:
+                    stack = stack[numpy.newaxis, ...]
+                for start in range(0, len(stack), chunk):
+                    yield stack[start:start + chunk]
+            else:
+                block = []
+                for frame in stack:
+                    block.append(frame)
+                    if len(block) == chunk:
+                        yield numpy.stack(block)
+                        block = []
+                if block:
+                    yield numpy.stack(block)
+
+        if variance is None:
+            for block in blocks(frames):
+                yield block, None
+        else:
+            for block, var_block in zip(blocks(frames), blocks(variance)):
+                yield block, var_block
+
+    def integrate1d_batch(self, frames, npt, correctSolidAngle=True,
+                          variance=None, error_model=None,
+                          radial_range=None, azimuth_range=None,
+                          mask=None, dummy=None, delta_dummy=None,
+                          polarization_factor=None, dark=None, flat=None,
+                          method="csr", unit=units.Q, safe=True,
+                          normalization_factor=1.0, chunk=16, metadata=None):
+        """Calculate the azimuthal integration of a stack of frames sharing
+        the same setup.
+
+        The setup (geometry, mask, ranges, engine ...) is validated only once
+        for the whole stack. With the Cython implementation of the CSR and LUT
+        methods, all frames of a chunk are integrated at once using a
+        sparse-matrix by dense-matrix product. Other methods (and the
+        "azimuthal" error model) fall back on a frame per frame integration.
+
+        :param frames: 3D array with the stack of frames, or iterable of 2D frames
+        :param npt: number of points in the output pattern
+        :type npt: int
+        :param correctSolidAngle: correct for solid angle of each pixel if True
+        :type correctSolidAngle: bool
+        :param variance: variance associated to each frame, same layout as frames
+        :param error_model: When the variance is unknown, an error model can be given: "poisson" (variance = I), "azimuthal" (variance = (I-<I>)^2)
+        :type error_model: str
+        :param radial_range: The lower and upper range of the radial unit.
+        :type radial_range: (float, float), optional
+        :param azimuth_range: The lower and upper range of the azimuthal angle in degree.
+        :type azimuth_range: (float, float), optional
+        :param mask: array (same size as image) with 1 for masked pixels, and 0 for valid pixels
+        :type mask: ndarray
+        :param dummy: value for dead/masked pixels
+        :type dummy: float
+        :param delta_dummy: precision for dummy value
+        :type delta_dummy: float
+        :param polarization_factor: polarization factor between -1 (vertical) and +1 (horizontal).
+        :type polarization_factor: float
+        :param dark: dark noise image
+        :type dark: ndarray
+        :param flat: flat field image
+        :type flat: ndarray
+        :param method: can be "numpy", "cython", "BBox" or "splitpixel", "lut", "csr", ...
+        :type method: str
+        :param unit: Output units, can be "q_nm^-1", "q_A^-1", "2th_deg", "2th_rad", "r_mm" for now
+        :type unit: pyFAI.units.Unit
+        :param safe: Do some extra checks to ensure LUT/CSR is still valid. False is faster.
+        :type safe: bool
+        :param normalization_factor: Value of a normalization monitor
+        :type normalization_factor: float
+        :param chunk: number of frames processed together
+        :type chunk: int
+        :param metadata: JSON serializable object containing the metadata, usually a dictionary.
+        :return: Integrate1dResult where intensity, sigma, sum and count are 2D arrays (nframes, npt)
+        :rtype: Integrate1dResult
+        """
+        method = self._normalize_method(method, dim=1, default=self.DEFAULT_METHOD_1D)
+        if error_model:
+            error_model = error_model.lower()
+        kwargs = {"npt": npt,
+                  "correctSolidAngle": correctSolidAngle,
+                  "radial_range": radial_range,
+                  "azimuth_range": azimuth_range,
+                  "mask": mask,
+                  "dummy": dummy,
+                  "delta_dummy": delta_dummy,
+                  "polarization_factor": polarization_factor,
+                  "dark": dark,
+                  "flat": flat,
+                  "method": method,
+                  "unit": unit,
+                  "safe": safe,
+                  "normalization_factor": normalization_factor}
+        sparse = (method.algo_lower in ("csr", "lut") and
+                  method.impl_lower == "cython" and
+                  error_model != "azimuthal")
+        empty = dummy if dummy is not None else self._empty
+
+        ref = csr = integr = None
+        intensity, sigma, sum_, count = [], [], [], []
+        for block, var_block in self._iter_batch(frames, variance, chunk):
+            if sparse and (csr is None):
+                # Builds the engine once, without integrating any frame
+                shape = block[0].shape
+                integr = self._setup_sparse_engine(method, shape, npt, radial_range,
+                                                   azimuth_range, mask, unit)
+                if integr is not None:
+                    csr = self._get_sparse_matrix(method, block[0].size)
+                sparse = csr is not None
+                if sparse:
+                    flags = self._correction_flags(mask, dark, flat)
+                    normalization = self._normalization_image(shape, correctSolidAngle,
+                                                              polarization_factor, flat)
+                    if dark is None:
+                        dark = self.detector.darkcurrent
+
+            if sparse:
+                if (var_block is None) and (error_model == "poisson"):
+                    var_block = block
+                signal, norm, var = self._integrate_sparse_stack(csr, block, var_block,
+                                                                 dummy=dummy, delta_dummy=delta_dummy,
+                                                                 dark=dark, normalization=normalization)
+                invalid = (norm == 0)
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    I = signal / norm / normalization_factor
+                    I[invalid] = empty
+                    intensity.append(I)
+                    if var is not None:
+                        error = numpy.sqrt(var) / (norm * normalization_factor)
+                        error[invalid] = empty
+                        sigma.append(error)
+                sum_.append(signal)
+                count.append(norm)
+            else:
+                for idx, frame in enumerate(block):
+                    res = self.integrate1d(frame,
+                                           variance=None if var_block is None else var_block[idx],
+                                           error_model=error_model,
+                                           **kwargs)
+                    if ref is None:
+                        ref = res
+                    intensity.append(res.intensity)
+                    if res.sigma is not None:
+                        sigma.append(res.sigma)
+                    sum_.append(res.sum)
+                    count.append(res.count)
+
+        if not intensity:
+            raise RuntimeError("No frame provided for integration")
+
+        if sparse:
+            unit = units.to_unit(unit)
+            radial = integr.bin_centers * unit.scale
+            compute_engine = str(method)
+            has_mask, has_dark, has_flat = flags
+        else:
+            radial, unit, compute_engine = ref.radial, ref.unit, ref.compute_engine
+            has_mask, has_dark, has_flat = ref.has_mask_applied, ref.has_dark_correction, ref.has_flat_correction
+        stack = numpy.concatenate if sparse else numpy.vstack
+        result = Integrate1dResult(radial, stack(intensity),
+                                   stack(sigma) if sigma else None)
+        result._set_method_called("integrate1d_batch")
+        result._set_compute_engine(compute_engine)
+        result._set_unit(unit)
+        result._set_sum(stack(sum_) if sum_[0] is not None else None)
+        result._set_count(stack(count) if count[0] is not None else None)
+        result._set_has_dark_correction(has_dark)
+        result._set_has_flat_correction(has_flat)
+        result._set_has_mask_applied(has_mask)
+        result._set_polarization_factor(polarization_factor)
+        result._set_normalization_factor(normalization_factor)
+        result._set_metadata(metadata)
+        return result
+
+    def integrate2d_batch(self, frames, npt_rad, npt_azim=360,
+                          correctSolidAngle=True,
+                          radial_range=None, azimuth_range=None,
+                          mask=None, dummy=None, delta_dummy=None,
+                          polarization_factor=None, dark=None, flat=None,
+                          method="csr", unit=units.Q, safe=True,
+                          normalization_factor=1.0, chunk=16, metadata=None):
+        """Calculate the azimuthal regrouped 2d images of a stack of frames
+        sharing the same setup.
+
+        The setup is validated only once for the whole stack. With the Cython
+        implementation of the CSR and LUT methods, all frames of a chunk are
+        regrouped at once using a sparse-matrix by dense-matrix product.
+        Other methods fall back on a frame per frame integration.
+
+        :param frames: 3D array with the stack of frames, or iterable of 2D frames
+        :param npt_rad: number of points in the radial direction
+        :type npt_rad: int
+        :param npt_azim: number of points in the azimuthal direction
+        :type npt_azim: int
+        :param correctSolidAngle: correct for solid angle of each pixel if True
+        :type correctSolidAngle: bool
+        :param radial_range: The lower and upper range of the radial unit.
+        :type radial_range: (float, float), optional
+        :param azimuth_range: The lower and upper range of the azimuthal angle in degree.
+        :type azimuth_range: (float, float), optional
+        :param mask: array (same size as image) with 1 for masked pixels, and 0 for valid pixels
+        :type mask: ndarray
+        :param dummy: value for dead/masked pixels
+        :type dummy: float
+        :param delta_dummy: precision for dummy value
+        :type delta_dummy: float
+        :param polarization_factor: polarization factor between -1 (vertical) and +1 (horizontal).
+        :type polarization_factor: float
+        :param dark: dark noise image
+        :type dark: ndarray
+        :param flat: flat field image
+        :type flat: ndarray
+        :param method: can be "numpy", "cython", "BBox" or "splitpixel", "lut", "csr", ...
+        :type method: str
+        :param unit: Output units, can be "q_nm^-1", "q_A^-1", "2th_deg", "2th_rad", "r_mm" for now
+        :type unit: pyFAI.units.Unit
+        :param safe: Do some extra checks to ensure LUT/CSR is still valid. False is faster.
+        :type safe: bool
+        :param normalization_factor: Value of a normalization monitor
+        :type normalization_factor: float
+        :param chunk: number of frames processed together
+        :type chunk: int
+        :param metadata: JSON serializable object containing the metadata, usually a dictionary.
+        :return: Integrate2dResult where intensity, sum and count are 3D arrays (nframes, npt_azim, npt_rad)
+        :rtype: Integrate2dResult
+        """
+        method = self._normalize_method(method, dim=2, default=self.DEFAULT_METHOD_2D)
+        kwargs = {"npt_rad": npt_rad,
+                  "npt_azim": npt_azim,
+                  "correctSolidAngle": correctSolidAngle,
+                  "radial_range": radial_range,
+                  "azimuth_range": azimuth_range,
+                  "mask": mask,
+                  "dummy": dummy,
+                  "delta_dummy": delta_dummy,
+                  "polarization_factor": polarization_factor,
+                  "dark": dark,
+                  "flat": flat,
+                  "method": method,
+                  "unit": unit,
+                  "safe": safe,
+                  "normalization_factor": normalization_factor}
+        sparse = (method.algo_lower in ("csr", "lut") and method.impl_lower == "cython")
+        empty = dummy if dummy is not None else self._empty
+
+        ref = csr = integr = None
+        intensity, sum_, count = [], [], []
+        for block, _ in self._iter_batch(frames, None, chunk):
+            if sparse and (csr is None):
+                # Builds the engine once, without integrating any frame
+                shape = block[0].shape
+                integr = self._setup_sparse_engine(method, shape, (npt_rad, npt_azim), radial_range,
+                                                   azimuth_range, mask, unit)
+                if integr is not None:
+                    csr = self._get_sparse_matrix(method, block[0].size)
+                sparse = csr is not None
+                if sparse:
+                    flags = self._correction_flags(mask, dark, flat)
+                    normalization = self._normalization_image(shape, correctSolidAngle,
+                                                              polarization_factor, flat)
+                    if dark is None:
+                        dark = self.detector.darkcurrent
+
+            if sparse:
+                signal, norm, _ = self._integrate_sparse_stack(csr, block,
+                                                               dummy=dummy, delta_dummy=delta_dummy,
+                                                               dark=dark, normalization=normalization)
+                # bins are ordered as (radial, azimuthal) in the sparse matrix
+                signal = signal.reshape(-1, npt_rad, npt_azim).transpose(0, 2, 1)
+                norm = norm.reshape(-1, npt_rad, npt_azim).transpose(0, 2, 1)
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    I = signal / norm / normalization_factor
+                I[norm == 0] = empty
+                intensity.append(I)
+                sum_.append(signal)
+                count.append(norm)
+            else:
+                for frame in block:
+                    res = self.integrate2d(frame, **kwargs)
+                    if ref is None:
+                        ref = res
+                    intensity.append(res.intensity[numpy.newaxis, ...])
+                    sum_.append(None if res.sum is None else res.sum[numpy.newaxis, ...])
+                    count.append(None if res.count is None else res.count[numpy.newaxis, ...])
+
+        if not intensity:
+            raise RuntimeError("No frame provided for integration")
+
+        if sparse:
+            unit = units.to_unit(unit)
+            radial = integr.bin_centers0 * unit.scale
+            azimuthal = integr.bin_centers1 * 180.0 / pi
+            compute_engine = str(method)
+            has_mask, has_dark, has_flat = flags
+        else:
+            radial, azimuthal, unit = ref.radial, ref.azimuthal, ref.unit
+            compute_engine = ref.compute_engine
+            has_mask, has_dark, has_flat = ref.has_mask_applied, ref.has_dark_correction, ref.has_flat_correction
+        result = Integrate2dResult(numpy.concatenate(intensity), radial, azimuthal)
+        result._set_method_called("integrate2d_batch")
+        result._set_compute_engine(compute_engine)
+        result._set_unit(unit)
+        result._set_sum(numpy.concatenate(sum_) if sum_[0] is not None else None)
+        result._set_count(numpy.concatenate(count) if count[0] is not None else None)
+        result._set_has_dark_correction(has_dark)
+        result._set_has_flat_correction(has_flat)
+        result._set_has_mask_applied(has_mask)
+        result._set_polarization_factor(polarization_factor)
+        result._set_normalization_factor(normalization_factor)
+        result._set_metadata(metadata)
+        return result
+
     @deprecated(since_version="0.14", reason="Use the class DefaultAiWriter")
     def save1D(self, filename, dim1, I, error=None, dim1_unit=units.TTH,
                has_dark=False, has_flat=False, polarization_factor=None, normalization_factor=None):
@@ -2986,6 +4034,414 @@ class AzimuthalIntegrator(Geometry):
         result._set_normalization_factor(normalization_factor)
         return result
 
+    def _sparse_filter_batch(self, sparse_filter, frames, npt_rad,
+                             correctSolidAngle=True, polarization_factor=None,
+                             dark=None, flat=None, method="csr", unit=units.Q,
+                             radial_range=None, azimuth_range=None,
+                             dummy=None, delta_dummy=None,
+                             mask=None, normalization_factor=1.0, chunk=16,
+                             variance=None, main_bin=False, **kwargs):
+        """Apply a filter of `pyFAI.ext.sparse_filter` on the pixels of each
+        radial bin, for a stack of frames.
+
+        The CSR (or LUT) engine is built (or validated) once, without
+        integrating any frame, then each chunk of frames is filtered in a single call.
+
+        :param sparse_filter: function of `pyFAI.ext.sparse_filter`
+        :param variance: variance of the frames, same layout as frames, if
+                         the filter accepts it
+        :param main_bin: set to True to provide the filter with the main bin
+                         of each pixel (`main` parameter), cached with the engine
+        :param kwargs: extra parameters of the filter
+        :return: SparseFilterSetup describing the bins and the corrections,
+                 and the outputs of the filter, concatenated over all frames
+        """
+        method = self._normalize_method(method, dim=1, default=self.DEFAULT_METHOD_1D)
+        if (method.algo_lower not in ("csr", "lut")) or (method.impl_lower != "cython"):
+            requested = method
+            method = IntegrationMethod.select_method(dim=1, split=method.split_lower,
+                                                     algo="csr", impl="cython")[0]
+            logger.warning("Filtering pixels requires a sparse matrix: method %s used instead of %s",
+                           method, requested)
+        if dummy is None:
+            empty = self._empty
+        else:
+            empty = dummy
+        unit = units.to_unit(unit)
+        setup = csr = normalization = None
+        outputs = []
+        for block, var_block in self._iter_batch(frames, variance, chunk):
+            if setup is None:
+                # Validates the setup and (re-)builds the engine if needed
+                integr = self._setup_sparse_engine(method, block[0].shape, npt_rad,
+                                                   radial_range=radial_range,
+                                                   azimuth_range=azimuth_range,
+                                                   mask=mask, unit=unit)
+                csr = None if integr is None else self._get_sparse_matrix(method, block[0].size)
+                if csr is None:
+                    raise RuntimeError("No sparse matrix available for method %s" % method)
+                setup = SparseFilterSetup(integr.bin_centers * unit.scale, unit, str(method),
+                                          *self._correction_flags(mask, dark, flat))
+                if main_bin:
+                    kwargs["main"] = self._get_main_bin(method, csr)
+                normalization = self._normalization_image(block[0].shape, correctSolidAngle,
+                                                          polarization_factor, flat)
+                if dark is None:
+                    dark = self.detector.darkcurrent
+            if var_block is not None:
+                kwargs["variance"] = var_block
+            outputs.append(sparse_filter(csr.data, csr.indices, csr.indptr, block, block[0].size,
+                                         dark=dark, normalization=normalization,
+                                         dummy=dummy, delta_dummy=delta_dummy,
+                                         normalization_factor=normalization_factor,
+                                         empty=empty, **kwargs))
+        if setup is None:
+            raise RuntimeError("No frame provided for integration")
+        return setup, [numpy.concatenate(i) for i in zip(*outputs)]
+
+    def medfilt1d_batch(self, frames, npt_rad=1024,
+                        correctSolidAngle=True,
+                        polarization_factor=None, dark=None, flat=None,
+                        method="csr", unit=units.Q, radial_range=None,
+                        percentile=50, dummy=None, delta_dummy=None,
+                        mask=None, normalization_factor=1.0, chunk=16,
+                        metadata=None):
+        """Median filter (or any percentile) of the pixels of each radial
+        bin, for a stack of frames sharing the same setup.
+
+        Unlike `medfilt1d`, there is no intermediate 2D integration: the
+        pixels of each radial bin are taken from the sparse matrix of the
+        CSR (or LUT) engine and sorted, weighted by their contribution to
+        the bin. Bins of all frames of a chunk are processed in parallel.
+
+        :param frames: 3D array with the stack of frames, or iterable of 2D frames
+        :param npt_rad: number of radial points
+        :param correctSolidAngle: correct for solid angle of each pixel if True
+        :type correctSolidAngle: bool
+        :param polarization_factor: polarization factor between -1 (vertical) and +1 (horizontal).
+        :type polarization_factor: float
+        :param dark: dark noise image
+        :type dark: ndarray
+        :param flat: flat field image
+        :type flat: ndarray
+        :param method: sparse matrix method, "csr" by default
+        :param unit: unit to be used for integration
+        :param radial_range: The lower and upper range of the radial unit.
+        :type radial_range: (float, float), optional
+        :param percentile: which percentile use for cutting out,
+                           percentile can be a 2-tuple to specify a region to
+                           average out
+        :param dummy: value for dead/masked pixels
+        :param delta_dummy: precision for dummy value
+        :param mask: masked out pixels array
+        :param normalization_factor: Value of a normalization monitor
+        :type normalization_factor: float
+        :param chunk: number of frames processed together
+        :type chunk: int
+        :param metadata: any other metadata,
+        :type metadata: JSON serializable dict
+        :return: Integrate1dResult where intensity and count are 2D arrays (nframes, npt_rad)
+        """
+        from .ext import sparse_filter
+        if "__len__" in dir(percentile):
+            quantile = tuple(i / 100.0 for i in percentile)
+        else:
+            quantile = percentile / 100.0
+        setup, (spectrum, count) = self._sparse_filter_batch(sparse_filter.quantile_csr, frames, npt_rad,
+                                                             correctSolidAngle=correctSolidAngle,
+                                                             polarization_factor=polarization_factor,
+                                                             dark=dark, flat=flat, method=method,
+                                                             unit=unit, radial_range=radial_range,
+                                                             dummy=dummy, delta_dummy=delta_dummy,
+                                                             mask=mask, normalization_factor=normalization_factor,
+                                                             chunk=chunk, quantile=quantile)
+        result = Integrate1dResult(setup.radial, spectrum)
+        result._set_method_called("medfilt1d_batch")
+        result._set_compute_engine(setup.compute_engine)
+        result._set_percentile(percentile)
+        result._set_unit(setup.unit)
+        result._set_count(count)
+        result._set_has_mask_applied(setup.has_mask_applied)
+        result._set_metadata(metadata)
+        result._set_has_dark_correction(setup.has_dark_correction)
+        result._set_has_flat_correction(setup.has_flat_correction)
+        result._set_polarization_factor(polarization_factor)
+        result._set_normalization_factor(normalization_factor)
+        return result
+
+    def sigma_clip_batch(self, frames, npt_rad=1024,
+                         correctSolidAngle=True,
+                         polarization_factor=None, dark=None, flat=None,
+                         method="csr", unit=units.Q, radial_range=None,
+                         thres=3, max_iter=5, dummy=None, delta_dummy=None,
+                         mask=None, normalization_factor=1.0, chunk=16,
+                         metadata=None):
+        """Iterative sigma-clipping of the pixels of each radial bin, for a
+        stack of frames sharing the same setup.
+
+        Unlike `sigma_clip`, there is no intermediate 2D integration: the
+        mean and standard deviation of each radial bin are calculated on the
+        pixels taken from the sparse matrix of the CSR (or LUT) engine, and
+        outlier pixels are discarded until convergence. Bins of all frames of
+        a chunk are processed in parallel.
+
+        :param frames: 3D array with the stack of frames, or iterable of 2D frames
+        :param npt_rad: number of radial points
+        :param bool correctSolidAngle: correct for solid angle of each pixel
+                if True
+        :param float polarization_factor: polarization factor between -1 (vertical)
+                and +1 (horizontal).
+        :param ndarray dark: dark noise image
+        :param ndarray flat: flat field image
+        :param method: sparse matrix method, "csr" by default
+        :param unit: unit to be used for integration
+        :param radial_range: The lower and upper range of the radial unit.
+        :type radial_range: (float, float), optional
+        :param thres: cut-off for n*sigma: discard any values with (I-<I>)/sigma > thres.
+                The threshold can be a 2-tuple with sigma_low and sigma_high.
+        :param max_iter: maximum number of iterations
+        :param dummy: value for dead/masked pixels
+        :param delta_dummy: precision for dummy value
+        :param mask: masked out pixels array
+        :param float normalization_factor: Value of a normalization monitor
+        :param chunk: number of frames processed together
+        :type chunk: int
+        :param metadata: any other metadata,
+        :type metadata: JSON serializable dict
+        :return: Integrate1dResult where intensity, sigma (the standard
+                 deviation) and count (of pixels kept) are 2D arrays (nframes, npt_rad)
+        """
+        from .ext import sparse_filter
+        if "__len__" in dir(thres) and len(thres) > 0:
+            sigma_lo = thres[0]
+            sigma_hi = thres[-1]
+        else:
+            sigma_lo = sigma_hi = thres
+        setup, (mean, std, count, _) = self._sparse_filter_batch(sparse_filter.sigma_clip_csr, frames, npt_rad,
+                                                                 correctSolidAngle=correctSolidAngle,
+                                                                 polarization_factor=polarization_factor,
+                                                                 dark=dark, flat=flat, method=method,
+                                                                 unit=unit, radial_range=radial_range,
+                                                                 dummy=dummy, delta_dummy=delta_dummy,
+                                                                 mask=mask, normalization_factor=normalization_factor,
+                                                                 chunk=chunk, sigma_lo=sigma_lo,
+                                                                 sigma_hi=sigma_hi, max_iter=max_iter)
+        result = Integrate1dResult(setup.radial, mean, std)
+        result._set_method_called("sigma_clip_batch")
+        result._set_compute_engine(setup.compute_engine)
+        result._set_percentile(thres)
+        result._set_unit(setup.unit)
+        result._set_count(count)
+        result._set_std(std)
+        result._set_has_mask_applied(setup.has_mask_applied)
+        result._set_metadata(metadata)
+        result._set_has_dark_correction(setup.has_dark_correction)
+        result._set_has_flat_correction(setup.has_flat_correction)
+        result._set_polarization_factor(polarization_factor)
+        result._set_normalization_factor(normalization_factor)
+        return result
+
+    def sigma_clip_ng(self, data, npt=1024,
+                      correctSolidAngle=True,
+                      polarization_factor=None,
+                      variance=None, error_model=None,
+                      radial_range=None, azimuth_range=None,
+                      dark=None, flat=None,
+                      method="csr", unit=units.Q,
+                      thres=5, max_iter=5,
+                      dummy=None, delta_dummy=None,
+                      mask=None, normalization_factor=1.0,
+                      metadata=None):
+        """Perform the 1D integration with an iterative sigma-clipping of
+        the pixels of each radial bin.
+
+        Pixels belonging to each bin are taken from the CSR (or LUT) sparse
+        matrix: the weighted mean and standard deviation of each bin are
+        calculated and outlier pixels, with (I-<I>)/std > thres, are discarded
+        until convergence. Unlike `sigma_clip`, no 2D integration is performed
+        and the statistics are those of the pixels, not of azimuthal bins.
+        Bins are processed in parallel.
+
+        :param data: input image as numpy array
+        :param npt: number of radial points
+        :param bool correctSolidAngle: correct for solid angle of each pixel
+                if True
+        :param float polarization_factor: polarization factor between -1 (vertical)
+                and +1 (horizontal).
+        :param ndarray variance: the variance of the signal
+        :param str error_model: can be "poisson" to assume a poissonian detector (variance=I),
+                any other value provides the standard error of the mean of the pixels kept
+        :param radial_range: The lower and upper range of the radial unit.
+        :type radial_range: (float, float), optional
+        :param azimuth_range: The lower and upper range of the azimuthal angle in degree.
+        :type azimuth_range: (float, float), optional
+        :param ndarray dark: dark noise image
+        :param ndarray flat: flat field image
+        :param method: sparse matrix method, "csr" by default
+        :param unit: unit to be used for integration
+        :param thres: cut-off for n*sigma: discard any values with (I-<I>)/sigma > thres.
+                The threshold can be a 2-tuple with sigma_low and sigma_high.
+        :param max_iter: maximum number of iterations
+        :param dummy: value for dead/masked pixels
+        :param delta_dummy: precision for dummy value
+        :param mask: masked out pixels array
+        :param float normalization_factor: Value of a normalization monitor
+        :param metadata: any other metadata,
+        :type metadata: JSON serializable dict
+        :return: Integrate1dResult with the mean intensity of the pixels kept,
+                 its uncertainty as sigma, the standard deviation of the
+                 pixels kept as std and their number as count
+        """
+        from .ext import sparse_filter
+        if "__len__" in dir(thres) and len(thres) > 0:
+            sigma_lo = thres[0]
+            sigma_hi = thres[-1]
+        else:
+            sigma_lo = sigma_hi = thres
+        if (variance is None) and error_model and (error_model.lower() == "poisson"):
+            if dark is None:
+                variance = numpy.ascontiguousarray(abs(data), numpy.float32)
+            else:
+                variance = abs(data) + abs(dark)
+        frames = data[numpy.newaxis, ...]
+        if variance is not None:
+            variance = variance[numpy.newaxis, ...]
+        setup, outputs = self._sparse_filter_batch(sparse_filter.sigma_clip_csr, frames, npt,
+                                                   correctSolidAngle=correctSolidAngle,
+                                                   polarization_factor=polarization_factor,
+                                                   dark=dark, flat=flat, method=method,
+                                                   unit=unit, radial_range=radial_range,
+                                                   azimuth_range=azimuth_range,
+                                                   dummy=dummy, delta_dummy=delta_dummy,
+                                                   mask=mask, normalization_factor=normalization_factor,
+                                                   variance=variance, sigma_lo=sigma_lo,
+                                                   sigma_hi=sigma_hi, max_iter=max_iter)
+        mean, std, count, error = [i[0] for i in outputs]
+        result = Integrate1dResult(setup.radial, mean, error)
+        result._set_method_called("sigma_clip_ng")
+        result._set_compute_engine(setup.compute_engine)
+        result._set_percentile(thres)
+        result._set_unit(setup.unit)
+        result._set_count(count)
+        result._set_std(std)
+        result._set_has_mask_applied(setup.has_mask_applied)
+        result._set_metadata(metadata)
+        result._set_has_dark_correction(setup.has_dark_correction)
+        result._set_has_flat_correction(setup.has_flat_correction)
+        result._set_polarization_factor(polarization_factor)
+        result._set_normalization_factor(normalization_factor)
+        return result
+
+    def sparsify(self, data, npt=1024,
+                 correctSolidAngle=True,
+                 polarization_factor=None,
+                 radial_range=None, azimuth_range=None,
+                 dark=None, flat=None,
+                 method="csr", unit=units.Q,
+                 thres=5, max_iter=5,
+                 cutoff=3, noise=1.0,
+                 dummy=None, delta_dummy=None,
+                 mask=None, normalization_factor=1.0, chunk=16,
+                 metadata=None):
+        """Select the pixels of a frame above the background, i.e. the
+        candidate pixels for Bragg peaks.
+
+        The background of each radial bin is the mean of its pixels after
+        sigma-clipping (like `sigma_clip_ng`). Then, in a single pass over the
+        sparse matrix, every pixel with an intensity above
+        `background + max(cutoff * std, noise)` of the bin it contributes the
+        most to is selected. Both steps are performed in parallel with the
+        same CSR (or LUT) matrix. The bin each pixel contributes the most to
+        is calculated once and kept with the engine.
+
+        A stack of frames sharing the same setup is processed by chunks, like
+        in `sigma_clip_batch`.
+
+        :param data: input image as numpy array, or stack of frames
+                (3D array or iterable of 2D frames)
+        :param npt: number of radial points
+        :param bool correctSolidAngle: correct for solid angle of each pixel
+                if True
+        :param float polarization_factor: polarization factor between -1 (vertical)
+                and +1 (horizontal).
+        :param radial_range: The lower and upper range of the radial unit.
+        :type radial_range: (float, float), optional
+        :param azimuth_range: The lower and upper range of the azimuthal angle in degree.
+        :type azimuth_range: (float, float), optional
+        :param ndarray dark: dark noise image
+        :param ndarray flat: flat field image
+        :param method: sparse matrix method, "csr" by default
+        :param unit: unit to be used for integration
+        :param thres: cut-off for n*sigma of the sigma-clipping of the background.
+                The threshold can be a 2-tuple with sigma_low and sigma_high.
+        :param max_iter: maximum number of iterations of the sigma-clipping
+        :param cutoff: pixels above the background by more than cutoff*std are selected
+        :param noise: minimum difference to the background, in intensity
+                (after normalization), to select a pixel
+        :param dummy: value for dead/masked pixels
+        :param delta_dummy: precision for dummy value
+        :param mask: masked out pixels array
+        :param float normalization_factor: Value of a normalization monitor
+        :param chunk: number of frames processed together
+        :param metadata: any other metadata,
+        :type metadata: JSON serializable dict
+        :return: SparseFrame with the index (in the flattened frame) and the
+                 raw intensity of the pixels selected, and the background
+                 profile. A list of SparseFrame, one per frame, for a stack.
+        """
+        from .ext import sparse_filter
+        if "__len__" in dir(thres) and len(thres) > 0:
+            sigma_lo = thres[0]
+            sigma_hi = thres[-1]
+        else:
+            sigma_lo = sigma_hi = thres
+
+        shape = []
+
+        def clip_and_sparsify(csr_data, indices, indptr, frames, size, empty=0.0, main=None, **kwargs):
+            shape[:] = frames.shape[1:]
+            mean, std, count, _ = sparse_filter.sigma_clip_csr(csr_data, indices, indptr, frames, size,
+                                                               sigma_lo=sigma_lo, sigma_hi=sigma_hi,
+                                                               max_iter=max_iter, empty=empty, **kwargs)
+            ptr, index, intensity = sparse_filter.sparsify_csr(csr_data, indices, indptr, frames, size,
+                                                               mean, std, cutoff=cutoff, noise=noise,
+                                                               main=main, **kwargs)
+            return mean, std, numpy.diff(ptr), index, intensity
+
+        single = isinstance(data, numpy.ndarray) and data.ndim == 2
+        setup, outputs = self._sparse_filter_batch(clip_and_sparsify, data, npt,
+                                                   correctSolidAngle=correctSolidAngle,
+                                                   polarization_factor=polarization_factor,
+                                                   dark=dark, flat=flat, method=method,
+                                                   unit=unit, radial_range=radial_range,
+                                                   azimuth_range=azimuth_range,
+                                                   dummy=dummy, delta_dummy=delta_dummy,
+                                                   mask=mask, normalization_factor=normalization_factor,
+                                                   chunk=chunk, main_bin=True)
+        mean, std, nselected, index, intensity = outputs
+        ptr = numpy.concatenate(([0], numpy.cumsum(nselected)))
+        results = []
+        for frame in range(len(nselected)):
+            result = SparseFrame(index[ptr[frame]:ptr[frame + 1]], intensity[ptr[frame]:ptr[frame + 1]])
+            result._set_shape(tuple(shape))
+            result._set_radial(setup.radial)
+            result._set_background_avg(mean[frame])
+            result._set_background_std(std[frame])
+            result._set_cutoff(cutoff)
+            result._set_noise(noise)
+            result._set_method_called("sparsify")
+            result._set_compute_engine(setup.compute_engine)
+            result._set_percentile(thres)
+            result._set_unit(setup.unit)
+            result._set_has_mask_applied(setup.has_mask_applied)
+            result._set_metadata(metadata)
+            result._set_has_dark_correction(setup.has_dark_correction)
+            result._set_has_flat_correction(setup.has_flat_correction)
+            result._set_polarization_factor(polarization_factor)
+            result._set_normalization_factor(normalization_factor)
+            results.append(result)
+        return results[0] if single else results
+
     def separate(self, data, npt_rad=1024, npt_azim=512, unit="2th_deg", method="splitpixel",
                  percentile=50, mask=None, restore_mask=True):
         """
@@ -3177,6 +4633,11 @@ class AzimuthalIntegrator(Geometry):
                         engine.engine.empty = self._empty
                     except Exception as exeption:
                         logger.error(exeption)
+        for engine in self.engine_registry.engines():
+            try:
+                engine.empty = self._empty
+            except Exception as exeption:
+                logger.error(exeption)
     empty = property(get_empty, set_empty)
 
     def __getnewargs_ex__(self):
@@ -3192,7 +4653,7 @@ class AzimuthalIntegrator(Geometry):
         :return: the state of the object
         """
 
-        state_blacklist = ('_lock', "engines")
+        state_blacklist = ('_lock', "engines", "engine_registry")
         state = Geometry.__getstate__(self)
         for key in state_blacklist:
             if key in state:
@@ -3209,3 +4670,4 @@ class AzimuthalIntegrator(Geometry):
         self._sem = threading.Semaphore()
         self._lock = threading.Semaphore()
         self.engines = {}
+        self.engine_registry = EngineRegistry()
@@ -28,7 +28,7 @@ from __future__ import print_function, division
 
 
 __author__ = "Jérôme Kieffer"
-__date__ = "07/06/2018"
+__date__ = "18/02/2019"
 __license__ = "MIT"
 __copyright__ = "2012-2017 European Synchrotron Radiation Facility, Grenoble, France"
 
@@ -41,13 +41,19 @@ import timeit
 import os
 import platform
 import subprocess
+import multiprocessing
+import numpy
 import fabio
 import os.path as op
 
 # To use use the locally build version of PyFAI, use ../bootstrap.py
 
 from .. import load
+from .. import units
+from .. import utils
 from ..azimuthalIntegrator import AzimuthalIntegrator
+from ..detectors import detector_factory
+from ..ext import _geometry, bilinear
 from ..utils import mathutil
 from ..test import utilstest
 from ..opencl import pyopencl, ocl
@@ -167,6 +173,118 @@ class BenchTest2D(BenchTest):
         self.data = None
 
 
+class BenchTestCsr(BenchTest):
+    """Test the sparse matrix multiplication of the CSR integrator with a given number of threads"""
+
+    def __init__(self, azimuthal_params, file_name, unit, method, output_size=None):
+        BenchTest.__init__(self)
+        self.azimuthal_params = azimuthal_params
+        self.file_name = file_name
+        self.unit = unit
+        self.method = method
+        self.output_size = output_size
+        self.nthread = 0
+
+    def setup(self):
+        self.ai = AzimuthalIntegrator(**self.azimuthal_params)
+        self.data = fabio.open(self.file_name).data
+        if self.output_size is None:
+            self.N = min(self.data.shape)
+            self.ai.integrate1d(self.data, self.N, unit=self.unit, method=self.method)
+        else:
+            self.N = self.output_size
+            self.ai.integrate2d(self.data, self.output_size[0], self.output_size[1], unit=self.unit, method=self.method)
+        module = sys.modules.get(AzimuthalIntegrator.__module__)
+        self.integrator = self.ai.engines[module.EXT_CSR_ENGINE].engine
+
+    def stmt(self):
+        return self.integrator.integrate(self.data, nthread=self.nthread)
+
+    def clean(self):
+        self.ai = None
+        self.data = None
+        self.integrator = None
+
+
+class BenchTestCorner(BenchTest):
+    """Test the calculation of the position of the pixel corners"""
+
+    def __init__(self, detector, unit, fused=True):
+        BenchTest.__init__(self)
+        self.detector = detector
+        self.unit = units.to_unit(unit)
+        self.fused = fused
+        self.nthread = 0
+
+    def setup(self):
+        detector = detector_factory(self.detector)
+        self.shape = detector.max_shape
+        self.ai = AzimuthalIntegrator(dist=0.1, poni1=0.1, poni2=0.1, rot1=0.1, rot2=0.2,
+                                      detector=detector, wavelength=1e-10)
+        self.space = self.unit.name.split("_")[0]
+
+    def stmt(self):
+        ai = self.ai
+        if self.fused:
+            return _geometry.calc_corner_rad_azim(ai.dist, ai.poni1, ai.poni2,
+                                                  ai.rot1, ai.rot2, ai.rot3,
+                                                  ai.pixel1, ai.pixel2, self.shape,
+                                                  self.space, ai.wavelength, nthread=self.nthread)
+        # Former path: positions of the corners, then angles, then 4D array
+        shape = self.shape
+        d1 = utils.expand2d(numpy.arange(shape[0] + 1.0), shape[1] + 1.0, False)
+        d2 = utils.expand2d(numpy.arange(shape[1] + 1.0), shape[0] + 1.0, True)
+        p1, p2, p3 = ai.detector.calc_cartesian_positions(d1, d2, center=False, use_cython=True)
+        res = _geometry.calc_rad_azim(ai.dist, ai.poni1, ai.poni2,
+                                      ai.rot1, ai.rot2, ai.rot3,
+                                      p1, p2, p3, self.space, ai.wavelength)
+        radi = numpy.ascontiguousarray(res[..., 0], numpy.float32)
+        azim = numpy.ascontiguousarray(res[..., 1], numpy.float32)
+        return bilinear.convert_corner_2D_to_4D(2, radi, azim)
+
+    def clean(self):
+        self.ai = None
+
+
+class BenchTestDistortion(BenchTest):
+    """Test the distortion correction of a stack of frames"""
+
+    def __init__(self, shape, method="csr", nframes=16, stack=True):
+        BenchTest.__init__(self)
+        self.shape = tuple(shape)
+        self.method = method
+        self.nframes = nframes
+        self.stack = stack
+        self.out = None
+
+    def setup(self):
+        from ..distortion import Distortion
+        detector = detector_factory("Detector", {"pixel1": 1e-4, "pixel2": 1e-4,
+                                                 "max_shape": self.shape})
+        # sinusoidal distortion of a few pixels, like a spline-corrected CCD
+        corners = detector.get_pixel_corners().copy()
+        pos1 = corners[..., 1] / detector.pixel1
+        pos2 = corners[..., 2] / detector.pixel2
+        corners[..., 1] = (pos1 + 2.0 * numpy.sin(pos2 / 50.0)) * detector.pixel1
+        corners[..., 2] = (pos2 + 2.0 * numpy.cos(pos1 / 70.0)) * detector.pixel2
+        detector.set_pixel_corners(corners)
+        self.distortion = Distortion(detector, self.shape, method=self.method,
+                                     mask=numpy.zeros(self.shape, numpy.int8))
+        self.distortion.calc_init()
+        self.data = numpy.random.poisson(100, (self.nframes,) + self.shape).astype(numpy.float32)
+        self.out = self.distortion.correct_stack(self.data)
+
+    def stmt(self):
+        if self.stack:
+            return self.distortion.correct_stack(self.data, out=self.out)
+        return [self.distortion.correct(frame) for frame in self.data]
+
+    def clean(self):
+        self.distortion = None
+        self.data = None
+        self.out = None
+
+
 class BenchTestGpu(BenchTest):
     """Test XRPD in OpenCL"""
 
@@ -504,6 +622,143 @@ class Bench(object):
         self.results[label] = results
         self.update_mp()
 
+    def bench_threads(self, method="csr", nthreads=None, dim=1):
+        """Measure the scaling of the OpenMP CSR integrator with the number of threads
+
+        Only the sparse matrix multiplication is timed, the matrix is built once per image.
+
+        :param method: "csr" or a CSR method with pixel splitting like "full_csr"
+        :param nthreads: list of number of threads, by default 1, 2, 4 ... up to the number of cores
+        :param dim: 1 or 2 for the dimentionality of the integration
+        """
+        self.update_mp()
+        if not nthreads:
+            ncpu = multiprocessing.cpu_count()
+            nthreads = [1 << i for i in range(ncpu.bit_length()) if (1 << i) < ncpu] + [ncpu]
+        print("Working on processor: %s" % self.get_cpu())
+        labels = OrderedDict((nthread, "%iD_%s_%i_threads" % (dim, method.upper(), nthread)) for nthread in nthreads)
+        results = OrderedDict((label, OrderedDict()) for label in labels.values())
+        for param in ds_list:
+            self.update_mp()
+            file_name = utilstest.UtilsTest.getimage(datasets[param])
+            poni = PONIS[param]
+            bench_test = BenchTestCsr(poni, file_name, self.unit, method, None if dim == 1 else self.out_2d)
+            try:
+                bench_test.setup()
+            except (MemoryError, RuntimeError) as error:
+                print(error)
+                break
+            size = bench_test.data.size / 1.0e6
+            if size > self.max_size:
+                bench_test.clean()
+                continue
+            print("%iD integration of %s %.1f Mpixel -> %s bins" % (dim, op.basename(file_name), size, bench_test.N))
+            reference = None
+            for nthread in nthreads:
+                bench_test.nthread = nthread
+                t = timeit.Timer(bench_test.stmt)
+                tmin = min([i / self.nbr for i in t.repeat(repeat=self.repeat, number=self.nbr)])
+                if reference is None:
+                    reference = tmin
+                print(" * %3i threads: %.1f ms, speed-up x%.2f" % (nthread, 1000.0 * tmin, reference / tmin))
+                results[labels[nthread]][size] = 1000.0 * tmin
+            bench_test.clean()
+            self.update_mp()
+        self.print_sep()
+        for label, result in results.items():
+            self.new_curve(result, label)
+            self.meth.append(label)
+            self.results[label] = result
+        self.update_mp()
+
+    def bench_corners(self, detectors=None):
+        """Compare the calculation of the pixel corner positions (corner_array)
+        with the fused OpenMP kernel against the former 3-step path.
+
+        :param detectors: list of detector names, by default from 1 to 16 Mpixel
+        """
+        self.update_mp()
+        print("Working on processor: %s" % self.get_cpu())
+        if not detectors:
+            detectors = ["Pilatus1M", "Pilatus2M", "Eiger4M", "Pilatus6M", "Eiger9M", "Eiger16M"]
+        labels = OrderedDict(((False, "Corners_former"), (True, "Corners_fused")))
+        results = OrderedDict((label, OrderedDict()) for label in labels.values())
+        for detector in detectors:
+            self.update_mp()
+            timings = {}
+            for fused, label in labels.items():
+                bench_test = BenchTestCorner(detector, self.unit, fused)
+                try:
+                    bench_test.setup()
+                except (MemoryError, RuntimeError) as error:
+                    print(error)
+                    break
+                size = bench_test.shape[0] * bench_test.shape[1] / 1.0e6
+                if size > self.max_size:
+                    bench_test.clean()
+                    break
+                t = timeit.Timer(bench_test.stmt)
+                tmin = min([i / self.nbr for i in t.repeat(repeat=self.repeat, number=self.nbr)])
+                timings[fused] = tmin
+                results[label][size] = 1000.0 * tmin
+                bench_test.clean()
+            if len(timings) == 2:
+                print("Corners of %s %.1f Mpixel: former %.1f ms, fused %.1f ms, speed-up x%.2f" %
+                      (detector, size, 1000.0 * timings[False], 1000.0 * timings[True],
+                       timings[False] / timings[True]))
+            self.update_mp()
+        self.print_sep()
+        for label, result in results.items():
+            self.new_curve(result, label)
+            self.meth.append(label)
+            self.results[label] = result
+        self.update_mp()
+
+    def bench_distortion(self, shapes=None, nframes=16):
+        """Compare the distortion correction of a stack of frames in a single
+        call (`correct_stack`) against the frame by frame correction.
+
+        :param shapes: list of detector shapes, by default from 1 to 16 Mpixel
+        :param nframes: number of frames of the stack
+        """
+        self.update_mp()
+        print("Working on processor: %s" % self.get_cpu())
+        if not shapes:
+            shapes = [(1024, 1024), (1024, 2048), (2048, 2048), (4096, 4096)]
+        for method in ("csr", "lut"):
+            labels = OrderedDict(((False, "Distortion_%s_frames" % method.upper()),
+                                  (True, "Distortion_%s_stack" % method.upper())))
+            results = OrderedDict((label, OrderedDict()) for label in labels.values())
+            for shape in shapes:
+                size = shape[0] * shape[1] / 1.0e6
+                if size > self.max_size:
+                    break
+                self.update_mp()
+                timings = {}
+                for stack, label in labels.items():
+                    bench_test = BenchTestDistortion(shape, method, nframes, stack)
+                    try:
+                        bench_test.setup()
+                    except (MemoryError, RuntimeError) as error:
+                        print(error)
+                        break
+                    t = timeit.Timer(bench_test.stmt)
+                    tmin = min([i / self.nbr for i in t.repeat(repeat=self.repeat, number=self.nbr)])
+                    timings[stack] = tmin / nframes
+                    results[label][size] = 1000.0 * tmin / nframes
+                    bench_test.clean()
+                if len(timings) == 2:
+                    print("Distortion %s of %.1f Mpixel: frames %.1f ms, stack %.1f ms per frame, speed-up x%.2f" %
+                          (method.upper(), size, 1000.0 * timings[False], 1000.0 * timings[True],
+                           timings[False] / timings[True]))
+                self.update_mp()
+            self.print_sep()
+            for label, result in results.items():
+                self.new_curve(result, label)
+                self.meth.append(label)
+                self.results[label] = result
+        self.update_mp()
+
     def bench_gpu1d(self, devicetype="gpu", useFp64=True, platformid=None, deviceid=None):
         self.update_mp()
         print("Working on %s, in " % devicetype + ("64 bits mode" if useFp64 else"32 bits mode") + "(%s.%s)" % (platformid, deviceid))
@@ -677,7 +932,8 @@ class Bench(object):
 
 
 def run_benchmark(number=10, repeat=1, memprof=False, max_size=1000,
-                  do_1d=True, do_2d=False, devices="all"):
+                  do_1d=True, do_2d=False, devices="all", nthreads=None,
+                  do_corners=False, do_distortion=False):
     """Run the integrated benchmark using the most common algorithms (method parameter)
 
     :param number: Measure timimg over number of executions
@@ -687,6 +943,10 @@ def run_benchmark(number=10, repeat=1, memprof=False, max_size=1000,
     :param do_1d: perfrom benchmarking using integrate1d
     :param do_2d: perfrom benchmarking using integrate2d
     :devices: "all", "cpu", "gpu" or "acc" or a list of devices [(proc_id, dev_id)]
+    :param nthreads: list of number of threads for benchmarking the scaling of
+                     the CSR integrator, empty list for the default, None to skip it
+    :param do_corners: benchmark the calculation of the pixel corner positions
+    :param do_distortion: benchmark the distortion correction of a stack of frames
     """
     print("Averaging over %i repetitions (best of %s)." % (number, repeat))
     bench = Bench(number, repeat, memprof, max_size=max_size)
@@ -725,6 +985,18 @@ def run_benchmark(number=10, repeat=1, memprof=False, max_size=1000,
             bench.bench_1d("lut_ocl", True, {"platformid": device[0], "deviceid": device[1]})
             bench.bench_1d("csr_ocl", True, {"platformid": device[0], "deviceid": device[1]})
 
+    if nthreads is not None:
+        if do_1d:
+            bench.bench_threads("csr", nthreads, dim=1)
+        if do_2d:
+            bench.bench_threads("csr", nthreads, dim=2)
+
+    if do_corners:
+        bench.bench_corners()
+
+    if do_distortion:
+        bench.bench_distortion()
+
     bench.save()
     bench.print_res()
     bench.update_mp()
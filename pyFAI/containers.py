@@ -32,9 +32,11 @@ __author__ = "Valentin Valls"
 __contact__ = "valentin.valls@esrf.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "27/09/2018"
+__date__ = "18/02/2019"
 __status__ = "development"
 
+import numpy
+
 
 class IntegrateResult(tuple):
     """
@@ -49,6 +51,7 @@ class IntegrateResult(tuple):
         self._sum_normalization = None  # sum of all normalization SA, pol, ...
         self._count = None  # sum of counts, from signal/norm
         self._count2 = None  # sum of counts squared, from variance
+        self._std = None  # standard deviation of the pixels of each bin
         self._unit = None
         self._has_mask_applied = None
         self._has_dark_correction = None
@@ -150,6 +153,21 @@ class IntegrateResult(tuple):
         """
         self._count = count
 
+    @property
+    def std(self):
+        """Standard deviation of the pixels of each bin, for sigma-clipping
+
+        :rtype: numpy.ndarray
+        """
+        return self._std
+
+    def _set_std(self, std):
+        """Set the standard deviation of the pixels of each bin
+
+        :type std: numpy.ndarray
+        """
+        self._std = std
+
     @property
     def unit(self):
         """Radial unit
@@ -271,6 +289,13 @@ class IntegrateResult(tuple):
     def _set_npt_azim(self, value):
         self._npt_azim = value
 
+    def __getnewargs__(self):
+        """Arguments of `__new__` when unpickling: the content of the tuple.
+
+        The other attributes are restored from the instance dictionary.
+        """
+        return tuple(self)
+
 
 class Integrate1dResult(IntegrateResult):
     """
@@ -389,3 +414,104 @@ class Integrate2dResult(IntegrateResult):
         if len(self) == 3:
             return None
         return self[3]
+
+
+class SparseFrame(IntegrateResult):
+    """Pixels of a frame above the background, as returned by `sparsify`.
+
+    Provide a tuple access to the index of the pixels selected (in the
+    flattened frame) and their raw intensity:
+
+    .. codeblock::
+
+        index, intensity = ai.sparsify(...)
+    """
+    def __new__(self, index, intensity):
+        return IntegrateResult.__new__(SparseFrame, (index, intensity))
+
+    def __init__(self, index, intensity):
+        super(SparseFrame, self).__init__()
+        self._shape = None
+        self._radial = None
+        self._background_avg = None
+        self._background_std = None
+        self._cutoff = None
+        self._noise = None
+
+    @property
+    def index(self):
+        """
+        Index of the pixels selected in the flattened frame
+
+        :rtype: numpy.ndarray
+        """
+        return self[0]
+
+    @property
+    def intensity(self):
+        """
+        Raw intensity of the pixels selected
+
+        :rtype: numpy.ndarray
+        """
+        return self[1]
+
+    @property
+    def shape(self):
+        "Shape of the frame"
+        return self._shape
+
+    def _set_shape(self, shape):
+        self._shape = shape
+
+    @property
+    def radial(self):
+        "Radial positions of the background profile"
+        return self._radial
+
+    def _set_radial(self, radial):
+        self._radial = radial
+
+    @property
+    def background_avg(self):
+        "Mean of the background of each radial bin"
+        return self._background_avg
+
+    def _set_background_avg(self, background):
+        self._background_avg = background
+
+    @property
+    def background_std(self):
+        "Standard deviation of the background of each radial bin"
+        return self._background_std
+
+    def _set_background_std(self, std):
+        self._background_std = std
+
+    @property
+    def cutoff(self):
+        "Threshold above the background, in standard deviation"
+        return self._cutoff
+
+    def _set_cutoff(self, cutoff):
+        self._cutoff = cutoff
+
+    @property
+    def noise(self):
+        "Minimum threshold above the background, in intensity"
+        return self._noise
+
+    def _set_noise(self, noise):
+        self._noise = noise
+
+    def to_dense(self, fill=0):
+        """Rebuild the frame with only the pixels selected
+
+        :param fill: value of the other pixels
+        :return: 2D array with the shape of the frame
+        """
+        dense = numpy.zeros(int(numpy.prod(self._shape)), dtype=self.intensity.dtype)
+        if fill:
+            dense[...] = fill
+        dense[self.index] = self.intensity
+        return dense.reshape(self._shape)
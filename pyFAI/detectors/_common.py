@@ -35,7 +35,7 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "04/02/2019"
+__date__ = "18/02/2019"
 __status__ = "stable"
 
 
@@ -350,6 +350,8 @@ class Detector(with_metaclass(DetectorMeta, object)):
             self._splineFile = None
             self.spline = None
             self.uniform_pixel = True
+        # corners are calculated from the spline
+        self._pixel_corners = None
 
     splineFile = property(get_splineFile, set_splineFile)
 
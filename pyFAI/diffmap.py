@@ -33,7 +33,7 @@ __author__ = "Jerome Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "31/01/2019"
+__date__ = "18/02/2019"
 __status__ = "development"
 __docformat__ = 'restructuredtext'
 
@@ -41,12 +41,12 @@ import os
 import time
 import posixpath
 import sys
+import threading
 import collections
 import glob
 import logging
 logger = logging.getLogger(__name__)
 import numpy
-import fabio
 import json
 
 from .opencl import ocl
@@ -54,6 +54,9 @@ from .units import to_unit
 from .third_party import six
 from . import version as PyFAI_VERSION, date as PyFAI_DATE, load
 from .io import Nexus, get_isotime
+from .io.sources import open_source
+from .io.journal import Journal
+from .utils import parallel
 from argparse import ArgumentParser
 urlparse = six.moves.urllib.parse.urlparse
 
@@ -61,6 +64,152 @@ DIGITS = [str(i) for i in range(10)]
 Position = collections.namedtuple('Position', 'index, rot, trans')
 
 
+class _MapWriter(object):
+    """Writer of the integrated patterns into the map dataset
+
+    Patterns may arrive in any order, they are gathered per row of the map,
+    which is a chunk of the dataset, and each row is written at once when it
+    is complete (or when the writer is flushed). The positions written are
+    marked in the `filled` dataset and recorded in the journal, if any, to be
+    able to resume the processing.
+    """
+
+    def __init__(self, dataset, filled=None, journal=None):
+        """
+        :param dataset: HDF5 dataset of shape (slow, fast, npt_rad)
+        :param filled: HDF5 dataset of shape (slow, fast) marking the processed positions
+        :param Journal journal: journal of the processing, if any
+        """
+        self.dataset = dataset
+        self.filled = filled
+        self.journal = journal
+        self.output = "%s::%s" % (dataset.file.filename, dataset.name)
+        self._rows = {}  # rot: (patterns, mask)
+        self._sources = {}  # rot: list of (input filename, frame, index in the map)
+
+    def write(self, pos, intensity, source=None):
+        """Store the pattern of a position
+
+        :param Position pos: position in the map
+        :param intensity: integrated pattern
+        :param source: 2-tuple (filename, index of the frame) of the input
+        """
+        shape = self.dataset.shape
+        if pos.rot + 1 > shape[0]:
+            self.dataset.resize((pos.rot + 1,) + shape[1:])
+            if self.filled is not None:
+                self.filled.resize((pos.rot + 1, shape[1]))
+        row = self._rows.get(pos.rot)
+        if row is None:
+            row = (numpy.zeros(shape[1:], dtype=self.dataset.dtype),
+                   numpy.zeros(shape[1], dtype=bool))
+            self._rows[pos.rot] = row
+        row[0][pos.trans] = intensity
+        row[1][pos.trans] = True
+        if source is not None:
+            self._sources.setdefault(pos.rot, []).append(source + (pos.index,))
+        if row[1].all():
+            self._write_row(pos.rot)
+
+    def _write_row(self, rot):
+        patterns, mask = self._rows.pop(rot)
+        if not mask.all():
+            # partial row: keep the positions already in the file
+            current = self.dataset[rot]
+            current[mask] = patterns[mask]
+            patterns = current
+        self.dataset[rot] = patterns
+        if self.filled is not None:
+            filled = self.filled[rot]
+            filled[mask] = 1
+            self.filled[rot] = filled
+        self.dataset.file.flush()
+        sources = self._sources.pop(rot, None)
+        if sources and (self.journal is not None):
+            self.journal.record_many([(filename, iframe, self.output, index)
+                                      for filename, iframe, index in sources])
+
+    def flush(self):
+        """Write all pending rows, even incomplete"""
+        for rot in sorted(self._rows):
+            self._write_row(rot)
+
+
+class _FrameIntegrator(object):
+    """Integration of the frames of a map, shared with the workers of the
+    pool: only the azimuthal integrator and the integration parameters, not
+    the output file.
+    """
+
+    def __init__(self, ai, npt_rad, method, unit):
+        """
+        :param ai: configured azimuthal integrator
+        :param npt_rad: number of points in diffraction pattern
+        :param method: integration method
+        :param unit: radial unit
+        """
+        self.ai = ai
+        self.npt_rad = npt_rad
+        self.method = method
+        self.unit = unit
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def parameters(self):
+        return (self.ai, self.npt_rad, self.method, self.unit)
+
+    def integrate_frame(self, frame):
+        """Integrate a frame
+
+        :param frame: 2d numpy array with an image to process
+        :return: integrated intensity
+        """
+        _tth, I = self.ai.integrate1d(frame, self.npt_rad, safe=False,
+                                      method=self.method, unit=self.unit)
+        return I
+
+    def read_frame(self, filename, iframe):
+        """Read a frame, keeping the last input file open in each thread
+
+        :param filename: name of the input file
+        :param iframe: index of the frame in the file
+        :return: 2d numpy array
+        """
+        local = self._local
+        if getattr(local, "filename", None) != filename:
+            if getattr(local, "source", None) is not None:
+                local.source.close()
+            local.source = open_source(filename)
+            local.filename = filename
+        return local.source.getframe(iframe).data
+
+
+def _process_job(description, integrator=None):
+    """Integrate a frame in a worker of the pool
+
+    :param description: 3-tuple (position, filename, index of the frame)
+    :param integrator: object with `read_frame` and `integrate_frame` methods
+        (DiffMap or _FrameIntegrator), by default the one of the pool
+    :return: position, input (filename, index of the frame), pattern and processing time
+    """
+    if integrator is None:
+        integrator = parallel.get_context()
+    pos, filename, iframe = description
+    t = time.time()
+    data = integrator.read_frame(filename, iframe)
+    intensity = integrator.integrate_frame(data)
+    return pos, (filename, iframe), intensity, time.time() - t
+
+
 class DiffMap(object):
     """
     Basic class for diffraction mapping experiment using pyFAI
@@ -98,6 +247,14 @@ class DiffMap(object):
         self.processed_file = []
         self.nxs = None
         self.experiment_title = "Diffraction Mapping"
+        self.filled = None
+        self.resume = False
+        self.journal = None
+        self._journal = None
+        self.njobs = 0
+        self.nthreads = 0
+        self.start_method = None
+        self._frame_integrator = None
 
     def __repr__(self):
         return "%s experiment with ntp_slow: %s ntp_fast: %s, npt_diff: %s" % \
@@ -190,6 +347,15 @@ If the number of files is too large, use double quotes like "*.edf" """
                             help="process using OpenCL on GPU ", default=False)
         parser.add_argument("-S", "--stats", dest="stats", action="store_true",
                             help="show statistics at the end", default=False)
+        parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=0,
+                            help="number of processes integrating frames in parallel, default: none")
+        parser.add_argument("--threads", dest="threads", type=int, default=0,
+                            help="number of threads integrating frames in parallel, default: none")
+        parser.add_argument("--resume", dest="resume", action="store_true", default=False,
+                            help="resume a processing: positions already in the output file are skipped")
+        parser.add_argument("--journal", dest="journal", metavar="FILE", default=None,
+                            help="journal recording the frames processed: if it exists, "
+                                 "the processing is resumed where it stopped")
         parser.add_argument("--gui", dest="gui", action="store_true",
                             help="Use the Graphical User Interface", default=True)
         parser.add_argument("--no-gui", dest="gui", action="store_false",
@@ -279,6 +445,10 @@ If the number of files is too large, use double quotes like "*.edf" """
         else:
             self.offset = 0
         self.stats = options.stats
+        self.njobs = options.jobs
+        self.nthreads = options.threads
+        self.resume = options.resume
+        self.journal = options.journal
 
         if with_config:
             if "do_2D" not in config["ai"]:
@@ -313,6 +483,9 @@ If the number of files is too large, use double quotes like "*.edf" """
         spath = self.hdf5path.split("/")
         assert len(spath) > 2
         nxs = Nexus(self.hdf5, mode="w")
+        resume = self.resume or ((self._journal is not None) and len(self._journal) > 0)
+        if resume and self._resume_from(nxs, spath):
+            return
         entry = nxs.new_entry(entry=spath[0], program_name="pyFAI", title="diffmap")
         grp = entry
         for subgrp in spath[1:-2]:
@@ -360,8 +533,43 @@ If the number of files is too large, use double quotes like "*.edf" """
             self.dataset.attrs["axes"] = str(self.unit).split("_")[0]
             self.dataset.attrs["creator"] = "pyFAI"
             self.dataset.attrs["long_name"] = str(self)
+        if "filled" in self.group:
+            self.filled = self.group["filled"]
+        else:
+            self.filled = self.group.create_dataset(name="filled",
+                                                    shape=(self.npt_slow, self.npt_fast),
+                                                    dtype="uint8",
+                                                    chunks=(1, self.npt_fast),
+                                                    maxshape=(None, None))
+            self.filled.attrs["long_name"] = "Positions already processed"
         self.nxs = nxs
 
+    def _resume_from(self, nxs, spath):
+        """Re-use the map of the latest entry of the output file
+
+        :param nxs: Nexus file opened for writing
+        :param spath: hdf5path split on "/"
+        :return: True if a map was found to resume the processing
+        """
+        name = "/".join(spath[1:])
+        for entry in nxs.get_entries():
+            if posixpath.basename(entry.name).startswith(spath[0]) and name in entry:
+                self.dataset = entry[name]
+                self.group = self.dataset.parent
+                if "filled" in self.group:
+                    self.filled = self.group["filled"]
+                    done = int(numpy.count_nonzero(self.filled[()]))
+                else:
+                    logger.warning("No processed positions recorded in %s: processing all frames", entry.name)
+                    self.filled = None
+                    done = 0
+                logger.info("Resuming processing of %s: %s positions already processed",
+                            self.dataset.name, done)
+                self.nxs = nxs
+                return True
+        logger.warning("No map to resume in %s: starting a new processing", self.hdf5)
+        return False
+
     def setup_ai(self):
         print("Setup of Azimuthal integrator ...")
         if self.poni:
@@ -390,8 +598,8 @@ If the number of files is too large, use double quotes like "*.edf" """
             # shape of detector undefined: reading the first image to guess it
             shape = self.ai.detector.shape
         else:
-            fimg = fabio.open(self.inputfiles[0])
-            shape = fimg.data.shape
+            with open_source(self.inputfiles[0]) as source:
+                shape = source.getframe(0).data.shape
         data = numpy.empty(shape, dtype=numpy.float32)
         print("Initialization of the Azimuthal Integrator using method %s" % (self.method, ))
         # enforce initialization of azimuthal integrator
@@ -454,15 +662,12 @@ If the number of files is too large, use double quotes like "*.edf" """
             self.makeHDF5()
 
         t = time.time()
-        fimg = fabio.open(filename)
-        self.process_one_frame(fimg.data)
-        if fimg.nframes > 1:
-            for i in range(fimg.nframes - 1):
-                fimg = fimg.next()
+        with open_source(filename) as source:
+            for fimg in source:
                 self.process_one_frame(fimg.data)
         t -= time.time()
         print("Processing %30s took %6.1fms (%i frames)" %
-              (os.path.basename(filename), -1000.0 * t, fimg.nframes))
+              (os.path.basename(filename), -1000.0 * t, source.nframes))
         self.timing.append(-t)
         self.processed_file.append(filename)
 
@@ -475,26 +680,133 @@ If the number of files is too large, use double quotes like "*.edf" """
         shape = self.dataset.shape
         if pos.rot + 1 > shape[0]:
             self.dataset.resize((pos.rot + 1, shape[1], shape[2]))
+            if self.filled is not None:
+                self.filled.resize((pos.rot + 1, shape[1]))
         elif pos.index < 0 or pos.rot < 0 or pos.trans < 0:
             return
+        elif self.resume and (self.filled is not None) and self.filled[pos.rot, pos.trans]:
+            return
 
-        _tth, I = self.ai.integrate1d(frame, self.npt_rad, safe=False,
-                                      method=self.method, unit=self.unit)
-        self.dataset[pos.rot, pos.trans, :] = I
+        self.dataset[pos.rot, pos.trans, :] = self.integrate_frame(frame)
+        if self.filled is not None:
+            self.filled[pos.rot, pos.trans] = 1
+
+    def get_frame_integrator(self):
+        """Part of the map needed to integrate frames, given to the workers
+
+        :return: _FrameIntegrator with the current integration parameters
+        """
+        parameters = (self.ai, self.npt_rad, self.method, self.unit)
+        if (self._frame_integrator is None) or (self._frame_integrator.parameters != parameters):
+            self._frame_integrator = _FrameIntegrator(*parameters)
+        return self._frame_integrator
+
+    def integrate_frame(self, frame):
+        """Integrate a frame with the azimuthal integrator of the map
+
+        :param frame: 2d numpy array with an image to process
+        :return: integrated intensity
+        """
+        return self.get_frame_integrator().integrate_frame(frame)
+
+    def read_frame(self, filename, iframe):
+        """Read a frame, keeping the last input file open in each thread
+
+        :param filename: name of the input file
+        :param iframe: index of the frame in the file
+        :return: 2d numpy array
+        """
+        return self.get_frame_integrator().read_frame(filename, iframe)
+
+    def iter_frames(self):
+        """Iterate over the frames to process.
+
+        Frames before the offset, positions already processed (when
+        resuming) and frames recorded in the journal are skipped.
+
+        :return: iterator over 3-tuple (position, filename, index of the frame in the file)
+        """
+        done = None
+        if (self.filled is not None) and self.resume:
+            done = self.filled[()].astype(bool)
+        idx = -1
+        for filename in self.inputfiles:
+            with open_source(filename) as source:
+                nframes = source.nframes
+            for iframe in range(nframes):
+                idx += 1
+                pos = self.get_pos(None, idx)
+                if pos.index < 0 or pos.rot < 0 or pos.trans < 0:
+                    continue
+                if (done is not None) and (pos.rot < done.shape[0]) and done[pos.rot, pos.trans]:
+                    continue
+                if (self._journal is not None) and self._journal.is_done(filename, iframe):
+                    continue
+                yield pos, filename, iframe
+        self._idx = idx
 
     def process(self):
+        """Process all input files.
+
+        With `njobs` (processes, created with `start_method`, see
+        `pyFAI.utils.parallel`) or `nthreads` (threads), frames are integrated
+        in parallel and written as they complete, in any order. Otherwise
+        frames are integrated one after the other. In both cases, patterns are
+        written one row of the map (i.e. one chunk) at a time.
+        When `resume` is set, positions already processed are skipped.
+        When `journal` is set, the frames processed are recorded in this file
+        and a processing interrupted is resumed where it stopped.
+        """
+        if self.journal is not None:
+            config = {"hdf5": os.path.abspath(self.hdf5), "hdf5path": self.hdf5path,
+                      "inputfiles": self.inputfiles, "offset": self.offset,
+                      "shape": [self.npt_slow, self.npt_fast, self.npt_rad],
+                      "method": self.method, "unit": str(self.unit)}
+            self._journal = Journal(self.journal, config=config)
+        try:
+            self._process()
+        finally:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def _process(self):
         if self.dataset is None:
             self.makeHDF5()
         self.init_ai()
         t0 = time.time()
-        # self._idx = -1
-        for f in self.inputfiles:
-            self.process_one_file(f)
+        cnt = 0
+        writer = _MapWriter(self.dataset, self.filled, self._journal)
+        frames = self.iter_frames()
+        njobs = self.njobs
+        nworkers = njobs or self.nthreads
+        try:
+            if nworkers:
+                start_method = self.start_method if njobs else parallel.THREAD
+                pool = parallel.create_pool(nworkers, self.get_frame_integrator(), start_method)
+                try:
+                    for pos, source, intensity, timing in pool.imap_unordered(_process_job, frames, chunksize=4):
+                        writer.write(pos, intensity, source)
+                        self.timing.append(timing)
+                        cnt += 1
+                    pool.close()
+                except BaseException:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+            else:
+                for description in frames:
+                    pos, source, intensity, timing = _process_job(description, self)
+                    writer.write(pos, intensity, source)
+                    self.timing.append(timing)
+                    cnt += 1
+        finally:
+            writer.flush()
         tot = time.time() - t0
-        cnt = self._idx + 1
         print(("Execution time for %i frames: %.3fs;"
                " Average execution time: %.1fms") %
-              (cnt, tot, 1000. * tot / cnt))
+              (cnt, tot, 1000. * tot / max(cnt, 1)))
         self.nxs.close()
 
     def get_use_gpu(self):
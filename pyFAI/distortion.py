@@ -30,16 +30,19 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "03/12/2018"
+__date__ = "18/02/2019"
 __status__ = "development"
 
 import logging
 import threading
 import os
+import hashlib
 import numpy
 logger = logging.getLogger(__name__)
 from math import ceil, floor
 from . import detectors
+from .utils import crc32
+from .engines.sparse_cache import SparseCache, get_default_cache
 from .opencl import ocl
 if ocl:
     from .opencl import azim_lut as ocl_azim_lut
@@ -69,6 +72,52 @@ else:
         linalg = None
 
 
+_spline_checksums = {}  # key: (path, mtime, size) of a spline file, value: checksum
+
+
+def get_distortion_checksum(detector):
+    """Checksum describing the distortion of a detector
+
+    The distortion is described by the content of the spline file when there
+    is one, else by the position of the pixel corners. The checksum of a
+    spline file is only calculated again when the file changes.
+
+    :param detector: pyFAI.detectors.Detector instance
+    :return: sha1 of the spline file as a string, or crc32 of the corners
+    """
+    spline = detector.splineFile
+    if spline:
+        stat = os.stat(spline)
+        key = (os.path.abspath(spline), stat.st_mtime, stat.st_size)
+        checksum = _spline_checksums.get(key)
+        if checksum is None:
+            with open(spline, "rb") as f:
+                checksum = _spline_checksums[key] = hashlib.sha1(f.read()).hexdigest()
+        return checksum
+    return crc32(numpy.ascontiguousarray(detector.get_pixel_corners()))
+
+
+class _CorrectionMatrix(object):
+    """Sparse matrix of a distortion correction, as stored in the sparse cache
+
+    Holds the CSR arrays (`data`, `indices`, `indptr`) or the look-up table
+    (`_lut`) with the attributes describing the output image.
+    """
+
+    def __init__(self, distortion):
+        if distortion.method == "lut":
+            self._lut = distortion.lut
+        else:
+            self.data, self.indices, self.indptr = distortion.lut
+            self.lut = distortion.lut
+        self.method = distortion.method
+        self.shape_out = tuple(distortion._shape_out)
+        self.offset1 = distortion.offset1
+        self.offset2 = distortion.offset2
+        self.delta1 = distortion.delta1
+        self.delta2 = distortion.delta2
+
+
 class Distortion(object):
     """
     This class applies a distortion correction on an image.
@@ -76,7 +125,7 @@ class Distortion(object):
     New version compatible both with CSR and LUT...
     """
     def __init__(self, detector="detector", shape=None, resize=False, empty=0,
-                 mask=None, method="CSR", device=None, workgroup=8):
+                 mask=None, method="CSR", device=None, workgroup=8, cache=None):
         """
         :param detector: detector instance or detector name
         :param shape: shape of the output image
@@ -85,6 +134,9 @@ class Distortion(object):
         :param method: "lut" or "csr", the former is faster
         :param device: Name of the device: None for OpenMP, "cpu" or "gpu" or the id of the OpenCL device a 2-tuple of integer
         :param workgroup: workgroup size for CSR on OpenCL
+        :param cache: SparseCache instance or directory name where correction
+                      matrices are stored, by default the one defined by the
+                      PYFAI_SPARSE_CACHE environment variable
         """
         self._shape_out = None
         if isinstance(detector, six.string_types):
@@ -104,6 +156,7 @@ class Distortion(object):
                 self._shape_out = self.detector.shape
             else:
                 raise RuntimeError("You need to provide either the detector or its shape")
+        self._shape_requested = self._shape_out  # part of the key in the sparse cache
 
         self._sem = threading.Semaphore()
         self.bin_size = None
@@ -123,6 +176,10 @@ class Distortion(object):
             self.workgroup = 8
         else:
             self.workgroup = int(workgroup)
+        if cache is None:
+            self.sparse_cache = get_default_cache()
+        else:
+            self.set_sparse_cache(cache)
 
     def __repr__(self):
         return os.linesep.join(["Distortion correction %s on device %s for detector shape %s:" % (self.method, self.device, self._shape_out),
@@ -236,9 +293,10 @@ class Distortion(object):
     def calc_init(self):
         """Initialize all arrays
         """
-        self.calc_pos()
-        self.calc_size()
-        self.calc_LUT()
+        if not self._load_cache():
+            self.calc_pos()
+            self.calc_size()
+            self.calc_LUT()
         if ocl and self.device is not None:
             if "lower" in dir(self.device):
                 self.device = self.device.lower()
@@ -268,6 +326,8 @@ class Distortion(object):
 
         :return: look up table either in CSR or LUT format depending on serl.method
         """
+        if self.lut is None and use_common and self._load_cache():
+            return self.lut
         if self.pos is None:
             self.calc_pos()
 
@@ -328,8 +388,84 @@ class Distortion(object):
                                 idx += 1
                         lut.shape = (self._shape_out[0] * self._shape_out[1]), self.max_size
                         self.lut = lut
+                    if use_common and _distortion:
+                        self._save_cache()
         return self.lut
 
+    def set_sparse_cache(self, cache=None):
+        """Configure the persistent storage of the correction matrix
+
+        With a cache, the sparse matrix is stored on disk the first time it
+        is calculated and memory-mapped by all later instances with the same
+        detector (spline file content or pixel corners), shapes, mask and
+        method, which makes the initialization almost instantaneous.
+
+        :param cache: SparseCache instance or directory name, None to disable it
+        """
+        if isinstance(cache, six.string_types):
+            cache = SparseCache(cache)
+        self.sparse_cache = cache
+
+    def _get_cache_key(self):
+        """Key of the correction matrix in the sparse cache
+
+        The distortion is described by the content of the spline file when
+        there is one, else by the position of the pixel corners.
+
+        :return: key as a string
+        """
+        detector = self.detector
+        config = dict(detector.get_config())
+        config.pop("splineFile", None)
+        distortion = get_distortion_checksum(detector)
+        return self.sparse_cache.get_key(algo="distortion",
+                                         method=self.method,
+                                         detector=detector.__class__.__name__,
+                                         config=config,
+                                         binning=tuple(detector.binning),
+                                         distortion=distortion,
+                                         shape_in=tuple(self.shape_in),
+                                         shape_out=self._shape_requested,
+                                         resize=self.resize,
+                                         mask=crc32(self.mask) if self.mask is not None else None)
+
+    def _load_cache(self):
+        """Retrieve the correction matrix from the sparse cache
+
+        :return: True if the matrix was found in the cache
+        """
+        if (self.sparse_cache is None) or (_distortion is None):
+            return False
+        try:
+            key = self._get_cache_key()
+        except (IOError, OSError) as err:
+            logger.warning("Unable to describe the distortion for the sparse cache: %s", err)
+            return False
+        matrix = self.sparse_cache.load(key)
+        if matrix is None:
+            return False
+        with self._sem:
+            if matrix.method == "lut":
+                self.lut = matrix._lut
+            else:
+                self.lut = matrix.lut
+            self._shape_out = tuple(matrix.shape_out)
+            self.offset1, self.offset2 = matrix.offset1, matrix.offset2
+            self.delta1, self.delta2 = matrix.delta1, matrix.delta2
+        logger.debug("Distortion correction matrix loaded from sparse cache")
+        return True
+
+    def _save_cache(self):
+        """Store the correction matrix in the sparse cache"""
+        if self.sparse_cache is None:
+            return
+        try:
+            key = self._get_cache_key()
+        except (IOError, OSError) as err:
+            logger.warning("Unable to describe the distortion for the sparse cache: %s", err)
+            return
+        self.sparse_cache.save(key, _CorrectionMatrix(self))
+
     def correct(self, image, dummy=None, delta_dummy=None):
         """
         Correct an image based on the look-up table calculated ...
@@ -405,6 +541,42 @@ class Distortion(object):
             raise
         return out
 
+    def correct_stack(self, stack, dummy=None, delta_dummy=None, out=None, nthread=0):
+        """
+        Correct a stack of images with the same look-up table, in a single call
+
+        With the Cython implementation, each row of the look-up table is read
+        once for all frames and output pixels are processed in parallel.
+        Other implementations (OpenCL, numpy) correct frames one by one.
+
+        :param stack: 3D-array with the images (nframes, shape_in0, shape_in1)
+        :param dummy: value suggested for bad pixels
+        :param delta_dummy: precision of the dummy value
+        :param out: output buffer to be re-used, float32 array of shape
+                    (nframes, shape_out0, shape_out1)
+        :param nthread: number of OpenMP threads, 0 for the default
+        :return: corrected stack of images, i.e. out if provided
+        """
+        stack = numpy.asarray(stack)
+        assert stack.ndim == 3, "stack is a 3D array"
+        if self.device or (_distortion is None):
+            if out is None:
+                out = numpy.empty((len(stack),) + tuple(self.shape_out), dtype=numpy.float32)
+            for frame, image in zip(out, stack):
+                frame[...] = self.correct(image, dummy, delta_dummy)
+            return out
+        if self.lut is None:
+            self.calc_LUT()
+        if tuple(stack.shape[1:]) != tuple(self.shape_in):
+            stack = numpy.array([_distortion.resize_image_2D(image, self.shape_in) for image in stack])
+        if self.method == "lut":
+            correct = _distortion.correct_LUT_stack
+        else:
+            correct = _distortion.correct_CSR_stack
+        return correct(stack, self._shape_out, self.lut,
+                       dummy=dummy or self.empty, delta_dummy=delta_dummy,
+                       out=out, nthread=nthread)
+
     def uncorrect(self, image, use_cython=False):
         """
         Take an image which has been corrected and transform it into it's raw (with loss of information)
@@ -21,6 +21,13 @@
 
 
 """CSR rebinning engine implemented in pure python (with bits of scipy !) 
+
+The matrix can optionally be stored in a compact form (see :class:`CompactCSR`)
+which halves the memory footprint of the indices and drops the coefficients
+when they are all equal to one (no pixel splitting).
+
+:class:`DistortionCSRIntegrator` composes the distortion correction of a
+detector with the integration matrix to integrate raw frames in a single pass.
 """
 
 from __future__ import absolute_import, print_function, with_statement
@@ -29,13 +36,13 @@ __author__ = "Jerome Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "30/11/2018"
+__date__ = "18/02/2019"
 __status__ = "development"
 
 import logging
 logger = logging.getLogger(__name__)
 import numpy
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, diags
 from .preproc import preproc as preproc_np
 try:
     from ..ext.preproc import preproc as preproc_cy
@@ -45,6 +52,12 @@ except ImportError as err:
 else:
     preproc = preproc_cy
 
+try:
+    from ..ext import sparse_utils
+except ImportError as err:
+    logger.warning("ImportError pyFAI.ext.sparse_utils %s", err)
+    sparse_utils = None
+
 from collections import namedtuple
 
 Integrate1dResult = namedtuple("Integrate1dResult", ["bins", "signal", "propagated"])
@@ -53,13 +66,89 @@ Integrate1dWithErrorResult = namedtuple("Integrate1dWithErrorResult", ["bins", "
 Integrate2dWithErrorResult = namedtuple("Integrate2dWithErrorResult", ["signal", "error", "bins0", "bins1", "propagated"])
 
 
+class CompactCSR(object):
+    """Compact storage of a CSR matrix, with 16-bit column indices.
+
+    Within a row, the column index of each element is stored as the
+    difference with the previous one (as uint16), the first one being
+    relative to `row_start`. Larger gaps are encoded with escape values
+    (65535) which do not contribute. Coefficients are float32 and are not
+    stored at all when they are all equal to one, which is the case of
+    histogram-like (no pixel splitting) integrators.
+
+    Only the multiplication with a (set of) vector(s) is provided, which is
+    performed directly on the compact representation.
+    """
+
+    def __init__(self, data, indices, indptr, shape=None):
+        """Constructor
+
+        :param data: the non zero values NZV
+        :param indices: the column number of the NZV
+        :param indptr: the index of the start of line
+        :param shape: shape of the matrix, by default deduced from indices
+        """
+        if sparse_utils is None:
+            raise RuntimeError("Compact CSR matrices need the pyFAI.ext.sparse_utils extension")
+        indices = numpy.asarray(indices)
+        indptr = numpy.asarray(indptr)
+        if data is not None:
+            data = numpy.asarray(data, dtype=numpy.float32)
+            if numpy.all(data == 1.0):
+                data = None
+        if shape is None:
+            shape = (len(indptr) - 1, int(indices.max()) + 1 if indices.size else 0)
+        self.shape = tuple(shape)
+        self.nnz = int(indptr[-1])
+        try:
+            # The arrays of the caller are encoded as is, without any copy
+            compact = sparse_utils.CSR_to_compact(data, indices, indptr)
+        except ValueError:
+            # unsorted indices: sort a copy, arrays of the caller are left untouched
+            matrix = csr_matrix((numpy.ones(len(indices), dtype=numpy.float32) if data is None else data,
+                                 indices, indptr), shape=self.shape).sorted_indices()
+            compact = sparse_utils.CSR_to_compact(None if data is None else matrix.data,
+                                                  matrix.indices, matrix.indptr)
+        self.data, self.deltas, self.row_start, self.indptr = compact
+
+    def __repr__(self):
+        return "CompactCSR %s with %i elements: %.3fMB" % (self.shape, self.nnz, self.nbytes / 1e6)
+
+    @property
+    def nbytes(self):
+        "Memory footprint of the matrix"
+        return sum(i.nbytes for i in (self.data, self.deltas, self.row_start, self.indptr)
+                   if i is not None)
+
+    def dot(self, vector, nthread=0):
+        """Multiplication of the matrix with a vector or a set of vectors
+
+        :param vector: array of shape (ncol,) or (ncol, nvec)
+        :param nthread: number of OpenMP threads, 0 for the default
+        :return: array of shape (nrow,) or (nrow, nvec), in float64
+        """
+        assert vector.shape[0] == self.shape[1], "vector size"
+        return sparse_utils.compact_dot(vector, self.data, self.deltas,
+                                        self.row_start, self.indptr, nthread)
+
+    def tocsr(self):
+        """Expand the matrix in the classical scipy representation
+
+        :return: scipy.sparse.csr_matrix
+        """
+        data, indices, indptr = sparse_utils.compact_to_CSR(self.data, self.deltas,
+                                                            self.row_start, self.indptr)
+        return csr_matrix((data, indices, indptr), shape=self.shape)
+
+
 class CSRIntegrator(object):
     def __init__(self,
                  size,
                  data=None,
                  indices=None,
                  indptr=None,
-                 empty=0.0):
+                 empty=0.0,
+                 compact=False):
         """Constructor of the abstract class
         
         :param size: input image size        
@@ -67,30 +156,46 @@ class CSRIntegrator(object):
         :param indices: indices of the CSR matrix
         :param indptr: indices of the start of line in the CSR matrix
         :param empty: value for empty pixels
+        :param compact: store the matrix as :class:`CompactCSR` to save memory
         """
         self.size = size
         self.empty = empty
+        self.compact = compact
         self.bins = None
         self._csr = None
         self.lut_size = 0  # actually nnz
         self.data = None
         self.indices = None
         self.indptr = None
+        self.deltas = None
+        self.row_start = None
         if (data is not None) and (indices is not None) and (indptr is not None):
             self.set_matrix(data, indices, indptr)
 
     def set_matrix(self, data, indices, indptr):
         """Actually set the CSR sparse matrix content
-        
+
+        With the compact storage, the original arrays are not kept: `data`,
+        `deltas`, `row_start` and `indptr` describe the compact matrix and
+        `indices` is None.
+
         :param data: the non zero values NZV
         :param indices: the column number of the NZV
         :param indptr: the index of the start of line"""
-        self.data = data
-        self.indices = indices
-        self.indptr = indptr
         self.lut_size = len(indices)
-        self._csr = csr_matrix((data, indices, indptr))
         self.bins = len(indptr) - 1
+        if self.compact:
+            self._csr = CompactCSR(data, indices, indptr, shape=(self.bins, self.size))
+            self.data = self._csr.data
+            self.indices = None
+            self.indptr = self._csr.indptr
+            self.deltas = self._csr.deltas
+            self.row_start = self._csr.row_start
+        else:
+            self.data = data
+            self.indices = indices
+            self.indptr = indptr
+            self._csr = csr_matrix((data, indices, indptr))
 
     def integrate(self,
                   signal,
@@ -148,6 +253,7 @@ class CsrIntegrator1d(CSRIntegrator):
                  indptr=None,
                  empty=0.0,
                  bin_centers=None,
+                 compact=False
                  ):
         """Constructor of the abstract class for 1D integration
         
@@ -156,12 +262,13 @@ class CsrIntegrator1d(CSRIntegrator):
         :param indptr: indices of the start of line in the CSR matrix
         :param empty: value for empty pixels
         :param bin_center: position of the bin center
+        :param compact: store the matrix as :class:`CompactCSR` to save memory
         
         Nota: bins are deduced from bin_centers 
 
         """
         self.bin_centers = bin_centers
-        CSRIntegrator.__init__(self, size, data, indices, indptr, empty)
+        CSRIntegrator.__init__(self, size, data, indices, indptr, empty, compact)
 
     def set_matrix(self, data, indices, indptr):
         """Actually set the CSR sparse matrix content
@@ -236,7 +343,8 @@ class CsrIntegrator2d(CSRIntegrator):
                  indptr=None,
                  empty=0.0,
                  bin_centers0=None,
-                 bin_centers1=None):
+                 bin_centers1=None,
+                 compact=False):
         """Constructor of the abstract class for 2D integration
         
         :param size: input image size
@@ -245,13 +353,14 @@ class CsrIntegrator2d(CSRIntegrator):
         :param indptr: indices of the start of line in the CSR matrix
         :param empty: value for empty pixels
         :param bin_center: position of the bin center
+        :param compact: store the matrix as :class:`CompactCSR` to save memory
 
         Nota: bins are deduced from bin_centers0, bin_centers1 
     
         """
         self.bin_centers0 = bin_centers0
         self.bin_centers1 = bin_centers1
-        CSRIntegrator.__init__(self, size, data, indices, indptr, empty)
+        CSRIntegrator.__init__(self, size, data, indices, indptr, empty, compact)
 
     def set_matrix(self, data, indices, indptr):
         """Actually set the CSR sparse matrix content
@@ -319,3 +428,116 @@ class CsrIntegrator2d(CSRIntegrator):
                                        self.bin_centers1,
                                        trans)
         return result
+
+
+class DistortionCSRIntegrator(object):
+    """Resampled integration of the raw frames of a distorted detector.
+
+    The distortion correction (corrected pixels x raw pixels) is composed
+    with the integration of the corrected image (bins x corrected pixels)
+    into a single sparse matrix (bins x raw pixels): frames are integrated in
+    one pass over the raw pixels, without intermediate corrected image. The
+    result is the one of the integration of the resampled (corrected) image,
+    not of the raw pixels at their actual position.
+
+    Normalization (solid-angle, polarization ...) is defined on the corrected
+    pixels and is folded into a second matrix with the same layout. Corrected
+    pixels without any contribution from raw pixels are ignored.
+    """
+
+    def __init__(self, integration, distortion, normalization=None,
+                 bin_centers=None, bin_centers1=None, empty=0.0):
+        """Constructor
+
+        :param integration: scipy.sparse.csr_matrix integrating the corrected
+                            image, of shape (nbins, corrected size)
+        :param distortion: scipy.sparse.csr_matrix correcting the raw image,
+                           of shape (corrected size, raw size)
+        :param normalization: normalization of the corrected pixels, or None
+        :param bin_centers: position of the (radial) bin centers
+        :param bin_centers1: position of the azimuthal bin centers, in 2D
+        :param empty: value for empty bins
+        """
+        assert integration.shape[1] == distortion.shape[0], "matrices are compatible"
+        self.size = distortion.shape[1]
+        self.bin_centers = bin_centers
+        self.bin_centers1 = bin_centers1
+        if bin_centers1 is None:
+            self.bins = integration.shape[0]
+        else:
+            self.bins = (len(bin_centers), len(bin_centers1))
+        self.empty = empty
+        coverage = numpy.asarray(distortion.sum(axis=1), dtype=numpy.float64).ravel()
+        valid = coverage > 0
+        scale = numpy.zeros(coverage.size, dtype=numpy.float64)
+        scale[valid] = 1.0 / coverage[valid]
+        integration = csr_matrix(integration, dtype=numpy.float64)
+        distortion = csr_matrix(distortion, dtype=numpy.float64)
+        self.signal = integration.dot(distortion).tocsr()
+        self.count = integration.dot(diags(scale)).dot(distortion).tocsr()
+        if normalization is not None:
+            scale *= numpy.asarray(normalization, dtype=numpy.float64).ravel()
+        self.normalization = integration.dot(diags(scale)).dot(distortion).tocsr()
+        self._variance = None
+
+    def __repr__(self):
+        return "DistortionCSRIntegrator %s bins on %i pixels: %.3fMB" % \
+            (self.bins, self.size, self.nbytes / 1e6)
+
+    @property
+    def nbytes(self):
+        "Memory footprint of the matrices"
+        return sum(matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+                   for matrix in (self.signal, self.normalization, self.count, self._variance)
+                   if matrix is not None)
+
+    def integrate(self, signal, variance=None, dummy=None, delta_dummy=None,
+                  dark=None, flat=None, mask=None, normalization_factor=1.0):
+        """Integrate a raw frame, i.e. before distortion correction
+
+        :param signal: raw image
+        :param variance: variance of the raw image, if any
+        :param dummy: value for dead pixels (optional)
+        :param delta_dummy: precision for dead-pixel value in dynamic masking
+        :param dark: dark-current of the raw image to be subtracted (if any)
+        :param flat: flat-field of the raw image to be divided by (if any)
+        :param mask: raw pixels to be discarded (non zero), if any
+        :param normalization_factor: multiplies the normalization of every pixel
+        :return: sum of signal, sum of variance, sum of normalization and count,
+                 shaped like the bins, i.e. (radial, azimuthal) in 2D
+        :rtype: 4-tuple of ndarrays
+        """
+        assert signal.size == self.size, "signal size"
+        signal = numpy.array(signal, dtype=numpy.float64).ravel()
+        valid = numpy.isfinite(signal)
+        if dummy is not None:
+            if delta_dummy:
+                valid &= abs(signal - dummy) > delta_dummy
+            else:
+                valid &= signal != dummy
+        if mask is not None:
+            valid &= numpy.logical_not(numpy.asarray(mask).ravel())
+        if dark is not None:
+            signal -= numpy.asarray(dark, dtype=numpy.float64).ravel()
+        weight = valid.astype(numpy.float64)
+        if flat is not None:
+            weight *= numpy.asarray(flat, dtype=numpy.float64).ravel()
+        signal[~valid] = 0.0
+
+        sum_signal = self.signal.dot(signal)
+        sum_normalization = self.normalization.dot(weight) * normalization_factor
+        count = self.count.dot(valid.astype(numpy.float64))
+        if variance is None:
+            sum_variance = None
+        else:
+            if self._variance is None:
+                self._variance = self.signal.multiply(self.signal).tocsr()
+            variance = numpy.array(variance, dtype=numpy.float64).ravel()
+            variance[~valid] = 0.0
+            sum_variance = self._variance.dot(variance)
+        if self.bin_centers1 is not None:
+            results = [sum_signal, sum_variance, sum_normalization, count]
+            for result in results:
+                if result is not None:
+                    result.shape = self.bins
+        return sum_signal, sum_variance, sum_normalization, count
@@ -30,12 +30,17 @@ __author__ = "Jerome Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "16/11/2018"
+__date__ = "18/02/2019"
 __status__ = "development"
 
 import logging
 logger = logging.getLogger(__name__)
 from threading import Semaphore
+from collections import OrderedDict
+import numpy
+
+DEFAULT_REGISTRY_SIZE = 2 ** 31
+"""Default memory budget of the engine registry: 2GB"""
 
 
 class Engine(object):
@@ -44,11 +49,131 @@ class Engine(object):
         """Constructor of the class"""
         self.lock = Semaphore()
         self.engine = engine
+        # (engine, array) main bin of each pixel, used by the sparse filters
+        self.main_bin = None
 
     def reset(self):
         with self.lock:
             self.engine = None
+            self.main_bin = None
 
     def set_engine(self, engine):
         "should be called from a locked region"
         self.engine = engine
+
+
+def engine_nbytes(engine):
+    """Estimate the memory footprint of a regrid-engine
+
+    For OpenCL engines, this is the size of all buffers allocated on the
+    device, for sparse matrix engines the size of the matrix.
+
+    :param engine: regrid-engine (CSR, LUT or OpenCL integrator)
+    :return: size in bytes
+    """
+    buffers = getattr(engine, "buffers", None)
+    if buffers:
+        return sum(int(buf.size) * numpy.dtype(buf.dtype).itemsize for buf in buffers)
+    nbytes = 0
+    for name in ("data", "indices", "indptr", "_lut", "deltas", "row_start"):
+        array = getattr(engine, name, None)
+        if array is not None:
+            # may also be a Cython memoryview
+            nbytes += numpy.asarray(array).nbytes
+    if nbytes == 0:
+        nbytes = getattr(engine, "lut_nbytes", None) or getattr(engine, "nbytes", 0)
+    return int(nbytes)
+
+
+class EngineRegistry(object):
+    """Store of regrid-engines, keyed by the full signature of the integration.
+
+    Engines are kept in least recently used order and evicted when the total
+    memory footprint (sparse matrix and OpenCL buffers) exceeds `max_size`.
+    The most recently used engine is never evicted.
+    """
+
+    def __init__(self, max_size=DEFAULT_REGISTRY_SIZE):
+        """Constructor of the registry
+
+        :param max_size: memory budget in bytes
+        """
+        self.max_size = int(max_size)
+        self._lock = Semaphore()
+        self._engines = OrderedDict()  # key: signature, value: (engine, nbytes)
+
+    def __repr__(self):
+        return "EngineRegistry: %i engines, %.3fMB/%.3fMB" % \
+            (len(self), self.nbytes / 1e6, self.max_size / 1e6)
+
+    def __len__(self):
+        return len(self._engines)
+
+    def __contains__(self, key):
+        return key in self._engines
+
+    @property
+    def nbytes(self):
+        "Memory footprint of all engines in the registry"
+        with self._lock:
+            return sum(nbytes for _, nbytes in self._engines.values())
+
+    def get(self, key):
+        """Retrieve an engine and mark it as the most recently used
+
+        :param key: signature of the integration
+        :return: engine or None if not in the registry
+        """
+        with self._lock:
+            value = self._engines.pop(key, None)
+            if value is None:
+                return None
+            self._engines[key] = value
+            return value[0]
+
+    def add(self, key, engine):
+        """Register an engine and evict the oldest ones if needed
+
+        :param key: signature of the integration
+        :param engine: regrid-engine
+        """
+        with self._lock:
+            self._engines.pop(key, None)
+            self._engines[key] = (engine, engine_nbytes(engine))
+        self.evict()
+
+    def evict(self, max_size=None):
+        """Remove the least recently used engines until the registry fits in max_size
+
+        :param max_size: memory budget in bytes, by default the one of the registry
+        """
+        if max_size is None:
+            max_size = self.max_size
+        with self._lock:
+            total = sum(nbytes for _, nbytes in self._engines.values())
+            while (total > max_size) and (len(self._engines) > 1):
+                key, (_, nbytes) = self._engines.popitem(last=False)
+                logger.debug("Evict engine %s from registry (%i bytes)", key, nbytes)
+                total -= nbytes
+
+    def clear(self):
+        """Empty the registry"""
+        with self._lock:
+            self._engines.clear()
+
+    def engines(self):
+        """List of the engines in the registry
+
+        :return: list of engines, the least recently used first
+        """
+        with self._lock:
+            return [engine for engine, _ in self._engines.values()]
+
+    def list_engines(self):
+        """Description of the engines in the registry
+
+        :return: list of (key, engine class name, size in bytes), the least recently used first
+        """
+        with self._lock:
+            return [(key, engine.__class__.__name__, nbytes)
+                    for key, (engine, nbytes) in self._engines.items()]
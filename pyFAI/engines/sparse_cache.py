@@ -0,0 +1,291 @@
+#
+#    Copyright (C) 2019 European Synchrotron Radiation Facility, Grenoble, France
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#  .
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#  .
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+
+"""Persistent on-disk cache for the sparse matrix (CSR and LUT) integrators.
+
+Building the sparse matrix of an integrator takes seconds on large detectors
+and used to be repeated by every process. This cache stores the matrices in
+a directory, one sub-directory per integration setup, addressed by the hash
+of all parameters defining the matrix. Arrays are stored as `.npy` files and
+memory-mapped on load, other attributes as JSON. Nothing is unpickled: only
+the integrator classes listed in `INTEGRATORS` can be restored.
+
+The default cache is configured with the environment variables
+`PYFAI_SPARSE_CACHE` (directory) and `PYFAI_SPARSE_CACHE_SIZE` (in bytes).
+"""
+
+from __future__ import absolute_import, print_function, with_statement
+
+__author__ = "Jerome Kieffer"
+__contact__ = "Jerome.Kieffer@ESRF.eu"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "18/02/2019"
+__status__ = "development"
+
+import os
+import json
+import shutil
+import hashlib
+import importlib
+import tempfile
+import logging
+logger = logging.getLogger(__name__)
+import numpy
+
+DEFAULT_MAX_SIZE = 2 ** 32
+"""Default maximum size of the cache: 4GB"""
+
+STATE = "state.json"
+"""Name of the file containing the non-array attributes of an integrator"""
+
+INTEGRATORS = ("pyFAI.ext.splitBBoxCSR.HistoBBox1d",
+               "pyFAI.ext.splitBBoxCSR.HistoBBox2d",
+               "pyFAI.ext.splitPixelFullCSR.FullSplitCSR_1d",
+               "pyFAI.ext.splitPixelFullCSR.FullSplitCSR_2d",
+               "pyFAI.ext.splitBBoxLUT.HistoBBox1d",
+               "pyFAI.ext.splitBBoxLUT.HistoBBox2d",
+               "pyFAI.ext.splitPixelFullLUT.HistoLUT1dFullSplit",
+               "pyFAI.ext.splitPixelFullLUT.HistoLUT2dFullSplit",
+               "pyFAI.distortion._CorrectionMatrix")
+"""Classes which can be stored in the cache"""
+
+ARRAYS = ("data", "indices", "indptr", "_lut",
+          "bin_centers", "bin_centers0", "bin_centers1")
+"""Attributes of the integrators needed at integration time.
+All other arrays (pixel positions, mask ...) are only used at setup."""
+
+
+def _to_json(obj):
+    """Conversion of numpy scalars for `json.dumps`"""
+    if isinstance(obj, numpy.generic):
+        return obj.item()
+    raise TypeError("%s is not JSON serializable" % type(obj))
+
+
+def _from_json(value):
+    """JSON has no tuple: lists are converted back to tuples"""
+    if isinstance(value, list):
+        return tuple(_from_json(i) for i in value)
+    return value
+
+
+class SparseCache(object):
+    """Size-bounded cache of sparse matrix integrators on disk.
+
+    Entries are evicted in least recently used order when the total size
+    exceeds `max_size`. The cache can be shared by several processes.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        """Constructor of the cache
+
+        :param directory: directory where the matrices are stored
+        :param max_size: maximum size of the cache on disk in bytes
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_size = int(max_size)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def __repr__(self):
+        return "SparseCache %s: %i entries, %.3fMB/%.3fMB" % \
+            (self.directory, len(self.keys()), self.nbytes / 1e6, self.max_size / 1e6)
+
+    @staticmethod
+    def get_key(**params):
+        """Calculate the key of an integrator from all parameters defining it.
+
+        :param params: JSON-serializable description of the integration setup
+        :return: hexadecimal digest
+        """
+        from .. import version
+        params["version"] = version
+        description = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+    def keys(self):
+        """List of the entries in the cache
+
+        :return: list of keys, the oldest used first
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            if key.endswith(".tmp"):
+                # entry being written
+                continue
+            path = os.path.join(self.directory, key, STATE)
+            if os.path.exists(path):
+                try:
+                    entries.append((os.stat(path).st_mtime, key))
+                except OSError:
+                    # entry removed by another process
+                    continue
+        return [key for _, key in sorted(entries)]
+
+    def _entry_size(self, key):
+        path = os.path.join(self.directory, key)
+        size = 0
+        for name in os.listdir(path):
+            size += os.stat(os.path.join(path, name)).st_size
+        return size
+
+    @property
+    def nbytes(self):
+        "Size of the cache on disk"
+        size = 0
+        for key in self.keys():
+            try:
+                size += self._entry_size(key)
+            except OSError:
+                continue
+        return size
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.directory, key, STATE))
+
+    def load(self, key):
+        """Retrieve an integrator from the cache
+
+        Arrays are memory-mapped in copy-on-write mode: pages are shared
+        between all processes using the same matrix, while the Cython
+        integrators still get writable buffers.
+
+        :param key: key of the integrator, as given by `get_key`
+        :return: integrator or None if not in the cache
+        """
+        path = os.path.join(self.directory, key)
+        if key not in self:
+            return None
+        try:
+            with open(os.path.join(path, STATE), "r") as f:
+                state = dict((name, _from_json(value)) for name, value in json.load(f).items())
+            classname = state.pop("__class__", None)
+            if classname not in INTEGRATORS:
+                logger.warning("Entry %s of sparse cache contains an unexpected class %s", key, classname)
+                return None
+            for name in ARRAYS:
+                filename = os.path.join(path, name + ".npy")
+                if os.path.exists(filename):
+                    state[name] = numpy.load(filename, mmap_mode="c", allow_pickle=False)
+            os.utime(os.path.join(path, STATE), None)
+        except (IOError, OSError, ValueError) as err:
+            logger.warning("Unable to read entry %s from sparse cache: %s", key, err)
+            return None
+        module, classname = classname.rsplit(".", 1)
+        klass = getattr(importlib.import_module(module), classname)
+        if state.get("unit") is not None:
+            from .. import units
+            state["unit"] = units.to_unit(state["unit"])
+        if state.get("lut") == "csr":
+            state["lut"] = (state["data"], state["indices"], state["indptr"])
+        integrator = klass.__new__(klass)
+        integrator.__dict__.update(state)
+        logger.debug("Integrator %s loaded from sparse cache", key)
+        return integrator
+
+    def save(self, key, integrator):
+        """Store an integrator in the cache and evict old entries if needed
+
+        :param key: key of the integrator, as given by `get_key`
+        :param integrator: sparse matrix integrator (CSR or LUT)
+        """
+        if key in self:
+            return
+        classname = integrator.__class__.__module__ + "." + integrator.__class__.__name__
+        if classname not in INTEGRATORS:
+            logger.warning("Integrator %s cannot be stored in the sparse cache", classname)
+            return
+        state = {"__class__": classname}
+        tmp = tempfile.mkdtemp(prefix=key, suffix=".tmp", dir=self.directory)
+        try:
+            for name, value in integrator.__dict__.items():
+                if name in ARRAYS and value is not None:
+                    # may also be a Cython memoryview
+                    numpy.save(os.path.join(tmp, name + ".npy"), numpy.asarray(value))
+                elif isinstance(value, numpy.ndarray):
+                    continue
+                elif name == "lut" and isinstance(value, tuple):
+                    state[name] = "csr"
+                elif name == "unit":
+                    state[name] = str(value)
+                else:
+                    try:
+                        json.dumps(value, default=_to_json)
+                    except (TypeError, ValueError):
+                        continue
+                    state[name] = value
+            with open(os.path.join(tmp, STATE), "w") as f:
+                json.dump(state, f, default=_to_json)
+            os.rename(tmp, os.path.join(self.directory, key))
+        except (IOError, OSError) as err:
+            # Could be an other process which stored the same entry
+            logger.debug("Unable to store entry %s in sparse cache: %s", key, err)
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self, max_size=None):
+        """Remove the least recently used entries until the cache fits in max_size
+
+        :param max_size: size limit in bytes, by default the one of the cache
+        """
+        if max_size is None:
+            max_size = self.max_size
+        sizes = []
+        for key in self.keys():
+            try:
+                sizes.append((key, self._entry_size(key)))
+            except OSError:
+                continue
+        total = sum(size for _, size in sizes)
+        for key, size in sizes:
+            if total <= max_size:
+                break
+            logger.debug("Evict entry %s from sparse cache", key)
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """Empty the cache"""
+        self.evict(0)
+
+
+_default_cache = None
+
+
+def get_default_cache():
+    """Sparse cache defined by the PYFAI_SPARSE_CACHE environment variable
+
+    :return: SparseCache instance or None if the cache is not configured
+    """
+    global _default_cache
+    directory = os.environ.get("PYFAI_SPARSE_CACHE")
+    if not directory:
+        return None
+    if (_default_cache is None) or (_default_cache.directory != os.path.abspath(directory)):
+        max_size = os.environ.get("PYFAI_SPARSE_CACHE_SIZE", DEFAULT_MAX_SIZE)
+        try:
+            _default_cache = SparseCache(directory, int(max_size))
+        except (IOError, OSError) as err:
+            logger.error("Unable to use %s as sparse cache: %s", directory, err)
+            return None
+    return _default_cache
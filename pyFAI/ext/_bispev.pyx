@@ -32,7 +32,7 @@ Created on Nov 4, 2013
 
 __authors__ = ["Zubair Nawaz", "Jerome Kieffer"]
 __contact__ = "Jerome.kieffer@esrf.fr"
-__date__ = "15/11/2018"
+__date__ = "18/02/2019"
 __status__ = "stable"
 __license__ = "MIT"
 
@@ -41,10 +41,13 @@ cimport numpy as cnumpy
 import cython
 cimport cython
 from cython.parallel import prange
+from libc.math cimport fmin, fmax
+
+include "omp_common.pxi"
 
 
 # copied bisplev function from fitpack.bisplev
-def bisplev(x, y, tck, dx=0, dy=0):
+def bisplev(x, y, tck, dx=0, dy=0, int nthread=0):
     """
     Evaluate a bivariate B-spline and its derivatives.
 
@@ -78,6 +81,7 @@ def bisplev(x, y, tck, dx=0, dy=0):
         This version does not implement derivatives.
     :param int dy: The orders of the partial derivatives in `y`.
         This version does not implement derivatives.
+    :param int nthread: number of OpenMP threads, 0 for the default.
     :rtype: ndarray
     :return: The B-spline or its derivative evaluated over the set formed by
         the cross-product of `x` and `y`.
@@ -105,7 +109,7 @@ def bisplev(x, y, tck, dx=0, dy=0):
     cy_x = numpy.ascontiguousarray(x, dtype=numpy.float32)
     cy_y = numpy.ascontiguousarray(y, dtype=numpy.float32)
 
-    z = cy_bispev(tx, ty, c, kx, ky, cy_x, cy_y)
+    z = cy_bispev(tx, ty, c, kx, ky, cy_x, cy_y, nthread)
     z.shape = len(y), len(x)
 
     # Transpose again afterwards to retrieve a memory-contiguous object
@@ -196,12 +200,20 @@ cdef cy_bispev(float[:] tx,
                int kx,
                int ky,
                float[:] x,
-               float[:] y):
+               float[:] y,
+               int nthread=0):
     """
     Actual implementation of bispev in Cython
 
+    The tensor product is evaluated in two steps: for each row (y), the
+    coefficients are first contracted with the B-splines along y, then
+    with those along x for every point of the row. This needs (kx+1)
+    multiplications per point instead of (kx+1)*(ky+1). Rows are
+    processed in parallel, accumulation is performed in double precision.
+
     :param tx: array of float size nx containing position of knots in x
     :param ty: array of float size ny containing position of knots in y
+    :param nthread: number of OpenMP threads, 0 for the default
     """
     cdef:
         int nx = tx.size
@@ -222,29 +234,144 @@ cdef cy_bispev(float[:] tx,
         cnumpy.int32_t[::1] lx = numpy.empty(mx, dtype=numpy.int32)
         cnumpy.int32_t[::1] ly = numpy.empty(my, dtype=numpy.int32)
 
-        int i, j, m, i1, l2, j1
-        int size_z = mx * my
+        # coefficients contracted along y, for each row
+        double[:, ::1] cy = numpy.empty((my, nkx1), dtype=numpy.float64)
+
+        int i, j, p, i1, j1, l2
+        double sp
 
-        # initializing z and h
-        float[::1] z = numpy.zeros(size_z, dtype=numpy.float32)
-        float arg, sp, err, tmp, a
+        float[::1] z = numpy.empty(mx * my, dtype=numpy.float32)
 
+    nthread = get_nthread(nthread)
     with nogil:
         # cannot be initialized in parallel, why ? segfaults on MacOSX
         init_w(tx, kx, x, lx, wx)
         init_w(ty, ky, y, ly, wy)
 
-        for j in prange(my):
+        for j in prange(my, schedule="static", num_threads=nthread):
+            for p in range(nkx1):
+                sp = 0.0
+                l2 = p * nky1 + ly[j]
+                for j1 in range(ky1):
+                    sp = sp + c[l2 + j1] * wy[j, j1]
+                cy[j, p] = sp
             for i in range(mx):
                 sp = 0.0
-                err = 0.0
                 for i1 in range(kx1):
-                    for j1 in range(ky1):
-                        # Implements Kahan summation
-                        l2 = lx[i] * nky1 + ly[j] + i1 * nky1 + j1
-                        a = c[l2] * wx[i, i1] * wy[j, j1] - err
-                        tmp = sp + a
-                        err = (tmp - sp) - a
-                        sp = tmp
-                z[j * mx + i] += sp
+                    sp = sp + cy[j, lx[i] + i1] * wx[i, i1]
+                z[j * mx + i] = <float> sp
+    return numpy.asarray(z)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline int find_interval(float[:] t, int n, int k, float arg) nogil:
+    """Index l of the knot interval t[l] <= arg < t[l+1], with k <= l < n-k-1
+
+    :param t: position of the knots
+    :param n: number of knots
+    :param k: order of the spline
+    :param arg: position, already clipped within the knots
+    :return: index of the interval
+    """
+    cdef int low = k, high = n - k - 1, mid
+    # bisection: t[low] <= arg and (arg < t[high] or high == n-k-1)
+    while high - low > 1:
+        mid = (low + high) // 2
+        if arg < t[mid]:
+            high = mid
+        else:
+            low = mid
+    return low
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline void bspline_weights(float[:] t, int k, float x, int l, double *h) nogil:
+    """Evaluate the (k+1) non-zero b-splines of degree k at t(l) <= x < t(l+1),
+    like fpbspl, in double precision and without memory allocation.
+
+    :param h: output buffer of size k+1 (at most 6)
+    """
+    cdef:
+        int i, j
+        double f
+        double hh[6]
+    h[0] = 1.0
+    for j in range(1, k + 1):
+        for i in range(j):
+            hh[i] = h[i]
+        h[0] = 0.0
+        for i in range(j):
+            f = hh[i] / (t[l + i + 1] - t[l + i + 1 - j])
+            h[i] = h[i] + f * (t[l + i + 1] - x)
+            h[i + 1] = f * (x - t[l + i + 1 - j])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline double bisplev_point(float[:] tx, float[:] ty, float[:] c,
+                                 int kx, int ky, float x, float y) nogil:
+    """Value of the spline at a single point (x, y), clipped within the knots"""
+    cdef:
+        int nx = tx.shape[0]
+        int ny = ty.shape[0]
+        int nky1 = ny - ky - 1
+        int lx, ly, i1, j1
+        double sp = 0.0
+        double hx[6]
+        double hy[6]
+    x = <float> fmin(fmax(x, tx[kx]), tx[nx - kx - 1])
+    y = <float> fmin(fmax(y, ty[ky]), ty[ny - ky - 1])
+    lx = find_interval(tx, nx, kx, x)
+    ly = find_interval(ty, ny, ky, y)
+    bspline_weights(tx, kx, x, lx, hx)
+    bspline_weights(ty, ky, y, ly, hy)
+    for i1 in range(kx + 1):
+        for j1 in range(ky + 1):
+            sp += c[(lx - kx + i1) * nky1 + ly - ky + j1] * hx[i1] * hy[j1]
+    return sp
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def bisplev_points(x, y, tck, int nthread=0):
+    """Evaluate a bivariate B-spline at a list of points (x[i], y[i])
+
+    Unlike `bisplev` which evaluates the spline on the cross-product of x
+    and y, each point is evaluated independently, in parallel.
+    Points outside the knots are clipped to the boundary, like `bisplev`.
+
+    :param x: 1D array with the position of the points along x
+    :param y: 1D array with the position of the points along y, same size as x
+    :param tck: A sequence of length 5 returned by `bisplrep` containing
+        the knot locations, the coefficients, and the degree of the spline:
+        [tx, ty, c, kx, ky].
+    :param nthread: number of OpenMP threads, 0 for the default
+    :return: 1D array with the value of the spline at each point
+    """
+    cdef:
+        int kx, ky, size, i
+        float[:] tx, ty, c, cx, cy
+        float[::1] z
+    tx = numpy.ascontiguousarray(tck[0], dtype=numpy.float32)
+    ty = numpy.ascontiguousarray(tck[1], dtype=numpy.float32)
+    c = numpy.ascontiguousarray(tck[2], dtype=numpy.float32)
+    kx = tck[3]
+    ky = tck[4]
+    if not ((0 < kx <= 5) and (0 < ky <= 5)):
+        raise ValueError("Spline orders kx = %d and ky = %d have to be within 1 and 5" % (kx, ky))
+    cx = numpy.ascontiguousarray(numpy.ravel(x), dtype=numpy.float32)
+    cy = numpy.ascontiguousarray(numpy.ravel(y), dtype=numpy.float32)
+    if cx.size != cy.size:
+        raise ValueError("x and y should have the same size")
+    size = cx.size
+    z = numpy.empty(size, dtype=numpy.float32)
+    nthread = get_nthread(nthread)
+    for i in prange(size, nogil=True, schedule="static", num_threads=nthread):
+        z[i] = <float> bisplev_point(tx, ty, c, kx, ky, cx[i], cy[i])
     return numpy.asarray(z)
@@ -33,6 +33,7 @@ __copyright__ = "2011-2018, ESRF"
 __contact__ = "jerome.kieffer@esrf.fr"
 
 include "sparse_common.pxi"
+include "omp_common.pxi"
 
 import cython
 cimport numpy as cnumpy
@@ -1220,47 +1221,9 @@ def correct_LUT_double(image, shape_out, lut_t[:, ::1] LUT not None,
     :param delta_dummy: precision for invalid pixels
     :return: corrected 2D image
     """
-    cdef:
-        int i, j, lshape0, lshape1, idx, size
-        float value, cdummy, cdelta_dummy
-        double sum, coef
-        cnumpy.float32_t[::1] lout, lin
-        bint do_dummy = dummy is not None
-    if do_dummy:
-        cdummy = dummy
-        if delta_dummy is None:
-            cdelta_dummy = 0.0
-    else:
-        cdummy = numpy.NaN
-        cdelta_dummy = 0.0
-
-    lshape0 = LUT.shape[0]
-    lshape1 = LUT.shape[1]
-    assert numpy.prod(shape_out) == LUT.shape[0], "shape_out0 * shape_out1 == LUT.shape[0]"
-
-    out = numpy.zeros(shape_out, dtype=numpy.float32)
-    lout = out.ravel()
-    lin = numpy.ascontiguousarray(image.ravel(), dtype=numpy.float32)
-    size = lin.size
-    for i in prange(lshape0, nogil=True, schedule="static"):
-        sum = 0.0
-        for j in range(lshape1):
-            idx = LUT[i, j].idx
-            coef = LUT[i, j].coef
-            if coef <= 0:
-                continue
-            if idx >= size:
-                with gil:
-                    logger.warning("Accessing %i >= %i !!!" % (idx, size))
-                    continue
-            value = lin[idx]
-            if do_dummy and fabs(value - cdummy) <= cdelta_dummy:
-                continue
-            sum = value * coef + sum
-        if do_dummy and (sum == 0.0):
-            sum = cdummy
-        lout[i] += sum  # this += is for Cython's reduction
-    return out
+    image = numpy.ascontiguousarray(image, dtype=numpy.float32)
+    return correct_LUT_stack(image.reshape((1,) + image.shape), shape_out, LUT,
+                             dummy, delta_dummy)[0]
 
 
 @cython.cdivision(True)
@@ -1374,48 +1337,152 @@ def correct_CSR_double(image, shape_out, LUT, dummy=None, delta_dummy=None):
     :param delta_dummy: precision for invalid pixels
     :return: corrected 2D image
     """
+    image = numpy.ascontiguousarray(image, dtype=numpy.float32)
+    return correct_CSR_stack(image.reshape((1,) + image.shape), shape_out, LUT,
+                             dummy, delta_dummy)[0]
+
+
+def _stack_buffers(images, shape_out, out):
+    """Input and output buffers of the correction of a stack of images
+
+    :param images: 3D stack of images (nframes, shape_in0, shape_in1)
+    :param shape_out: shape of an output image
+    :param out: output buffer to be reused, if any
+    :return: input as (nframes, size) float32 array, output of shape
+             (nframes, shape_out0, shape_out1) and its (nframes, bins) view
+    """
+    images = numpy.ascontiguousarray(images, dtype=numpy.float32)
+    assert images.ndim == 3, "images is a 3D stack"
+    nframes = images.shape[0]
+    shape = (nframes,) + tuple(shape_out)
+    if out is None:
+        out = numpy.empty(shape, dtype=numpy.float32)
+    else:
+        assert out.shape == shape, "output buffer shape"
+        assert out.dtype == numpy.float32, "output buffer is float32"
+        assert out.flags["C_CONTIGUOUS"], "output buffer is contiguous"
+    return images.reshape((nframes, -1)), out, out.reshape((nframes, -1))
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.initializedcheck(False)
+def correct_LUT_stack(images, shape_out, lut_t[:, ::1] LUT not None,
+                      dummy=None, delta_dummy=None, out=None, int nthread=0):
+    """Correct a stack of images with the same look-up table
+
+    Output pixels are distributed over the OpenMP threads, each row of the
+    table is read once for all images of the stack. Accumulation is
+    performed in double precision.
+
+    :param images: 3D array with the stack of images (nframes, shape_in0, shape_in1)
+    :param shape_out: shape of an output image
+    :param LUT: Look up table, here a 2D-array of struct
+    :param dummy: value for invalid pixels
+    :param delta_dummy: precision for invalid pixels
+    :param out: output buffer of shape (nframes, shape_out0, shape_out1) in
+                float32 to be reused, a new one is allocated if None
+    :param nthread: number of OpenMP threads, 0 for the default
+    :return: corrected stack of images, i.e. out
+    """
     cdef:
-        int i, j, idx, size, bins
-        float value, cdummy, cdelta_dummy
-        double coef, sum
-        cnumpy.float32_t[::1] lout, lin, data
-        int[::1] indices, indptr
+        int i, j, k, lshape0, lshape1, idx, size, nframes
+        float value, cdummy = 0.0, cdelta_dummy = 0.0
+        double sum, coef
+        cnumpy.float32_t[:, ::1] lout, lin
         bint do_dummy = dummy is not None
+    if do_dummy:
+        cdummy = dummy
+        cdelta_dummy = delta_dummy or 0.0
+
+    lshape0 = LUT.shape[0]
+    lshape1 = LUT.shape[1]
+    assert numpy.prod(shape_out) == LUT.shape[0], "shape_out0 * shape_out1 == LUT.shape[0]"
+    lin, out, lout = _stack_buffers(images, shape_out, out)
+    nframes = lin.shape[0]
+    size = lin.shape[1]
+    nthread = get_nthread(nthread)
+
+    for i in prange(lshape0, nogil=True, schedule="static", num_threads=nthread):
+        for k in range(nframes):
+            sum = 0.0
+            for j in range(lshape1):
+                idx = LUT[i, j].idx
+                coef = LUT[i, j].coef
+                if (coef <= 0.0) or (idx >= size):
+                    continue
+                value = lin[k, idx]
+                if do_dummy and fabs(value - cdummy) <= cdelta_dummy:
+                    continue
+                sum = sum + value * coef
+            if do_dummy and (sum == 0.0):
+                sum = cdummy
+            lout[k, i] = sum
+    return out
 
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.initializedcheck(False)
+def correct_CSR_stack(images, shape_out, LUT, dummy=None, delta_dummy=None,
+                      out=None, int nthread=0):
+    """Correct a stack of images with the same sparse matrix (CSR format)
+
+    Output pixels are distributed over the OpenMP threads, each row of the
+    matrix is read once for all images of the stack. Accumulation is
+    performed in double precision.
+
+    :param images: 3D array with the stack of images (nframes, shape_in0, shape_in1)
+    :param shape_out: shape of an output image
+    :param LUT: Look up table, here a 3-tuple array of ndarray
+    :param dummy: value for invalid pixels
+    :param delta_dummy: precision for invalid pixels
+    :param out: output buffer of shape (nframes, shape_out0, shape_out1) in
+                float32 to be reused, a new one is allocated if None
+    :param nthread: number of OpenMP threads, 0 for the default
+    :return: corrected stack of images, i.e. out
+    """
+    cdef:
+        int i, j, k, idx, size, bins, nframes, start, stop
+        float value, cdummy = 0.0, cdelta_dummy = 0.0
+        double sum, coef
+        cnumpy.float32_t[:, ::1] lout, lin
+        cnumpy.float32_t[::1] data
+        int[::1] indices, indptr
+        bint do_dummy = dummy is not None
     if do_dummy:
         cdummy = dummy
-        if delta_dummy is None:
-            cdelta_dummy = 0.0
-    else:
-        cdummy = numpy.NaN 
-        cdelta_dummy = 0.0
+        cdelta_dummy = delta_dummy or 0.0
 
-    data, indices, indptr = LUT
-    bins = indptr.size - 1
+    data = numpy.ascontiguousarray(LUT[0], dtype=numpy.float32)
+    indices = numpy.ascontiguousarray(LUT[1], dtype=numpy.int32)
+    indptr = numpy.ascontiguousarray(LUT[2], dtype=numpy.int32)
+    bins = indptr.shape[0] - 1
     assert numpy.prod(shape_out) == bins, "shape_out0*shape_out1 == indptr.size-1"
-    out = numpy.zeros(shape_out, dtype=numpy.float32)
-    lout = out.ravel()
-    lin = numpy.ascontiguousarray(image.ravel(), dtype=numpy.float32)
-    size = image.size
-
-    for i in prange(bins, nogil=True, schedule="static"):
-        sum = 0.0    # double precision
-        for j in range(indptr[i], indptr[i + 1]):
-            idx = indices[j]
-            coef = data[j]
-            if coef <= 0.0:
-                continue
-            if idx >= size:
-                with gil:
-                    logger.warning("Accessing %i >= %i !!!" % (idx, size))
+    lin, out, lout = _stack_buffers(images, shape_out, out)
+    nframes = lin.shape[0]
+    size = lin.shape[1]
+    nthread = get_nthread(nthread)
+
+    for i in prange(bins, nogil=True, schedule="static", num_threads=nthread):
+        start = indptr[i]
+        stop = indptr[i + 1]
+        for k in range(nframes):
+            sum = 0.0
+            for j in range(start, stop):
+                coef = data[j]
+                idx = indices[j]
+                if (coef <= 0.0) or (idx >= size):
                     continue
-            value = lin[idx]
-            if do_dummy and fabs(value - cdummy) <= cdelta_dummy:
-                continue
-            sum = sum + value * coef  # += operator not allowed in // sections
-        if do_dummy and (sum == 0.0):
-            sum = cdummy
-        lout[i] += sum  # this += is for Cython's reduction
+                value = lin[k, idx]
+                if do_dummy and fabs(value - cdummy) <= cdelta_dummy:
+                    continue
+                sum = sum + value * coef
+            if do_dummy and (sum == 0.0):
+                sum = cdummy
+            lout[k, i] = sum
     return out
 
 
@@ -28,7 +28,7 @@
 
 __author__ = "Jerome Kieffer"
 __license__ = "MIT"
-__date__ = "26/10/2018"
+__date__ = "18/02/2019"
 __copyright__ = "2011-2016, ESRF"
 __contact__ = "jerome.kieffer@esrf.fr"
 
@@ -39,6 +39,8 @@ import numpy
 from cython.parallel cimport prange
 from libc.math cimport sin, cos, atan2, sqrt, M_PI
 
+include "omp_common.pxi"
+
 cdef double twopi = 2.0 * M_PI
 
 # We declare a second cython.floating so that it behaves like an actual template
@@ -612,6 +614,108 @@ def calc_rad_azim(double L,
         return nout
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.initializedcheck(False)
+@cython.cdivision(True)
+def calc_corner_rad_azim(double L,
+                         double poni1,
+                         double poni2,
+                         double rot1,
+                         double rot2,
+                         double rot3,
+                         double pixel1,
+                         double pixel2,
+                         shape,
+                         space="2th",
+                         wavelength=None,
+                         bint chi_discontinuity_at_pi=True,
+                         int nthread=0):
+    """Calculate the radial & azimutal position of the 4 corners of each pixel
+    of a regular detector (flat, contiguous, without distortion) using OpenMP.
+
+    Each pixel corner is calculated once and written directly in the 4D array
+    of corners, without intermediate arrays for the pixel positions.
+
+    :param L: distance sample - PONI
+    :param poni1: PONI coordinate along y axis
+    :param poni2: PONI coordinate along x axis
+    :param rot1: angle1
+    :param rot2: angle2
+    :param rot3: angle3
+    :param pixel1: pixel size along y axis
+    :param pixel2: pixel size along x axis
+    :param shape: 2-tuple with the shape of the detector
+    :param space: can be "2th", "q" or "r" for radial units. Azimuthal units are radians
+    :param wavelength: in meter, needed for q
+    :param chi_discontinuity_at_pi: set to False to obtain chi in the range [0, 2pi[ instead of [-pi, pi[
+    :param nthread: number of OpenMP threads, 0 for the default
+    :return: ndarray of float32 with shape (shape[0], shape[1], 4, 2), like corner_array
+    :raise: KeyError when space is bad !
+            ValueError when wavelength is missing
+    """
+    cdef:
+        int height = shape[0], width = shape[1]
+        int i, j
+        double sinRot1 = sin(rot1)
+        double cosRot1 = cos(rot1)
+        double sinRot2 = sin(rot2)
+        double cosRot2 = cos(rot2)
+        double sinRot3 = sin(rot3)
+        double cosRot3 = cos(rot3)
+        int cspace = 0
+        float[:, :, :, ::1] out = numpy.empty((height, width, 4, 2), dtype=numpy.float32)
+        double p1, p2, t1, t2, t3, fwavelength = 0.0, chi, rad
+
+    if space == "2th":
+        cspace = 1
+    elif space == "q":
+        cspace = 2
+        if not wavelength:
+            raise ValueError("wavelength is needed for q calculation")
+        else:
+            fwavelength = float(wavelength)
+    elif space == "r":
+        cspace = 3
+    else:
+        raise KeyError("Not implemented space %s in cython" % space)
+    nthread = get_nthread(nthread)
+
+    # Loop over the (height+1) x (width+1) grid of corners, each one belongs to up to 4 pixels.
+    # Threads work on different rows of corners, so they never write at the same place.
+    for i in prange(height + 1, nogil=True, schedule="static", num_threads=nthread):
+        p1 = i * pixel1 - poni1
+        for j in range(width + 1):
+            p2 = j * pixel2 - poni2
+            t1 = f_t1(p1, p2, L, sinRot1, cosRot1, sinRot2, cosRot2, sinRot3, cosRot3)
+            t2 = f_t2(p1, p2, L, sinRot1, cosRot1, sinRot2, cosRot2, sinRot3, cosRot3)
+            t3 = f_t3(p1, p2, L, sinRot1, cosRot1, sinRot2, cosRot2, sinRot3, cosRot3)
+            if cspace == 1:
+                rad = atan2(sqrt(t1 * t1 + t2 * t2), t3)
+            elif cspace == 2:
+                rad = 4.0e-9 * M_PI / fwavelength * sin(atan2(sqrt(t1 * t1 + t2 * t2), t3) / 2.0)
+            else:
+                rad = sqrt(t1 * t1 + t2 * t2)
+            chi = atan2(t1, t2)
+            if not chi_discontinuity_at_pi:
+                chi = (chi + twopi) % twopi
+            if i < height:
+                if j < width:
+                    out[i, j, 0, 0] = rad
+                    out[i, j, 0, 1] = chi
+                if j > 0:
+                    out[i, j - 1, 3, 0] = rad
+                    out[i, j - 1, 3, 1] = chi
+            if i > 0:
+                if j < width:
+                    out[i - 1, j, 1, 0] = rad
+                    out[i - 1, j, 1, 1] = chi
+                if j > 0:
+                    out[i - 1, j - 1, 2, 0] = rad
+                    out[i - 1, j - 1, 2, 1] = chi
+    return numpy.asarray(out)
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.initializedcheck(False)
@@ -54,6 +54,10 @@ cdef class Bilinear:
     def __dealloc__(self):
         self.data = None
 
+    def __reduce__(self):
+        "Helper function for pickling the interpolator"
+        return (self.__class__, (numpy.asarray(self.data),))
+
     def f_cy(self, x):
         """
         Function -f((y,x)) where f is a continuous function
@@ -0,0 +1,237 @@
+# coding: utf-8
+#
+#    Project: Azimuthal integration
+#             https://github.com/silx-kit/pyFAI
+#
+#    Copyright (C) 2019 European Synchrotron Radiation Facility, Grenoble, France
+#
+#    Principal author:       Jérôme Kieffer (Jerome.Kieffer@ESRF.eu)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Preprocessing fused with the sparse matrix multiplication.
+
+Common to all integrators storing their matrix in CSR format (attributes
+`data`, `indices` and `indptr`). To be included after regrid_common.pxi and
+omp_common.pxi.
+"""
+
+
+class CsrPreprocIntegrator(object):
+    """Mixin providing `integrate_ng` and `derive_mask` to CSR integrators
+
+    Integrators have to implement `_update_boundaries` for `derive_mask`.
+    """
+
+    def _update_boundaries(self):
+        """Re-calculate the range of the bins with the current mask
+
+        :return: False if not possible (i.e. pixel positions not available)
+        """
+        return False
+
+    def derive_mask(self, mask, mask_checksum=None):
+        """Build the integrator for a given mask from this unmasked one.
+
+        Masking only removes pixels: the sparse matrix is the one of this
+        integrator without the columns of masked pixels, which is much faster
+        than building it again. This is only valid when the mask does not
+        change the range of the bins, i.e. when the range was provided or
+        when the masked pixels do not define the boundaries.
+
+        :param mask: array with masked pixels with 1 (0=not masked)
+        :param mask_checksum: checksum of the mask buffer
+        :return: new integrator, or None if it cannot be derived
+        """
+        if self.check_mask:
+            return None
+        assert mask.size == self.size, "mask size"
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new.check_mask = True
+        new.cmask = numpy.ascontiguousarray(mask.ravel(), dtype=mask_d)
+        new.mask_checksum = mask_checksum if mask_checksum else crc32(mask)
+        if not new._update_boundaries():
+            return None
+        for name in ("pos0_min", "pos0_max", "pos1_min", "pos1_max"):
+            if getattr(new, name, None) != getattr(self, name, None):
+                logger.debug("Mask changes %s, integrator cannot be derived", name)
+                return None
+
+        indptr = numpy.asarray(self.indptr)
+        indices = numpy.asarray(self.indices)
+        keep = (new.cmask == 0)[indices]
+        # number of elements kept before each position in the original matrix
+        kept = numpy.zeros(indices.size + 1, dtype=numpy.int32)
+        numpy.cumsum(keep, out=kept[1:])
+        new.indptr = numpy.ascontiguousarray(kept[indptr])
+        new.indices = numpy.ascontiguousarray(indices[keep])
+        new.data = numpy.ascontiguousarray(numpy.asarray(self.data)[keep])
+        new.nnz = int(new.indptr[-1])
+        new.lut = (new.data, new.indices, new.indptr)
+        new.lut_checksum = crc32(new.data)
+        new.lut_nbytes = sum([i.nbytes for i in new.lut])
+        return new
+
+    @cython.cdivision(True)
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.initializedcheck(False)
+    def integrate_ng(self,
+                     weights,
+                     variance=None,
+                     dark=None,
+                     dark_variance=None,
+                     flat=None,
+                     solidangle=None,
+                     polarization=None,
+                     absorption=None,
+                     dummy=None,
+                     delta_dummy=None,
+                     double normalization_factor=1.0,
+                     int nthread=0):
+        """Preprocess and integrate in a single pass over the pixels.
+
+        Each pixel is corrected on the fly (dark subtraction, dummy and NaN
+        rejection, flat, polarization, solid-angle and absorption) while the
+        sparse matrix is multiplied, so no intermediate image is allocated.
+
+        :param weights: input image
+        :param variance: variance of the input image, if any
+        :param dark: array with the dark-current value to be subtracted (if any)
+        :param dark_variance: variance of the dark-current (if any)
+        :param flat: array with the flat-field to be divided by (if any)
+        :param solidangle: array with the solid angle of each pixel (if any)
+        :param polarization: array with the polarization correction (if any)
+        :param absorption: array with the absorption correction (if any)
+        :param dummy: value for dead pixels (optional)
+        :param delta_dummy: precision for dead-pixel value in dynamic masking
+        :param normalization_factor: multiplies the normalization of every pixel
+        :param nthread: number of OpenMP threads, 0 for the default
+        :return: sum of signal, sum of variance, sum of normalization and count,
+                 shaped like the bins, i.e. (radial, azimuthal) in 2D
+        :rtype: 4-tuple of ndarrays
+        """
+        cdef:
+            cnumpy.int32_t i = 0, j = 0, idx = 0, size = self.size
+            cnumpy.int32_t nbins = self.indptr.size - 1
+            acc_t acc_sig = 0.0, acc_var = 0.0, acc_norm = 0.0, acc_count = 0.0, coef = 0.0
+            data_t one_sig = 0.0, one_var = 0.0, one_norm = 0.0, one_flat = 0.0
+            data_t cdummy = 0.0, cddummy = 0.0
+            bint check_dummy = False, do_variance = False, do_dark = False, do_dark_variance = False
+            bint do_flat = False, do_solidangle = False, do_polarization = False, do_absorption = False
+            acc_t[::1] sum_sig = numpy.zeros(nbins, dtype=acc_d)
+            acc_t[::1] sum_var = numpy.zeros(nbins, dtype=acc_d)
+            acc_t[::1] sum_norm = numpy.zeros(nbins, dtype=acc_d)
+            acc_t[::1] sum_count = numpy.zeros(nbins, dtype=acc_d)
+            data_t[::1] ccoef = self.data
+            cnumpy.int32_t[::1] indices = self.indices, indptr = self.indptr
+            data_t[::1] cdata, cvariance, cdark, cdark_variance, cflat, csolidangle, cpolarization, cabsorption
+
+        assert weights.size == size, "weights size"
+        nthread = get_nthread(nthread)
+        cdata = numpy.ascontiguousarray(weights.ravel(), dtype=data_d)
+        if dummy is not None:
+            check_dummy = True
+            cdummy = <data_t> float(dummy)
+            cddummy = <data_t> float(delta_dummy or 0.0)
+        if variance is not None:
+            do_variance = True
+            assert variance.size == size, "variance array size"
+            cvariance = numpy.ascontiguousarray(variance.ravel(), dtype=data_d)
+        if dark is not None:
+            do_dark = True
+            assert dark.size == size, "dark current array size"
+            cdark = numpy.ascontiguousarray(dark.ravel(), dtype=data_d)
+        if dark_variance is not None:
+            do_dark_variance = True
+            assert dark_variance.size == size, "dark variance array size"
+            cdark_variance = numpy.ascontiguousarray(dark_variance.ravel(), dtype=data_d)
+        if flat is not None:
+            do_flat = True
+            assert flat.size == size, "flat-field array size"
+            cflat = numpy.ascontiguousarray(flat.ravel(), dtype=data_d)
+        if solidangle is not None:
+            do_solidangle = True
+            assert solidangle.size == size, "Solid angle array size"
+            csolidangle = numpy.ascontiguousarray(solidangle.ravel(), dtype=data_d)
+        if polarization is not None:
+            do_polarization = True
+            assert polarization.size == size, "polarization array size"
+            cpolarization = numpy.ascontiguousarray(polarization.ravel(), dtype=data_d)
+        if absorption is not None:
+            do_absorption = True
+            assert absorption.size == size, "absorption array size"
+            cabsorption = numpy.ascontiguousarray(absorption.ravel(), dtype=data_d)
+
+        for i in prange(nbins, nogil=True, schedule="guided", num_threads=nthread):
+            acc_sig = 0.0
+            acc_var = 0.0
+            acc_norm = 0.0
+            acc_count = 0.0
+            for j in range(indptr[i], indptr[i + 1]):
+                coef = ccoef[j]
+                if coef == 0.0:
+                    continue
+                idx = indices[j]
+                one_sig = cdata[idx]
+                if isnan(one_sig):
+                    continue
+                if check_dummy and (((cddummy == 0.0) and (one_sig == cdummy)) or
+                                    ((cddummy != 0.0) and (fabs(one_sig - cdummy) <= cddummy))):
+                    continue
+                one_norm = <data_t> normalization_factor
+                if do_flat:
+                    one_flat = cflat[idx]
+                    if check_dummy and (((cddummy == 0.0) and (one_flat == cdummy)) or
+                                        ((cddummy != 0.0) and (fabs(one_flat - cdummy) <= cddummy))):
+                        continue
+                    one_norm = one_norm * one_flat
+                # Nota: -= and *= operators are seen as reduction in cython parallel.
+                if do_variance:
+                    one_var = cvariance[idx]
+                else:
+                    one_var = 0.0
+                if do_dark:
+                    one_sig = one_sig - cdark[idx]
+                    if do_dark_variance:
+                        one_var = one_var + cdark_variance[idx]
+                if do_polarization:
+                    one_norm = one_norm * cpolarization[idx]
+                if do_solidangle:
+                    one_norm = one_norm * csolidangle[idx]
+                if do_absorption:
+                    one_norm = one_norm * cabsorption[idx]
+                if isnan(one_sig) or isnan(one_norm) or isnan(one_var) or (one_norm == 0.0):
+                    continue
+                acc_sig = acc_sig + coef * one_sig
+                acc_var = acc_var + coef * coef * one_var
+                acc_norm = acc_norm + coef * one_norm
+                acc_count = acc_count + coef
+
+            sum_sig[i] += acc_sig
+            sum_var[i] += acc_var
+            sum_norm[i] += acc_norm
+            sum_count[i] += acc_count
+
+        result = [numpy.asarray(sum_sig), numpy.asarray(sum_var),
+                  numpy.asarray(sum_norm), numpy.asarray(sum_count)]
+        if numpy.ndim(self.bins) > 0:
+            result = [ary.reshape(tuple(self.bins)) for ary in result]
+        return tuple(result)
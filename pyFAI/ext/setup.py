@@ -85,7 +85,8 @@ def configuration(parent_package='', top_path=None):
         create_extension_config('morphology'),
         create_extension_config('watershed'),
         create_extension_config('_tree'),
-        create_extension_config('sparse_utils'),
+        create_extension_config('sparse_utils', can_use_openmp=True),
+        create_extension_config('sparse_filter', can_use_openmp=True),
         create_extension_config('preproc', can_use_openmp=True),
         create_extension_config('inpainting'),
         create_extension_config('invert_geometry')
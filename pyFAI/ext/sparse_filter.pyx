@@ -0,0 +1,684 @@
+# coding: utf-8
+#
+#    Project: Azimuthal integration
+#             https://github.com/silx-kit/pyFAI
+#
+#    Copyright (C) 2019 European Synchrotron Radiation Facility, Grenoble, France
+#
+#    Principal author:       Jérôme Kieffer (Jerome.Kieffer@ESRF.eu)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Statistics of the pixels of each bin of a sparse matrix.
+
+Quantiles (i.e. median filter) and sigma-clipping are calculated on the
+pixels themselves, gathered from the rows of the CSR matrix of an integrator,
+without any intermediate 2D regrouping. Each pixel is preprocessed on the fly
+(dark-current subtraction, dummy rejection and normalization) and weighted by
+its coefficient in the matrix times its normalization, so that, without
+rejection, the mean of a bin is the intensity given by the integrator.
+
+Pixels above the background of their bin can also be selected in a single
+pass over the matrix (see `sparsify_csr`), to store frames sparsely and to
+restrict the search for Bragg peaks to these candidate pixels.
+
+All functions process a stack of frames at once, bins of all frames being
+distributed over the OpenMP threads.
+"""
+
+__author__ = "Jerome Kieffer"
+__contact__ = "Jerome.kieffer@esrf.fr"
+__date__ = "18/02/2019"
+__status__ = "development"
+__license__ = "MIT"
+
+include "regrid_common.pxi"
+include "omp_common.pxi"
+
+import logging
+logger = logging.getLogger(__name__)
+from cython.parallel import prange, parallel
+from libc.stdlib cimport malloc, free, qsort
+
+
+cdef struct pixel_t:
+    data_t value
+    data_t weight
+    data_t variance
+
+
+cdef int _compare_pixel(const void *a, const void *b) nogil:
+    cdef data_t va = (<pixel_t *> a).value, vb = (<pixel_t *> b).value
+    return (va > vb) - (va < vb)
+
+
+class _Preprocessing(object):
+    """Buffers of the preprocessing of a stack of frames"""
+
+    def __init__(self, frames, size, dark, normalization, dummy, delta_dummy, variance=None):
+        self.frames = self._stack(frames, size)
+        assert self.frames.shape[1] == size, "frames size"
+        self.do_variance = variance is not None
+        self.variance = numpy.zeros((1, 1), dtype=data_d)
+        if self.do_variance:
+            self.variance = self._stack(variance, size)
+            assert self.variance.shape == self.frames.shape, "variance shape"
+        self.do_dark = dark is not None
+        self.dark = numpy.zeros(1, dtype=data_d)
+        if self.do_dark:
+            assert dark.size == size, "dark current array size"
+            self.dark = numpy.ascontiguousarray(dark.ravel(), dtype=data_d)
+        self.do_norm = normalization is not None
+        self.normalization = numpy.zeros(1, dtype=data_d)
+        if self.do_norm:
+            assert normalization.size == size, "normalization array size"
+            self.normalization = numpy.ascontiguousarray(normalization.ravel(), dtype=data_d)
+        self.check_dummy = dummy is not None
+        self.dummy = float(dummy) if self.check_dummy else 0.0
+        self.delta_dummy = float(delta_dummy or 0.0)
+
+    @staticmethod
+    def _stack(frames, size):
+        frames = numpy.asarray(frames)
+        if frames.ndim < 3 and frames.size == size:
+            frames = frames.reshape(1, -1)
+        return numpy.ascontiguousarray(frames.reshape(len(frames), -1), dtype=data_d)
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.initializedcheck(False)
+cdef inline bint _preprocess(data_t[:, ::1] frames,
+                             int frame,
+                             int idx,
+                             bint do_dark,
+                             data_t[::1] dark,
+                             bint do_norm,
+                             data_t[::1] normalization,
+                             bint check_dummy,
+                             data_t dummy,
+                             data_t delta_dummy,
+                             data_t normalization_factor,
+                             data_t *value,
+                             data_t *norm) nogil:
+    """Dark-current subtraction and normalization of a single pixel
+
+    :return: False if the pixel is not valid (dummy, NaN or not normalizable)
+    """
+    cdef data_t one_value, one_norm
+    one_value = frames[frame, idx]
+    if isnan(one_value):
+        return False
+    if check_dummy and (((delta_dummy == 0.0) and (one_value == dummy)) or
+                        ((delta_dummy != 0.0) and (fabs(one_value - dummy) <= delta_dummy))):
+        return False
+    if do_dark:
+        one_value = one_value - dark[idx]
+    one_norm = normalization_factor
+    if do_norm:
+        one_norm = one_norm * normalization[idx]
+    if isnan(one_value) or isnan(one_norm) or (one_norm <= 0.0):
+        return False
+    value[0] = one_value
+    norm[0] = one_norm
+    return True
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.initializedcheck(False)
+cdef int _gather(pixel_t *buffer,
+                 data_t[::1] coefs,
+                 cnumpy.int32_t[::1] indices,
+                 int start,
+                 int stop,
+                 data_t[:, ::1] frames,
+                 int frame,
+                 bint do_variance,
+                 data_t[:, ::1] variance,
+                 bint do_dark,
+                 data_t[::1] dark,
+                 bint do_norm,
+                 data_t[::1] normalization,
+                 bint check_dummy,
+                 data_t dummy,
+                 data_t delta_dummy,
+                 data_t normalization_factor) nogil:
+    """Preprocess the valid pixels of a bin into the buffer
+
+    :return: number of valid pixels
+    """
+    cdef:
+        int j, idx, n = 0
+        data_t coef, value = 0.0, norm = 1.0
+    for j in range(start, stop):
+        coef = coefs[j]
+        if coef <= 0.0:
+            continue
+        idx = indices[j]
+        if not _preprocess(frames, frame, idx, do_dark, dark, do_norm, normalization,
+                           check_dummy, dummy, delta_dummy, normalization_factor,
+                           &value, &norm):
+            continue
+        buffer[n].value = value / norm
+        buffer[n].weight = coef * norm
+        if do_variance:
+            buffer[n].variance = variance[frame, idx] / (norm * norm)
+        n = n + 1
+    return n
+
+
+@cython.cdivision(True)
+cdef acc_t _weighted_select(pixel_t *buffer, int n, acc_t target) nogil:
+    """Weighted quantile by selection, without sorting the whole buffer
+
+    The position of each pixel in the distribution is taken at the middle of
+    its weight, the quantile is linearly interpolated between the pixels
+    around the target position (as the "hazen" definition of numpy).
+    The buffer is partially reordered.
+
+    :param target: position of the quantile, in weight
+    """
+    cdef:
+        int lo = 0, hi = n - 1, lt, gt, k
+        bint has_previous = False
+        data_t pivot, a, b, c, max_less = 0.0, max_less_w = 0.0
+        acc_t acc = 0.0, w_less, w_equal, position, previous = 0.0, previous_position = 0.0
+        pixel_t tmp
+    while lo <= hi:
+        # median of three as pivot
+        a = buffer[lo].value
+        b = buffer[(lo + hi) // 2].value
+        c = buffer[hi].value
+        if (a <= b) == (b <= c):
+            pivot = b
+        elif (b <= a) == (a <= c):
+            pivot = a
+        else:
+            pivot = c
+        # three-way partition: [lo, lt) < pivot, [lt, gt] == pivot, (gt, hi] > pivot
+        lt = lo
+        gt = hi
+        k = lo
+        w_less = 0.0
+        w_equal = 0.0
+        max_less_w = -1.0
+        while k <= gt:
+            if buffer[k].value < pivot:
+                w_less = w_less + buffer[k].weight
+                if (max_less_w < 0.0) or (buffer[k].value >= max_less):
+                    max_less = buffer[k].value
+                    max_less_w = buffer[k].weight
+                tmp = buffer[k]
+                buffer[k] = buffer[lt]
+                buffer[lt] = tmp
+                lt = lt + 1
+                k = k + 1
+            elif buffer[k].value > pivot:
+                tmp = buffer[k]
+                buffer[k] = buffer[gt]
+                buffer[gt] = tmp
+                gt = gt - 1
+            else:
+                w_equal = w_equal + buffer[k].weight
+                k = k + 1
+        if (lt > lo) and (acc + w_less - 0.5 * max_less_w >= target):
+            # the quantile is among the smaller values
+            hi = lt - 1
+            continue
+        position = acc + w_less
+        for k in range(lt, gt + 1):
+            position = position + 0.5 * buffer[k].weight
+            if position >= target:
+                if k > lt:
+                    return pivot
+                if lt > lo:
+                    previous = max_less
+                    previous_position = acc + w_less - 0.5 * max_less_w
+                elif not has_previous:
+                    return pivot
+                return previous + (pivot - previous) * (target - previous_position) / (position - previous_position)
+            position = position + 0.5 * buffer[k].weight
+        # the quantile is among the larger values
+        has_previous = True
+        previous = pivot
+        previous_position = acc + w_less + w_equal - 0.5 * buffer[gt].weight
+        acc = acc + w_less + w_equal
+        lo = gt + 1
+    # target beyond the last pixel
+    return previous
+
+
+@cython.cdivision(True)
+cdef acc_t _weighted_quantile(pixel_t *buffer, int n, double qlo, double qhi) nogil:
+    """Quantile (or mean between two quantiles) of the weighted values
+
+    The position of each pixel in the distribution is taken at the middle of
+    its weight, quantiles are linearly interpolated between pixels (as the
+    "hazen" definition of numpy). For a single quantile, the buffer is only
+    partially reordered, else it is sorted in place.
+    """
+    cdef:
+        int k
+        acc_t total = 0.0, cumulative = 0.0, position
+        acc_t sum_w = 0.0, sum_wv = 0.0
+    for k in range(n):
+        total = total + buffer[k].weight
+    if total <= 0.0:
+        return 0.0
+    if qlo == qhi:
+        return _weighted_select(buffer, n, qlo * total)
+    # mean of the pixels between both quantiles
+    qsort(buffer, n, sizeof(pixel_t), _compare_pixel)
+    for k in range(n):
+        position = (cumulative + 0.5 * buffer[k].weight) / total
+        cumulative = cumulative + buffer[k].weight
+        if (position >= qlo) and (position <= qhi):
+            sum_w = sum_w + buffer[k].weight
+            sum_wv = sum_wv + buffer[k].weight * buffer[k].value
+    if sum_w <= 0.0:
+        return 0.0
+    return sum_wv / sum_w
+
+
+@cython.cdivision(True)
+cdef int _sigma_clip(pixel_t *buffer, int n, double sigma_lo, double sigma_hi, int max_iter,
+                     bint do_variance, acc_t *mean, acc_t *std, acc_t *error) nogil:
+    """Iterative rejection of the outliers among the weighted values
+
+    Rejected pixels are removed from the buffer, in place.
+
+    :return: number of pixels kept
+    """
+    cdef:
+        int k, it, kept
+        acc_t sum_w = 0.0, sum_wv, sum_wd2, sum_w2v = 0.0, delta, m = 0.0, s = 0.0
+    for it in range(max_iter + 1):
+        sum_w = 0.0
+        sum_wv = 0.0
+        sum_wd2 = 0.0
+        for k in range(n):
+            sum_w = sum_w + buffer[k].weight
+            sum_wv = sum_wv + buffer[k].weight * buffer[k].value
+        if sum_w <= 0.0:
+            n = 0
+            break
+        m = sum_wv / sum_w
+        for k in range(n):
+            delta = buffer[k].value - m
+            sum_wd2 = sum_wd2 + buffer[k].weight * delta * delta
+        s = sqrt(sum_wd2 / sum_w)
+        if (it == max_iter) or (s == 0.0):
+            break
+        kept = 0
+        for k in range(n):
+            delta = (buffer[k].value - m) / s
+            if (delta <= sigma_hi) and (delta >= -sigma_lo):
+                buffer[kept] = buffer[k]
+                kept = kept + 1
+        if kept == n:
+            break
+        n = kept
+    mean[0] = m
+    std[0] = s
+    if n == 0:
+        error[0] = 0.0
+    elif do_variance:
+        # uncertainty of the mean propagated from the variance of the pixels kept
+        for k in range(n):
+            sum_w2v = sum_w2v + buffer[k].weight * buffer[k].weight * buffer[k].variance
+        error[0] = sqrt(sum_w2v) / sum_w
+    else:
+        # standard error of the mean
+        error[0] = s / sqrt(<acc_t> n)
+    return n
+
+
+def _check_csr(data, indices, indptr):
+    data = numpy.ascontiguousarray(data, dtype=data_d)
+    indices = numpy.ascontiguousarray(indices, dtype=numpy.int32)
+    indptr = numpy.ascontiguousarray(indptr, dtype=numpy.int32)
+    assert indptr[-1] <= data.size, "indptr"
+    assert indices.size == data.size, "indices size"
+    return data, indices, indptr
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.initializedcheck(False)
+def quantile_csr(data, indices, indptr, frames, size,
+                 quantile=0.5,
+                 dark=None,
+                 normalization=None,
+                 dummy=None,
+                 delta_dummy=None,
+                 double normalization_factor=1.0,
+                 double empty=0.0,
+                 int nthread=0):
+    """Weighted quantile of the pixels of each bin, for a stack of frames
+
+    :param data: coefficients of the CSR matrix
+    :param indices: column (pixel) indices of the CSR matrix
+    :param indptr: row pointers of the CSR matrix
+    :param frames: 3D stack of frames (or a single frame)
+    :param size: number of pixels of a frame
+    :param quantile: quantile in [0, 1], or 2-tuple of quantiles to average
+        the pixels between them (trimmed mean)
+    :param dark: dark-current image to be subtracted (if any)
+    :param normalization: product of the flat, solid-angle and polarization
+        images, the pixels are divided by (if any)
+    :param dummy: value for dead pixels (optional)
+    :param delta_dummy: precision for dead-pixel value in dynamic masking
+    :param normalization_factor: divides the intensity of every pixel
+    :param empty: value of bins without valid pixel
+    :param nthread: number of OpenMP threads, 0 for the default
+    :return: quantile and number of valid pixels, as (nframes, nbins) arrays
+    :rtype: 2-tuple of ndarray
+    """
+    cdef:
+        double qlo, qhi
+        int nframes, nbins, ntask, task, frame, bin_, n, max_row
+        pixel_t *buffer
+        data_t[::1] ccoef, cdark, cnorm
+        cnumpy.int32_t[::1] cindices, cindptr
+        data_t[:, ::1] cframes
+        bint do_dark, do_norm, check_dummy
+        data_t cdummy, cddummy, cfactor = <data_t> normalization_factor
+        acc_t cempty = empty
+        acc_t[:, ::1] result
+        acc_t[:, ::1] count
+
+    if "__len__" in dir(quantile):
+        qlo, qhi = min(quantile), max(quantile)
+    else:
+        qlo = qhi = quantile
+    assert 0.0 <= qlo <= qhi <= 1.0, "quantile in [0, 1]"
+    ccoef, cindices, cindptr = _check_csr(data, indices, indptr)
+    prep = _Preprocessing(frames, size, dark, normalization, dummy, delta_dummy)
+    cframes = prep.frames
+    cdark = prep.dark
+    cnorm = prep.normalization
+    do_dark, do_norm, check_dummy = prep.do_dark, prep.do_norm, prep.check_dummy
+    cdummy, cddummy = prep.dummy, prep.delta_dummy
+    nframes = cframes.shape[0]
+    nbins = cindptr.shape[0] - 1
+    ntask = nframes * nbins
+    max_row = max(1, int(numpy.diff(indptr).max())) if nbins else 1
+    result = numpy.zeros((nframes, nbins), dtype=acc_d)
+    count = numpy.zeros((nframes, nbins), dtype=acc_d)
+    nthread = get_nthread(nthread)
+
+    with nogil, parallel(num_threads=nthread):
+        buffer = <pixel_t *> malloc(max_row * sizeof(pixel_t))
+        for task in prange(ntask, schedule="guided"):
+            frame = task // nbins
+            bin_ = task % nbins
+            n = _gather(buffer, ccoef, cindices, cindptr[bin_], cindptr[bin_ + 1],
+                        cframes, frame, False, cframes, do_dark, cdark, do_norm, cnorm,
+                        check_dummy, cdummy, cddummy, cfactor)
+            count[frame, bin_] = n
+            if n == 0:
+                result[frame, bin_] = cempty
+            else:
+                result[frame, bin_] = _weighted_quantile(buffer, n, qlo, qhi)
+        free(buffer)
+    return numpy.asarray(result), numpy.asarray(count)
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.initializedcheck(False)
+def sigma_clip_csr(data, indices, indptr, frames, size,
+                   double sigma_lo=3.0,
+                   double sigma_hi=3.0,
+                   int max_iter=5,
+                   variance=None,
+                   dark=None,
+                   normalization=None,
+                   dummy=None,
+                   delta_dummy=None,
+                   double normalization_factor=1.0,
+                   double empty=0.0,
+                   int nthread=0):
+    """Iterative sigma-clipping of the pixels of each bin, for a stack of frames
+
+    At each iteration, the weighted mean and standard deviation of the pixels
+    of a bin are calculated and the pixels with (I-<I>)/sigma outside of
+    [-sigma_lo, sigma_hi] are discarded, until no more pixel is discarded or
+    `max_iter` is reached. Discarded pixels are removed from the bucket of
+    the bin in place, so each iteration only visits the pixels kept.
+
+    :param data: coefficients of the CSR matrix
+    :param indices: column (pixel) indices of the CSR matrix
+    :param indptr: row pointers of the CSR matrix
+    :param frames: 3D stack of frames (or a single frame)
+    :param size: number of pixels of a frame
+    :param sigma_lo: cut-off for the pixels below the mean, in standard deviation
+    :param sigma_hi: cut-off for the pixels above the mean, in standard deviation
+    :param max_iter: maximum number of iterations
+    :param variance: variance of the frames, same layout as frames (if any)
+    :param dark: dark-current image to be subtracted (if any)
+    :param normalization: product of the flat, solid-angle and polarization
+        images, the pixels are divided by (if any)
+    :param dummy: value for dead pixels (optional)
+    :param delta_dummy: precision for dead-pixel value in dynamic masking
+    :param normalization_factor: divides the intensity of every pixel
+    :param empty: value of bins without valid pixel
+    :param nthread: number of OpenMP threads, 0 for the default
+    :return: mean, standard deviation, number of pixels kept and uncertainty
+        of the mean (propagated from the variance if provided, else the
+        standard error of the mean), as (nframes, nbins) arrays
+    :rtype: 4-tuple of ndarray
+    """
+    cdef:
+        int nframes, nbins, ntask, task, frame, bin_, n, max_row
+        pixel_t *buffer
+        acc_t one_mean, one_std, one_error
+        data_t[::1] ccoef, cdark, cnorm
+        cnumpy.int32_t[::1] cindices, cindptr
+        data_t[:, ::1] cframes, cvariance
+        bint do_variance, do_dark, do_norm, check_dummy
+        data_t cdummy, cddummy, cfactor = <data_t> normalization_factor
+        acc_t cempty = empty
+        acc_t[:, ::1] mean, std, count, error
+
+    ccoef, cindices, cindptr = _check_csr(data, indices, indptr)
+    prep = _Preprocessing(frames, size, dark, normalization, dummy, delta_dummy, variance)
+    cframes = prep.frames
+    cvariance = prep.variance
+    do_variance = prep.do_variance
+    cdark = prep.dark
+    cnorm = prep.normalization
+    do_dark, do_norm, check_dummy = prep.do_dark, prep.do_norm, prep.check_dummy
+    cdummy, cddummy = prep.dummy, prep.delta_dummy
+    nframes = cframes.shape[0]
+    nbins = cindptr.shape[0] - 1
+    ntask = nframes * nbins
+    max_row = max(1, int(numpy.diff(indptr).max())) if nbins else 1
+    mean = numpy.zeros((nframes, nbins), dtype=acc_d)
+    std = numpy.zeros((nframes, nbins), dtype=acc_d)
+    count = numpy.zeros((nframes, nbins), dtype=acc_d)
+    error = numpy.zeros((nframes, nbins), dtype=acc_d)
+    nthread = get_nthread(nthread)
+
+    with nogil, parallel(num_threads=nthread):
+        buffer = <pixel_t *> malloc(max_row * sizeof(pixel_t))
+        for task in prange(ntask, schedule="guided"):
+            frame = task // nbins
+            bin_ = task % nbins
+            one_mean = 0.0
+            one_std = 0.0
+            one_error = 0.0
+            n = _gather(buffer, ccoef, cindices, cindptr[bin_], cindptr[bin_ + 1],
+                        cframes, frame, do_variance, cvariance, do_dark, cdark, do_norm, cnorm,
+                        check_dummy, cdummy, cddummy, cfactor)
+            if n > 0:
+                n = _sigma_clip(buffer, n, sigma_lo, sigma_hi, max_iter, do_variance,
+                                &one_mean, &one_std, &one_error)
+            count[frame, bin_] = n
+            if n == 0:
+                mean[frame, bin_] = cempty
+                std[frame, bin_] = cempty
+                error[frame, bin_] = cempty
+            else:
+                mean[frame, bin_] = one_mean
+                std[frame, bin_] = one_std
+                error[frame, bin_] = one_error
+        free(buffer)
+    return numpy.asarray(mean), numpy.asarray(std), numpy.asarray(count), numpy.asarray(error)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.initializedcheck(False)
+def _main_bin(data, indices, indptr, size):
+    """Flag, for each pixel, the element of the CSR matrix of the bin it
+    contributes the most to
+
+    :return: array of uint8, 1 for the main element of each pixel
+    """
+    cdef:
+        int bin_, j, idx, nbins
+        data_t[::1] ccoef
+        cnumpy.int32_t[::1] cindices, cindptr
+        data_t[::1] best = numpy.zeros(size, dtype=data_d)
+        cnumpy.int32_t[::1] position = numpy.zeros(size, dtype=numpy.int32) - 1
+        cnumpy.uint8_t[::1] main
+
+    ccoef, cindices, cindptr = _check_csr(data, indices, indptr)
+    nbins = cindptr.shape[0] - 1
+    main = numpy.zeros(ccoef.shape[0], dtype=numpy.uint8)
+    with nogil:
+        for bin_ in range(nbins):
+            for j in range(cindptr[bin_], cindptr[bin_ + 1]):
+                idx = cindices[j]
+                if ccoef[j] > best[idx]:
+                    best[idx] = ccoef[j]
+                    position[idx] = j
+        for idx in range(position.shape[0]):
+            if position[idx] >= 0:
+                main[position[idx]] = 1
+    return numpy.asarray(main)
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.initializedcheck(False)
+def sparsify_csr(data, indices, indptr, frames, size,
+                 background, std,
+                 double cutoff=3.0,
+                 double noise=0.0,
+                 dark=None,
+                 normalization=None,
+                 dummy=None,
+                 delta_dummy=None,
+                 double normalization_factor=1.0,
+                 main=None,
+                 int nthread=0):
+    """Select the pixels above the background, for a stack of frames
+
+    Each pixel is compared to the background of the bin it contributes the
+    most to: it is selected when its preprocessed intensity exceeds
+    `background + max(cutoff * std, noise)`. The background and its standard
+    deviation are typically the mean and std of the pixels of each bin after
+    sigma-clipping (see `sigma_clip_csr`). Bins of all frames are processed in
+    parallel, each pixel being visited once.
+
+    :param data: coefficients of the CSR matrix
+    :param indices: column (pixel) indices of the CSR matrix
+    :param indptr: row pointers of the CSR matrix
+    :param frames: 3D stack of frames (or a single frame)
+    :param size: number of pixels of a frame
+    :param background: background of each bin, as (nframes, nbins) array
+    :param std: standard deviation of the background, as (nframes, nbins) array
+    :param cutoff: threshold above the background, in standard deviation
+    :param noise: minimum threshold above the background, in intensity
+    :param dark: dark-current image to be subtracted (if any)
+    :param normalization: product of the flat, solid-angle and polarization
+        images, the pixels are divided by (if any)
+    :param dummy: value for dead pixels (optional)
+    :param delta_dummy: precision for dead-pixel value in dynamic masking
+    :param normalization_factor: divides the intensity of every pixel
+    :param main: pre-calculated output of `_main_bin` for this matrix (if any)
+    :param nthread: number of OpenMP threads, 0 for the default
+    :return: pointer to the first pixel of each frame (nframes+1), index of
+        the pixels selected in the frame and their raw intensity. Pixels of
+        frame `i` are `index[ptr[i]:ptr[i+1]]`, in increasing order.
+    :rtype: 3-tuple of ndarray
+    """
+    cdef:
+        int nframes, nbins, ntask, task, frame, bin_, j, idx
+        data_t value = 0.0, norm = 1.0
+        acc_t threshold
+        data_t[::1] ccoef, cdark, cnorm
+        cnumpy.int32_t[::1] cindices, cindptr
+        cnumpy.uint8_t[::1] cmain
+        data_t[:, ::1] cframes
+        acc_t[:, ::1] cbackground, cstd
+        cnumpy.uint8_t[:, ::1] selected
+        bint do_dark, do_norm, check_dummy
+        data_t cdummy, cddummy, cfactor = <data_t> normalization_factor
+
+    ccoef, cindices, cindptr = _check_csr(data, indices, indptr)
+    if main is None:
+        main = _main_bin(ccoef, cindices, cindptr, size)
+    assert main.size == ccoef.shape[0], "main size"
+    cmain = numpy.ascontiguousarray(main, dtype=numpy.uint8)
+    prep = _Preprocessing(frames, size, dark, normalization, dummy, delta_dummy)
+    cframes = prep.frames
+    cdark = prep.dark
+    cnorm = prep.normalization
+    do_dark, do_norm, check_dummy = prep.do_dark, prep.do_norm, prep.check_dummy
+    cdummy, cddummy = prep.dummy, prep.delta_dummy
+    nframes = cframes.shape[0]
+    nbins = cindptr.shape[0] - 1
+    ntask = nframes * nbins
+    cbackground = numpy.ascontiguousarray(background, dtype=acc_d).reshape(nframes, nbins)
+    cstd = numpy.ascontiguousarray(std, dtype=acc_d).reshape(nframes, nbins)
+    selected = numpy.zeros((nframes, size), dtype=numpy.uint8)
+    nthread = get_nthread(nthread)
+
+    for task in prange(ntask, nogil=True, schedule="guided", num_threads=nthread):
+        frame = task // nbins
+        bin_ = task % nbins
+        # assigned here to be private to the thread
+        value = 0.0
+        norm = 1.0
+        threshold = cbackground[frame, bin_] + max(cutoff * cstd[frame, bin_], noise)
+        for j in range(cindptr[bin_], cindptr[bin_ + 1]):
+            if cmain[j] == 0:
+                continue
+            idx = cindices[j]
+            if not _preprocess(cframes, frame, idx, do_dark, cdark, do_norm, cnorm,
+                               check_dummy, cdummy, cddummy, cfactor, &value, &norm):
+                continue
+            if value / norm > threshold:
+                selected[frame, idx] = 1
+
+    mask = numpy.asarray(selected, dtype=bool)
+    ptr = numpy.zeros(nframes + 1, dtype=numpy.int64)
+    numpy.cumsum(mask.sum(axis=1), out=ptr[1:])
+    index = numpy.nonzero(mask)[1].astype(numpy.int32)
+    intensity = numpy.asarray(prep.frames)[mask]
+    return ptr, index, intensity
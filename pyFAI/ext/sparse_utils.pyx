@@ -29,11 +29,14 @@
 
 __author__ = "Jerome Kieffer"
 __contact__ = "Jerome.kieffer@esrf.fr"
-__date__ = "26/11/2018"
+__date__ = "18/02/2019"
 __status__ = "stable"
 __license__ = "MIT"
 
 include "sparse_common.pxi"
+include "omp_common.pxi"
+
+cdef cnumpy.uint16_t ESCAPE = 65535
 
 
 @cython.boundscheck(False)
@@ -113,6 +116,201 @@ def CSR_to_LUT(data, indices, indptr):
     return numpy.asarray(lut)
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def CSR_to_compact(data, indices, indptr):
+    """Conversion to the compact CSR representation
+
+    Within a row, column indices are stored on 16 bits as the difference
+    with the previous index, the first one being relative to `row_start`.
+    Gaps larger than 65534 are split using escape values (65535), which
+    do not correspond to any pixel and have a null coefficient.
+
+    :param data: coef of the sparse matrix as 1D array, or None if all coefficients are one
+    :param indices: index of the col position in input array as 1D array, sorted within each row
+    :param indptr: index of the start of the row in the indices array
+    :return: the same matrix as compact CSR representation
+    :rtype: 4-tuple of numpy array (data or None, deltas, row_start, indptr)
+    """
+    cdef:
+        int nrow = indptr.size - 1
+        bint do_data = data is not None
+        cnumpy.int32_t[::1] indices_ = numpy.ascontiguousarray(indices, dtype=numpy.int32)
+        cnumpy.int32_t[::1] indptr_ = numpy.ascontiguousarray(indptr, dtype=numpy.int32)
+        cnumpy.int32_t[::1] row_start = numpy.zeros(nrow, dtype=numpy.int32)
+        cnumpy.int32_t[::1] new_indptr = numpy.zeros(nrow + 1, dtype=numpy.int32)
+        cnumpy.float32_t[::1] data_, new_data
+        cnumpy.uint16_t[::1] deltas
+        int i, j, prev, delta, nelt
+    if do_data:
+        data_ = numpy.ascontiguousarray(data, dtype=numpy.float32)
+
+    with nogil:
+        # First pass: measure the size of the encoded indices
+        nelt = 0
+        for i in range(nrow):
+            new_indptr[i] = nelt
+            if indptr_[i + 1] > indptr_[i]:
+                prev = row_start[i] = indices_[indptr_[i]]
+                for j in range(indptr_[i], indptr_[i + 1]):
+                    delta = indices_[j] - prev
+                    if delta < 0:
+                        with gil:
+                            raise ValueError("Indices are not sorted in row %i" % i)
+                    nelt += delta // ESCAPE + 1
+                    prev = indices_[j]
+        new_indptr[nrow] = nelt
+
+    deltas = numpy.zeros(nelt, dtype=numpy.uint16)
+    if do_data:
+        new_data = numpy.zeros(nelt, dtype=numpy.float32)
+
+    with nogil:
+        # Second pass: actually encode
+        nelt = 0
+        for i in range(nrow):
+            prev = row_start[i]
+            for j in range(indptr_[i], indptr_[i + 1]):
+                delta = indices_[j] - prev
+                while delta >= ESCAPE:
+                    deltas[nelt] = ESCAPE
+                    delta = delta - ESCAPE
+                    nelt += 1
+                deltas[nelt] = delta
+                if do_data:
+                    new_data[nelt] = data_[j]
+                nelt += 1
+                prev = indices_[j]
+
+    return (numpy.asarray(new_data) if do_data else None,
+            numpy.asarray(deltas),
+            numpy.asarray(row_start),
+            numpy.asarray(new_indptr))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def compact_to_CSR(data, deltas, row_start, indptr):
+    """Conversion from the compact CSR representation
+
+    :param data: coef of the sparse matrix as 1D array, or None if all coefficients are one
+    :param deltas: delta-encoded column indices, as uint16
+    :param row_start: column index of the first element of each row
+    :param indptr: index of the start of the row in the deltas array
+    :return: the same matrix as CSR representation
+    :rtype: 3-tuple of numpy array (data, indices, indptr)
+    """
+    cdef:
+        int nrow = indptr.size - 1
+        bint do_data = data is not None
+        cnumpy.uint16_t[::1] deltas_ = numpy.ascontiguousarray(deltas, dtype=numpy.uint16)
+        cnumpy.int32_t[::1] row_start_ = numpy.ascontiguousarray(row_start, dtype=numpy.int32)
+        cnumpy.int32_t[::1] indptr_ = numpy.ascontiguousarray(indptr, dtype=numpy.int32)
+        cnumpy.float32_t[::1] data_
+        cnumpy.float32_t[::1] new_data = numpy.ones(deltas.size, dtype=numpy.float32)
+        cnumpy.int32_t[::1] indices = numpy.zeros(deltas.size, dtype=numpy.int32)
+        cnumpy.int32_t[::1] new_indptr = numpy.zeros(nrow + 1, dtype=numpy.int32)
+        int i, j, pos, nelt
+        cnumpy.uint16_t delta
+    if do_data:
+        data_ = numpy.ascontiguousarray(data, dtype=numpy.float32)
+    with nogil:
+        nelt = 0
+        for i in range(nrow):
+            new_indptr[i] = nelt
+            pos = row_start_[i]
+            for j in range(indptr_[i], indptr_[i + 1]):
+                delta = deltas_[j]
+                pos = pos + delta
+                if delta == ESCAPE:
+                    continue
+                indices[nelt] = pos
+                if do_data:
+                    new_data[nelt] = data_[j]
+                nelt += 1
+        new_indptr[nrow] = nelt
+    return numpy.asarray(new_data[:nelt]), numpy.asarray(indices[:nelt]), numpy.asarray(new_indptr)
+
+
+ctypedef fused vector_t:
+    cnumpy.float32_t
+    cnumpy.float64_t
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.initializedcheck(False)
+cdef void _compact_dot(vector_t[:, ::1] vector,
+                       cnumpy.float32_t[::1] data,
+                       bint do_data,
+                       cnumpy.uint16_t[::1] deltas,
+                       cnumpy.int32_t[::1] row_start,
+                       cnumpy.int32_t[::1] indptr,
+                       acc_t[:, ::1] result,
+                       int nthread) nogil:
+    """Actual multiplication, in the precision of the vector"""
+    cdef:
+        int nrow = indptr.shape[0] - 1
+        int nvec = vector.shape[1]
+        int i, j, k, pos
+        cnumpy.uint16_t delta
+        acc_t coef
+    for i in prange(nrow, schedule="guided", num_threads=nthread):
+        pos = row_start[i]
+        for j in range(indptr[i], indptr[i + 1]):
+            delta = deltas[j]
+            pos = pos + delta
+            if delta == ESCAPE:
+                continue
+            if do_data:
+                coef = data[j]
+            else:
+                coef = 1.0
+            for k in range(nvec):
+                result[i, k] += coef * vector[pos, k]
+
+
+def compact_dot(vector, data, deltas, row_start, indptr, int nthread=0):
+    """Multiplication of a compact CSR matrix with a vector, or a set of vectors
+
+    The matrix is used as is, without decoding it. Vectors in double
+    precision are used as is, any other type is converted to float32.
+
+    :param vector: array of shape (ncol,) or (ncol, nvec)
+    :param data: coef of the sparse matrix as 1D array, or None if all coefficients are one
+    :param deltas: delta-encoded column indices, as uint16
+    :param row_start: column index of the first element of each row
+    :param indptr: index of the start of the row in the deltas array
+    :param nthread: number of OpenMP threads, 0 for the default
+    :return: array of shape (nrow,) or (nrow, nvec)
+    """
+    cdef:
+        int nrow = indptr.size - 1
+        bint do_data = data is not None
+        cnumpy.uint16_t[::1] deltas_ = numpy.ascontiguousarray(deltas, dtype=numpy.uint16)
+        cnumpy.int32_t[::1] row_start_ = numpy.ascontiguousarray(row_start, dtype=numpy.int32)
+        cnumpy.int32_t[::1] indptr_ = numpy.ascontiguousarray(indptr, dtype=numpy.int32)
+        cnumpy.float32_t[::1] data_ = None
+        acc_t[:, ::1] result
+    if do_data:
+        data_ = numpy.ascontiguousarray(data, dtype=numpy.float32)
+    vector = numpy.asarray(vector)
+    ndim = vector.ndim
+    vector = vector.reshape((vector.shape[0], -1))
+    result = numpy.zeros((nrow, vector.shape[1]), dtype=acc_d)
+    nthread = get_nthread(nthread)
+    if vector.dtype == numpy.float64:
+        _compact_dot[cnumpy.float64_t](numpy.ascontiguousarray(vector), data_, do_data,
+                                       deltas_, row_start_, indptr_, result, nthread)
+    else:
+        _compact_dot[cnumpy.float32_t](numpy.ascontiguousarray(vector, dtype=numpy.float32),
+                                       data_, do_data, deltas_, row_start_, indptr_,
+                                       result, nthread)
+    if ndim == 1:
+        return numpy.asarray(result)[:, 0]
+    return numpy.asarray(result)
+
+
 cdef class Vector:
     """Variable size vector"""
     cdef:
@@ -33,11 +33,12 @@ reverse implementation based on a sparse matrix multiplication
 
 __author__ = "Jerome Kieffer"
 __contact__ = "Jerome.kieffer@esrf.fr"
-__date__ = "15/11/2018"
+__date__ = "18/02/2019"
 __status__ = "stable"
 __license__ = "MIT"
 
 include "regrid_common.pxi"
+include "omp_common.pxi"
 
 import cython
 import os
@@ -49,8 +50,10 @@ import numpy
 from ..utils import crc32
 from ..utils.decorators import deprecated
 
+include "csr_preproc.pxi"
 
-class HistoBBox1d(object):
+
+class HistoBBox1d(CsrPreprocIntegrator):
     """
     Now uses CSR (Compressed Sparse raw) with main attributes:
     * nnz: number of non zero elements
@@ -148,6 +151,24 @@ class HistoBBox1d(object):
         self.lut = (self.data, self.indices, self.indptr)
         self.lut_nbytes = sum([i.nbytes for i in self.lut])      
 
+    def _update_boundaries(self):
+        """Re-calculate the range of the bins with the current mask
+
+        :return: False if the pixel positions are not available anymore
+        """
+        if self.pos0Range is not None and len(self.pos0Range) > 1:
+            return True
+        if getattr(self, "cpos0", None) is None:
+            return False
+        if getattr(self, "dpos0", None) is None:
+            self.calc_boundaries_nosplit(self.pos0Range)
+        else:
+            # Do not overwrite the buffers shared with the original integrator
+            self.cpos0_sup = numpy.empty_like(self.cpos0)
+            self.cpos0_inf = numpy.empty_like(self.cpos0)
+            self.calc_boundaries(self.pos0Range)
+        return True
+
     @cython.boundscheck(False)
     @cython.wraparound(False)
     def calc_boundaries(self, pos0Range):
@@ -507,7 +528,8 @@ class HistoBBox1d(object):
                   solidAngle=None,
                   polarization=None,
                   double normalization_factor=1.0,
-                  int coef_power=1):
+                  int coef_power=1,
+                  int nthread=0):
         """
         Actually perform the integration which in this case looks more like a matrix-vector product
 
@@ -527,6 +549,7 @@ class HistoBBox1d(object):
         :type polarization: ndarray
         :param normalization_factor: divide the valid result by this value
         :param coef_power: set to 2 for variance propagation, leave to 1 for mean calculation
+        :param nthread: number of OpenMP threads, 0 for the default (OMP_NUM_THREADS or all cores)
 
         :return: positions, pattern, weighted_histogram and unweighted_histogram
         :rtype: 4-tuple of ndarrays
@@ -544,6 +567,7 @@ class HistoBBox1d(object):
             data_t[::1] cdata, tdata, cflat, cdark, csolidAngle, cpolarization
             cnumpy.int32_t[::1] indices = self.indices, indptr = self.indptr
         assert weights.size == size, "weights size"
+        nthread = get_nthread(nthread)
 
         if dummy is not None:
             do_dummy = True
@@ -578,7 +602,7 @@ class HistoBBox1d(object):
             tdata = numpy.ascontiguousarray(weights.ravel(), dtype=data_d)
             cdata = numpy.zeros(size, dtype=data_d)
             if do_dummy:
-                for i in prange(size, nogil=True, schedule="static"):
+                for i in prange(size, nogil=True, schedule="static", num_threads=nthread):
                     data = tdata[i]
                     if ((cddummy != 0) and (fabs(data - cdummy) > cddummy)) or ((cddummy == 0) and (data != cdummy)):
                         # Nota: -= and /= operatore are seen as reduction in cython parallel.
@@ -594,7 +618,7 @@ class HistoBBox1d(object):
                     else:  # set all dummy_like values to cdummy. simplifies further processing
                         cdata[i] += cdummy
             else:
-                for i in prange(size, nogil=True, schedule="static"):
+                for i in prange(size, nogil=True, schedule="static", num_threads=nthread):
                     data = tdata[i]
                     if do_dark:
                         data = data - cdark[i]
@@ -609,7 +633,7 @@ class HistoBBox1d(object):
             if do_dummy:
                 tdata = numpy.ascontiguousarray(weights.ravel(), dtype=data_d)
                 cdata = numpy.zeros(size, dtype=data_d)
-                for i in prange(size, nogil=True, schedule="static"):
+                for i in prange(size, nogil=True, schedule="static", num_threads=nthread):
                     data = tdata[i]
                     if ((cddummy != 0) and (fabs(data - cdummy) > cddummy)) or ((cddummy == 0) and (data != cdummy)):
                         cdata[i] += data
@@ -618,7 +642,7 @@ class HistoBBox1d(object):
             else:
                 cdata = numpy.ascontiguousarray(weights.ravel(), dtype=data_d)
 
-        for i in prange(bins, nogil=True, schedule="guided"):
+        for i in prange(bins, nogil=True, schedule="guided", num_threads=nthread):
             acc_data = 0.0
             acc_count = 0.0
             for j in range(indptr[i], indptr[i + 1]):
@@ -654,7 +678,7 @@ class HistoBBox1d(object):
 ################################################################################
 
 
-class HistoBBox2d(object):
+class HistoBBox2d(CsrPreprocIntegrator):
     @cython.boundscheck(False)
     def __init__(self,
                  pos0,
@@ -758,6 +782,27 @@ class HistoBBox2d(object):
         self.lut = (self.data, self.indices, self.indptr)
         self.lut_checksum = crc32(self.data)
 
+    def _update_boundaries(self):
+        """Re-calculate the range of the bins with the current mask
+
+        :return: False if the pixel positions are not available anymore
+        """
+        if (self.pos0Range is not None and len(self.pos0Range) > 1 and
+                self.pos1Range is not None and len(self.pos1Range) > 1):
+            return True
+        if getattr(self, "cpos0", None) is None or getattr(self, "cpos1", None) is None:
+            return False
+        if getattr(self, "dpos0", None) is None:
+            self.calc_boundaries_nosplit(self.pos0Range, self.pos1Range)
+        else:
+            # Do not overwrite the buffers shared with the original integrator
+            self.cpos0_sup = numpy.empty_like(self.cpos0)
+            self.cpos0_inf = numpy.empty_like(self.cpos0)
+            self.cpos1_sup = numpy.empty_like(self.cpos1)
+            self.cpos1_inf = numpy.empty_like(self.cpos1)
+            self.calc_boundaries(self.pos0Range, self.pos1Range)
+        return True
+
     @cython.boundscheck(False)
     @cython.wraparound(False)
     def calc_boundaries(self, pos0Range, pos1Range):
@@ -1249,7 +1294,8 @@ class HistoBBox2d(object):
                   solidAngle=None,
                   polarization=None,
                   double normalization_factor=1.0,
-                  int coef_power=1
+                  int coef_power=1,
+                  int nthread=0
                   ):
         """
         Actually perform the 2D integration which in this case looks more like a matrix-vector product
@@ -1270,6 +1316,7 @@ class HistoBBox2d(object):
         :type polarization: ndarray
         :param normalization_factor: divide the valid result by this value
         :param coef_power: set to 2 for variance propagation, leave to 1 for mean calculation
+        :param nthread: number of OpenMP threads, 0 for the default (OMP_NUM_THREADS or all cores)
         :return:  I(2d), bin_centers0(1d), bin_centers1(1d), weighted histogram(2d), unweighted histogram (2d)
         :rtype: 5-tuple of ndarrays
 
@@ -1287,6 +1334,7 @@ class HistoBBox2d(object):
             cnumpy.int32_t[::1] indices = self.indices, indptr = self.indptr
 
         assert weights.size == size, "weights size"
+        nthread = get_nthread(nthread)
 
         if dummy is not None:
             do_dummy = True
@@ -1320,7 +1368,7 @@ class HistoBBox2d(object):
             tdata = numpy.ascontiguousarray(weights.ravel(), dtype=data_d)
             cdata = numpy.zeros(size, dtype=data_d)
             if do_dummy:
-                for i in prange(size, nogil=True, schedule="static"):
+                for i in prange(size, nogil=True, schedule="static", num_threads=nthread):
                     data = tdata[i]
                     if ((cddummy != 0) and (fabs(data - cdummy) > cddummy)) or ((cddummy == 0) and (data != cdummy)):
                         # Nota: -= and /= operatore are seen as reduction in cython parallel.
@@ -1337,7 +1385,7 @@ class HistoBBox2d(object):
                         # set all dummy_like values to cdummy. simplifies further processing
                         cdata[i] += cdummy
             else:
-                for i in prange(size, nogil=True, schedule="static"):
+                for i in prange(size, nogil=True, schedule="static", num_threads=nthread):
                     data = tdata[i]
                     if do_dark:
                         data = data - cdark[i]
@@ -1352,7 +1400,7 @@ class HistoBBox2d(object):
             if do_dummy:
                 tdata = numpy.ascontiguousarray(weights.ravel(), dtype=data_d)
                 cdata = numpy.zeros(size, dtype=data_d)
-                for i in prange(size, nogil=True, schedule="static"):
+                for i in prange(size, nogil=True, schedule="static", num_threads=nthread):
                     data = tdata[i]
                     if ((cddummy != 0) and (fabs(data - cdummy) > cddummy)) or ((cddummy == 0) and (data != cdummy)):
                         cdata[i] += data
@@ -1361,7 +1409,7 @@ class HistoBBox2d(object):
             else:
                 cdata = numpy.ascontiguousarray(weights.ravel(), dtype=data_d)
 
-        for i in prange(bins, nogil=True, schedule="guided"):
+        for i in prange(bins, nogil=True, schedule="guided", num_threads=nthread):
             acc_data = 0.0
             acc_count = 0.0
             for j in range(indptr[i], indptr[i + 1]):
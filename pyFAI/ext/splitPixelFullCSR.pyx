@@ -31,11 +31,12 @@ Sparse matrix represented using the CompressedSparseRow.
 
 __author__ = "Jerome Kieffer"
 __contact__ = "Jerome.kieffer@esrf.fr"
-__date__ = "15/01/2019"
+__date__ = "18/02/2019"
 __status__ = "stable"
 __license__ = "MIT"
 
 include "regrid_common.pxi"
+include "omp_common.pxi"
 
 import cython
 import os
@@ -52,6 +53,8 @@ from libc.stdio cimport printf, fflush, stdout
 from ..utils import crc32
 from ..utils.decorators import deprecated
 
+include "csr_preproc.pxi"
+
 cdef struct Function:
     float slope
     float intersect
@@ -162,7 +165,7 @@ cdef inline int on_boundary(float A, float B, float C, float D) nogil:
             ((A < -piover2) and (B > piover2) and (C > piover2) and (D < -piover2)))
 
 
-class FullSplitCSR_1d(object):
+class FullSplitCSR_1d(CsrPreprocIntegrator):
     """
     Now uses CSR (Compressed Sparse raw) with main attributes:
     * nnz: number of non zero elements
@@ -232,6 +235,13 @@ class FullSplitCSR_1d(object):
         self.lut = (self.data, self.indices, self.indptr)
         self.lut_nbytes = sum([i.nbytes for i in self.lut])
 
+    def _update_boundaries(self):
+        """The range of the bins does not depend on the mask
+
+        :return: True
+        """
+        return True
+
     @cython.cdivision(True)
     @cython.boundscheck(False)
     @cython.wraparound(False)
@@ -444,7 +454,8 @@ class FullSplitCSR_1d(object):
                   solidAngle=None,
                   polarization=None,
                   double normalization_factor=1.0,
-                  int coef_power=1):
+                  int coef_power=1,
+                  int nthread=0):
         """
         Actually perform the integration which in this case looks more like a matrix-vector product
 
@@ -464,6 +475,7 @@ class FullSplitCSR_1d(object):
         :type polarization: ndarray
         :param normalization_factor: divide the valid result by this value
         :param coef_power: set to 2 for variance propagation, leave to 1 for mean calculation
+        :param nthread: number of OpenMP threads, 0 for the default (OMP_NUM_THREADS or all cores)
 
         :return: positions, pattern, weighted_histogram and unweighted_histogram
         :rtype: 4-tuple of ndarrays
@@ -481,6 +493,7 @@ class FullSplitCSR_1d(object):
             data_t[::1] cdata, tdata, cflat, cdark, csolidAngle, cpolarization
             numpy.int32_t[::1] indices = self.indices, indptr = self.indptr
         assert weights.size == size, "weights size"
+        nthread = get_nthread(nthread)
 
         if dummy is not None:
             do_dummy = True
@@ -515,7 +528,7 @@ class FullSplitCSR_1d(object):
             tdata = numpy.ascontiguousarray(weights.ravel(), dtype=data_d)
             cdata = numpy.zeros(size, dtype=data_d)
             if do_dummy:
-                for i in prange(size, nogil=True, schedule="static"):
+                for i in prange(size, nogil=True, schedule="static", num_threads=nthread):
                     data = tdata[i]
                     if ((cddummy != 0) and (fabs(data - cdummy) > cddummy)) or ((cddummy == 0) and (data != cdummy)):
                         # Nota: -= and /= operatore are seen as reduction in cython parallel.
@@ -531,7 +544,7 @@ class FullSplitCSR_1d(object):
                     else:  # set all dummy_like values to cdummy. simplifies further processing
                         cdata[i] += cdummy
             else:
-                for i in prange(size, nogil=True, schedule="static"):
+                for i in prange(size, nogil=True, schedule="static", num_threads=nthread):
                     data = tdata[i]
                     if do_dark:
                         data = data - cdark[i]
@@ -546,7 +559,7 @@ class FullSplitCSR_1d(object):
             if do_dummy:
                 tdata = numpy.ascontiguousarray(weights.ravel(), dtype=data_d)
                 cdata = numpy.zeros(size, dtype=data_d)
-                for i in prange(size, nogil=True, schedule="static"):
+                for i in prange(size, nogil=True, schedule="static", num_threads=nthread):
                     data = tdata[i]
                     if ((cddummy != 0) and (fabs(data - cdummy) > cddummy)) or ((cddummy == 0) and (data != cdummy)):
                         cdata[i] += data
@@ -555,7 +568,7 @@ class FullSplitCSR_1d(object):
             else:
                 cdata = numpy.ascontiguousarray(weights.ravel(), dtype=data_d)
 
-        for i in prange(bins, nogil=True, schedule="guided"):
+        for i in prange(bins, nogil=True, schedule="guided", num_threads=nthread):
             acc_data = 0.0
             acc_count = 0.0
             for j in range(indptr[i], indptr[i + 1]):
@@ -591,7 +604,7 @@ class FullSplitCSR_1d(object):
 ################################################################################
 
 
-class FullSplitCSR_2d(object):
+class FullSplitCSR_2d(CsrPreprocIntegrator):
     """
     Now uses CSR (Compressed Sparse raw) with main attributes:
     * nnz: number of non zero elements
@@ -664,6 +677,13 @@ class FullSplitCSR_2d(object):
         self.lut = (self.data, self.indices, self.indptr)
         self.lut_nbytes = sum([i.nbytes for i in self.lut])
 
+    def _update_boundaries(self):
+        """The range of the bins does not depend on the mask
+
+        :return: True
+        """
+        return True
+
     @cython.cdivision(True)
     @cython.boundscheck(False)
     @cython.wraparound(False)
@@ -1096,7 +1116,8 @@ class FullSplitCSR_2d(object):
                   solidAngle=None,
                   polarization=None,
                   double normalization_factor=1.0,
-                  int coef_power=1
+                  int coef_power=1,
+                  int nthread=0
                   ):
         """
         Actually perform the 2D integration which in this case looks more like a matrix-vector product
@@ -1117,6 +1138,7 @@ class FullSplitCSR_2d(object):
         :type polarization: ndarray
         :param normalization_factor: divide the valid result by this value
         :param coef_power: set to 2 for variance propagation, leave to 1 for mean calculation
+        :param nthread: number of OpenMP threads, 0 for the default (OMP_NUM_THREADS or all cores)
         :return:  I(2d), bin_centers0(1d), bin_centers1(1d), weighted histogram(2d), unweighted histogram (2d)
         :rtype: 5-tuple of ndarrays
 
@@ -1134,6 +1156,7 @@ class FullSplitCSR_2d(object):
             numpy.int32_t[::1] indices = self.indices, indptr = self.indptr
 
         assert weights.size == size, "weights size"
+        nthread = get_nthread(nthread)
 
         if dummy is not None:
             do_dummy = True
@@ -1167,7 +1190,7 @@ class FullSplitCSR_2d(object):
             tdata = numpy.ascontiguousarray(weights.ravel(), dtype=data_d)
             cdata = numpy.zeros(size, dtype=data_d)
             if do_dummy:
-                for i in prange(size, nogil=True, schedule="static"):
+                for i in prange(size, nogil=True, schedule="static", num_threads=nthread):
                     data = tdata[i]
                     if ((cddummy != 0) and (fabs(data - cdummy) > cddummy)) or ((cddummy == 0) and (data != cdummy)):
                         # Nota: -= and /= operatore are seen as reduction in cython parallel.
@@ -1184,7 +1207,7 @@ class FullSplitCSR_2d(object):
                         # set all dummy_like values to cdummy. simplifies further processing
                         cdata[i] += cdummy
             else:
-                for i in prange(size, nogil=True, schedule="static"):
+                for i in prange(size, nogil=True, schedule="static", num_threads=nthread):
                     data = tdata[i]
                     if do_dark:
                         data = data - cdark[i]
@@ -1199,7 +1222,7 @@ class FullSplitCSR_2d(object):
             if do_dummy:
                 tdata = numpy.ascontiguousarray(weights.ravel(), dtype=data_d)
                 cdata = numpy.zeros(size, dtype=data_d)
-                for i in prange(size, nogil=True, schedule="static"):
+                for i in prange(size, nogil=True, schedule="static", num_threads=nthread):
                     data = tdata[i]
                     if ((cddummy != 0) and (fabs(data - cdummy) > cddummy)) or ((cddummy == 0) and (data != cdummy)):
                         cdata[i] += data
@@ -1208,7 +1231,7 @@ class FullSplitCSR_2d(object):
             else:
                 cdata = numpy.ascontiguousarray(weights.ravel(), dtype=data_d)
 
-        for i in prange(bins, nogil=True, schedule="guided"):
+        for i in prange(bins, nogil=True, schedule="guided", num_threads=nthread):
             acc_data = 0.0
             acc_count = 0.0
             for j in range(indptr[i], indptr[i + 1]):
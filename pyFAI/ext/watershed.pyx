@@ -30,7 +30,7 @@
 """
 __author__ = "Jerome Kieffer"
 __contact__ = "Jerome.kieffer@esrf.fr"
-__date__ = "11/01/2018"
+__date__ = "18/02/2019"
 __status__ = "stable"
 __license__ = "MIT"
 
@@ -72,6 +72,17 @@ cdef class Region:
         self.border = None
         self.peaks = None
 
+    def __reduce__(self):
+        "Helper function for pickling the region"
+        return (self.__class__, (self.index,),
+                (self.size, self.pass_to, self.mini, self.maxi, self.highest_pass,
+                 self.neighbors, self.border, self.peaks))
+
+    def __setstate__(self, state):
+        "Helper function for unpickling the region"
+        (self.size, self.pass_to, self.mini, self.maxi, self.highest_pass,
+         self.neighbors, self.border, self.peaks) = state
+
     def __repr__(self):
         return "Region %s of size %s:\n neighbors: %s\n border: %s\n" % (self.index, self.size, self.neighbors, self.border) + \
                "peaks: %s\n maxi=%s, mini=%s, pass=%s to %s" % (self.peaks, self.maxi, self.mini, self.highest_pass, self.pass_to)
@@ -39,7 +39,7 @@ __author__ = "Jerome Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "03/01/2019"
+__date__ = "18/02/2019"
 __status__ = "production"
 __docformat__ = 'restructuredtext'
 
@@ -55,6 +55,7 @@ from . import units
 from .utils.decorators import deprecated
 from .utils import crc32
 from . import utils
+from .utils.array_cache import ArrayCache, get_default_cache
 from .io import ponifile
 
 logger = logging.getLogger(__name__)
@@ -71,6 +72,9 @@ except ImportError:
     logger.debug("Backtrace", exc_info=True)
     bilinear = None
 
+# Radial spaces implemented in the Cython extension _geometry
+_CYTHON_SPACES = ("2th", "q", "r")
+
 PolarizationArray = namedtuple("PolarizationArray", ["array", "checksum"])
 PolarizationDescription = namedtuple("PolarizationDescription",
                                      ["polarization_factor", "axis_offset"])
@@ -149,6 +153,8 @@ class Geometry(object):
         self._correct_solid_angle_for_spline = True
         self._sem = threading.Semaphore()
         self._transmission_normal = None
+        self.array_cache = get_default_cache()  # shared storage of position arrays
+        self.array_dtype = None  # dtype of center/delta arrays, None for native
 
         if detector:
             if isinstance(detector, utils.StringTypes):
@@ -615,6 +621,19 @@ class Geometry(object):
         """Deprecated version of :meth:`position_array`, left for compatibility see doc of position_array"""
         return self.position_array(*arg, **kwarg)
 
+    def _is_regular_detector(self):
+        """Tell if the pixel corners are on a regular grid, without distortion
+
+        :return: True for flat and contiguous detectors, without spline,
+                 displacement map or explicit pixel corners
+        """
+        detector = self.detector
+        return (detector.IS_CONTIGUOUS and detector.IS_FLAT and
+                (detector._pixel_corners is None) and (detector.spline is None) and
+                (detector._dx is None) and (detector._dy is None) and
+                (type(detector).calc_cartesian_positions == detectors.Detector.calc_cartesian_positions) and
+                (type(detector).get_pixel_corners == detectors.Detector.get_pixel_corners))
+
     def corner_array(self, shape=None, unit=None, use_cython=True, scale=True):
         """
         Generate a 3D array of the given shape with (i,j) (radial
@@ -649,8 +668,20 @@ class Geometry(object):
         if self._cached_array.get(key) is None or shape != self._cached_array.get(key).shape[:2]:
             with self._sem:
                 if self._cached_array.get(key) is None or shape != self._cached_array.get(key).shape[:2]:
-                    corners = None
-                    if (_geometry is not None) and use_cython:
+                    corners = self._load_shared_array(key, shape)
+                    cython_space = (_geometry is not None) and use_cython and (space in _CYTHON_SPACES)
+                    if (corners is None) and cython_space and self._is_regular_detector():
+                        try:
+                            corners = _geometry.calc_corner_rad_azim(self.dist, self.poni1, self.poni2,
+                                                                     self.rot1, self.rot2, self.rot3,
+                                                                     self.detector.pixel1, self.detector.pixel2,
+                                                                     shape, space, self._wavelength,
+                                                                     chi_discontinuity_at_pi=self.chiDiscAtPi)
+                        except KeyError:
+                            logger.debug("No fast path for space: %s", space)
+                        except AttributeError as err:
+                            logger.warning("AttributeError: The binary extension _geomety may be missing: %s", err)
+                    if (corners is None) and cython_space:
                         if self.detector.IS_CONTIGUOUS:
                             d1 = utils.expand2d(numpy.arange(shape[0] + 1.0), shape[1] + 1.0, False)
                             d2 = utils.expand2d(numpy.arange(shape[1] + 1.0), shape[0] + 1.0, True)
@@ -709,6 +740,8 @@ class Geometry(object):
                                 corners[..., 0] = rad
                             else:
                                 corners[:shape[0], :shape[1], :, 0] = rad[:shape[0], :shape[1], :]
+                    if not isinstance(corners, numpy.memmap):
+                        corners = self._publish_array(key, shape, corners)
                     self._cached_array[key] = corners
 
         res = self._cached_array[key]
@@ -766,6 +799,77 @@ class Geometry(object):
         """
         return self.corner_array(shape, unit=units.RecD2_NM, scale=False)
 
+    def set_array_cache(self, cache=None, dtype=None):
+        """Configure the storage of the position arrays (centers, corners and deltas)
+
+        With a cache, arrays are shared with all processes using the same
+        geometry and detector, via memory-mapped files: only the first one
+        calculates them, the other ones attach to them.
+
+        :param cache: ArrayCache instance or directory name, None to disable sharing
+        :param dtype: dtype of the center and delta arrays, like numpy.float32 to
+                      halve their size. None for the native precision (float64).
+                      Corner arrays are always in float32.
+        """
+        if isinstance(cache, utils.StringTypes):
+            cache = ArrayCache(cache)
+        self.array_cache = cache
+        self.array_dtype = numpy.dtype(dtype) if dtype is not None else None
+        self.reset()
+
+    def _get_array_key(self, name, shape):
+        """Key of a position array in the array cache.
+
+        Does not use getPyFAI which would lock the semaphore.
+
+        :param name: name of the array in the cache, like "2th_center"
+        :param shape: shape of the detector
+        :return: key as a string
+        """
+        from .distortion import get_distortion_checksum
+        detector = self.detector
+        distortion = None if detector.uniform_pixel else get_distortion_checksum(detector)
+        return self.array_cache.get_key(name=name,
+                                        shape=tuple(shape),
+                                        dtype=str(self.array_dtype),
+                                        detector=detector.__class__.__name__,
+                                        detector_config=detector.getPyFAI(),
+                                        binning=detector.get_binning(),
+                                        distortion=distortion,
+                                        param=[float(i) for i in (self._dist, self._poni1, self._poni2,
+                                                                  self._rot1, self._rot2, self._rot3)],
+                                        wavelength=self._wavelength,
+                                        chiDiscAtPi=self.chiDiscAtPi,
+                                        oversampling=self._oversampling)
+
+    def _load_shared_array(self, name, shape):
+        """Retrieve a position array from the array cache
+
+        :param name: name of the array in the cache, like "2th_center"
+        :param shape: shape of the detector
+        :return: array or None if not available
+        """
+        if self.array_cache is None or shape is None:
+            return None
+        return self.array_cache.load(self._get_array_key(name, shape))
+
+    def _publish_array(self, name, shape, ary):
+        """Convert a position array to the requested dtype and share it via the array cache
+
+        :param name: name of the array in the cache, like "2th_center"
+        :param shape: shape of the detector
+        :param ary: freshly calculated array
+        :return: array to be cached, memory-mapped if shared
+        """
+        if (self.array_dtype is not None) and (name.endswith("_center") or name.endswith("_delta")):
+            ary = numpy.ascontiguousarray(ary, dtype=self.array_dtype)
+        if self.array_cache is None or shape is None:
+            return ary
+        key = self._get_array_key(name, shape)
+        self.array_cache.save(key, ary)
+        shared = self.array_cache.load(key)
+        return ary if shared is None else shared
+
     def center_array(self, shape=None, unit="2th_deg", scale=True):
         """
         Generate a 2D array of the given shape with (i,j) (radial
@@ -797,11 +901,13 @@ class Geometry(object):
             else:
                 return ary
 
-        pos = self.position_array(shape, corners=False)
-        x = pos[..., 2]
-        y = pos[..., 1]
-        z = pos[..., 0]
-        ary = unit.equation(x, y, z, self.wavelength)
+        ary = self._load_shared_array(key, shape)
+        if ary is None:
+            pos = self.position_array(shape, corners=False)
+            x = pos[..., 2]
+            y = pos[..., 1]
+            z = pos[..., 0]
+            ary = self._publish_array(key, shape, unit.equation(x, y, z, self.wavelength))
         self._cached_array[key] = ary
         if scale and unit:
             return ary * unit.scale
@@ -838,10 +944,12 @@ class Geometry(object):
                 return ary * unit.scale
             else:
                 return ary
-        center = self.center_array(shape, unit=unit, scale=False)
-        corners = self.corner_array(shape, unit=unit, scale=False)
-        delta = abs(corners[..., 0] - numpy.atleast_3d(center))
-        ary = delta.max(axis=-1)
+        ary = self._load_shared_array(space, shape)
+        if ary is None:
+            center = self.center_array(shape, unit=unit, scale=False)
+            corners = self.corner_array(shape, unit=unit, scale=False)
+            delta = abs(corners[..., 0] - numpy.atleast_3d(center))
+            ary = self._publish_array(space, shape, delta.max(axis=-1))
         self._cached_array[space] = ary
         if scale and unit:
             return ary * unit.scale
@@ -1808,7 +1916,7 @@ class Geometry(object):
         numerical = ["_dist", "_poni1", "_poni2", "_rot1", "_rot2", "_rot3",
                      "chiDiscAtPi", "_wavelength",
                      '_oversampling', '_correct_solid_angle_for_spline',
-                     '_transmission_normal',
+                     '_transmission_normal', 'array_cache', 'array_dtype',
                      ]
         # array = []
         for key in numerical:
@@ -1825,7 +1933,7 @@ class Geometry(object):
         numerical = ["_dist", "_poni1", "_poni2", "_rot1", "_rot2", "_rot3",
                      "chiDiscAtPi", "_dssa_order", "_wavelength",
                      '_oversampling', '_correct_solid_angle_for_spline',
-                     '_transmission_normal',
+                     '_transmission_normal', 'array_cache', 'array_dtype',
                      ]
         if memo is None:
             memo = {}
@@ -36,15 +36,18 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "22/08/2018"
+__date__ = "18/02/2019"
 __status__ = "development"
 __docformat__ = 'restructuredtext'
 
 
 import os
+import inspect
 import logging
 import json
+import threading
 import numpy
+from math import pi
 from collections import OrderedDict, namedtuple
 from scipy.optimize import minimize
 from silx.image import marchingsquares
@@ -54,8 +57,11 @@ from .detectors import detector_factory, Detector
 from .geometry import Geometry
 from .geometryRefinement import GeometryRefinement
 from .azimuthalIntegrator import AzimuthalIntegrator
-from .utils import StringTypes
+from .utils import StringTypes, deg2rad, crc32
 from .multi_geometry import MultiGeometry
+from .method_registry import IntegrationMethod
+from .containers import Integrate1dResult, Integrate2dResult
+from . import units
 from .units import CONST_hc, CONST_q
 
 logger = logging.getLogger(__name__)
@@ -430,6 +436,42 @@ class Goniometer(object):
         mg = MultiGeometry(ais)
         return mg
 
+    def get_scan(self, npt_rad=1800, npt_azim=None, **kwargs):
+        """Creates a scan integrator for this goniometer.
+
+        Images are streamed through the scan integrator, position by position,
+        while geometries and sparse matrices are cached and shared between
+        equivalent positions. See `GoniometerScan` for the options.
+
+        :param npt_rad: number of points in the radial direction
+        :param npt_azim: number of azimuthal bins, None for a 1D integration
+        :return: GoniometerScan instance
+        """
+        return GoniometerScan(self, npt_rad, npt_azim, **kwargs)
+
+    def integrate_scan(self, frames, positions, npt_rad=1800, npt_azim=None,
+                       monitors=None, **kwargs):
+        """Integrate all images of a scan into a single pattern.
+
+        Equivalent to `get_mg(positions).integrate1d(frames, ...)` with the
+        CSR method, but images are read and integrated one at a time.
+
+        :param frames: iterable of images, one per position
+        :param positions: iterable of goniometer positions
+        :param npt_rad: number of points in the radial direction
+        :param npt_azim: number of azimuthal bins, None for a 1D integration
+        :param monitors: iterable with the monitor value of each image
+        :return: Integrate1dResult or Integrate2dResult
+        """
+        scan = self.get_scan(npt_rad, npt_azim, **kwargs)
+        if monitors is None:
+            for frame, position in zip(frames, positions):
+                scan.add(frame, position)
+        else:
+            for frame, position, monitor in zip(frames, positions, monitors):
+                scan.add(frame, position, monitor)
+        return scan.result()
+
     def to_dict(self):
         """Export the goniometer configuration to a dictionary
 
@@ -520,6 +562,245 @@ class Goniometer(object):
         return gonio
 
 
+class GoniometerScan(object):
+    """Integration of the images of a goniometer scan, streamed one by one.
+
+    Results are the ones of a `MultiGeometry` over all positions with the CSR
+    method, but images are integrated as they come and never kept in memory.
+
+    The geometry of each position is built only once. Sparse matrices are
+    shared between positions with the same geometry and, for 1D integration
+    over the full azimuthal range, between positions differing only by the
+    rotation around the incoming beam (rot3), which does not change the
+    radial position of the pixels.
+    """
+
+    def __init__(self, goniometer, npt_rad=1800, npt_azim=None, unit="2th_deg",
+                 radial_range=(0, 180), azimuth_range=(-180, 180),
+                 correctSolidAngle=True, polarization_factor=None,
+                 error_model=None, mask=None, method="splitpixel",
+                 empty=0.0, chi_disc=180):
+        """Constructor of the scan integrator
+
+        :param goniometer: Goniometer instance
+        :param npt_rad: number of points in the radial direction
+        :param npt_azim: number of azimuthal bins, None for a 1D integration
+        :param unit: radial unit
+        :param radial_range: common radial range for integration
+        :param azimuth_range: common azimuthal range for integration (in deg)
+        :param correctSolidAngle: correct for solid angle
+        :param polarization_factor: None for no correction, else a value from -1 to +1
+        :param error_model: "poisson" to propagate the variance
+        :param mask: mask of the detector, by default the one of the goniometer's detector
+        :param method: integration method, only the pixel splitting is used
+        :param empty: value for empty bins
+        :param chi_disc: position of the chi discontinuity, 180 or 0
+        """
+        self.goniometer = goniometer
+        self.npt_rad = npt_rad
+        self.npt_azim = npt_azim
+        self.unit = units.to_unit(unit)
+        self.radial_range = tuple(radial_range[:2])
+        self.azimuth_range = tuple(azimuth_range[:2])
+        self.correctSolidAngle = correctSolidAngle
+        self.polarization_factor = polarization_factor
+        self.error_model = (error_model or "").lower()
+        self.mask = mask
+        dim = 1 if npt_azim is None else 2
+        self.method = IntegrationMethod.select_one_available(method, dim=dim)
+        self.empty = empty
+        self.chi_disc = chi_disc
+        self._lock = threading.Lock()
+        self._ais = {}
+        self._matrices = {}
+        self.reset()
+
+    def __repr__(self):
+        return "GoniometerScan with %s frames, %s geometries and %s sparse matrices" % \
+            (self.nframes, len(self._ais), len(self._matrices))
+
+    def reset(self):
+        """Restart the accumulation, keeping geometries and sparse matrices"""
+        with self._lock:
+            self.nframes = 0
+            self._integrator = None
+            self._sum = None
+            self._count = None
+            self._sum_variance = None
+
+    @property
+    def npt(self):
+        return self.npt_rad if self.npt_azim is None else (self.npt_rad, self.npt_azim)
+
+    @property
+    def full_azimuth(self):
+        "True when the integration covers all azimuthal angles"
+        return abs(self.azimuth_range[1] - self.azimuth_range[0]) >= 360
+
+    @property
+    def _wavelength_dependent(self):
+        "True when the radial unit depends on the wavelength"
+        if self.unit.equation is None:
+            return False
+        try:
+            argspec = inspect.getfullargspec(self.unit.equation)
+        except AttributeError:
+            # Python 2
+            argspec = inspect.getargspec(self.unit.equation)
+        required = argspec.args[:len(argspec.args) - len(argspec.defaults or ())]
+        return "wavelength" in required
+
+    @staticmethod
+    def _geometry_key(poni):
+        return tuple(round(float(value), 12) for value in poni)
+
+    def get_ai(self, position):
+        """Retrieve the azimuthal integrator of a goniometer position
+
+        :param position: the goniometer position
+        :return: AzimuthalIntegrator, shared by all identical geometries
+        """
+        poni = self.goniometer.trans_function(self.goniometer.param, position)
+        key = self._geometry_key(poni)
+        with self._lock:
+            ai = self._ais.get(key)
+            if ai is None:
+                ai = self.goniometer.get_ai(position)
+                if self.chi_disc == 0:
+                    ai.setChiDiscAtZero()
+                else:
+                    ai.setChiDiscAtPi()
+                self._ais[key] = ai
+        return ai
+
+    def _get_matrix(self, ai, shape):
+        """Retrieve the sparse matrix of a geometry
+
+        :param ai: azimuthal integrator of the position
+        :param shape: shape of the image
+        :return: scipy.sparse.csr_matrix, number of pixel per bin, CSR integrator
+        """
+        from scipy.sparse import csr_matrix
+        key = list(self._geometry_key((ai.dist, ai.poni1, ai.poni2, ai.rot1, ai.rot2, ai.rot3)))
+        if (self.npt_azim is None) and self.full_azimuth:
+            # the radial position does not depend on the rotation around the beam
+            key[5] = None
+        key = tuple(key) + (tuple(shape),)
+        if self._wavelength_dependent:
+            # i.e. q or d*, when the wavelength changes along the scan
+            key += (ai.wavelength,)
+        with self._lock:
+            entry = self._matrices.get(key)
+        if entry is not None:
+            return entry
+
+        split = self.method.split_lower
+        if split == "pseudo":
+            split = "full"
+        radial_range = tuple(i / self.unit.scale for i in self.radial_range)
+        azimuth_range = tuple(deg2rad(self.azimuth_range[i]) for i in (0, -1))
+        if azimuth_range[1] <= azimuth_range[0]:
+            azimuth_range = (azimuth_range[0], azimuth_range[1] + 2 * pi)
+        ai.check_chi_disc(azimuth_range)
+        mask = self.mask if self.mask is not None else ai.mask
+        if mask is None:
+            mask_crc = None
+        else:
+            mask = numpy.ascontiguousarray(mask)
+            mask_crc = crc32(mask)
+        integr = ai.setup_CSR(shape, self.npt, mask, radial_range, azimuth_range,
+                              mask_checksum=mask_crc, unit=self.unit, split=split)
+        csr = csr_matrix((integr.data, integr.indices, integr.indptr),
+                         shape=(len(integr.indptr) - 1, integr.size))
+        entry = (csr, csr.dot(numpy.ones(integr.size, dtype=numpy.float64)), integr)
+        with self._lock:
+            self._matrices[key] = entry
+        return entry
+
+    def add(self, image, position, monitor=1.0, variance=None):
+        """Integrate one image and accumulate it into the result
+
+        :param image: 2D array with the image
+        :param position: goniometer position of the image
+        :param monitor: normalization monitor value of this image
+        :param variance: variance of the image, by default the one of the error model
+        """
+        ai = self.get_ai(position)
+        csr, count, integr = self._get_matrix(ai, image.shape)
+        normalization = ai._normalization_image(image.shape, self.correctSolidAngle,
+                                                self.polarization_factor)
+        signal = numpy.array(image, dtype=numpy.float64).ravel()
+        dark = ai.detector.darkcurrent
+        if dark is not None:
+            signal -= dark.ravel()
+        if normalization is not None:
+            signal /= normalization.ravel()
+        sum_ = csr.dot(signal) / monitor
+        sac = (ai.pixel1 * ai.pixel2 / ai.dist ** 2) if self.correctSolidAngle else 1.0
+        if variance is None and self.error_model == "poisson":
+            variance = image
+        if variance is not None:
+            variance = numpy.array(variance, dtype=numpy.float64).ravel()
+            if normalization is not None:
+                variance /= normalization.ravel() ** 2
+            sum_variance = csr.multiply(csr).dot(variance) / monitor ** 2
+        else:
+            sum_variance = None
+
+        with self._lock:
+            if self._sum is None:
+                self._integrator = integr
+                self._sum = numpy.zeros_like(sum_)
+                self._count = numpy.zeros_like(sum_)
+            self._sum += sum_
+            self._count += count * sac
+            if sum_variance is not None:
+                if self._sum_variance is None:
+                    self._sum_variance = numpy.zeros_like(sum_)
+                self._sum_variance += sum_variance
+            self.nframes += 1
+
+    def result(self):
+        """Normalized result of all images added so far
+
+        :return: Integrate1dResult or Integrate2dResult
+        """
+        with self._lock:
+            if self._sum is None:
+                raise RuntimeError("No image integrated in the scan")
+            sum_ = self._sum.copy()
+            count = self._count.copy()
+            sum_variance = None if self._sum_variance is None else self._sum_variance.copy()
+            integr = self._integrator
+        if self.npt_azim is not None:
+            # bins are ordered as (radial, azimuthal) in the sparse matrix
+            sum_ = sum_.reshape(self.npt).T
+            count = count.reshape(self.npt).T
+            if sum_variance is not None:
+                sum_variance = sum_variance.reshape(self.npt).T
+
+        tiny = numpy.finfo("float32").tiny
+        norm = numpy.maximum(count, tiny)
+        invalid = count <= 0.0
+        I = sum_ / norm
+        I[invalid] = self.empty
+        if sum_variance is None:
+            sigma = None
+        else:
+            sigma = numpy.sqrt(sum_variance) / norm
+            sigma[invalid] = self.empty
+
+        if self.npt_azim is None:
+            result = Integrate1dResult(integr.bin_centers * self.unit.scale, I, sigma)
+        else:
+            result = Integrate2dResult(I, integr.bin_centers0 * self.unit.scale,
+                                       integr.bin_centers1 * 180.0 / pi, sigma)
+        result._set_unit(self.unit)
+        result._set_sum(sum_)
+        result._set_count(count)
+        return result
+
+
 class SingleGeometry(object):
     """This class represents a single geometry of a detector position on a
     goniometer arm
@@ -37,7 +37,7 @@ __author__ = "Jerome Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "17/12/2018"
+__date__ = "18/02/2019"
 __status__ = "production"
 
 import os
@@ -63,6 +63,7 @@ from . import utils as gui_utils
 from ..detectors import detector_factory, Detector
 from ..geometryRefinement import GeometryRefinement
 from .peak_picker import PeakPicker
+from ..ring_extraction import RingExtraction
 from .. import units
 from .. import average
 from ..utils import measure_offset, expand_args, \
@@ -617,13 +618,15 @@ class AbstractCalibration(object):
             self.read_wavelength()
             self.peakPicker.points.calibrant.wavelength = self.wavelength
 
-    def extract_cpt(self, method="massif", pts_per_deg=1.0):
+    def extract_cpt(self, method="massif", pts_per_deg=1.0, njobs=None):
         """
         Performs an automatic keypoint extraction:
         Can be used in recalib or in calib after a first calibration has been performed.
 
         :param method: method for keypoint extraction
         :param pts_per_deg: number of control points per azimuthal degree (increase for better precision)
+        :param njobs: number of workers searching the rings in parallel,
+            by default all CPU without GUI and 1 with the GUI
         """
         logger.info("in extract_cpt with method %s", method)
         assert self.ai
@@ -661,34 +664,35 @@ class AbstractCalibration(object):
             self.max_rings = tth.size
 
         ms = marchingsquares.MarchingSquaresMergeImpl(ttha, self.mask, use_minmax_cache=True)
-
+        data = self.peakPicker.data
+        extraction = RingExtraction(data, ttha, tth_min, tth_max, mask=self.mask)
+        jobs = []
         for i in range(tth.size):
             if rings >= self.max_rings:
                 break
-            mask = numpy.logical_and(ttha >= tth_min[i], ttha < tth_max[i])
-            if self.mask is not None:
-                mask = numpy.logical_and(mask, numpy.logical_not(self.mask))
-            size = mask.sum(dtype=int)
+            pixels = extraction.ring_pixels(i)
+            size = pixels.size
             if (size > 0):
                 rings += 1
-                self.peakPicker.massif_contour(mask)
                 if self.gui:
+                    self.peakPicker.massif_contour(extraction.ring_mask(pixels))
                     update_fig(self.peakPicker.fig)
-                sub_data = self.peakPicker.data.ravel()[numpy.where(mask.ravel())]
+                sub_data = data.ravel()[pixels]
                 mean = sub_data.mean(dtype=numpy.float64)
                 std = sub_data.std(dtype=numpy.float64)
                 upper_limit = mean + std
-                mask2 = numpy.logical_and(self.peakPicker.data > upper_limit, mask)
-                size2 = mask2.sum(dtype=int)
+                pixels2 = pixels[sub_data > upper_limit]
+                size2 = pixels2.size
                 if size2 < 1000:
                     upper_limit = mean
-                    mask2 = numpy.logical_and(self.peakPicker.data > upper_limit, mask)
-                    size2 = mask2.sum()
+                    pixels2 = pixels[sub_data > upper_limit]
+                    size2 = pixels2.size
                 # length of the arc:
                 points = ms.find_pixels(tth[i])
-                seeds = set((i[0], i[1]) for i in points if mask2[i[0], i[1]])
+                valid = extraction.in_ring(i, points, upper_limit)
+                seeds = set((pt[0], pt[1]) for pt, ok in zip(points, valid) if ok)
                 # max number of points: 360 points for a full circle
-                azimuthal = chia[points[:, 0].clip(0, self.peakPicker.data.shape[0]), points[:, 1].clip(0, self.peakPicker.data.shape[1])]
+                azimuthal = chia[points[:, 0].clip(0, data.shape[0]), points[:, 1].clip(0, data.shape[1])]
                 nb_deg_azim = numpy.unique(numpy.rad2deg(azimuthal).round()).size
                 keep = int(nb_deg_azim * pts_per_deg)
                 if keep == 0:
@@ -699,7 +703,15 @@ class AbstractCalibration(object):
                 logger.info("Extracting datapoint for ring %s (2theta = %.2f deg); "
                             "searching for %i pts out of %i with I>%.1f, dmin=%.1f" %
                             (i, numpy.degrees(tth[i]), keep, size2, upper_limit, dist_min))
-                _res = self.peakPicker.peaks_from_area(mask=mask2, Imin=upper_limit, keep=keep, method=method, ring=i, dmin=dist_min, seed=seeds)
+                jobs.append(extraction.make_job(i, pixels2, upper_limit, keep, dist_min, seeds,
+                                                shuffle=(method == "massif")))
+
+        if njobs is None:
+            njobs = 1 if self.gui else None
+        detector = self.peakPicker.__getattribute__(method)
+        results = extraction.find_peaks(detector, jobs, njobs)
+        for job, points in zip(jobs, results):
+            self.peakPicker.append_peaks(points, job.ring)
 
         self.peakPicker.points.save(self.basename + ".npt")
         if self.weighted:
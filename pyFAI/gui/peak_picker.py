@@ -35,7 +35,7 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "25/10/2018"
+__date__ = "18/02/2019"
 __status__ = "production"
 
 import os
@@ -211,19 +211,31 @@ class PeakPicker(object):
         obj = self.__getattribute__(method)
 
         points = obj.peaks_from_area(**kwargs)
-        if points:
-            gpt = self.points.append(points, ring)
-            if self.fig:
-                npl = numpy.array(points)
-                gpt.plot = self.ax.plot(npl[:, 1], npl[:, 0], "o", scalex=False, scaley=False)
-                pt0x = gpt.points[0][1]
-                pt0y = gpt.points[0][0]
-                gpt.annotate = self.ax.annotate(gpt.label, xy=(pt0x, pt0y), xytext=(pt0x + 10, pt0y + 10),
-                                                weight="bold", size="large", color="black",
-                                                arrowprops=dict(facecolor='white', edgecolor='white'))
-                update_fig(self.fig)
+        self.append_peaks(points, ring)
         return points
 
+    def append_peaks(self, points, ring=0):
+        """
+        Add a group of peaks to the control points, and display them
+
+        :param points: list of peaks [y,x], [y,x], ...]
+        :param ring: ring number to which assign the points
+        :return: the group of points or None if empty
+        """
+        if not points:
+            return
+        gpt = self.points.append(points, ring)
+        if self.fig:
+            npl = numpy.array(points)
+            gpt.plot = self.ax.plot(npl[:, 1], npl[:, 0], "o", scalex=False, scaley=False)
+            pt0x = gpt.points[0][1]
+            pt0y = gpt.points[0][0]
+            gpt.annotate = self.ax.annotate(gpt.label, xy=(pt0x, pt0y), xytext=(pt0x + 10, pt0y + 10),
+                                            weight="bold", size="large", color="black",
+                                            arrowprops=dict(facecolor='white', edgecolor='white'))
+            update_fig(self.fig)
+        return gpt
+
     def reset(self):
         """
         Reset control point and graph (if needed)
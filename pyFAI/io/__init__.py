@@ -45,7 +45,7 @@ __author__ = "Jerome Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "05/02/2019"
+__date__ = "18/02/2019"
 __status__ = "production"
 __docformat__ = 'restructuredtext'
 
@@ -65,6 +65,7 @@ except ImportError:
 
 
 from ..utils import StringTypes, fully_qualified_name
+from ..third_party import six
 from .. import units
 from .. import version
 from .. import containers
@@ -81,6 +82,10 @@ else:
         h5py._errors.silence_errors()
     except AttributeError:  # old h5py
         pass
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 try:
     import fabio
 except ImportError:
@@ -215,20 +220,56 @@ class Writer(object):
                 self.__setattr__(k, v)
 
 
+def get_compression(name):
+    """Arguments of `h5py.Group.create_dataset` for a compression filter
+
+    "lz4" and "bitshuffle" (with LZ4) require the hdf5plugin package.
+
+    :param name: None, "gzip", "lzf", "lz4" or "bitshuffle"
+    :return: dict with the keyword arguments, empty if not available
+    """
+    if not name:
+        return {}
+    name = name.lower()
+    if name in ("gzip", "lzf"):
+        return {"compression": name}
+    if name in ("lz4", "bitshuffle"):
+        if hdf5plugin is None:
+            logger.warning("Compression %s requires hdf5plugin, data are not compressed", name)
+            return {}
+        if name == "lz4":
+            return dict(hdf5plugin.LZ4())
+        return dict(hdf5plugin.Bitshuffle())
+    raise RuntimeError("Unknown compression %s" % name)
+
+
 class HDF5Writer(Writer):
     """
     Class allowing to write HDF5 Files.
+
+    By default every frame is written synchronously. With `buffer_frames`,
+    frames are gathered in memory and written by slabs from a background
+    thread; at most `max_pending` slabs are waiting for writing, after which
+    `write` blocks (back-pressure).
     """
     CONFIG = "config"
     DATASET_NAME = "data"
 
-    def __init__(self, filename, hpath="data", fast_scan_width=None, append_frames=False):
+    def __init__(self, filename, hpath="data", fast_scan_width=None, append_frames=False,
+                 chunk_frames=1, compression=None, buffer_frames=0, max_pending=2,
+                 start_frame=0):
         """
         Constructor of an HDF5 writer:
 
         :param filename: name of the file
         :param hpath: name of the group: it will contain data (2-4D dataset), [tth|q|r] and pyFAI, group containing the configuration
         :param fast_scan_width: set it to define the width of
+        :param chunk_frames: number of frames per HDF5 chunk, the dataset is also extended by this number of frames
+        :param compression: compression filter, see `get_compression`
+        :param buffer_frames: number of frames written at once by the background thread, 0 to write synchronously
+        :param max_pending: maximum number of slabs waiting for writing
+        :param start_frame: index of the first frame to write, to resume an
+            interrupted processing: the frames already in the file are kept
         """
         Writer.__init__(self, filename)
         self.hpath = hpath
@@ -255,6 +296,18 @@ class HDF5Writer(Writer):
         self.ndim = None
         self._current_frame = None
         self._append_frames = append_frames
+        self.chunk_frames = max(1, int(chunk_frames or 1))
+        self.compression = compression
+        self.buffer_frames = max(0, int(buffer_frames or 0))
+        self.max_pending = max(1, int(max_pending))
+        self._nframes = 0  # number of frames (or lines in fast scan) written
+        self.start_frame = max(0, int(start_frame or 0))
+        self._buffer = None
+        self._buffer_index = None
+        self._buffer_size = 0
+        self._queue = None
+        self._thread = None
+        self._error = None
 
     def __repr__(self):
         return "HDF5 writer on file %s:%s %sinitialized" % (self.filename, self.hpath, "" if self._initialized else "un")
@@ -277,10 +330,10 @@ class HDF5Writer(Writer):
                 raise RuntimeError("No h5py library, no chance")
 
             try:
-                self.hdf5 = h5py.File(self.filename)
+                self.hdf5 = h5py.File(self.filename, "a")
             except IOError:  # typically a corrupted HDF5 file !
                 os.unlink(self.filename)
-                self.hdf5 = h5py.File(self.filename)
+                self.hdf5 = h5py.File(self.filename, "a")
             self.hdf5.attrs["default"] = numpy.string_(self.hpath)
 
             self.entry = self.hdf5.require_group(self.hpath)
@@ -289,8 +342,8 @@ class HDF5Writer(Writer):
 
             self.process = self.entry.require_group("integrate")
             self.process.attrs["NX_class"] = numpy.string_("NXprocess")
-            self.process["program"] = numpy.string_("PyFAI")
-            self.process["version"] = numpy.string_(version)
+            self._replace(self.process, "program", numpy.string_("PyFAI"))
+            self._replace(self.process, "version", numpy.string_(version))
             self.process.attrs["default"] = numpy.string_("results")
 
             self.nxdata = self.process.require_group("results")
@@ -305,7 +358,7 @@ class HDF5Writer(Writer):
                 try:
                     if isinstance(value, (tuple, list, dict)):
                         value = json.dumps(value)
-                    self.config[key] = value
+                    self._replace(self.config, key, value)
                 except Exception as e:
                     logger.error("Unable to set %s: %s", key, value)
                     logger.debug("Backtrace", exc_info=True)
@@ -334,25 +387,36 @@ class HDF5Writer(Writer):
                 self.fast_motor.attrs["axis"] = numpy.string_("1")
                 self.radial_values.attrs["axis"] = numpy.string_("2")
                 if do_2D:
-                    chunk = 1, self.fast_scan_width, self.fai_cfg["nbpt_azim"], self.fai_cfg["nbpt_rad"]
+                    chunk = self.chunk_frames, self.fast_scan_width, self.fai_cfg["nbpt_azim"], self.fai_cfg["nbpt_rad"]
                     self.ndim = 4
                     self.azimuthal_values.attrs["axis"] = numpy.string_("3")
                 else:
-                    chunk = 1, self.fast_scan_width, self.fai_cfg["nbpt_rad"]
+                    chunk = self.chunk_frames, self.fast_scan_width, self.fai_cfg["nbpt_rad"]
                     self.ndim = 3
             else:
                 self.radial_values.attrs["axis"] = numpy.string_("1")
                 if do_2D:
-                    chunk = 1, self.fai_cfg["nbpt_azim"], self.fai_cfg["nbpt_rad"]
+                    chunk = self.chunk_frames, self.fai_cfg["nbpt_azim"], self.fai_cfg["nbpt_rad"]
                     self.ndim = 3
                     self.azimuthal_values.attrs["axis"] = numpy.string_("2")
                 else:
                     self.nxdata.attrs["axis"] = numpy.string_("radial")
-                    chunk = 1, self.fai_cfg["nbpt_rad"]
+                    chunk = self.chunk_frames, self.fai_cfg["nbpt_rad"]
                     self.ndim = 2
 
+            previous = None
             if self.DATASET_NAME in self.nxdata:
-                del self.nxdata[self.DATASET_NAME]
+                previous = self.nxdata[self.DATASET_NAME]
+                if self.start_frame and (previous.shape[1:] == tuple(chunk[1:])):
+                    if previous.shape[0] < self.start_frame:
+                        logger.warning("Only %s frames in %s, resuming at frame %s",
+                                       previous.shape[0], self.filename, self.start_frame)
+                else:
+                    if self.start_frame:
+                        logger.warning("Dataset in %s does not match, frames before %s are lost",
+                                       self.filename, self.start_frame)
+                    del self.nxdata[self.DATASET_NAME]
+                    previous = None
             shape = list(chunk)
             if self.lima_cfg.get("number_of_frames", 0) > 0:
                 if self.fast_scan_width is not None:
@@ -365,8 +429,12 @@ class HDF5Writer(Writer):
             else:
                 dtype = numpy.dtype(dtype)
             # FIXME: Number of frames could be provided optionally to the constructor
-            self.dataset = self.nxdata.require_dataset(self.DATASET_NAME, shape, dtype=dtype, chunks=chunk,
-                                                       maxshape=(None,) + chunk[1:])
+            if previous is not None:
+                self.dataset = previous
+            else:
+                self.dataset = self.nxdata.require_dataset(self.DATASET_NAME, shape, dtype=dtype, chunks=chunk,
+                                                           maxshape=(None,) + chunk[1:],
+                                                           **get_compression(self.compression))
             if do_2D:
                 self.nxdata.attrs["interpretation"] = numpy.string_("image")
                 self.dataset.attrs["interpretation"] = numpy.string_("image")
@@ -379,9 +447,96 @@ class HDF5Writer(Writer):
             name = "Mapping " if self.fast_scan_width else "Scanning "
             name += "2D" if self.fai_cfg.get("nbpt_azim", 0) > 1 else "1D"
             name += " experiment"
-            self.entry["title"] = numpy.string_(name)
-            self.entry["start_time"] = numpy.string_(get_isotime())
-            self.process["start_time"] = numpy.string_(get_isotime())
+            self._replace(self.entry, "title", numpy.string_(name))
+            self._replace(self.entry, "start_time", numpy.string_(get_isotime()))
+            self._replace(self.process, "start_time", numpy.string_(get_isotime()))
+            self._nframes = 0
+            if self.start_frame:
+                self._reserve(self.start_frame)
+                if self._append_frames:
+                    self._current_frame = self.start_frame - 1
+            if self.buffer_frames and self.fast_scan_width:
+                logger.warning("Buffered writing is not available for mapping experiments, frames are written synchronously")
+                self.buffer_frames = 0
+            if self.buffer_frames:
+                self._queue = six.moves.queue.Queue(self.max_pending)
+                self._thread = threading.Thread(target=self._write_slabs, name="HDF5Writer")
+                self._thread.daemon = True
+                self._thread.start()
+
+    @staticmethod
+    def _replace(group, name, value):
+        """Set a dataset in a group, replacing the one of a previous run"""
+        if name in group:
+            del group[name]
+        group[name] = value
+
+    def _reserve(self, size):
+        """Extend the dataset to contain at least `size` frames.
+
+        Must be called with the semaphore acquired.
+        The dataset grows by whole chunks to limit the number of resizes.
+        """
+        self._nframes = max(self._nframes, size)
+        if size > self.dataset.shape[0]:
+            chunks = self.chunk[0]
+            self.dataset.resize(chunks * ((size + chunks - 1) // chunks), axis=0)
+
+    def _write_slabs(self):
+        """Background thread writing the slabs of frames"""
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                if self._error is not None:
+                    continue
+                start, slab = job
+                try:
+                    with self._sem:
+                        self._reserve(start + len(slab))
+                        self.dataset[start:start + len(slab)] = slab
+                except Exception as err:
+                    logger.error("Unable to write frames %s-%s: %s", start, start + len(slab) - 1, err)
+                    logger.debug("Backtrace", exc_info=True)
+                    self._error = err
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _send_buffer(self):
+        """Hand the frames buffered so far to the background thread"""
+        if self._buffer_size:
+            self._queue.put((self._buffer_index, self._buffer[:self._buffer_size]))
+        self._buffer = None
+        self._buffer_index = None
+        self._buffer_size = 0
+
+    def _buffer_frame(self, index, intensity):
+        """Add a frame to the buffer, sent for writing when full or when
+        frames are not consecutive"""
+        self._check_error()
+        if (self._buffer is not None) and \
+           (index != self._buffer_index + self._buffer_size or self._buffer_size == self.buffer_frames):
+            self._send_buffer()
+        if self._buffer is None:
+            self._buffer = numpy.empty((self.buffer_frames,) + self.dataset.shape[1:], dtype=self.dataset.dtype)
+            self._buffer_index = index
+        self._buffer[self._buffer_size] = intensity
+        self._buffer_size += 1
+        if self._buffer_size == self.buffer_frames:
+            self._send_buffer()
+
+    def _wait_writing(self):
+        """Write all buffered frames and wait for the background thread"""
+        if self._queue is not None:
+            self._send_buffer()
+            self._queue.join()
+            self._check_error()
 
     def flush(self, radial=None, azimuthal=None):
         """
@@ -390,6 +545,7 @@ class HDF5Writer(Writer):
         :param radial: position in radial direction
         :param  azimuthal: position in azimuthal direction
         """
+        self._wait_writing()
         with self._sem:
             if not self.hdf5:
                 raise RuntimeError('No opened file')
@@ -404,16 +560,28 @@ class HDF5Writer(Writer):
                 else:
                     logger.warning("Unable to assign azimuthal axis position")
             if self.process is not None:
-                self.process["end_time"] = numpy.string_(get_isotime())
+                self._replace(self.process, "end_time", numpy.string_(get_isotime()))
             if self.entry is not None:
-                self.entry["end_time"] = numpy.string_(get_isotime())
+                self._replace(self.entry, "end_time", numpy.string_(get_isotime()))
             self.hdf5.flush()
 
     def close(self):
         logger.debug("Close")
         if self.hdf5:
-            self.flush()
+            try:
+                self.flush()
+            finally:
+                if self._thread is not None:
+                    self._queue.put(None)
+                    self._thread.join()
+                    self._thread = None
+                    self._queue = None
             with self._sem:
+                if (self.dataset is not None) and \
+                        (self.dataset.shape[0] > self._nframes) and \
+                        not self.lima_cfg.get("number_of_frames", 0):
+                    # remove the frames pre-allocated but never written, if any
+                    self.dataset.resize(self._nframes, axis=0)
                 self.hdf5.close()
                 self.hdf5 = None
 
@@ -456,14 +624,15 @@ class HDF5Writer(Writer):
             if self.dataset is None:
                 logger.warning("Writer not initialized !")
                 return
-            if self.fast_scan_width:
+            if self._queue is not None:
+                # frames are buffered after releasing the semaphore, needed by the background thread
+                pass
+            elif self.fast_scan_width:
                 index0, index1 = (index // self.fast_scan_width, index % self.fast_scan_width)
-                if index0 >= self.dataset.shape[0]:
-                    self.dataset.resize(index0 + 1, axis=0)
+                self._reserve(index0 + 1)
                 self.dataset[index0, index1] = data
             else:
-                if index >= self.dataset.shape[0]:
-                    self.dataset.resize(index + 1, axis=0)
+                self._reserve(index + 1)
                 self.dataset[index] = intensity
             if (not self.has_azimuthal_values) and \
                (azimuthal is not None) and \
@@ -479,6 +648,8 @@ class HDF5Writer(Writer):
                self.radial_values is not None:
                 self.radial_values[:] = radial
                 self.has_radial_values = True
+        if self._queue is not None:
+            self._buffer_frame(index, intensity)
 
 
 class DefaultAiWriter(Writer):
@@ -899,7 +1070,7 @@ class Nexus(object):
         if pre_existing and self.mode == "r":
             self.h5 = h5py.File(self.filename, mode=self.mode)
         else:
-            self.h5 = h5py.File(self.filename)
+            self.h5 = h5py.File(self.filename, mode="a")
         self.to_close = []
 
         if not pre_existing:
@@ -948,7 +1119,7 @@ class Nexus(object):
 
         :return: list of HDF5 groups
         """
-        entries = [(grp, from_isotime(self.h5[grp + "/start_time"].value))
+        entries = [(grp, from_isotime(self.h5[grp + "/start_time"][()]))
                    for grp in self.h5
                    if isinstance(self.h5[grp], h5py.Group) and
                    ("start_time" in self.h5[grp]) and
@@ -1089,7 +1260,7 @@ class Nexus(object):
                 else:
                     logger.warning("Not overwriting %s in %s", toplevel[name].name, self.filename)
                     return
-            toplevel[name] = obj.value
+            toplevel[name] = obj[()]
             for k, v in obj.attrs.items():
                 toplevel[name].attrs[k] = v
 
@@ -0,0 +1,205 @@
+# coding: utf-8
+#
+#    Project: Azimuthal integration
+#             https://github.com/silx-kit/pyFAI
+#
+#    Copyright (C) 2019 European Synchrotron Radiation Facility, Grenoble, France
+#
+#    Principal author:       Jérôme Kieffer (Jerome.Kieffer@ESRF.eu)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Journal of a batch processing, to resume it after an interruption.
+
+The journal is a text file with one JSON record per line. The first record
+describes the processing (its configuration), each of the following ones a
+frame already processed: the input file, the index of the frame in the
+input, the output file and the index of the frame in the output.
+
+Frames are recorded only once their result is on disk, so after a crash
+(or the preemption of a node) the processing can be restarted with the same
+journal: recorded frames are skipped and outputs are completed from the
+recorded offsets.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+__author__ = "Jerome Kieffer"
+__contact__ = "Jerome.Kieffer@ESRF.eu"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "18/02/2019"
+__status__ = "development"
+__docformat__ = 'restructuredtext'
+
+import os
+import json
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Journal(object):
+    """Append-only journal of the frames processed by a batch processing"""
+
+    VERSION = "pyFAI journal v1"
+
+    def __init__(self, filename, config=None, resume=True):
+        """Open a journal, re-using the records of a previous processing
+
+        :param filename: name of the journal file
+        :param config: JSON-serializable description of the processing, a
+            journal recorded with another configuration is discarded
+        :param resume: set to False to discard the previous records
+        """
+        self.filename = os.path.abspath(filename)
+        self.config = self._serialize(config)
+        self._lock = threading.Lock()
+        self._done = {}  # (input, frame): (output, offset)
+        self._offsets = {}  # output: number of frames recorded
+        if resume and os.path.exists(self.filename):
+            if not self._load():
+                logger.warning("Journal %s does not match the processing: starting from scratch",
+                               self.filename)
+                self._done = {}
+                self._offsets = {}
+                resume = False
+        else:
+            resume = False
+        self._fd = open(self.filename, "a" if resume else "w")
+        if not resume:
+            self._append([{"journal": self.VERSION, "config": self.config}])
+        else:
+            logger.info("Resuming from journal %s: %s frames already processed",
+                        self.filename, len(self._done))
+
+    def __repr__(self):
+        return "Journal %s: %s frames processed" % (self.filename, len(self._done))
+
+    def __len__(self):
+        return len(self._done)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _serialize(config):
+        "Canonical JSON representation of the configuration"
+        return json.loads(json.dumps(config, sort_keys=True, default=str))
+
+    @staticmethod
+    def _key(input_name, frame):
+        return (str(input_name), int(frame))
+
+    def _load(self):
+        """Read the records of a previous processing
+
+        :return: False if the journal does not correspond to this processing
+        """
+        with open(self.filename, "rb") as fd:
+            lines = fd.readlines()
+        if lines and not lines[-1].endswith(b"\n"):
+            # last record interrupted while being written
+            logger.debug("Discard incomplete record in journal: %s", lines[-1])
+            lines.pop()
+            with open(self.filename, "rb+") as fd:
+                fd.truncate(sum(len(line) for line in lines))
+        if not lines:
+            return False
+        try:
+            header = json.loads(lines[0].decode("utf-8"))
+        except ValueError:
+            return False
+        if header.get("journal") != self.VERSION or header.get("config") != self.config:
+            return False
+        for line in lines[1:]:
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                logger.warning("Skip corrupted record in journal %s: %s", self.filename, line)
+                continue
+            self._register(record)
+        return True
+
+    def _register(self, record):
+        key = self._key(record["input"], record["frame"])
+        output = record.get("output")
+        offset = record.get("offset")
+        self._done[key] = (output, offset)
+        if output is not None and offset is not None:
+            self._offsets[output] = max(self._offsets.get(output, 0), offset + 1)
+
+    def _append(self, records):
+        for record in records:
+            self._fd.write(json.dumps(record) + "\n")
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+
+    def is_done(self, input_name, frame=0):
+        """Tell if a frame was already processed
+
+        :param input_name: name of the input (i.e. filename)
+        :param frame: index of the frame in the input
+        :rtype: bool
+        """
+        return self._key(input_name, frame) in self._done
+
+    def get_offset(self, output):
+        """Number of frames recorded in an output
+
+        :param output: name of the output
+        :return: index of the next frame to write in this output
+        """
+        return self._offsets.get(output, 0)
+
+    def record(self, input_name, frame=0, output=None, offset=None):
+        """Record a frame processed, once its result is on disk
+
+        :param input_name: name of the input (i.e. filename)
+        :param frame: index of the frame in the input
+        :param output: name of the output file, if any
+        :param offset: index of the frame in the output, if any
+        """
+        self.record_many([(input_name, frame, output, offset)])
+
+    def record_many(self, records):
+        """Record several frames at once
+
+        :param records: list of 4-tuple (input_name, frame, output, offset)
+        """
+        records = [{"input": str(input_name), "frame": int(frame), "output": output,
+                    "offset": None if offset is None else int(offset)}
+                   for input_name, frame, output, offset in records]
+        with self._lock:
+            if self._fd is None:
+                raise RuntimeError("Journal %s is closed" % self.filename)
+            self._append(records)
+            for record in records:
+                self._register(record)
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                self._fd.close()
+                self._fd = None
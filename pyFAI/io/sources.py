@@ -0,0 +1,292 @@
+# coding: utf-8
+#
+#    Project: Azimuthal integration
+#             https://github.com/silx-kit/pyFAI
+#
+#    Copyright (C) 2019 European Synchrotron Radiation Facility, Grenoble, France
+#
+#    Principal author:       Jérôme Kieffer (Jerome.Kieffer@ESRF.eu)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Sources of frames for the batch processing.
+
+A source gives access to the frames of an input file. Uncompressed EDF files
+and uncompressed HDF5 datasets (contiguous, or chunked frame by frame) are
+memory-mapped: frames are views on the file, pages are read by the operating
+system when the integrator accesses them, without intermediate copy.
+All other formats are read with FabIO.
+
+Frames are provided as `fabio.numpyimage.NumpyImage` with the data and the
+header of the frame, as expected by the rest of the processing. The
+memory-mapping is copy-on-write, so frames are writable and modifications are
+never written back to the file.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+__author__ = "Jerome Kieffer"
+__contact__ = "Jerome.Kieffer@ESRF.eu"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "18/02/2019"
+__status__ = "development"
+__docformat__ = 'restructuredtext'
+
+import os
+import threading
+import logging
+import numpy
+import fabio
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+class FrameSource(object):
+    """Access to the frames of an input file
+
+    Mimics the part of the FabIO API used for the processing: `filename`,
+    `nframes`, `getframe`, `data` and `header` of the first frame.
+    """
+
+    zero_copy = False
+    "True when frames are views on the file, without copy"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.nframes = 0
+
+    def __repr__(self):
+        return "%s on %s: %i frames" % (self.__class__.__name__, self.filename, self.nframes)
+
+    def __len__(self):
+        return self.nframes
+
+    def __iter__(self):
+        for index in range(self.nframes):
+            yield self.getframe(index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def getframe(self, index):
+        """Retrieve a frame
+
+        :param index: index of the frame
+        :return: image with data and header
+        :rtype: fabio.fabioimage.FabioImage
+        """
+        raise NotImplementedError("FrameSource is an abstract class")
+
+    @property
+    def data(self):
+        return self.getframe(0).data
+
+    @property
+    def header(self):
+        return self.getframe(0).header
+
+    def close(self):
+        pass
+
+
+class FabioSource(FrameSource):
+    """Frames read and decompressed by FabIO"""
+
+    def __init__(self, filename):
+        FrameSource.__init__(self, filename)
+        self._image = fabio.open(filename)
+        self.filename = self._image.filename
+        self.nframes = self._image.nframes
+        self._lock = threading.Lock()
+
+    def getframe(self, index):
+        if not 0 <= index < self.nframes:
+            raise IndexError("Frame %s out of range" % index)
+        if self.nframes == 1:
+            return self._image
+        with self._lock:
+            return self._image.getframe(index)
+
+    def close(self):
+        self._image = None
+
+
+class _MmapSource(FrameSource):
+    """Frames as views on a copy-on-write memory map of the file"""
+
+    zero_copy = True
+
+    def __init__(self, filename):
+        FrameSource.__init__(self, filename)
+        self._buffer = None
+        self._frames = []  # list of (offset, dtype, shape, header)
+
+    def _map(self, path):
+        if self._buffer is None:
+            self._buffer = numpy.memmap(path, dtype=numpy.uint8, mode="c")
+        return self._buffer
+
+    def getframe(self, index):
+        if not 0 <= index < self.nframes:
+            raise IndexError("Frame %s out of range" % index)
+        offset, dtype, shape, header = self._frames[index]
+        size = int(numpy.prod(shape)) * dtype.itemsize
+        data = self._buffer[offset: offset + size].view(dtype).reshape(shape)
+        return fabio.numpyimage.NumpyImage(data=data, header=header)
+
+    def close(self):
+        self._buffer = None
+
+
+def _native_dtype(dtype):
+    """Check the data can be used without conversion
+
+    :param dtype: numpy dtype of the data in the file
+    :return: the native dtype
+    :raise ValueError: if the byte-order needs to be swapped
+    """
+    dtype = numpy.dtype(dtype)
+    if dtype.kind not in "iuf":
+        raise ValueError("Unsupported data type %s" % dtype)
+    if not dtype.isnative:
+        raise ValueError("Byte order is not native")
+    return dtype.newbyteorder("=")
+
+
+class EdfMmapSource(_MmapSource):
+    """Memory-mapped uncompressed EDF file"""
+
+    def __init__(self, filename):
+        """
+        :param filename: name of the EDF file
+        :raise ValueError: if the file cannot be memory-mapped
+        """
+        _MmapSource.__init__(self, filename)
+        with open(filename, "rb") as f:
+            magic = f.read(3)
+        if magic[:2] == b"\x1f\x8b" or magic == b"BZh":
+            # fabio reads gzip/bzip2 files transparently, offsets do not match the file
+            raise ValueError("Compressed file")
+        image = fabio.openheader(filename)
+        if not isinstance(image, fabio.edfimage.EdfImage):
+            raise ValueError("Not an EDF file")
+        file_size = os.path.getsize(filename)
+        for frame in image._frames:
+            if getattr(frame, "_data_compression", None) or getattr(frame, "bfname", None):
+                raise ValueError("Compressed or external data")
+            header = frame.header
+            byteorder = header.get("ByteOrder", "LowByteFirst")
+            data_type = header.get("DataType")
+            if data_type not in fabio.edfimage.DATA_TYPES:
+                raise ValueError("Unknown data type %s" % data_type)
+            dtype = numpy.dtype(fabio.edfimage.DATA_TYPES[data_type])
+            dtype = dtype.newbyteorder("<" if byteorder == "LowByteFirst" else ">")
+            dtype = _native_dtype(dtype)
+            shape = tuple(frame.shape)
+            if numpy.prod(shape) * dtype.itemsize != frame.size:
+                raise ValueError("Size of the data block does not match its shape")
+            if frame.start + frame.size > file_size:
+                raise ValueError("Data block beyond the end of the file")
+            self._frames.append((frame.start, dtype, shape, header))
+        self.filename = image.filename
+        self.nframes = len(self._frames)
+        self._map(self.filename)
+
+
+class Hdf5MmapSource(_MmapSource):
+    """Memory-mapped uncompressed HDF5 dataset
+
+    The dataset has to be contiguous, or chunked with one frame per chunk,
+    without any filter (compression, shuffle, ...).
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: name of the file with the path of the dataset, as
+            "filename.h5::/path/to/dataset"
+        :raise ValueError: if the dataset cannot be memory-mapped
+        """
+        _MmapSource.__init__(self, filename)
+        if h5py is None:
+            raise ValueError("h5py is not available")
+        if "::" not in filename:
+            raise ValueError("No dataset path provided")
+        path, name = filename.split("::", 1)
+        with h5py.File(path, "r") as h5:
+            dataset = h5[name]
+            if dataset.ndim not in (2, 3):
+                raise ValueError("Dataset is not an image or a stack of images")
+            if dataset.is_virtual or dataset.external:
+                raise ValueError("Virtual or external dataset")
+            if dataset.id.get_create_plist().get_nfilters():
+                raise ValueError("Filtered (i.e. compressed) dataset")
+            dtype = _native_dtype(dataset.dtype)
+            shape = dataset.shape if dataset.ndim == 3 else (1,) + dataset.shape
+            frame_size = int(numpy.prod(shape[1:])) * dtype.itemsize
+            if dataset.chunks is None:
+                offset = dataset.id.get_offset()
+                if offset is None:
+                    raise ValueError("Dataset not allocated")
+                offsets = [offset + i * frame_size for i in range(shape[0])]
+            elif tuple(dataset.chunks[-2:]) == tuple(shape[-2:]) and \
+                    (dataset.ndim == 2 or dataset.chunks[0] == 1):
+                if not hasattr(dataset.id, "get_chunk_info_by_coord"):
+                    raise ValueError("h5py is too old to locate chunks")
+                offsets = []
+                for i in range(shape[0]):
+                    coord = (i, 0, 0) if dataset.ndim == 3 else (0, 0)
+                    info = dataset.id.get_chunk_info_by_coord(coord)
+                    if info.byte_offset is None:
+                        raise ValueError("Chunk %s not allocated" % i)
+                    offsets.append(info.byte_offset)
+            else:
+                raise ValueError("Chunks do not match frames")
+        self._frames = [(offset, dtype, shape[1:], {}) for offset in offsets]
+        self.nframes = len(self._frames)
+        self._map(path)
+
+
+def open_source(filename, mmap=True):
+    """Open the best source for an input file
+
+    :param filename: name of the file, "filename.h5::/path" for HDF5 datasets
+    :param mmap: set to False to disable memory-mapping
+    :return: source of frames
+    :rtype: FrameSource
+    """
+    if mmap:
+        if "::" in filename:
+            candidates = [Hdf5MmapSource]
+        else:
+            candidates = [EdfMmapSource]
+        for cls in candidates:
+            try:
+                return cls(filename)
+            except Exception as err:
+                logger.debug("%s not usable for %s: %s", cls.__name__, filename, err)
+    return FabioSource(filename)
@@ -31,7 +31,7 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "17/10/2018"
+__date__ = "18/02/2019"
 __status__ = "production"
 
 import sys
@@ -90,6 +90,28 @@ class Massif(object):
         self._sem_binning = threading.Semaphore()
         self._sem_median = threading.Semaphore()
 
+    def __getstate__(self):
+        """Helper function for pickling the massif, i.e. for pools of processes
+
+        :return: the state of the object
+        """
+        state_blacklist = ("_sem", "_sem_label", "_sem_binning", "_sem_median")
+        state = self.__dict__.copy()
+        for key in state_blacklist:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        """Helper function for unpickling the massif
+
+        :param state: the state of the object
+        """
+        self.__dict__.update(state)
+        self._sem = threading.Semaphore()
+        self._sem_label = threading.Semaphore()
+        self._sem_binning = threading.Semaphore()
+        self._sem_median = threading.Semaphore()
+
     def nearest_peak(self, x):
         """
         :param x: coordinates of the peak
@@ -192,10 +214,20 @@ class Massif(object):
         :param seed: list of good guesses to start with
         :return: list of peaks [y,x], [y,x], ...]
         """
-        all_points = numpy.vstack(numpy.where(mask)).T
-        res = []
-        cnt = 0
-        dmin2 = dmin * dmin
+        all_points = self.shuffle_points(numpy.vstack(numpy.where(mask)).T, seed)
+        return self.select_peaks(all_points, mask, Imin, keep, dmin)
+
+    @staticmethod
+    def shuffle_points(all_points, seed=None):
+        """Order in which the points of an area are tried by `peaks_from_area`
+
+        This is the only random part of the peak search: once the points are
+        ordered, `select_peaks` is deterministic.
+
+        :param all_points: array of [y,x] of all pixels in the area, shuffled in place
+        :param seed: list of good guesses, tried first
+        :return: array of [y,x]
+        """
         if len(all_points) > 0:
             numpy.random.shuffle(all_points)
         if seed:
@@ -203,6 +235,24 @@ class Massif(object):
             if len(seeds) > 0:
                 numpy.random.shuffle(seeds)
             all_points = numpy.concatenate((seeds, all_points))
+        return all_points
+
+    def select_peaks(self, all_points, mask, Imin=numpy.finfo(numpy.float64).min,
+                     keep=1000, dmin=0.0):
+        """
+        Climb to the nearest peak from each point, in order, and keep the
+        ones within the area
+
+        :param all_points: array of [y,x] as given by `shuffle_points`
+        :param mask: 2d array with mask.
+        :param Imin: minimum of intensity above the background to keep the point
+        :param keep: maximum number of points to keep
+        :param dmin: minimum distance to another peak
+        :return: list of peaks [y,x], [y,x], ...]
+        """
+        res = []
+        cnt = 0
+        dmin2 = dmin * dmin
         for idx in all_points:
             out = self.nearest_peak(idx)
             if out is not None:
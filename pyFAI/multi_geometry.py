@@ -33,19 +33,24 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "04/02/2019"
+__date__ = "18/02/2019"
 __status__ = "stable"
 __docformat__ = 'restructuredtext'
 
-import collections
+try:
+    from collections.abc import Iterable
+except ImportError:  # Python2
+    from collections import Iterable
 import logging
 logger = logging.getLogger(__name__)
 from .azimuthalIntegrator import AzimuthalIntegrator
 from .containers import Integrate1dResult
 from .containers import Integrate2dResult
 from . import units
+from .utils import deg2rad, crc32
 import threading
 import numpy
+from math import pi
 from .method_registry import IntegrationMethod
 error = None
 
@@ -79,6 +84,7 @@ class MultiGeometry(object):
         self.unit = units.to_unit(unit)
         self.abolute_solid_angle = None
         self.empty = empty
+        self._merged_csr = None
         if chi_disc == 0:
             for ai in self.ais:
                 ai.setChiDiscAtZero()
@@ -113,7 +119,10 @@ class MultiGeometry(object):
         :param all: return a dict with all information in it (deprecated, please refer to the documentation of Integrate1dResult).
         :param lst_mask: numpy.Array or list of numpy.array which mask the lst_data.
         :param lst_flat: numpy.Array or list of numpy.array which flat the lst_data.
-        :param method: integration method, a string or a registered method
+        :param method: integration method, a string or a registered method.
+            With the Cython CSR implementation, all images are integrated at
+            once with a single sparse matrix built over the pixels of all
+            geometries.
         :return: 2th/I or a dict with everything depending on "all"
         :rtype: Integrate1dResult, dict
         """
@@ -123,7 +132,7 @@ class MultiGeometry(object):
             raise RuntimeError("List of images cannot be empty")
         if normalization_factor is None:
             normalization_factor = [1.0] * len(self.ais)
-        elif not isinstance(normalization_factor, collections.Iterable):
+        elif not isinstance(normalization_factor, Iterable):
             normalization_factor = [normalization_factor] * len(self.ais)
         if lst_variance is None:
             lst_variance = [None] * len(self.ais)
@@ -135,9 +144,17 @@ class MultiGeometry(object):
             lst_flat = [None] * len(self.ais)
         elif isinstance(lst_flat, numpy.ndarray):
             lst_flat = [lst_flat] * len(self.ais)
+        if self._use_merged_csr(method, error_model):
+            integr, sum_, count, sum_variance = self._integrate_merged_csr(lst_data, npt, method,
+                                                                           correctSolidAngle, lst_variance,
+                                                                           error_model, polarization_factor,
+                                                                           normalization_factor, lst_mask, lst_flat)
+            radial = integr.bin_centers * self.unit.scale
+            return self._merged_result1d(radial, sum_, count, sum_variance, all)
+
         sum_ = numpy.zeros(npt, dtype=numpy.float64)
         count = numpy.zeros(npt, dtype=numpy.float64)
-        sigma2 = None
+        sum_variance = None
         for ai, data, monitor, variance, mask, flat in zip(self.ais, lst_data, normalization_factor, lst_variance, lst_mask, lst_flat):
             res = ai.integrate1d(data, npt=npt,
                                  correctSolidAngle=correctSolidAngle,
@@ -151,9 +168,10 @@ class MultiGeometry(object):
             count += res.count * sac
             sum_ += res.sum / monitor
             if res.sigma is not None:
-                if sigma2 is None:
-                    sigma2 = numpy.zeros(npt, dtype=numpy.float64)
-                sigma2 += (res.sigma ** 2) / monitor
+                # sigma = sqrt(sum of variance) / count for each geometry
+                if sum_variance is None:
+                    sum_variance = numpy.zeros(npt, dtype=numpy.float64)
+                sum_variance += (res.sigma * res.count / monitor) ** 2
 
         tiny = numpy.finfo("float32").tiny
         norm = numpy.maximum(count, tiny)
@@ -161,8 +179,8 @@ class MultiGeometry(object):
         I = sum_ / norm
         I[invalid] = self.empty
 
-        if sigma2 is not None:
-            sigma = numpy.sqrt(sigma2) / norm
+        if sum_variance is not None:
+            sigma = numpy.sqrt(sum_variance) / norm
             sigma[invalid] = self.empty
             result = Integrate1dResult(res.radial, I, sigma)
         else:
@@ -203,7 +221,10 @@ class MultiGeometry(object):
         :param all: return a dict with all information in it (deprecated, please refer to the documentation of Integrate2dResult).
         :param lst_mask: numpy.Array or list of numpy.array which mask the lst_data.
         :param lst_flat: numpy.Array or list of numpy.array which flat the lst_data.
-        :param method: integration method (or its name)
+        :param method: integration method (or its name).
+            With the Cython CSR implementation, all images are integrated at
+            once with a single sparse matrix built over the pixels of all
+            geometries.
         :return: I/2th/chi or a dict with everything depending on "all"
         :rtype: Integrate2dResult, dict
         """
@@ -211,7 +232,7 @@ class MultiGeometry(object):
             raise RuntimeError("List of images cannot be empty")
         if normalization_factor is None:
             normalization_factor = [1.0] * len(self.ais)
-        elif not isinstance(normalization_factor, collections.Iterable):
+        elif not isinstance(normalization_factor, Iterable):
             normalization_factor = [normalization_factor] * len(self.ais)
         if lst_variance is None:
             lst_variance = [None] * len(self.ais)
@@ -226,9 +247,23 @@ class MultiGeometry(object):
 
         method = IntegrationMethod.select_one_available(method, dim=2)
 
+        if self._use_merged_csr(method, error_model):
+            integr, sum_, count, sum_variance = self._integrate_merged_csr(lst_data, (npt_rad, npt_azim), method,
+                                                                           correctSolidAngle, lst_variance,
+                                                                           error_model, polarization_factor,
+                                                                           normalization_factor, lst_mask, lst_flat)
+            # bins are ordered as (radial, azimuthal) in the sparse matrix
+            sum_ = sum_.reshape(npt_rad, npt_azim).T
+            count = count.reshape(npt_rad, npt_azim).T
+            if sum_variance is not None:
+                sum_variance = sum_variance.reshape(npt_rad, npt_azim).T
+            radial = integr.bin_centers0 * self.unit.scale
+            azimuthal = integr.bin_centers1 * 180.0 / pi
+            return self._merged_result2d(radial, azimuthal, sum_, count, sum_variance, all)
+
         sum_ = numpy.zeros((npt_azim, npt_rad), dtype=numpy.float64)
         count = numpy.zeros_like(sum_)
-        sigma2 = None
+        sum_variance = None
         for ai, data, monitor, variance, mask, flat in zip(self.ais, lst_data, normalization_factor, lst_variance, lst_mask, lst_flat):
             res = ai.integrate2d(data, npt_rad=npt_rad, npt_azim=npt_azim,
                                  correctSolidAngle=correctSolidAngle,
@@ -242,9 +277,10 @@ class MultiGeometry(object):
             count += res.count * sac
             sum_ += res.sum / monitor
             if res.sigma is not None:
-                if sigma2 is None:
-                    sigma2 = count = numpy.zeros_like(sum_)
-                sigma2 += (res.sigma ** 2) / monitor
+                # sigma = sqrt(sum of variance) / count for each geometry
+                if sum_variance is None:
+                    sum_variance = numpy.zeros_like(sum_)
+                sum_variance += (res.sigma * res.count / monitor) ** 2
 
         tiny = numpy.finfo("float32").tiny
         norm = numpy.maximum(count, tiny)
@@ -252,8 +288,8 @@ class MultiGeometry(object):
         I = sum_ / norm
         I[invalid] = self.empty
 
-        if sigma2 is not None:
-            sigma = numpy.sqrt(sigma2) / norm
+        if sum_variance is not None:
+            sigma = numpy.sqrt(sum_variance) / norm
             sigma[invalid] = self.empty
             result = Integrate2dResult(I, res.radial, res.azimuthal, sigma)
         else:
@@ -274,6 +310,174 @@ class MultiGeometry(object):
 
         return result
 
+    @staticmethod
+    def _use_merged_csr(method, error_model=None):
+        """Tell if all images can be integrated at once with a merged sparse matrix
+
+        :param method: IntegrationMethod
+        :param error_model: name of the error model
+        :return: True for the Cython CSR method, except for the "azimuthal" error model
+        """
+        return (method.algo_lower == "csr" and
+                method.impl_lower == "cython" and
+                (error_model or "").lower() != "azimuthal")
+
+    def _get_merged_csr(self, lst_shape, npt, method, lst_mask):
+        """Retrieve the sparse matrix integrating the pixels of all geometries
+
+        The CSR matrices of all geometries are set up with the common ranges
+        (and cached by each azimuthal integrator), then stacked horizontally:
+        the columns of the merged matrix are the concatenated pixels of all
+        images. The merged matrix is kept as long as the matrices of the
+        geometries do not change.
+
+        :param lst_shape: shape of the image of each geometry
+        :param npt: number of bins, int in 1D or (npt_rad, npt_azim) in 2D
+        :param method: IntegrationMethod with a Cython CSR implementation
+        :param lst_mask: mask of each geometry, None to use the detector mask
+        :return: merged scipy.sparse.csr_matrix and the CSR integrator of the first geometry
+        """
+        from scipy.sparse import csr_matrix, hstack
+        split = method.split_lower
+        if split == "pseudo":
+            split = "full"
+        radial_range = tuple(i / self.unit.scale for i in self.radial_range)
+        azimuth_range = tuple(deg2rad(self.azimuth_range[i]) for i in (0, -1))
+        if azimuth_range[1] <= azimuth_range[0]:
+            azimuth_range = (azimuth_range[0], azimuth_range[1] + 2 * pi)
+
+        integrators = []
+        for ai, shape, mask in zip(self.ais, lst_shape, lst_mask):
+            if mask is None:
+                mask = ai.mask
+            if mask is None:
+                mask_crc = None
+            else:
+                mask = numpy.ascontiguousarray(mask)
+                mask_crc = crc32(mask)
+            ai.check_chi_disc(azimuth_range)
+            integrators.append(ai.setup_CSR(shape, npt, mask, radial_range, azimuth_range,
+                                            mask_checksum=mask_crc, unit=self.unit, split=split))
+
+        key = tuple(id(integr) for integr in integrators)
+        with self._sem:
+            if (self._merged_csr is None) or (self._merged_csr[0] != key):
+                blocks = [csr_matrix((integr.data, integr.indices, integr.indptr),
+                                     shape=(len(integr.indptr) - 1, integr.size))
+                          for integr in integrators]
+                # integrators are kept to prevent the re-use of their id
+                self._merged_csr = (key, integrators, hstack(blocks, format="csr"))
+            merged = self._merged_csr[2]
+        return merged, integrators[0]
+
+    def _integrate_merged_csr(self, lst_data, npt, method, correctSolidAngle,
+                              lst_variance, error_model, polarization_factor,
+                              normalization_factor, lst_mask, lst_flat):
+        """Integrate all images with a single sparse matrix product
+
+        Each image is corrected (dark, flat, polarization, solid-angle) and
+        divided by its monitor, the normalization of its pixels is the
+        absolute solid angle of a pixel (or 1), like in the loop over the
+        geometries. Both are concatenated and multiplied at once by the merged
+        matrix.
+
+        The variance is propagated through the squared coefficients of the
+        matrix: `sum_variance` is the sum over all pixels of coef² ·
+        variance / (normalization · monitor)².
+
+        :return: CSR integrator of the first geometry, sum of signal,
+                 sum of normalization and sum of variance (or None), flat
+        """
+        csr, integr = self._get_merged_csr([data.shape for data in lst_data],
+                                           npt, method, lst_mask)
+        error_model = (error_model or "").lower()
+        do_variance = (error_model == "poisson") or \
+            any(variance is not None for variance in lst_variance)
+        signal = []
+        norm = []
+        variances = []
+        for ai, data, monitor, variance, flat in zip(self.ais, lst_data, normalization_factor, lst_variance, lst_flat):
+            normalization = ai._normalization_image(data.shape, correctSolidAngle,
+                                                    polarization_factor, flat)
+            dark = ai.detector.darkcurrent
+            one = numpy.array(data, dtype=numpy.float64).ravel()
+            if dark is not None:
+                one -= dark.ravel()
+            if normalization is not None:
+                one /= normalization.ravel()
+            signal.append(one / monitor)
+            sac = (ai.pixel1 * ai.pixel2 / ai.dist ** 2) if correctSolidAngle else 1.0
+            norm.append(numpy.zeros(one.size, dtype=numpy.float64) + sac)
+            if do_variance:
+                if variance is None:
+                    if error_model == "poisson":
+                        variance = data
+                    else:
+                        variance = numpy.zeros(data.shape)
+                one = numpy.array(variance, dtype=numpy.float64).ravel()
+                if normalization is not None:
+                    one /= normalization.ravel() ** 2
+                variances.append(one / monitor ** 2)
+
+        res = csr.dot(numpy.vstack((numpy.concatenate(signal), numpy.concatenate(norm))).T)
+        if do_variance:
+            sum_variance = csr.multiply(csr).dot(numpy.concatenate(variances))
+        else:
+            sum_variance = None
+        return integr, res[:, 0], res[:, 1], sum_variance
+
+    def _merged_normalize(self, sum_, count, sum_variance):
+        """Calculate intensity and error from the sums of the merged integration
+
+        :return: intensity, error (or None)
+        """
+        tiny = numpy.finfo("float32").tiny
+        norm = numpy.maximum(count, tiny)
+        invalid = count <= 0.0
+        I = sum_ / norm
+        I[invalid] = self.empty
+        if sum_variance is None:
+            sigma = None
+        else:
+            sigma = numpy.sqrt(sum_variance) / norm
+            sigma[invalid] = self.empty
+        return I, sigma
+
+    def _merged_result1d(self, radial, sum_, count, sum_variance, all=False):
+        I, sigma = self._merged_normalize(sum_, count, sum_variance)
+        if all:
+            logger.warning("integrate1d(all=True) is deprecated. Please refer to the documentation of Integrate1dResult")
+            return {"I": I,
+                    "radial": radial,
+                    "unit": self.unit,
+                    "count": count,
+                    "sum": sum_}
+        result = Integrate1dResult(radial, I, sigma)
+        result._set_method_called("integrate1d")
+        result._set_compute_engine("MultiGeometry merged CSR")
+        result._set_unit(self.unit)
+        result._set_sum(sum_)
+        result._set_count(count)
+        return result
+
+    def _merged_result2d(self, radial, azimuthal, sum_, count, sum_variance, all=False):
+        I, sigma = self._merged_normalize(sum_, count, sum_variance)
+        if all:
+            logger.warning("integrate2d(all=True) is deprecated. Please refer to the documentation of Integrate2dResult")
+            return {"I": I,
+                    "radial": radial,
+                    "azimuthal": azimuthal,
+                    "count": count,
+                    "sum": sum_,
+                    "unit": self.unit}
+        result = Integrate2dResult(I, radial, azimuthal, sigma)
+        result._set_method_called("integrate2d")
+        result._set_compute_engine("MultiGeometry merged CSR")
+        result._set_sum(sum_)
+        result._set_count(count)
+        result._set_unit(self.unit)
+        return result
+
     def set_wavelength(self, value):
         """
         Changes the wavelength of a group of azimuthal integrators
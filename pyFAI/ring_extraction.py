@@ -0,0 +1,231 @@
+# coding: utf-8
+#
+#    Project: Azimuthal integration
+#             https://github.com/silx-kit/pyFAI
+#
+#    Copyright (C) 2019 European Synchrotron Radiation Facility, Grenoble, France
+#
+#    Principal author:       Jérôme Kieffer (Jerome.Kieffer@ESRF.eu)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Extraction of control points along the rings of a calibrant.
+
+Pixels are assigned to their ring once, with a single sorted search of the
+2theta array over the boundaries of all rings, then grouped by ring. The
+statistics of a ring only touch the pixels of this ring and the search for
+peaks, which is the expensive part, is performed for all rings in parallel.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+__author__ = "Jerome Kieffer"
+__contact__ = "Jerome.Kieffer@ESRF.eu"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "18/02/2019"
+__status__ = "development"
+__docformat__ = 'restructuredtext'
+
+import logging
+import multiprocessing
+import numpy
+
+from .massif import Massif
+from .utils import parallel
+
+logger = logging.getLogger(__name__)
+
+
+class RingJob(object):
+    """Description of the search for peaks along one ring"""
+
+    def __init__(self, ring, pixels, Imin, keep, dmin, seed, candidates=None):
+        """
+        :param ring: index of the ring
+        :param pixels: flat indices of the pixels of the ring above Imin
+        :param Imin: minimum intensity of the peaks
+        :param keep: maximum number of peaks to keep
+        :param dmin: minimum distance between two peaks
+        :param seed: set of good guesses to start with
+        :param candidates: array of [y,x] in the order they are tried (massif only)
+        """
+        self.ring = ring
+        self.pixels = pixels
+        self.Imin = Imin
+        self.keep = keep
+        self.dmin = dmin
+        self.seed = seed
+        self.candidates = candidates
+
+
+def _process_job(job, context=None):
+    """Search the peaks of one ring
+
+    :param job: RingJob instance
+    :param context: (detector, extraction), by default the one of the pool
+    :return: list of peaks [y,x], [y,x], ...]
+    """
+    if context is None:
+        context = parallel.get_context()
+    detector, extraction = context
+    mask = extraction.ring_mask(job.pixels)
+    if job.candidates is not None:
+        return detector.select_peaks(job.candidates, mask, Imin=job.Imin,
+                                     keep=job.keep, dmin=job.dmin)
+    return detector.peaks_from_area(mask=mask, Imin=job.Imin, keep=job.keep,
+                                    dmin=job.dmin, seed=job.seed)
+
+
+class RingExtraction(object):
+    """Assignment of the pixels of an image to the rings of a calibrant,
+    and parallel search of peaks along those rings.
+    """
+
+    def __init__(self, data, ttha, tth_min, tth_max, mask=None):
+        """Constructor of the engine
+
+        Rings are expected to be sorted and not to overlap, as calculated by
+        the calibration.
+
+        :param data: 2d array with the image
+        :param ttha: 2d array with 2theta of each pixel
+        :param tth_min: array with the lower bound in 2theta of each ring (included)
+        :param tth_max: array with the upper bound in 2theta of each ring (excluded)
+        :param mask: 2d array, non-zero for invalid pixels
+        """
+        self.data = data
+        self.shape = data.shape
+        assert ttha.shape == self.shape
+        tth_min = numpy.ascontiguousarray(tth_min, dtype=numpy.float64)
+        tth_max = numpy.ascontiguousarray(tth_max, dtype=numpy.float64)
+        self.nrings = tth_min.size
+        bounds = numpy.empty(2 * self.nrings, dtype=numpy.float64)
+        bounds[0::2] = tth_min
+        bounds[1::2] = tth_max
+        assert numpy.all(bounds[1:] >= bounds[:-1]), "rings are sorted and do not overlap"
+
+        # odd positions are within a ring: tth_min[i] <= tth < tth_max[i]
+        position = numpy.searchsorted(bounds, ttha.ravel(), side="right")
+        ring_id = numpy.where(position % 2 == 1, position // 2, -1).astype(numpy.int32)
+        if mask is not None:
+            ring_id[numpy.asarray(mask).ravel() != 0] = -1
+        self.ring_id = ring_id.reshape(self.shape)
+
+        # stable sort keeps the pixels of each ring in ascending order
+        order = numpy.argsort(ring_id, kind="mergesort")
+        count = numpy.bincount(ring_id + 1, minlength=self.nrings + 1)
+        self.ring_ptr = numpy.concatenate(([0], numpy.cumsum(count)))[1:]
+        self.ring_pixels_sorted = order
+
+    def ring_size(self, index):
+        """Number of valid pixels in a ring
+
+        :param index: index of the ring
+        :return: number of pixels
+        """
+        return int(self.ring_ptr[index + 1] - self.ring_ptr[index])
+
+    def ring_pixels(self, index):
+        """Pixels belonging to a ring
+
+        :param index: index of the ring
+        :return: array with the flat indices of the pixels, sorted
+        """
+        return self.ring_pixels_sorted[self.ring_ptr[index]:self.ring_ptr[index + 1]]
+
+    def ring_mask(self, pixels):
+        """Build the mask of an area from its pixels
+
+        :param pixels: flat indices of the pixels
+        :return: 2d boolean array, True within the area
+        """
+        mask = numpy.zeros(self.shape, dtype=bool)
+        mask.ravel()[pixels] = True
+        return mask
+
+    def in_ring(self, index, points, Imin):
+        """Check which points belong to a ring and are above a threshold
+
+        :param index: index of the ring
+        :param points: array of [y,x]
+        :param Imin: minimum intensity (excluded)
+        :return: 1d boolean array
+        """
+        points = numpy.asarray(points)
+        if points.size == 0:
+            return numpy.zeros(0, dtype=bool)
+        ys = points[:, 0]
+        xs = points[:, 1]
+        return numpy.logical_and(self.ring_id[ys, xs] == index,
+                                 self.data[ys, xs] > Imin)
+
+    def make_job(self, index, pixels, Imin, keep, dmin, seed, shuffle=False):
+        """Description of the search for peaks along a ring
+
+        :param index: index of the ring
+        :param pixels: flat indices of the pixels above Imin
+        :param Imin: minimum intensity of the peaks
+        :param keep: maximum number of peaks to keep
+        :param dmin: minimum distance between two peaks
+        :param seed: set of good guesses to start with
+        :param shuffle: set to True to define the order of the candidates now,
+            as done by `Massif.peaks_from_area`
+        :return: RingJob instance
+        """
+        candidates = None
+        if shuffle:
+            width = self.shape[1]
+            candidates = numpy.vstack((pixels // width, pixels % width)).T
+            candidates = Massif.shuffle_points(candidates, seed)
+        return RingJob(index, pixels, Imin, keep, dmin, seed, candidates)
+
+    def find_peaks(self, detector, jobs, njobs=None, start_method=None):
+        """Search the peaks along all rings
+
+        Candidates of the jobs have to be defined beforehand, in the order of
+        the rings, as this consumes the random generator: the results are then
+        the same whatever the number of workers.
+
+        :param detector: object with a `peaks_from_area` method, and
+            `select_peaks` for jobs with candidates (i.e. Massif)
+        :param jobs: list of RingJob
+        :param njobs: number of workers, by default the number of CPU.
+            1 to process the rings serially.
+        :param start_method: start method of the workers, see `pyFAI.utils.parallel`.
+            The detector and the extraction are pickled with spawn and forkserver.
+        :return: list of peaks of each job, in the same order
+        """
+        if njobs is None:
+            njobs = multiprocessing.cpu_count()
+        njobs = max(1, min(njobs, len(jobs)))
+        context = (detector, self)
+        if njobs == 1:
+            return [_process_job(job, context) for job in jobs]
+
+        pool = parallel.create_pool(njobs, context, start_method)
+        try:
+            result = pool.map(_process_job, jobs)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return result
@@ -36,11 +36,12 @@ from __future__ import print_function, division
 __author__ = "Jérôme Kieffer"
 __contact__ = "Jerome.Kieffer@esrf.eu"
 __license__ = "MIT"
-__date__ = "05/10/2018"
+__date__ = "18/02/2019"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 
 import os
 import time
+import hashlib
 import numpy
 import logging
 import scipy.optimize
@@ -54,6 +55,7 @@ try:
 except ImportError:
     logger.debug("Backtrace", exc_info=True)
     from scipy.interpolate import fitpack
+from .utils.array_cache import ArrayCache, get_default_cache
 
 
 class Spline(object):
@@ -292,14 +294,16 @@ class Spline(object):
                 (deltax.mean() < 0.01) and(deltay.mean() < 0.01) and
                 (histXmax < 0.01) and (histYmax < 0.01))
 
-    def spline2array(self, timing=False):
+    def spline2array(self, timing=False, cache=None):
         """
         Calculates the displacement matrix using fitpack
         bisplev(x, y, tck, dx = 0, dy = 0)
 
         :param timing: profile the calculation or not
         :type timing: bool
-
+        :param cache: ArrayCache instance or directory name where the
+                      displacement arrays are stored, by default the one
+                      defined by the PYFAI_ARRAY_CACHE environment variable
         :return: xDispArray, yDispArray
         :rtype: 2-tuple of ndarray
 
@@ -308,8 +312,21 @@ class Spline(object):
         values) at points given by the cross-product of the rank-1
         arrays x and y. In special cases, return an array or just a
         float if either x or y or both are floats.
+
+        With a cache, the displacement arrays are calculated only once for
+        a given spline and memory-mapped afterwards.
         """
         if self.xDispArray is None:
+            if cache is None:
+                cache = get_default_cache()
+            elif not isinstance(cache, ArrayCache):
+                cache = ArrayCache(cache)
+            if cache is not None:
+                keys = [self._get_cache_key(cache, name) for name in ("x", "y")]
+                arrays = [cache.load(key) for key in keys]
+                if arrays[0] is not None and arrays[1] is not None:
+                    self.xDispArray, self.yDispArray = arrays
+                    return self.xDispArray, self.yDispArray
             x_1d_array = numpy.arange(self.xmin, self.xmax + 1)
             y_1d_array = numpy.arange(self.ymin, self.ymax + 1)
             startTime = time.time()
@@ -333,8 +350,27 @@ class Spline(object):
                             " Y-Displacement Spline evaluation:  %.3f sec." %
                             ((intermediateTime - startTime),
                              (time.time() - intermediateTime)))
+            if cache is not None:
+                cache.save(keys[0], self.xDispArray)
+                cache.save(keys[1], self.yDispArray)
         return self.xDispArray, self.yDispArray
 
+    def _get_cache_key(self, cache, name):
+        """Key of a displacement array in the array cache
+
+        :param cache: ArrayCache instance
+        :param name: "x" or "y"
+        :return: key as a string
+        """
+        digest = hashlib.sha1()
+        for array in (self.xSplineKnotsX, self.xSplineKnotsY, self.xSplineCoeff,
+                      self.ySplineKnotsX, self.ySplineKnotsY, self.ySplineCoeff):
+            digest.update(numpy.ascontiguousarray(array, dtype=numpy.float64).tobytes())
+        return cache.get_key(spline=digest.hexdigest(),
+                             order=self.splineOrder,
+                             range=[self.xmin, self.xmax, self.ymin, self.ymax],
+                             displacement=name)
+
     def splineFuncX(self, x, y, list_of_points=False):
         """
         Calculates the displacement matrix using fitpack for the X
@@ -355,6 +391,14 @@ class Spline(object):
             elif abs(x[:, 1:] - x[:, :-1] - numpy.zeros((x.shape[0], x.shape[1] - 1))).max() < 1e-6:
                 x = x[:, 0]
                 y = y[0]
+        if list_of_points and x.ndim == 1 and len(x) == len(y) and \
+                "bisplev_points" in dir(fitpack):
+            return fitpack.bisplev_points(x, y,
+                                          [self.xSplineKnotsX,
+                                           self.xSplineKnotsY,
+                                           self.xSplineCoeff,
+                                           self.splineOrder,
+                                           self.splineOrder])
         if list_of_points and x.ndim == 1 and len(x) == len(y):
             size = len(x)
             if size > 1:
@@ -402,6 +446,14 @@ class Spline(object):
                 x = x[:, 0]
                 y = y[0]
 
+        if list_of_points and x.ndim == 1 and len(x) == len(y) and \
+                "bisplev_points" in dir(fitpack):
+            return fitpack.bisplev_points(x, y,
+                                          [self.ySplineKnotsX,
+                                           self.ySplineKnotsY,
+                                           self.ySplineCoeff,
+                                           self.splineOrder,
+                                           self.splineOrder])
         if list_of_points and x.ndim == 1 and len(x) == len(y):
             size = len(x)
             if size > 1:
@@ -429,37 +481,50 @@ class Spline(object):
         else:
             return y_disp_array.T
 
-    def array2spline(self, smoothing=1000, timing=False):
+    def array2spline(self, smoothing=1000, timing=False, step=1):
         """
         Calculates the spline coefficients from the displacements
         matrix using fitpack.
 
+        Displacement fields are smooth: on large detectors, fitting the
+        spline on a sub-sampled grid (one point every `step` pixels, the
+        last row and column being always included) is much faster and gives
+        almost the same spline. The smoothing factor, which is a sum of
+        squared residuals, is scaled by the number of points.
+
         :param smoothing: the greater the smoothing, the fewer the number of knots remaining
         :type smoothing: float
         :param timing: print the profiling of the calculation
         :type timing: bool
+        :param step: sub-sampling of the grid used for the fit, 1 to use all pixels
+        :type step: int
         """
         self.xmin = 0.0
         self.ymin = 0.0
         self.xmax = self.xDispArray.shape[1] - 1.0
         self.ymax = self.yDispArray.shape[0] - 1.0
 
+        step = max(1, int(step))
+        x_idx = numpy.unique(numpy.append(numpy.arange(0, int(self.xmax) + 1, step), int(self.xmax)))
+        y_idx = numpy.unique(numpy.append(numpy.arange(0, int(self.ymax) + 1, step), int(self.ymax)))
+        smoothing = smoothing * (x_idx.size * y_idx.size) / ((self.xmax + 1.0) * (self.ymax + 1.0))
+
         if timing:
             startTime = time.time()
 
         xRectBivariateSpline = scipy.interpolate.fitpack2.RectBivariateSpline(
-            numpy.arange(self.xmax + 1.0),
-            numpy.arange(self.ymax + 1.0),
-            self.xDispArray.transpose(),
+            x_idx.astype(numpy.float64),
+            y_idx.astype(numpy.float64),
+            self.xDispArray[y_idx][:, x_idx].transpose(),
             s=smoothing)
 
         if timing:
             intermediateTime = time.time()
 
         yRectBivariateSpline = scipy.interpolate.fitpack2.RectBivariateSpline(
-            numpy.arange(self.xmax + 1.0),
-            numpy.arange(self.ymax + 1.0),
-            self.yDispArray.transpose(),
+            x_idx.astype(numpy.float64),
+            y_idx.astype(numpy.float64),
+            self.yDispArray[y_idx][:, x_idx].transpose(),
             s=smoothing)
 
         if timing:
@@ -73,6 +73,7 @@ from . import test_watershed
 from . import test_multi_geometry
 from . import test_ocl_sort
 from . import test_worker
+from . import test_diffmap
 from . import test_utils_shell
 from . import test_utils_stringutil
 from . import test_utils_mathutil
@@ -89,6 +90,7 @@ from ..opencl import test as test_opencl
 from ..gui import test as test_gui
 from . import test_invert_geometry
 from . import test_massif
+from . import test_ring_extraction
 
 
 def suite():
@@ -127,6 +129,7 @@ def suite():
     testsuite.addTest(test_multi_geometry.suite())
     testsuite.addTest(test_ocl_sort.suite())
     testsuite.addTest(test_worker.suite())
+    testsuite.addTest(test_diffmap.suite())
     testsuite.addTest(test_utils_shell.suite())
     testsuite.addTest(test_utils_stringutil.suite())
     testsuite.addTest(test_utils_mathutil.suite())
@@ -140,6 +143,7 @@ def suite():
     testsuite.addTest(test_pyfai_api.suite())
     testsuite.addTest(test_invert_geometry.suite())
     testsuite.addTest(test_massif.suite())
+    testsuite.addTest(test_ring_extraction.suite())
     return testsuite
 
 
@@ -49,7 +49,7 @@ import shutil
 from . import utilstest
 from .utilstest import UtilsTest
 logger = logging.getLogger(__name__)
-from ..azimuthalIntegrator import AzimuthalIntegrator
+from ..azimuthalIntegrator import AzimuthalIntegrator, EXT_CSR_ENGINE
 from ..detectors import Detector
 if logger.getEffectiveLevel() <= logging.DEBUG:
     import pylab
@@ -522,6 +522,206 @@ class TestSetter(unittest.TestCase):
         self.assertTrue(abs(self.ai.darkcurrent - 0.5 * (self.rnd1 + self.rnd2)).max() == 0, "Dark array is OK")
 
 
+class TestBatch(unittest.TestCase):
+    """Test the integration of stacks of frames"""
+
+    @classmethod
+    def setUpClass(cls):
+        data, cls.ai = utilstest.create_fake_data(poissonian=False)
+        cls.stack = numpy.array([data * (i + 1) for i in range(3)], dtype=numpy.float32)
+        cls.stack[1, 10:20, 10:20] = -1
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ai = cls.stack = None
+
+    def test_integrate1d_batch(self):
+        kwargs = {"npt": 200, "unit": "2th_deg", "method": "csr", "dummy": -1,
+                  "polarization_factor": 0.9, "error_model": "poisson"}
+        res = self.ai.integrate1d_batch(self.stack, chunk=2, **kwargs)
+        self.assertEqual(res.intensity.shape, (len(self.stack), 200))
+        self.assertEqual(res.sigma.shape, (len(self.stack), 200))
+        self.assertEqual(res.method_called, "integrate1d_batch")
+        for frame, intensity, sigma in zip(self.stack, res.intensity, res.sigma):
+            ref = self.ai.integrate1d(frame, **kwargs)
+            self.assertTrue(numpy.allclose(ref.radial, res.radial), "radial matches")
+            self.assertTrue(numpy.allclose(ref.intensity, intensity), "intensity matches")
+            self.assertTrue(numpy.allclose(ref.sigma, sigma), "sigma matches")
+
+        # iterator of frames and fall-back on frame per frame integration
+        res_it = self.ai.integrate1d_batch(iter(self.stack), npt=200, unit="2th_deg", method="splitbbox")
+        self.assertEqual(res_it.intensity.shape, (len(self.stack), 200))
+        ref = self.ai.integrate1d(self.stack[-1], 200, unit="2th_deg", method="splitbbox")
+        self.assertTrue(numpy.allclose(ref.intensity, res_it.intensity[-1]), "intensity matches")
+
+    def test_batch_integrates_once(self):
+        calls = []
+        ai = AzimuthalIntegrator()
+        ai.setPyFAI(**self.ai.getPyFAI())
+        integrate1d = ai.integrate1d
+
+        def counter(*args, **kwargs):
+            calls.append(args[0])
+            return integrate1d(*args, **kwargs)
+
+        ai.integrate1d = counter
+        res = ai.integrate1d_batch(self.stack, 200, unit="2th_deg", method="csr", dummy=-1)
+        self.assertEqual(len(calls), 0, "engine is set up without integrating")
+        ref = integrate1d(self.stack[0], 200, unit="2th_deg", method="csr", dummy=-1)
+        self.assertTrue(numpy.allclose(ref.radial, res.radial), "radial matches")
+        self.assertEqual(str(res.unit), str(ref.unit))
+        self.assertEqual(res.compute_engine, ref.compute_engine)
+        self.assertEqual(res.has_mask_applied, ref.has_mask_applied)
+        self.assertEqual(res.has_dark_correction, ref.has_dark_correction)
+
+        ai.integrate1d_batch(self.stack, 200, unit="2th_deg", method="splitbbox")
+        self.assertEqual(len(calls), len(self.stack), "each frame is integrated once")
+
+    def test_integrate2d_batch(self):
+        kwargs = {"npt_rad": 100, "npt_azim": 36, "unit": "q_nm^-1", "dummy": -1}
+        for method in ("csr", "lut"):
+            res = self.ai.integrate2d_batch(self.stack, method=method, **kwargs)
+            self.assertEqual(res.intensity.shape, (len(self.stack), 36, 100))
+            for frame, intensity in zip(self.stack, res.intensity):
+                ref = self.ai.integrate2d(frame, method=method, **kwargs)
+                self.assertTrue(numpy.allclose(ref.radial, res.radial), "radial matches")
+                self.assertTrue(numpy.allclose(ref.azimuthal, res.azimuthal), "azimuthal matches")
+                self.assertTrue(numpy.allclose(ref.intensity, intensity, atol=1e-3), "%s intensity matches" % method)
+
+    def test_sigma_clip_batch(self):
+        kwargs = {"npt_rad": 100, "unit": "2th_deg", "method": "csr", "dummy": -1,
+                  "polarization_factor": 0.9}
+        # without clipping, the mean is the integrated intensity
+        res = self.ai.sigma_clip_batch(self.stack, thres=1000, chunk=2, **kwargs)
+        self.assertEqual(res.intensity.shape, (len(self.stack), 100))
+        self.assertEqual(res.method_called, "sigma_clip_batch")
+        for frame, intensity in zip(self.stack, res.intensity):
+            ref = self.ai.integrate1d(frame, 100, unit="2th_deg", method="csr", dummy=-1,
+                                      polarization_factor=0.9)
+            self.assertTrue(numpy.allclose(ref.radial, res.radial), "radial matches")
+            self.assertTrue(numpy.allclose(ref.intensity, intensity, rtol=1e-4), "intensity matches")
+
+        self.assertEqual(str(res.unit), str(ref.unit))
+        self.assertEqual(res.compute_engine, ref.compute_engine)
+        self.assertEqual(res.has_mask_applied, ref.has_mask_applied)
+
+        clipped = self.ai.sigma_clip_batch(iter(self.stack), thres=2, max_iter=10, **kwargs)
+        self.assertTrue((clipped.count <= res.count).all(), "pixels are discarded")
+        self.assertTrue((clipped.count < res.count).any(), "pixels are discarded")
+        self.assertTrue((clipped.sigma <= res.sigma + 1e-6).all(), "deviation decreases")
+
+    def test_sparse_filters_do_not_integrate(self):
+        calls = []
+        ai = AzimuthalIntegrator()
+        ai.setPyFAI(**self.ai.getPyFAI())
+        integrate1d = ai.integrate1d
+
+        def counter(*args, **kwargs):
+            calls.append(args[0])
+            return integrate1d(*args, **kwargs)
+
+        ai.integrate1d = counter
+        kwargs = {"unit": "2th_deg", "method": "csr", "dummy": -1}
+        ai.medfilt1d_batch(self.stack, 100, **kwargs)
+        ai.sigma_clip_batch(self.stack, 100, **kwargs)
+        ai.sigma_clip_ng(self.stack[0], 100, **kwargs)
+        ai.sparsify(self.stack[0], 100, **kwargs)
+        self.assertEqual(len(calls), 0, "engine is set up without integrating")
+
+    def test_sigma_clip_ng(self):
+        kwargs = {"unit": "2th_deg", "method": "csr", "dummy": -1, "polarization_factor": 0.9}
+        frame = self.stack[1].copy()
+        ref = self.ai._integrate1d_ng(frame, 100, error_model="poisson", **kwargs)
+        res = self.ai.sigma_clip_ng(frame, 100, thres=1000, error_model="poisson", **kwargs)
+        self.assertEqual(res.method_called, "sigma_clip_ng")
+        self.assertTrue(numpy.allclose(ref.radial, res.radial), "radial matches")
+        self.assertTrue(numpy.allclose(ref.intensity, res.intensity, rtol=1e-4), "intensity matches")
+        self.assertTrue(numpy.allclose(ref.sigma, res.sigma, rtol=1e-4), "sigma matches")
+
+        # outliers are discarded
+        numpy.random.seed(0)
+        outliers = numpy.random.randint(0, frame.size, 200)
+        frame.ravel()[outliers] = 1e6
+        res = self.ai.sigma_clip_ng(frame, 100, thres=3, max_iter=10, **kwargs)
+        clean = self.ai.sigma_clip_ng(self.stack[1], 100, thres=3, max_iter=10, **kwargs)
+        self.assertEqual(res.intensity.shape, (100,))
+        self.assertEqual(res.count.shape, (100,))
+        self.assertEqual(res.std.shape, (100,))
+        self.assertTrue(res.intensity.max() < 1e5, "outliers are discarded")
+        self.assertTrue(numpy.allclose(res.intensity, clean.intensity, rtol=0.05), "intensity matches")
+        self.assertTrue(res.count.sum() < clean.count.sum(), "outliers are discarded")
+        self.assertTrue(numpy.allclose(res.sigma, res.std / numpy.sqrt(numpy.maximum(res.count, 1))),
+                        "standard error of the mean")
+
+    def test_sparsify(self):
+        npt = 50
+        kwargs = {"unit": "2th_deg", "method": "nosplit_csr", "correctSolidAngle": False, "dummy": -1}
+        frame = self.stack[1].copy()
+        numpy.random.seed(0)
+        peaks = numpy.random.randint(0, frame.size, 20)
+        frame.ravel()[peaks] = 1e6
+        if self.ai.detector.mask is not None:
+            peaks = peaks[self.ai.detector.mask.ravel()[peaks] == 0]
+        res = self.ai.sparsify(frame, npt, thres=3, cutoff=4, noise=1, **kwargs)
+        self.assertEqual(res.method_called, "sparsify")
+        self.assertEqual(res.background_avg.shape, (npt,))
+        self.assertTrue(numpy.all(numpy.diff(res.index) > 0), "index sorted")
+        self.assertTrue(numpy.isin(peaks, res.index).all(), "peaks selected")
+        self.assertTrue(numpy.allclose(res.intensity, frame.ravel()[res.index]), "raw intensity")
+        self.assertEqual(res.to_dense().shape, frame.shape)
+
+        # reference: each pixel compared to the background of its bin
+        engine = self.ai.engines[EXT_CSR_ENGINE].engine
+        indptr = numpy.asarray(engine.indptr)
+        indices = numpy.asarray(engine.indices)
+        expected = []
+        for i in range(npt):
+            idx = indices[indptr[i]:indptr[i + 1]]
+            values = frame.ravel()[idx]
+            threshold = res.background_avg[i] + max(4 * res.background_std[i], 1)
+            expected.append(idx[(values != -1) & (values > threshold)])
+        expected = numpy.sort(numpy.concatenate(expected))
+        self.assertTrue(numpy.array_equal(expected, res.index), "pixels selected")
+
+        # the main bin of each pixel is kept with the engine
+        main = self.ai.engines[EXT_CSR_ENGINE].main_bin
+        self.assertIs(main[0], engine)
+        self.ai.sparsify(frame, npt, thres=3, cutoff=4, noise=1, **kwargs)
+        self.assertIs(self.ai.engines[EXT_CSR_ENGINE].main_bin[1], main[1], "main bin is reused")
+
+        # stack of frames, processed by chunks
+        stack = numpy.array([frame, self.stack[0], frame])
+        results = self.ai.sparsify(iter(stack), npt, thres=3, cutoff=4, noise=1, chunk=2, **kwargs)
+        self.assertEqual(len(results), len(stack))
+        for one, obt in zip(stack, results):
+            ref = self.ai.sparsify(one, npt, thres=3, cutoff=4, noise=1, **kwargs)
+            self.assertEqual(obt.shape, frame.shape)
+            self.assertTrue(numpy.array_equal(ref.index, obt.index), "pixels selected")
+            self.assertTrue(numpy.allclose(ref.background_avg, obt.background_avg), "background")
+
+    def test_medfilt1d_batch(self):
+        npt = 50
+        res = self.ai.medfilt1d_batch(self.stack, npt, unit="2th_deg", method="nosplit_csr",
+                                      correctSolidAngle=False, dummy=-1)
+        self.assertEqual(res.intensity.shape, (len(self.stack), npt))
+        self.assertEqual(res.method_called, "medfilt1d_batch")
+        engine = self.ai.engines[EXT_CSR_ENGINE].engine
+        indptr = numpy.asarray(engine.indptr)
+        indices = numpy.asarray(engine.indices)
+        for frame, spectrum, count in zip(self.stack, res.intensity, res.count):
+            frame = frame.ravel()
+            for i in range(npt):
+                values = frame[indices[indptr[i]:indptr[i + 1]]]
+                values = values[values != -1]
+                self.assertEqual(count[i], values.size)
+                if values.size:
+                    self.assertAlmostEqual(spectrum[i], numpy.median(values), places=3)
+        # trimmed mean between quartiles
+        res = self.ai.medfilt1d_batch(self.stack, npt, unit="2th_deg", method="nosplit_csr",
+                                      correctSolidAngle=False, dummy=-1, percentile=(25, 75))
+        self.assertTrue(numpy.isfinite(res.intensity).all())
+
+
 def suite():
     loader = unittest.defaultTestLoader.loadTestsFromTestCase
     testsuite = unittest.TestSuite()
@@ -531,6 +731,7 @@ def suite():
     # Consumes a lot of memory
     # testsuite.addTest(loader(TestAzimPilatus))
     testsuite.addTest(loader(TestSaxs))
+    testsuite.addTest(loader(TestBatch))
     return testsuite
 
 
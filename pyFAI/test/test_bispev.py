@@ -107,10 +107,40 @@ class TestBispev(unittest.TestCase):
         self.assertTrue(abs(dx_loc - dx_ref).max() < 2e-5, "Result are similar")
 
 
+class TestBispevPoints(unittest.TestCase):
+    """Evaluation on a synthetic spline, compared with scipy"""
+
+    def setUp(self):
+        import scipy.interpolate
+        x = numpy.arange(0, 520, 8, dtype=numpy.float64)
+        y = numpy.arange(0, 400, 8, dtype=numpy.float64)
+        z = numpy.sin(x / 70.0)[:, None] * numpy.cos(y / 90.0)[None, :] + x[:, None] / 500.0
+        fit = scipy.interpolate.RectBivariateSpline(x, y, z, s=0.01)
+        self.tck = list(fit.get_knots()) + [fit.get_coeffs(), 3, 3]
+
+    def test_grid(self):
+        x = numpy.arange(-5, 530, 1.5)
+        y = numpy.arange(0, 400, 2.0)
+        ref = fitpack.bisplev(x, y, self.tck)
+        self.assertLess(abs(_bispev.bisplev(x, y, self.tck) - ref).max(), 2e-5, "same as scipy")
+        self.assertTrue(numpy.allclose(_bispev.bisplev(x, y, self.tck, nthread=1),
+                                       _bispev.bisplev(x, y, self.tck, nthread=2)), "threads")
+
+    def test_points(self):
+        numpy.random.seed(0)
+        x = numpy.random.uniform(-10, 530, 500)
+        y = numpy.random.uniform(-10, 410, 500)
+        ref = numpy.array([fitpack.bisplev(i, j, self.tck) for i, j in zip(x, y)])
+        res = _bispev.bisplev_points(x, y, self.tck)
+        self.assertEqual(res.shape, x.shape)
+        self.assertLess(abs(res - ref).max(), 2e-5, "same as scipy")
+
+
 def suite():
     loader = unittest.defaultTestLoader.loadTestsFromTestCase
     testsuite = unittest.TestSuite()
     testsuite.addTest(loader(TestBispev))
+    testsuite.addTest(loader(TestBispevPoints))
     return testsuite
 
 
@@ -34,6 +34,9 @@ from __future__ import absolute_import, division, print_function
 
 
 import unittest
+import json
+import os
+import shutil
 import numpy
 import logging
 from . import utilstest
@@ -42,7 +45,10 @@ from .. import opencl
 from ..ext import splitBBox
 from ..ext import splitBBoxCSR
 from ..engines.CSR_engine import CsrIntegrator2d, CsrIntegrator1d
+from ..engines import sparse_cache
+from ..engines.sparse_cache import SparseCache
 from .. import azimuthalIntegrator
+from .. import units
 if opencl.ocl:
     from ..opencl import azim_csr as ocl_azim_csr
 
@@ -218,11 +224,361 @@ class TestCSR(utilstest.ParametricTestCase):
         self.assertTrue(numpy.allclose(res_csr[4].T, res_scipy[3][..., 2]), "count is same as normalization")
         self.assertTrue(numpy.allclose(res_csr[3].T, res_scipy[3][..., 0]), "sum_data is almost the same")
 
+    def test_compact(self):
+        """The compact storage gives the same result as scipy with less memory"""
+        for method, dim in (("csr", 1), ("nosplit_csr", 1), ("csr", 2), ("nosplit_csr", 2)):
+            with self.subTest(method=method, dim=dim):
+                self.ai.reset()
+                if dim == 1:
+                    self.ai.integrate1d(self.data, self.N, unit="2th_deg", method=method)
+                    engine = self.ai.engines[azimuthalIntegrator.EXT_CSR_ENGINE].engine
+                    kwargs = {"bin_centers": engine.bin_centers}
+                    klass = CsrIntegrator1d
+                else:
+                    self.ai.integrate2d(self.data, self.N, unit="2th_deg", method=method)
+                    engine = self.ai.engines[azimuthalIntegrator.EXT_CSR_ENGINE].engine
+                    kwargs = {"bin_centers0": engine.bin_centers0, "bin_centers1": engine.bin_centers1}
+                    klass = CsrIntegrator2d
+                scipy_engine = klass(self.data.size, data=engine.data, indices=engine.indices,
+                                     indptr=engine.indptr, **kwargs)
+                compact_engine = klass(self.data.size, data=engine.data, indices=engine.indices,
+                                       indptr=engine.indptr, compact=True, **kwargs)
+                self.assertIsNone(compact_engine.indices, "indices are not kept")
+                if method == "nosplit_csr":
+                    self.assertIsNone(compact_engine.data, "coefficients are dropped without splitting")
+                ref_size = engine.data.nbytes + engine.indices.nbytes + engine.indptr.nbytes
+                self.assertLess(compact_engine._csr.nbytes, ref_size, "compact is smaller")
+                res_scipy = scipy_engine.integrate(self.data, dummy=-1, delta_dummy=0.5)
+                res_compact = compact_engine.integrate(self.data, dummy=-1, delta_dummy=0.5)
+                self.assertTrue(numpy.allclose(res_scipy.propagated, res_compact.propagated), "same sums")
+                self.assertTrue(numpy.allclose(res_scipy.signal, res_compact.signal), "same signal")
+
+    def test_compact_setup(self):
+        """Compact CSR matrices are reachable from setup_CSR and integrate1d_ng"""
+        shape = self.data.shape
+        for split, dim in (("bbox", 1), ("no", 1), ("bbox", 2)):
+            with self.subTest(split=split, dim=dim):
+                self.ai.reset()
+                npt = self.N if dim == 1 else (self.N, 36)
+                compact = self.ai.setup_CSR(shape, npt, unit="2th_deg", split=split, compact=True)
+                self.assertIsInstance(compact, CsrIntegrator1d if dim == 1 else CsrIntegrator2d)
+                self.assertTrue(compact.compact)
+                self.assertEqual(len(self.ai.engine_registry), 1, "the full matrix is not kept")
+                self.assertIs(self.ai.setup_CSR(shape, npt, unit="2th_deg", split=split, compact=True),
+                              compact, "compact matrix is registered")
+                full = self.ai.setup_CSR(shape, npt, unit="2th_deg", split=split)
+                self.assertNotIsInstance(full, (CsrIntegrator1d, CsrIntegrator2d))
+                ref = full.integrate(self.data)
+                res = compact.integrate(self.data)
+                if dim == 1:
+                    self.assertTrue(numpy.allclose(res.propagated[:, 0], ref[-2]), "same signal")
+                    self.assertTrue(numpy.allclose(res.propagated[:, 2], ref[-1]), "same normalization")
+                else:
+                    self.assertTrue(numpy.allclose(res.propagated[..., 0], ref[-2].T), "same signal")
+
+        kwargs = {"npt": self.N, "unit": "2th_deg", "error_model": "poisson",
+                  "polarization_factor": 0.9, "method": "nosplit_csr"}
+        self.ai.reset()
+        ref = self.ai._integrate1d_ng(self.data, **kwargs)
+        try:
+            self.ai.compact_csr = True
+            res = self.ai._integrate1d_ng(self.data, **kwargs)
+        finally:
+            self.ai.compact_csr = False
+        self.assertTrue(self.ai.engines[azimuthalIntegrator.EXT_CSR_ENGINE].engine.compact, "compact engine used")
+        self.assertTrue(numpy.allclose(ref.intensity, res.intensity, rtol=1e-4), "intensity matches")
+        self.assertTrue(numpy.allclose(ref.sigma, res.sigma, rtol=1e-4), "sigma matches")
+        self.assertTrue(numpy.allclose(ref.count, res.count), "count matches")
+
+    def test_derive_mask(self):
+        """A masked CSR matrix derived from the unmasked one is the same as the one built"""
+        shape = self.data.shape
+        mask = numpy.zeros(shape, dtype=numpy.int8)
+        mask[100:150, 200:300] = 1
+        mask[::7, 5] = 1
+        tth = self.ai.array_from_unit(shape, "center", "2th_deg", scale=False)
+        dtth = self.ai.array_from_unit(shape, "delta", "2th_deg", scale=False)
+        chi = self.ai.chiArray(shape)
+        dchi = self.ai.deltaChi(shape)
+        for split in ("bbox", "no"):
+            for dim in (1, 2):
+                with self.subTest(split=split, dim=dim):
+                    delta0 = None if split == "no" else dtth
+                    delta1 = None if split == "no" else dchi
+                    if dim == 1:
+                        klass = splitBBoxCSR.HistoBBox1d
+                        args = (tth, delta0)
+                        bins = self.N
+                    else:
+                        klass = splitBBoxCSR.HistoBBox2d
+                        args = (tth, delta0, chi, delta1)
+                        bins = (self.N, 36)
+                    unmasked = klass(*args, bins=bins, unit="2th_deg")
+                    ref = klass(*args, bins=bins, mask=mask, unit="2th_deg")
+                    derived = unmasked.derive_mask(mask)
+                    self.assertIsNotNone(derived, "integrator can be derived")
+                    self.assertTrue(numpy.array_equal(ref.indptr, derived.indptr), "indptr")
+                    self.assertTrue(numpy.array_equal(ref.indices, derived.indices), "indices")
+                    self.assertTrue(numpy.array_equal(ref.data, derived.data), "data")
+                    self.assertEqual(ref.mask_checksum, derived.mask_checksum, "mask checksum")
+                    self.assertEqual(derived.lut_checksum, ref.lut_checksum, "lut checksum")
+                    self.assertIsNot(unmasked.data, derived.data, "original matrix is untouched")
+                    self.assertTrue(numpy.array_equal(ref.integrate(self.data)[-2], derived.integrate(self.data)[-2]), "same integration")
+
+        # Masking the pixel with the largest angle changes the binning
+        extreme = numpy.zeros(shape, dtype=numpy.int8)
+        extreme.ravel()[numpy.argmax(tth)] = 1
+        unmasked = splitBBoxCSR.HistoBBox1d(tth, None, bins=self.N, unit="2th_deg")
+        self.assertIsNone(unmasked.derive_mask(extreme), "Boundaries changed")
+        # ... unless the range is provided
+        unmasked = splitBBoxCSR.HistoBBox1d(tth, None, bins=self.N, pos0Range=(0, 10), unit="2th_deg")
+        derived = unmasked.derive_mask(extreme)
+        ref = splitBBoxCSR.HistoBBox1d(tth, None, bins=self.N, pos0Range=(0, 10), mask=extreme, unit="2th_deg")
+        self.assertTrue(numpy.array_equal(ref.indices, derived.indices), "indices")
+
+        # Through the azimuthal integrator: with a range, the unmasked matrix is
+        # built once and all masked ones are derived from it
+        built = []
+        derived = []
+        derive_mask = splitBBoxCSR.HistoBBox1d.derive_mask
+
+        def counting_ai():
+            ai = azimuthalIntegrator.AzimuthalIntegrator()
+            ai.setPyFAI(**self.ai.getPyFAI())
+            setup_CSR = ai._setup_CSR
+
+            def counting_setup(*args):
+                built.append(args[2])
+                return setup_CSR(*args)
+
+            ai._setup_CSR = counting_setup
+            return ai
+
+        def counting_derive(integrator, mask, mask_checksum=None):
+            result = derive_mask(integrator, mask, mask_checksum)
+            derived.append(result)
+            return result
+
+        ai = counting_ai()
+        splitBBoxCSR.HistoBBox1d.derive_mask = counting_derive
+        try:
+            other = numpy.zeros(shape, dtype=numpy.int8)
+            other[300:320, :] = 1
+            unit = units.to_unit("2th_deg")
+            radial_range = (0, 0.5)
+            masked = ai.setup_CSR(shape, self.N, mask=mask, pos0_range=radial_range, unit=unit, split="bbox")
+            masked2 = ai.setup_CSR(shape, self.N, mask=other, pos0_range=radial_range, unit=unit, split="bbox")
+            unmasked = ai.setup_CSR(shape, self.N, pos0_range=radial_range, unit=unit, split="bbox")
+        finally:
+            splitBBoxCSR.HistoBBox1d.derive_mask = derive_mask
+        self.assertEqual(built, [None], "only the unmasked matrix is built")
+        self.assertEqual(len(derived), 2, "both masked matrices are derived")
+        self.assertIs(derived[0], masked)
+        self.assertIs(derived[1], masked2)
+        self.assertTrue(numpy.array_equal(masked.indices, unmasked.derive_mask(mask).indices), "derived")
+        self.assertEqual(len(ai.engine_registry), 3, "all integrators are registered")
+
+        # Without range, a beamstop changes the boundaries: a single build
+        beamstop = numpy.zeros(shape, dtype=numpy.int8)
+        beamstop.ravel()[numpy.argsort(tth.ravel())[:100]] = 1
+        built[:] = []
+        ai = counting_ai()
+        masked = ai.setup_CSR(shape, self.N, mask=beamstop, unit=unit, split="bbox")
+        self.assertEqual(len(built), 1, "one build")
+        self.assertIsNotNone(built[0], "of the masked matrix")
+        self.assertEqual(len(ai.engine_registry), 1, "no unmasked matrix kept")
+
+        # ... but derived when the unmasked matrix is already available
+        built[:] = []
+        ai = counting_ai()
+        ai.setup_CSR(shape, self.N, unit=unit, split="bbox")
+        ai.setup_CSR(shape, self.N, mask=other, unit=unit, split="bbox")
+        self.assertEqual(built, [None], "masked matrix derived")
+
+    def test_nthread(self):
+        """The result of the OpenMP matrix multiplication does not depend on the number of threads"""
+        # Full pixel splitting has no 2D CSR engine
+        for method, dim in (("csr", 1), ("full_csr", 1), ("csr", 2)):
+            with self.subTest(method=method, dim=dim):
+                self.ai.reset()
+                if dim == 1:
+                    self.ai.integrate1d(self.data, self.N, unit="2th_deg", method=method)
+                else:
+                    self.ai.integrate2d(self.data, self.N, unit="2th_deg", method=method)
+                engine = self.ai.engines[azimuthalIntegrator.EXT_CSR_ENGINE].engine
+                ref = engine.integrate(self.data, dummy=-1, delta_dummy=0.5, nthread=1)
+                for nthread in (0, 2, 3):
+                    res = engine.integrate(self.data, dummy=-1, delta_dummy=0.5, nthread=nthread)
+                    for r, o in zip(ref, res):
+                        self.assertTrue(numpy.array_equal(r, o), "nthread=%s" % nthread)
+
+        # The number of threads is taken from the integrator
+        calls = []
+        integrate = splitBBoxCSR.HistoBBox1d.integrate
+
+        def recorder(engine, *args, **kwargs):
+            calls.append(kwargs.get("nthread"))
+            return integrate(engine, *args, **kwargs)
+
+        splitBBoxCSR.HistoBBox1d.integrate = recorder
+        try:
+            ref = self.ai.integrate1d(self.data, self.N, unit="2th_deg", method="csr")
+            self.ai.nthread = 2
+            res = self.ai.integrate1d(self.data, self.N, unit="2th_deg", method="csr")
+        finally:
+            splitBBoxCSR.HistoBBox1d.integrate = integrate
+            self.ai.nthread = 0
+        self.assertEqual(calls, [0, 2])
+        self.assertTrue(numpy.array_equal(ref.intensity, res.intensity), "same result")
+
+    def test_integrate_ng(self):
+        """Fused preprocessing and integration vs. the legacy CSR and the 3-pass implementation"""
+        variance = abs(self.data)
+        for method, dim in (("csr", 1), ("full_csr", 1), ("csr", 2)):
+            with self.subTest(method=method, dim=dim):
+                self.ai.reset()
+                if dim == 1:
+                    self.ai.integrate1d(self.data, self.N, unit="2th_deg", method=method)
+                else:
+                    self.ai.integrate2d(self.data, self.N, unit="2th_deg", method=method)
+                engine = self.ai.engines[azimuthalIntegrator.EXT_CSR_ENGINE].engine
+                ref = engine.integrate(self.data)
+                signal, sum_variance, normalization, count = engine.integrate_ng(self.data, variance=variance)
+                if dim == 2:
+                    signal, normalization, count = signal.T, normalization.T, count.T
+                self.assertTrue(numpy.allclose(signal, ref[-2]), "signal matches")
+                self.assertTrue(numpy.allclose(normalization, ref[-1]), "normalization matches")
+                self.assertTrue(numpy.allclose(count, ref[-1]), "count matches")
+                var_ref = engine.integrate(variance, coef_power=2)
+                self.assertTrue(numpy.allclose(sum_variance, var_ref[-2].T), "variance uses squared coefficients")
+
+        kwargs = {"npt": self.N, "unit": "2th_deg", "error_model": "poisson",
+                  "polarization_factor": 0.9, "normalization_factor": 3.0}
+        ref = self.ai._integrate1d_ng(self.data, method="histogram", **kwargs)
+        res = self.ai._integrate1d_ng(self.data, method="nosplit_csr", **kwargs)
+        self.assertEqual(res.method_called, "integrate1d_ng")
+        self.assertTrue(numpy.allclose(ref.radial, res.radial), "radial matches")
+        self.assertTrue(numpy.allclose(ref.intensity, res.intensity, rtol=1e-4), "intensity matches")
+        self.assertTrue(numpy.allclose(ref.sigma, res.sigma, rtol=1e-4), "sigma matches")
+        self.assertTrue(numpy.allclose(ref.count, res.count), "count matches")
+
+
+class TestSparseCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data, cls.ai = utilstest.create_fake_data(poissonian=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ai = cls.data = None
+
+    def setUp(self):
+        self.directory = os.path.join(utilstest.UtilsTest.tempdir, self.id())
+        self.cache = SparseCache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        self.cache = None
+
+    def test_cache(self):
+        for method, engine_name in (("csr", azimuthalIntegrator.EXT_CSR_ENGINE),
+                                    ("lut", azimuthalIntegrator.EXT_LUT_ENGINE)):
+            self.ai.reset()
+            self.ai.sparse_cache = self.cache
+            ref = self.ai.integrate1d(self.data, 100, unit="2th_deg", method=method)
+            ref2d = self.ai.integrate2d(self.data, 100, 36, unit="2th_deg", method=method)
+            ai = azimuthalIntegrator.AzimuthalIntegrator()
+            ai.setPyFAI(**self.ai.getPyFAI())
+            ai.sparse_cache = self.cache
+            res = ai.integrate1d(self.data, 100, unit="2th_deg", method=method)
+            res2d = ai.integrate2d(self.data, 100, 36, unit="2th_deg", method=method)
+            self.assertTrue(numpy.allclose(ref.radial, res.radial), "radial matches")
+            self.assertTrue(numpy.allclose(ref.intensity, res.intensity), "intensity matches")
+            self.assertTrue(numpy.allclose(ref2d.intensity, res2d.intensity), "2D intensity matches")
+            self.assertIn("2th_deg", str(ai.engines[engine_name].engine.unit))
+        # no unmasked matrix is built without a range
+        self.assertEqual(len(self.cache.keys()), 4, "One entry per setup")
+
+        # a different setup is not found in the cache
+        ai.rot1 = 0.1
+        key = ai._get_sparse_key("CSR", self.data.shape, 100, None, None, None, units.to_unit("2th_deg"), "bbox")
+        self.assertNotIn(key, self.cache)
+
+        # eviction
+        self.cache.evict(self.cache.nbytes - 1)
+        self.assertEqual(len(self.cache.keys()), 3, "oldest entry evicted")
+        self.cache.clear()
+        self.assertEqual(len(self.cache.keys()), 0, "cache is empty")
+
+    def test_state(self):
+        self.ai.reset()
+        self.ai.sparse_cache = self.cache
+        self.ai.integrate1d(self.data, 100, unit="2th_deg", method="csr")
+        key = self.cache.keys()[0]
+        path = os.path.join(self.directory, key)
+        self.assertFalse([i for i in os.listdir(path) if i.endswith(".pkl")], "nothing is pickled")
+        self.assertIsNotNone(self.cache.load(key))
+
+        # only known integrators are restored
+        filename = os.path.join(path, sparse_cache.STATE)
+        with open(filename) as f:
+            state = json.load(f)
+        state["__class__"] = "os.system"
+        with open(filename, "w") as f:
+            json.dump(state, f)
+        with utilstest.TestLogging(logger=sparse_cache.logger, warning=1):
+            self.assertIsNone(self.cache.load(key))
+
+
+class TestEngineRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.data, self.ai = utilstest.create_fake_data(poissonian=False)
+
+    def tearDown(self):
+        self.ai = self.data = None
+
+    def test_registry(self):
+        registry = self.ai.engine_registry
+        engines = {}
+        # alternate between two setups sharing the same engine slot
+        for _ in range(2):
+            self.ai.integrate1d(self.data, 100, unit="q_nm^-1", method="csr")
+            engine_1d = self.ai.engines[azimuthalIntegrator.EXT_CSR_ENGINE].engine
+            self.ai.integrate2d(self.data, 100, 36, unit="2th_deg", method="csr")
+            engine_2d = self.ai.engines[azimuthalIntegrator.EXT_CSR_ENGINE].engine
+            self.assertIsNot(engine_1d, engine_2d)
+            self.assertIs(engines.setdefault("1d", engine_1d), engine_1d, "1D engine is not rebuilt")
+            self.assertIs(engines.setdefault("2d", engine_2d), engine_2d, "2D engine is not rebuilt")
+        # the detector is masked, without range: masked matrices are built directly
+        self.assertEqual(len(registry), 2)
+
+        listing = registry.list_engines()
+        self.assertEqual(listing[-1][0][0], "CSR")
+        self.assertEqual(listing[-1][1], "HistoBBox2d", "most recently used is last")
+        self.assertEqual(listing[-1][2], engine_2d.data.nbytes + engine_2d.indices.nbytes + engine_2d.indptr.nbytes)
+        self.assertEqual(registry.nbytes, sum(i[2] for i in listing))
+
+        # memory budget
+        registry.max_size = listing[-1][2]
+        registry.evict()
+        self.assertEqual(len(registry), 1, "oldest engine evicted")
+        self.ai.integrate1d(self.data, 100, unit="q_nm^-1", method="csr")
+        self.assertIsNot(self.ai.engines[azimuthalIntegrator.EXT_CSR_ENGINE].engine, engines["1d"], "engine rebuilt")
+        self.assertEqual(len(registry), 1, "Only one engine fits in the budget")
+
+        # geometry change
+        self.ai.rot1 = 0.1
+        self.assertEqual(len(registry), 0, "registry emptied on reset")
+
 
 def suite():
     testsuite = unittest.TestSuite()
     loader = unittest.defaultTestLoader.loadTestsFromTestCase
     testsuite.addTest(loader(TestCSR))
+    testsuite.addTest(loader(TestSparseCache))
+    testsuite.addTest(loader(TestEngineRegistry))
     return testsuite
 
 
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+#    Project: Azimuthal integration
+#             https://github.com/silx-kit/pyFAI
+#
+#    Copyright (C) 2019 European Synchrotron Radiation Facility, Grenoble, France
+#
+#    Principal author:       Jérôme Kieffer (Jerome.Kieffer@ESRF.eu)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"Test suite for the diffraction mapping"
+
+from __future__ import absolute_import, division, print_function
+
+__author__ = "Jérôme Kieffer"
+__contact__ = "Jerome.Kieffer@ESRF.eu"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "18/02/2019"
+
+import os
+import shutil
+import unittest
+import logging
+import numpy
+import fabio
+from .utilstest import UtilsTest
+from ..diffmap import DiffMap
+from ..azimuthalIntegrator import AzimuthalIntegrator
+from ..detectors import Detector
+logger = logging.getLogger(__name__)
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+@unittest.skipIf(h5py is None, "h5py is missing")
+class TestDiffMap(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = os.path.join(UtilsTest.tempdir, self.id())
+        if not os.path.isdir(self.tempdir):
+            os.makedirs(self.tempdir)
+        numpy.random.seed(0)
+        self.files = []
+        for i in range(6):
+            filename = os.path.join(self.tempdir, "frame_%04i.edf" % i)
+            fabio.edfimage.EdfImage(data=numpy.random.random((50, 60)).astype("float32")).write(filename)
+            self.files.append(filename)
+        detector = Detector(1e-4, 1e-4, max_shape=(50, 60))
+        self.ai = AzimuthalIntegrator(dist=0.1, detector=detector)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        self.tempdir = self.files = self.ai = None
+
+    def process(self, name, inputfiles=None, **kwargs):
+        diffmap = DiffMap(npt_fast=3, npt_slow=2, npt_rad=20)
+        diffmap.ai = self.ai
+        diffmap.method = "splitbbox"
+        diffmap.hdf5 = os.path.join(self.tempdir, name)
+        diffmap.inputfiles = inputfiles or self.files
+        for key, value in kwargs.items():
+            setattr(diffmap, key, value)
+        diffmap.process()
+        with h5py.File(diffmap.hdf5, "r") as h5:
+            entry = sorted(i for i in h5 if i.startswith("diff_map"))[-1]
+            result = h5[entry]["data/map"][()]
+            filled = h5[entry]["data/filled"][()]
+        return diffmap, result, filled
+
+    def test_process(self):
+        _, ref, filled = self.process("sequential.h5")
+        self.assertEqual(ref.shape, (2, 3, 20))
+        self.assertTrue(filled.all(), "all positions are processed")
+        expected = self.ai.integrate1d(fabio.open(self.files[4]).data, 20, method="splitbbox", unit="2th_deg")
+        self.assertTrue(numpy.allclose(ref[1, 1], expected.intensity), "position (1, 1) is frame 4")
+
+        _, obt, _ = self.process("threads.h5", nthreads=2)
+        self.assertTrue(numpy.allclose(ref, obt), "threads give the same map")
+        if hasattr(os, "fork"):
+            _, obt, _ = self.process("jobs.h5", njobs=2, start_method="fork")
+            self.assertTrue(numpy.allclose(ref, obt), "processes give the same map")
+        _, obt, _ = self.process("spawn.h5", njobs=2, start_method="spawn")
+        self.assertTrue(numpy.allclose(ref, obt), "spawned processes give the same map")
+
+    def test_resume(self):
+        _, ref, _ = self.process("reference.h5")
+        _, partial, filled = self.process("resume.h5", inputfiles=self.files[:4])
+        self.assertEqual(filled.sum(), 4, "partial processing")
+        diffmap, obt, filled = self.process("resume.h5", resume=True, nthreads=2)
+        self.assertEqual(len(diffmap.timing), 2, "only missing positions are processed")
+        self.assertTrue(filled.all(), "all positions are processed")
+        self.assertTrue(numpy.allclose(ref, obt), "resumed map is complete")
+
+    def test_journal(self):
+        _, ref, _ = self.process("reference.h5")
+        journal = os.path.join(self.tempdir, "journal.json")
+
+        def interrupted(frame, calls=[]):
+            calls.append(frame)
+            if len(calls) > 4:
+                raise KeyboardInterrupt("interrupted")
+            return DiffMap.integrate_frame(diffmap, frame)
+
+        diffmap = DiffMap(npt_fast=3, npt_slow=2, npt_rad=20)
+        diffmap.ai = self.ai
+        diffmap.method = "splitbbox"
+        diffmap.hdf5 = os.path.join(self.tempdir, "journal.h5")
+        diffmap.inputfiles = self.files
+        diffmap.journal = journal
+        diffmap.integrate_frame = interrupted
+        self.assertRaises(KeyboardInterrupt, diffmap.process)
+        diffmap.nxs.close()
+
+        diffmap, obt, filled = self.process("journal.h5", journal=journal)
+        self.assertEqual(len(diffmap.timing), 2, "only missing frames are processed")
+        self.assertTrue(filled.all(), "all positions are processed")
+        self.assertTrue(numpy.allclose(ref, obt), "resumed map is complete")
+
+
+def suite():
+    loader = unittest.defaultTestLoader.loadTestsFromTestCase
+    testsuite = unittest.TestSuite()
+    testsuite.addTest(loader(TestDiffMap))
+    return testsuite
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -34,10 +34,12 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "30/10/2018"
+__date__ = "18/02/2019"
 
 
 import unittest
+import os
+import shutil
 import numpy
 import fabio
 import logging
@@ -294,6 +296,186 @@ class TestImplementations(unittest.TestCase):
         self.assertTrue(numpy.allclose(csr1[0], csr4[0], atol=2e-7), "same data 1-4")
 
 
+def distorted_detector(shape=(64, 80)):
+    """Small detector with a sinusoidal distortion of a couple of pixels"""
+    det = detectors.Detector(1e-4, 1e-4, max_shape=shape)
+    corners = det.get_pixel_corners().copy()
+    pos1 = corners[..., 1] / 1e-4
+    pos2 = corners[..., 2] / 1e-4
+    corners[..., 1] = (pos1 + 1.5 * numpy.sin(pos2 / 10.0)) * 1e-4
+    corners[..., 2] = (pos2 + 1.5 * numpy.cos(pos1 / 12.0)) * 1e-4
+    det.set_pixel_corners(corners)
+    return det
+
+
+class TestStack(unittest.TestCase):
+    """Correction of a stack of frames in a single call"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.det = distorted_detector()
+        shape = cls.det.shape
+        cls.mask = numpy.zeros(shape, numpy.int8)
+        numpy.random.seed(0)
+        cls.stack = numpy.random.poisson(100, (5,) + shape).astype(numpy.float32)
+        cls.stack[2, 10:20, 30:40] = -1
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.det = cls.mask = cls.stack = None
+
+    def test_correct_stack(self):
+        for method in ("csr", "lut"):
+            dis = distortion.Distortion(self.det, self.det.shape, method=method, mask=self.mask)
+            ref = numpy.array([dis.correct(frame) for frame in self.stack])
+            res = dis.correct_stack(self.stack)
+            self.assertEqual(res.shape, ref.shape)
+            self.assertTrue(numpy.allclose(res, ref), "%s: stack matches frames" % method)
+
+            # output buffer is reused
+            out = numpy.zeros_like(res)
+            res = dis.correct_stack(self.stack, dummy=-1, out=out)
+            self.assertTrue(res is out, "%s: output buffer reused" % method)
+            ref = dis.correct(self.stack[2], dummy=-1)
+            self.assertTrue(numpy.allclose(res[2], ref), "%s: dummy values" % method)
+            self.assertTrue(numpy.allclose(dis.correct_stack(self.stack, nthread=1), dis.correct_stack(self.stack, nthread=2)),
+                            "%s: independent of the number of threads" % method)
+
+
+class TestSparseCache(unittest.TestCase):
+    """Correction matrix stored on disk and memory-mapped on reload"""
+
+    def setUp(self):
+        self.directory = os.path.join(UtilsTest.tempdir, self.id())
+        self.det = distorted_detector()
+        self.mask = numpy.zeros(self.det.shape, numpy.int8)
+        self.image = numpy.random.poisson(100, self.det.shape).astype(numpy.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.det = self.mask = self.image = None
+
+    def test_reload(self):
+        for method in ("csr", "lut"):
+            ref = distortion.Distortion(self.det, self.det.shape, method=method, mask=self.mask)
+            ref.calc_init()
+            dis1 = distortion.Distortion(self.det, self.det.shape, method=method, mask=self.mask,
+                                         cache=self.directory)
+            dis1.calc_init()
+            self.assertIsNotNone(dis1.pos, "%s: matrix calculated" % method)
+            dis2 = distortion.Distortion(self.det, self.det.shape, method=method, mask=self.mask,
+                                         cache=self.directory)
+            dis2.calc_init()
+            self.assertIsNone(dis2.pos, "%s: matrix loaded from the cache" % method)
+            self.assertEqual(dis2.shape_out, ref.shape_out)
+            self.assertTrue(numpy.allclose(dis2.correct(self.image), ref.correct(self.image)),
+                            "%s: same correction" % method)
+        self.assertEqual(len(dis2.sparse_cache.keys()), 2, "one entry per method")
+
+        # a different distortion is a different entry
+        det = detectors.Detector(1e-4, 1e-4, max_shape=self.det.shape)
+        dis3 = distortion.Distortion(det, det.shape, mask=self.mask, cache=self.directory)
+        dis3.calc_LUT()
+        self.assertEqual(len(dis3.sparse_cache.keys()), 3, "new entry")
+
+
+class TestFusedIntegration(unittest.TestCase):
+    """Distortion correction composed with the azimuthal integration"""
+
+    def setUp(self):
+        from ..azimuthalIntegrator import AzimuthalIntegrator
+        self.det = distorted_detector()
+        self.ai = AzimuthalIntegrator(dist=0.05, poni1=3e-3, poni2=4e-3, detector=self.det)
+        self.ai.sparse_cache = None
+        numpy.random.seed(0)
+        self.image = numpy.random.poisson(100, self.det.shape).astype(numpy.float32) + 1
+
+    def tearDown(self):
+        self.det = self.ai = self.image = None
+
+    def test_integrate1d(self):
+        from ..azimuthalIntegrator import AzimuthalIntegrator
+        dis = distortion.Distortion(self.det, self.det.shape, method="csr",
+                                    mask=numpy.zeros(self.det.shape, numpy.int8))
+        corrected = dis.correct(self.image, dummy=-1, delta_dummy=0.5)
+        regular = AzimuthalIntegrator(dist=0.05, poni1=3e-3, poni2=4e-3,
+                                      detector=detectors.Detector(1e-4, 1e-4, max_shape=dis.shape_out))
+        regular.sparse_cache = None
+        for correctSolidAngle in (False, True):
+            ref = regular._integrate1d_ng(corrected, 50, correctSolidAngle=correctSolidAngle,
+                                          dummy=-1, delta_dummy=0.5, method="csr", unit="2th_deg")
+            res = self.ai.integrate1d_distorted(self.image, 50, correctSolidAngle=correctSolidAngle,
+                                                unit="2th_deg", error_model="poisson")
+            self.assertTrue(numpy.allclose(res.radial, ref.radial), "same bins")
+            self.assertTrue(numpy.allclose(res.intensity, ref.intensity, rtol=1e-4),
+                            "solid angle %s: same as correction then integration" % correctSolidAngle)
+            self.assertIsNotNone(res.sigma, "error propagated")
+        self.assertEqual(len(self.ai.engine_registry), 3, "distortion and 2 fused matrices")
+
+        # raw pixels discarded by the mask or by their dummy value
+        image = self.image.copy()
+        image[10:20, 30:40] = -1
+        mask = numpy.zeros(self.det.shape, numpy.int8)
+        mask[10:20, 30:40] = 1
+        res1 = self.ai.integrate1d_distorted(image, 50, dummy=-1, delta_dummy=0.5, unit="2th_deg")
+        res2 = self.ai.integrate1d_distorted(image, 50, mask=mask, unit="2th_deg")
+        self.assertTrue(numpy.allclose(res1.intensity, res2.intensity), "dummy like mask")
+        self.assertTrue(res2.intensity.min() > 0, "masked pixels do not contribute")
+
+    def test_integrate2d(self):
+        res1 = self.ai.integrate1d_distorted(self.image, 40, unit="r_mm")
+        res2 = self.ai.integrate2d_distorted(self.image, 40, 36, unit="r_mm")
+        self.assertEqual(res2.intensity.shape, (36, 40))
+        self.assertTrue(numpy.allclose(res1.radial, res2.radial), "same radial bins")
+        self.assertTrue(numpy.allclose(res2.sum_signal.sum(axis=0), res1.sum_signal), "same signal")
+        self.assertTrue(numpy.allclose(res2.sum_normalization.sum(axis=0), res1.sum_normalization), "same normalization")
+
+    def test_spline(self):
+        """Fused matrices of a detector described by a spline"""
+        from ..azimuthalIntegrator import AzimuthalIntegrator
+        from ..spline import Spline
+        directory = os.path.join(UtilsTest.tempdir, self.id())
+        os.makedirs(directory)
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        y, x = numpy.ogrid[:64, :80]
+        splines = []
+        for amplitude in (1.5, 1.5, 2.0):
+            spline = Spline()
+            spline.xDispArray = (amplitude * numpy.sin(y / 10.0) + 0 * x).astype(numpy.float32)
+            spline.yDispArray = (amplitude * numpy.cos(x / 12.0) + 0 * y).astype(numpy.float32)
+            spline.array2spline(smoothing=0.1)
+            spline.grid = 1000.0
+            spline.pixelSize = (100.0, 100.0)
+            filename = os.path.join(directory, "%s.spline" % len(splines))
+            spline.write(filename)
+            splines.append(filename)
+
+        det = detectors.Detector(splineFile=splines[0])
+        ai = AzimuthalIntegrator(dist=0.05, poni1=3e-3, poni2=4e-3, detector=det)
+        ai.sparse_cache = None
+        image = numpy.random.poisson(100, det.shape).astype(numpy.float32)
+        ref = ai.integrate1d_distorted(image, 50, unit="2th_deg")
+        self.assertEqual(ref.method_called, "integrate1d_distorted")
+        res = ai.integrate2d_distorted(image, 50, 36, unit="2th_deg")
+        self.assertEqual(res.method_called, "integrate2d_distorted")
+        self.assertEqual(len(ai.engine_registry), 3, "distortion and 2 fused matrices")
+
+        # matrices are identified by the content of the spline file, not by its name
+        det.splineFile = splines[1]
+        ai.integrate1d_distorted(image, 50, unit="2th_deg")
+        self.assertEqual(len(ai.engine_registry), 3, "same distortion")
+        det.splineFile = splines[2]
+        res = ai.integrate1d_distorted(image, 50, unit="2th_deg")
+        self.assertEqual(len(ai.engine_registry), 5, "new distortion")
+        self.assertFalse(numpy.allclose(res.intensity, ref.intensity), "different distortion")
+
+        # the fused matrix is opt-in: the raw pixels are integrated at their actual position
+        res = ai._integrate1d_ng(image, 50, method="csr", unit="2th_deg")
+        self.assertNotEqual(res.method_called, "integrate1d_distorted")
+        res = ai._integrate2d_ng(image, 50, 36, method="csr", unit="2th_deg")
+        self.assertNotEqual(res.method_called, "integrate2d_distorted")
+
+
 class TestManual(unittest.TestCase):
 
     def test(self):
@@ -392,6 +574,11 @@ def suite():
     testsuite.addTest(TestHalfCCD("test_ref_vs_fit2d"))
     testsuite.addTest(TestHalfCCD("test_lut_vs_fit2d"))
     testsuite.addTest(TestHalfCCD("test_csr_vs_fit2d"))
+    testsuite.addTest(TestStack("test_correct_stack"))
+    testsuite.addTest(TestSparseCache("test_reload"))
+    testsuite.addTest(TestFusedIntegration("test_integrate1d"))
+    testsuite.addTest(TestFusedIntegration("test_integrate2d"))
+    testsuite.addTest(TestFusedIntegration("test_spline"))
     return testsuite
 
 
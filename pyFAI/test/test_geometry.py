@@ -36,7 +36,7 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "06/12/2018"
+__date__ = "18/02/2019"
 
 
 import unittest
@@ -47,6 +47,7 @@ import numpy
 import itertools
 import logging
 import os.path
+import shutil
 
 from . import utilstest
 logger = logging.getLogger(__name__)
@@ -54,7 +55,8 @@ logger = logging.getLogger(__name__)
 from .. import geometry
 from ..azimuthalIntegrator import AzimuthalIntegrator
 from .. import units
-from ..detectors import detector_factory
+from .. import utils
+from ..detectors import detector_factory, Detector
 from ..third_party import transformations
 from .utilstest import UtilsTest
 import fabio
@@ -213,6 +215,11 @@ class TestRecprocalSpacingSquarred(unittest.TestCase):
         delta = rd2 - (q / (2 * numpy.pi)) ** 2
         self.assertTrue(numpy.allclose(rd2, (q / (2 * numpy.pi)) ** 2), "corners rd2 = (q/2pi)**2, delat=%s" % delta)
 
+    def test_corner_no_warning(self):
+        "Units without Cython implementation fall back on numpy silently"
+        with utilstest.TestLogging(logger=geometry.logger, warning=0):
+            self.geo.corner_array(self.shape, unit="d*2_A^-2", scale=False)
+
     def test_delta(self):
         drd2a = self.geo.deltaRd2(self.shape)
         rd2 = self.geo.rd2Array(self.shape)
@@ -346,6 +353,29 @@ class TestFastPath(utilstest.ParametricTestCase):
                 self.assertTrue(delta_r < self.EPSILON_R, "data=%s, space='%s' delta_r: %s" % (data, space, delta_r))
                 self.assertTrue(cnt_delta_a < count_a, "data:%s, space: %s cnt_delta_a: %s" % (data, space, cnt_delta_a))
 
+    def test_corner_fused(self):
+        """Test the fused kernel for corners against the former 3-step path"""
+        from ..ext import _geometry, bilinear
+        for data in self.get_geometries():
+            if data["detector"] != "Pilatus100k":
+                # only regular detectors are handled by the fused kernel
+                continue
+            geo = geometry.Geometry(**data)
+            shape = geo.detector.shape
+            d1 = utils.expand2d(numpy.arange(shape[0] + 1.0), shape[1] + 1.0, False)
+            d2 = utils.expand2d(numpy.arange(shape[1] + 1.0), shape[0] + 1.0, True)
+            p1, p2, p3 = geo.detector.calc_cartesian_positions(d1, d2, center=False)
+            for space, chi_disc, nthread in itertools.product(("2th", "q", "r"), (True, False), (0, 1, 3)):
+                with self.subTest(data=data, space=space, chi_disc=chi_disc, nthread=nthread):
+                    res = _geometry.calc_rad_azim(geo.dist, geo.poni1, geo.poni2, geo.rot1, geo.rot2, geo.rot3,
+                                                  p1, p2, p3, space, geo.wavelength, chi_disc)
+                    ref = bilinear.convert_corner_2D_to_4D(2, numpy.ascontiguousarray(res[..., 0]),
+                                                           numpy.ascontiguousarray(res[..., 1]))
+                    obt = _geometry.calc_corner_rad_azim(geo.dist, geo.poni1, geo.poni2, geo.rot1, geo.rot2, geo.rot3,
+                                                         geo.detector.pixel1, geo.detector.pixel2, shape, space,
+                                                         geo.wavelength, chi_disc, nthread)
+                    self.assertTrue(numpy.array_equal(ref, obt), "same corners")
+
     def test_XYZ(self):
         """Test the calc_pos_zyx with full detectors"""
         geometries = self.get_geometries()
@@ -512,6 +542,69 @@ class TestBug474(unittest.TestCase):
         self.assertLess(delta, 1e-5, "error on position is %s" % delta)
 
 
+class TestArrayCache(unittest.TestCase):
+    """Position arrays shared between geometries via memory-mapped files"""
+
+    def setUp(self):
+        self.directory = os.path.join(UtilsTest.tempdir, self.id())
+        self.detector = detector_factory("Pilatus100k")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_shared(self):
+        ref = geometry.Geometry(dist=0.1, poni1=0.02, poni2=0.03, rot1=0.1, detector=self.detector, wavelength=1e-10)
+        geo1 = geometry.Geometry(dist=0.1, poni1=0.02, poni2=0.03, rot1=0.1, detector=self.detector, wavelength=1e-10)
+        geo1.set_array_cache(self.directory, numpy.float32)
+        center = geo1.center_array(unit="q_nm^-1", scale=False)
+        corner = geo1.corner_array(unit="q_nm^-1", scale=False)
+        delta = geo1.delta_array(unit="q_nm^-1", scale=False)
+        self.assertEqual(center.dtype, numpy.float32, "float32 center")
+        self.assertEqual(delta.dtype, numpy.float32, "float32 delta")
+        self.assertEqual(len(geo1.array_cache.keys()), 3, "3 arrays shared")
+        self.assertTrue(numpy.allclose(center, ref.center_array(unit="q_nm^-1", scale=False)), "center")
+        self.assertTrue(numpy.allclose(corner, ref.corner_array(unit="q_nm^-1", scale=False)), "corner")
+        self.assertTrue(numpy.allclose(delta, ref.delta_array(unit="q_nm^-1", scale=False), atol=1e-4), "delta")
+
+        # Same geometry in an other "process": arrays are attached, not calculated
+        geo2 = geometry.Geometry(dist=0.1, poni1=0.02, poni2=0.03, rot1=0.1, detector=self.detector, wavelength=1e-10)
+        geo2.set_array_cache(self.directory, numpy.float32)
+        geo2.position_array = None  # would fail if called
+        center2 = geo2.center_array(unit="q_nm^-1", scale=False)
+        self.assertIsInstance(center2, numpy.memmap, "memory-mapped")
+        self.assertTrue(numpy.array_equal(center, center2), "same array")
+        self.assertTrue(numpy.array_equal(corner, geo2.corner_array(unit="q_nm^-1", scale=False)), "same array")
+
+        # Different geometry: different arrays
+        geo2.position_array = ref.position_array
+        geo2.rot1 = 0.2
+        geo2.center_array(unit="q_nm^-1", scale=False)
+        self.assertEqual(len(geo1.array_cache.keys()), 4, "new array")
+
+        geo1.array_cache.clear()
+        self.assertEqual(len(geo1.array_cache.keys()), 0, "empty cache")
+
+    def test_distortion(self):
+        "Detectors with the same pixel size and shape but different distortions"
+        detectors = []
+        for shift in (0, 1e-3):
+            detector = Detector(1e-4, 1e-4, max_shape=(50, 60))
+            corners = numpy.array(detector.get_pixel_corners())
+            corners[..., 1:] += shift
+            detector.set_pixel_corners(corners)
+            detectors.append(detector)
+        arrays = []
+        for detector in detectors:
+            geo = geometry.Geometry(dist=0.1, poni1=0.002, poni2=0.003, detector=detector, wavelength=1e-10)
+            geo.set_array_cache(self.directory)
+            ref = geometry.Geometry(dist=0.1, poni1=0.002, poni2=0.003, detector=detector, wavelength=1e-10)
+            corner = geo.corner_array(unit="2th_deg", scale=False)
+            self.assertTrue(numpy.allclose(corner, ref.corner_array(unit="2th_deg", scale=False)), "corner")
+            arrays.append(corner)
+        self.assertFalse(numpy.allclose(arrays[0], arrays[1]), "distortions are not mixed up")
+        self.assertEqual(len(geo.array_cache.keys()), 2, "one array per distortion")
+
+
 def suite():
     loader = unittest.defaultTestLoader.loadTestsFromTestCase
     testsuite = unittest.TestSuite()
@@ -522,6 +615,7 @@ def suite():
     testsuite.addTest(loader(TestCalcFrom))
     testsuite.addTest(loader(TestGeometry))
     testsuite.addTest(loader(TestFastPath))
+    testsuite.addTest(loader(TestArrayCache))
     return testsuite
 
 
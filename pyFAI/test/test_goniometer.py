@@ -35,7 +35,7 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "Jérôme.Kieffer@esrf.fr"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "10/01/2018"
+__date__ = "18/02/2019"
 
 import os
 import unittest
@@ -43,7 +43,8 @@ import logging
 from .utilstest import UtilsTest
 logger = logging.getLogger(__name__)
 import numpy
-from ..goniometer import GeometryTranslation, Goniometer, numexpr
+from ..goniometer import GeometryTranslation, ExtendedTransformation, Goniometer, numexpr
+from .. import units
 
 
 @unittest.skipUnless(numexpr, "Numexpr package is missing")
@@ -114,10 +115,96 @@ class TestTranslation(unittest.TestCase):
             os.unlink(fname)
 
 
+@unittest.skipUnless(numexpr, "Numexpr package is missing")
+class TestGoniometerScan(unittest.TestCase):
+    """
+    Test the streamed integration of a goniometer scan
+    """
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.gt = GeometryTranslation(pos_names=["angle", "phi"],
+                                      param_names=["dist", "poni1", "poni2"],
+                                      dist_expr="dist",
+                                      poni1_expr="poni1",
+                                      poni2_expr="poni2",
+                                      rot1_expr="0.0",
+                                      rot2_expr="angle",
+                                      rot3_expr="phi")
+        self.gonio = Goniometer([0.1, 0.01, 0.01], self.gt, "Detector", wavelength=1e-10)
+        self.gonio.detector.pixel1 = self.gonio.detector.pixel2 = 1e-4
+        self.gonio.detector.max_shape = (100, 120)
+        self.positions = [(0.0, 0.0), (0.1, 0.0), (0.1, 0.3), (0.0, 0.0)]
+        numpy.random.seed(0)
+        self.frames = [numpy.random.random((100, 120)) * 100 for _ in self.positions]
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.gt = self.gonio = self.positions = self.frames = None
+
+    def test_integrate1d(self):
+        monitors = [1.0, 2.0, 3.0, 4.0]
+        mg = self.gonio.get_mg(self.positions)
+        ref = mg.integrate1d(self.frames, 100, method="csr", normalization_factor=monitors)
+        scan = self.gonio.get_scan(100, method="csr")
+        for frame, position, monitor in zip(self.frames, self.positions, monitors):
+            scan.add(frame, position, monitor)
+        obt = scan.result()
+        self.assertEqual(scan.nframes, 4)
+        self.assertEqual(len(scan._ais), 3, "identical positions share their geometry")
+        self.assertEqual(len(scan._matrices), 2, "rotation around the beam shares the sparse matrix")
+        self.assertTrue(numpy.allclose(ref.radial, obt.radial), "radial position is the same")
+        self.assertTrue(numpy.allclose(ref.sum, obt.sum), "sum is the same")
+        self.assertTrue(numpy.allclose(ref.count, obt.count), "count is the same")
+        self.assertTrue(numpy.allclose(ref.intensity, obt.intensity), "intensity is the same")
+
+        obt = self.gonio.integrate_scan(self.frames, self.positions, 100, method="csr",
+                                        monitors=monitors, error_model="poisson")
+        self.assertTrue(numpy.allclose(ref.intensity, obt.intensity), "intensity is the same")
+        self.assertIsNotNone(obt.sigma)
+
+    def test_integrate2d(self):
+        mg = self.gonio.get_mg(self.positions)
+        ref = mg.integrate2d(self.frames, 100, 36, method="csr")
+        scan = self.gonio.get_scan(100, 36, method="csr")
+        for frame, position in zip(self.frames, self.positions):
+            scan.add(frame, position)
+        obt = scan.result()
+        self.assertEqual(len(scan._matrices), 3, "no sharing in 2D when rot3 differs")
+        self.assertTrue(numpy.allclose(ref.azimuthal, obt.azimuthal), "azimuthal position is the same")
+        self.assertTrue(numpy.allclose(ref.sum, obt.sum), "sum is the same")
+        self.assertTrue(numpy.allclose(ref.intensity, obt.intensity), "intensity is the same")
+
+    def test_wavelength(self):
+        gt = ExtendedTransformation(pos_names=["energy"],
+                                    param_names=["dist", "poni1", "poni2"],
+                                    dist_expr="dist",
+                                    poni1_expr="poni1",
+                                    poni2_expr="poni2",
+                                    rot1_expr="0.0",
+                                    rot2_expr="0.0",
+                                    rot3_expr="0.0",
+                                    wavelength_expr="12.398419843320026/energy")
+        gonio = Goniometer([0.1, 0.005, 0.006], gt, self.gonio.detector)
+        positions = [10.0, 12.0]
+        frames = self.frames[:2]
+        mg = gonio.get_mg(positions)
+        for unit, radial_range, nmatrices in (("2th_deg", (0, 60), 1), ("q_nm^-1", (0, 60), 2)):
+            mg.unit = units.to_unit(unit)
+            mg.radial_range = radial_range
+            ref = mg.integrate1d(frames, 100, method="csr")
+            scan = gonio.get_scan(100, unit=unit, radial_range=radial_range, method="csr")
+            for frame, position in zip(frames, positions):
+                scan.add(frame, position)
+            obt = scan.result()
+            self.assertEqual(len(scan._matrices), nmatrices, unit)
+            self.assertTrue(numpy.allclose(ref.intensity, obt.intensity), "%s intensity is the same" % unit)
+
+
 def suite():
     loader = unittest.defaultTestLoader.loadTestsFromTestCase
     testsuite = unittest.TestSuite()
     testsuite.addTest(loader(TestTranslation))
+    testsuite.addTest(loader(TestGoniometerScan))
     return testsuite
 
 
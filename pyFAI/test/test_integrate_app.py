@@ -37,6 +37,7 @@ import numpy
 import shutil
 
 import pyFAI.app.integrate
+import pyFAI.io
 from .utilstest import UtilsTest
 from pyFAI.io import integration_config
 
@@ -55,6 +56,10 @@ class TestIntegrateApp(unittest.TestCase):
             self.gui = False
             self.json = ".azimint.json"
             self.monitor_key = None
+            self.readers = 0
+            self.integrators = 0
+            self.queue_size = 4
+            self.jobs = 0
 
     @contextlib.contextmanager
     def jsontempfile(self, ponipath, nbpt_azim=1):
@@ -177,6 +182,18 @@ class _ResultObserver(pyFAI.app.integrate.IntegrationObserver):
         self.result.append(result)
 
 
+class _InterruptingObserver(_ResultObserver):
+
+    def __init__(self, nframes):
+        super(_InterruptingObserver, self).__init__()
+        self.nframes = nframes
+
+    def data_result(self, data_id, result):
+        super(_InterruptingObserver, self).data_result(data_id, result)
+        if len(self.result) >= self.nframes:
+            self.request_interruption()
+
+
 class TestProcess(unittest.TestCase):
 
     @classmethod
@@ -294,6 +311,106 @@ class TestProcess(unittest.TestCase):
         numpy.testing.assert_array_almost_equal(result.radial, expected_radial, decimal=1)
         numpy.testing.assert_array_almost_equal(result.azimuthal, expected_azimuthal, decimal=1)
 
+    def test_process_pipeline(self):
+        params = {"do_2D": True,
+                  "nbpt_azim": 2,
+                  "nbpt_rad": 2,
+                  "method": ("bbox", "histogram", "cython")}
+        config = self.base_config.copy()
+        config.update(params)
+        multiframe = fabio.edfimage.EdfImage(data=numpy.array([[0, 0], [0, 100], [0, 0]]))
+        for i in range(2, 6):
+            multiframe.appendFrame(data=numpy.array([[0, 0], [0, 100 * i], [0, 0]]))
+        filename = os.path.join(self.tempDir, "multiframe.edf")
+        multiframe.write(filename)
+        data = [filename,
+                numpy.array([[0, 0], [0, 300], [0, 0]]),
+                numpy.array([[[0, 0], [0, 700], [0, 0]], [[0, 0], [0, 800], [0, 0]]])]
+
+        sequential = _ResultObserver()
+        pyFAI.app.integrate.process(data, self.tempDir, config, monitor_name=None, observer=sequential)
+        pipelined = _ResultObserver()
+        outdir = os.path.join(self.tempDir, "pipeline")
+        os.makedirs(outdir)
+        pyFAI.app.integrate.process(data, outdir, config, monitor_name=None, observer=pipelined,
+                                    nreader=2, nintegrator=3, queue_size=1)
+        self.assertEqual(len(sequential.result), 8)
+        self.assertEqual(len(pipelined.result), 8)
+        for ref, obt in zip(sequential.result, pipelined.result):
+            numpy.testing.assert_array_almost_equal(ref.intensity, obt.intensity)
+        self.assertEqual(sorted(os.listdir(outdir)), ["array_1.azim", "array_2_pyFAI.h5", "multiframe_pyFAI.h5"])
+
+    def check_process_jobs(self, start_method):
+        params = {"do_2D": False,
+                  "nbpt_rad": 2,
+                  "method": ("bbox", "csr", "cython")}
+        config = self.base_config.copy()
+        config.update(params)
+        multiframe = fabio.edfimage.EdfImage(data=numpy.array([[0, 0], [0, 100], [0, 0]]))
+        for i in range(2, 6):
+            multiframe.appendFrame(data=numpy.array([[0, 0], [0, 100 * i], [0, 0]]))
+        filename = os.path.join(self.tempDir, "multiframe.edf")
+        multiframe.write(filename)
+        data = [numpy.array([[0, 0], [0, 300], [0, 0]]),
+                filename,
+                fabio.numpyimage.NumpyImage(data=numpy.array([[0, 0], [0, 400], [0, 0]]))]
+
+        sequential = _ResultObserver()
+        pyFAI.app.integrate.process(data, self.tempDir, config, monitor_name=None, observer=sequential)
+        parallel = _ResultObserver()
+        outdir = os.path.join(self.tempDir, "jobs_%s" % start_method)
+        os.makedirs(outdir)
+        pyFAI.app.integrate.process(data, outdir, config, monitor_name=None, observer=parallel, njobs=2,
+                                    start_method=start_method)
+        self.assertEqual(len(sequential.result), 7)
+        self.assertEqual(len(parallel.result), 7)
+        for ref, obt in zip(sequential.result, parallel.result):
+            numpy.testing.assert_array_almost_equal(ref.intensity, obt.intensity)
+        self.assertEqual(len(os.listdir(outdir)), 3)
+        self.assertIn("multiframe_pyFAI.h5", os.listdir(outdir))
+
+    @unittest.skipUnless(hasattr(os, "fork"), "fork is required")
+    def test_process_jobs(self):
+        self.check_process_jobs("fork")
+
+    def test_process_jobs_spawn(self):
+        self.check_process_jobs("spawn")
+
+    @unittest.skipIf(pyFAI.io.h5py is None, "h5py is required")
+    def test_process_journal(self):
+        params = {"do_2D": False,
+                  "nbpt_rad": 2,
+                  "method": ("bbox", "csr", "cython")}
+        config = self.base_config.copy()
+        config.update(params)
+        multiframe = fabio.edfimage.EdfImage(data=numpy.array([[0, 0], [0, 100], [0, 0]]))
+        for i in range(2, 6):
+            multiframe.appendFrame(data=numpy.array([[0, 0], [0, 100 * i], [0, 0]]))
+        filename = os.path.join(self.tempDir, "multiframe.edf")
+        multiframe.write(filename)
+        data = [numpy.array([[0, 0], [0, 300], [0, 0]]), filename]
+        journal = os.path.join(self.tempDir, "journal.json")
+
+        sequential = _ResultObserver()
+        pyFAI.app.integrate.process(data, self.tempDir, config, monitor_name=None, observer=sequential)
+        outdir = os.path.join(self.tempDir, "journal")
+        os.makedirs(outdir)
+        interrupted = _InterruptingObserver(3)
+        pyFAI.app.integrate.process(data, outdir, config, monitor_name=None, observer=interrupted,
+                                    journal=journal)
+        self.assertEqual(len(interrupted.result), 3)
+        resumed = _ResultObserver()
+        pyFAI.app.integrate.process(data, outdir, config, monitor_name=None, observer=resumed,
+                                    journal=journal)
+        self.assertEqual(len(resumed.result), 3, "only missing frames are processed")
+        for ref, obt in zip(sequential.result, interrupted.result + resumed.result):
+            numpy.testing.assert_array_almost_equal(ref.intensity, obt.intensity)
+        with pyFAI.io.h5py.File(os.path.join(outdir, "multiframe_pyFAI.h5"), "r") as h5:
+            intensity = h5["data/integrate/results/data"][()]
+        self.assertEqual(len(intensity), 5, "output is completed")
+        for ref, obt in zip(sequential.result[1:], intensity):
+            numpy.testing.assert_array_almost_equal(ref.intensity, obt)
+
     def test_unsupported_types(self):
         params = {"do_2D": True,
                   "nbpt_azim": 2,
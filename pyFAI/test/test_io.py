@@ -34,7 +34,7 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "10/01/2018"
+__date__ = "18/02/2019"
 
 
 import unittest
@@ -121,6 +121,104 @@ class testHDF5Writer(unittest.TestCase):
         self.assertTrue(statinfo.st_size / 1e6 > nmbytes, "file size (%s) is larger than dataset" % statinfo.st_size)
 
 
+    def test_buffered_writer(self):
+        if io.h5py is None:
+            self.skipTest("h5py is missing")
+        h5file = os.path.join(self.tmpdir, "buffered.h5")
+        nbpt = 50
+        n = 23
+        data = numpy.random.random((n, nbpt)).astype(numpy.float32)
+        radial = numpy.linspace(0, 1, nbpt)
+        writer = io.HDF5Writer(filename=h5file, hpath="data", append_frames=True,
+                               chunk_frames=8, compression="gzip", buffer_frames=5, max_pending=1)
+        writer.init({"nbpt_rad": nbpt, "do_2D": False})
+        for i in range(n):
+            writer.write((radial, data[i]))
+        # a frame out of order is written in its own slab
+        writer.write(data[0] * 2, index=n + 2)
+        writer.close()
+        with io.h5py.File(h5file, "r") as h5:
+            dataset = h5["data/integrate/results/data"]
+            self.assertEqual(dataset.shape, (n + 3, nbpt), "pre-allocated frames are removed")
+            self.assertEqual(dataset.chunks, (8, nbpt))
+            self.assertEqual(dataset.compression, "gzip")
+            self.assertTrue(numpy.array_equal(dataset[:n], data), "data are written")
+            self.assertTrue(numpy.array_equal(dataset[n + 2], data[0] * 2), "data are written")
+            self.assertTrue(numpy.allclose(h5["data/integrate/results/radial"][()], radial), "radial")
+
+    def test_empty_writer(self):
+        if io.h5py is None:
+            self.skipTest("h5py is missing")
+        h5file = os.path.join(self.tmpdir, "empty.h5")
+        writer = io.HDF5Writer(filename=h5file, hpath="data", append_frames=True, chunk_frames=8)
+        writer.init({"nbpt_rad": 10, "do_2D": False})
+        writer.close()
+        with io.h5py.File(h5file, "r") as h5:
+            self.assertEqual(h5["data/integrate/results/data"].shape, (0, 10), "no frame written")
+
+    def test_resume_writer(self):
+        if io.h5py is None:
+            self.skipTest("h5py is missing")
+        h5file = os.path.join(self.tmpdir, "resume.h5")
+        nbpt = 10
+        data = numpy.random.random((6, nbpt)).astype(numpy.float32)
+        writer = io.HDF5Writer(filename=h5file, hpath="data", append_frames=True)
+        writer.init({"nbpt_rad": nbpt, "do_2D": False})
+        for frame in data[:4]:
+            writer.write(frame)
+        writer.close()
+        # frames after the 3rd one are not recorded as processed, i.e. lost
+        writer = io.HDF5Writer(filename=h5file, hpath="data", append_frames=True, start_frame=3)
+        writer.init({"nbpt_rad": nbpt, "do_2D": False})
+        for frame in data[3:]:
+            writer.write(frame)
+        writer.close()
+        with io.h5py.File(h5file, "r") as h5:
+            dataset = h5["data/integrate/results/data"]
+            self.assertEqual(dataset.shape, data.shape, "frames are appended")
+            self.assertTrue(numpy.array_equal(dataset[()], data), "frames are kept")
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmpdir = os.path.join(UtilsTest.tempdir, "io_journal")
+        if not os.path.isdir(self.tmpdir):
+            os.mkdir(self.tmpdir)
+        self.filename = os.path.join(self.tmpdir, "journal.json")
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+        self.tmpdir = None
+
+    def test_resume(self):
+        from pyFAI.io.journal import Journal
+        config = {"nbpt_rad": 10}
+        with Journal(self.filename, config) as journal:
+            self.assertEqual(len(journal), 0)
+            journal.record("a.edf", 0, "a.h5", 0)
+            journal.record_many([("a.edf", 1, "a.h5", 1), ("b.edf", 0, "b.dat", None)])
+        # simulate a crash while writing a record
+        with open(self.filename, "a") as fd:
+            fd.write('{"input": "a.ed')
+        with Journal(self.filename, config) as journal:
+            self.assertEqual(len(journal), 3)
+            self.assertTrue(journal.is_done("a.edf", 1))
+            self.assertTrue(journal.is_done("b.edf"))
+            self.assertFalse(journal.is_done("a.edf", 2))
+            self.assertEqual(journal.get_offset("a.h5"), 2)
+            self.assertEqual(journal.get_offset("c.h5"), 0)
+            journal.record("a.edf", 2, "a.h5", 2)
+        with Journal(self.filename, config) as journal:
+            self.assertEqual(journal.get_offset("a.h5"), 3, "incomplete record is discarded")
+        with Journal(self.filename, {"nbpt_rad": 20}) as journal:
+            self.assertEqual(len(journal), 0, "other processing")
+        with Journal(self.filename, {"nbpt_rad": 20}, resume=False) as journal:
+            self.assertEqual(len(journal), 0)
+
+
 class testFabIOWriter(unittest.TestCase):
     """the tested class is not yet finished ... JK07/2017"""
 
@@ -156,12 +254,87 @@ class testFabIOWriter(unittest.TestCase):
         self.assertTrue(statinfo.st_size / 1e6 > nmbytes, "file size (%s) is larger than dataset" % statinfo.st_size)
 
 
+class TestSources(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmpdir = os.path.join(UtilsTest.tempdir, "io_sources")
+        if not os.path.isdir(self.tmpdir):
+            os.mkdir(self.tmpdir)
+        self.stack = numpy.random.randint(0, 1000, size=(3, 7, 5)).astype(numpy.int32)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+        self.tmpdir = None
+
+    def check_source(self, filename, mmap=True):
+        from pyFAI.io.sources import open_source
+        with open_source(filename, mmap) as source:
+            self.assertEqual(source.nframes, len(self.stack))
+            for frame, ref in zip(source, self.stack):
+                self.assertEqual(frame.data.dtype, ref.dtype)
+                self.assertTrue(numpy.array_equal(frame.data, ref), "data match")
+                # frames are writable but the file is never modified
+                frame.data[0, 0] = -1
+            self.assertRaises(IndexError, source.getframe, len(self.stack))
+            zero_copy = source.zero_copy
+        with open_source(filename, mmap) as source:
+            self.assertTrue(numpy.array_equal(source.getframe(0).data, self.stack[0]), "file unchanged")
+        return zero_copy
+
+    def test_edf(self):
+        import fabio
+        filename = os.path.join(self.tmpdir, "stack.edf")
+        edf = fabio.edfimage.EdfImage(data=self.stack[0], header={"monitor": "12"})
+        for frame in self.stack[1:]:
+            edf.appendFrame(data=frame)
+        edf.write(filename)
+        self.assertTrue(self.check_source(filename))
+        self.assertFalse(self.check_source(filename, mmap=False))
+        from pyFAI.io.sources import open_source
+        with open_source(filename) as source:
+            self.assertEqual(source.getframe(0).header.get("monitor"), "12")
+
+    def test_compressed_edf(self):
+        import fabio
+        import gzip
+        import bz2
+        filename = os.path.join(self.tmpdir, "stack.edf")
+        edf = fabio.edfimage.EdfImage(data=self.stack[0])
+        for frame in self.stack[1:]:
+            edf.appendFrame(data=frame)
+        edf.write(filename)
+        with open(filename, "rb") as f:
+            raw = f.read()
+        for ext, compressor in ((".gz", gzip.open), (".bz2", bz2.BZ2File)):
+            with compressor(filename + ext, "wb") as f:
+                f.write(raw)
+            # read via fabio, not memory-mapped
+            self.assertFalse(self.check_source(filename + ext), ext)
+
+    def test_hdf5(self):
+        if io.h5py is None:
+            self.skipTest("h5py is missing")
+        filename = os.path.join(self.tmpdir, "stack.h5")
+        with io.h5py.File(filename, "w") as h5:
+            h5["contiguous"] = self.stack
+            h5.create_dataset("chunked", data=self.stack, chunks=(1,) + self.stack.shape[1:])
+            h5.create_dataset("compressed", data=self.stack, compression="gzip")
+        self.assertTrue(self.check_source(filename + "::/contiguous"))
+        # locating chunks requires a recent h5py
+        self.check_source(filename + "::/chunked")
+        self.assertFalse(self.check_source(filename + "::/compressed"))
+
+
 def suite():
     testsuite = unittest.TestSuite()
     loader = unittest.defaultTestLoader.loadTestsFromTestCase
     testsuite.addTest(loader(TestIsoTime))
     testsuite.addTest(loader(TestNexus))
     testsuite.addTest(loader(testHDF5Writer))
+    testsuite.addTest(loader(TestSources))
+    testsuite.addTest(loader(TestJournal))
     # testsuite.addTest(loader(testFabIOWriter))
     return testsuite
 
@@ -35,9 +35,10 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "10/01/2018"
+__date__ = "18/02/2019"
 
 import unittest
+import numpy
 import logging
 from .utilstest import UtilsTest
 logger = logging.getLogger(__name__)
@@ -129,6 +130,62 @@ class TestMultiGeometry(unittest.TestCase):
         self.assertTrue(delta_sum.max() < 0.04, "pixel sum is the same delta=%s" % delta_sum.max())
         self.assertTrue(delta.max() < 0.007, "pixel intensity is the same (for populated pixels) delta=%s" % delta.max())
 
+    def test_integrate_merged_csr(self):
+        "All images integrated at once with a merged CSR matrix"
+        monitors = [1.0, 2.0, 0.5, 4.0]
+        npt_azim = 36
+        sum1d = numpy.zeros(self.N)
+        count1d = numpy.zeros(self.N)
+        sum2d = numpy.zeros((npt_azim, self.N))
+        count2d = numpy.zeros((npt_azim, self.N))
+        for ai, data, monitor in zip(self.ais, self.lst_data, monitors):
+            sac = ai.pixel1 * ai.pixel2 / ai.dist ** 2
+            res = ai.integrate1d(data, self.N, radial_range=self.range, azimuth_range=self.mg.azimuth_range,
+                                 unit="2th_deg", method="csr", polarization_factor=0.9)
+            sum1d += res.sum / monitor
+            count1d += res.count * sac
+            res = ai.integrate2d(data, self.N, npt_azim, radial_range=self.range, azimuth_range=self.mg.azimuth_range,
+                                 unit="2th_deg", method="csr", polarization_factor=0.9)
+            sum2d += res.sum / monitor
+            count2d += res.count * sac
+
+        obt = self.mg.integrate1d(self.lst_data, self.N, method="csr", polarization_factor=0.9,
+                                  normalization_factor=monitors)
+        self.assertEqual(abs(res.radial - obt.radial).max(), 0, "Bin position is the same")
+        self.assertTrue(numpy.allclose(obt.sum, sum1d, rtol=1e-5), "sum is the same")
+        self.assertTrue(numpy.allclose(obt.count, count1d, rtol=1e-5), "count is the same")
+        valid = count1d > 0
+        self.assertTrue(numpy.allclose(obt.intensity[valid], sum1d[valid] / count1d[valid], rtol=1e-5), "intensity is the same")
+
+        # the merged matrix is reused, variance is propagated
+        obt = self.mg.integrate1d(self.lst_data, self.N, method="csr", error_model="poisson")
+        self.assertIsNotNone(obt.sigma)
+        self.assertTrue(numpy.all(obt.sigma[valid] > 0), "error is positive")
+        self.assertEqual(obt.method_called, "integrate1d")
+        self.assertEqual(obt.compute_engine, "MultiGeometry merged CSR")
+
+        obt = self.mg.integrate2d(self.lst_data, self.N, npt_azim, method="csr", polarization_factor=0.9,
+                                  normalization_factor=monitors)
+        self.assertEqual(abs(res.radial - obt.radial).max(), 0, "Bin position is the same")
+        self.assertEqual(abs(res.azimuthal - obt.azimuthal).max(), 0, "Bin position is the same")
+        self.assertTrue(numpy.allclose(obt.sum, sum2d, rtol=1e-5, atol=1e-3), "sum is the same")
+        self.assertTrue(numpy.allclose(obt.count, count2d, rtol=1e-5, atol=1e-12), "count is the same")
+        self.assertEqual(obt.method_called, "integrate2d")
+        self.assertEqual(obt.compute_engine, "MultiGeometry merged CSR")
+
+    def test_sigma(self):
+        "The error is propagated the same way with the merged CSR matrix and image per image"
+        monitors = [1.0, 2.0, 0.5, 4.0]
+        npt = 40
+        kwargs = {"error_model": "poisson", "correctSolidAngle": False, "normalization_factor": monitors}
+        merged = self.mg.integrate1d(self.lst_data, npt, method="csr", **kwargs)
+        loop = self.mg.integrate1d(self.lst_data, npt, method="splitbbox", **kwargs)
+        valid = loop.count > 0
+        self.assertTrue(numpy.allclose(merged.intensity[valid], loop.intensity[valid], rtol=1e-3), "intensity is the same")
+        # pixel splitting: the merged matrix propagates coef², the legacy integrators coef
+        self.assertTrue(numpy.all(merged.sigma[valid] <= loop.sigma[valid] * (1 + 1e-6)), "coef² <= coef")
+        self.assertTrue(numpy.allclose(merged.sigma[valid], loop.sigma[valid], rtol=0.15), "sigma is the same")
+
 
 def suite():
     testsuite = unittest.TestSuite()
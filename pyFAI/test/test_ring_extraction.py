@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+#    Project: Azimuthal integration
+#             https://github.com/silx-kit/pyFAI
+#
+#    Copyright (C) 2019 European Synchrotron Radiation Facility, Grenoble, France
+#
+#    Principal author:       Jérôme Kieffer (Jerome.Kieffer@ESRF.eu)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import, division, print_function
+
+"""Test suite for the extraction of control points along rings"""
+
+__author__ = "Jérôme Kieffer"
+__contact__ = "Jerome.Kieffer@ESRF.eu"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "18/02/2019"
+
+
+import unittest
+import pickle
+import numpy
+import logging
+logger = logging.getLogger(__name__)
+
+from ..azimuthalIntegrator import AzimuthalIntegrator
+from ..detectors import Detector
+from ..massif import Massif
+from ..ring_extraction import RingExtraction
+
+
+class TestRingExtraction(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestRingExtraction, cls).setUpClass()
+        shape = (200, 200)
+        detector = Detector(1e-4, 1e-4, max_shape=shape)
+        ai = AzimuthalIntegrator(dist=0.05, poni1=0.008, poni2=0.011, detector=detector)
+        cls.ttha = ai.twoThetaArray(shape)
+        chia = ai.chiArray(shape)
+        cls.tth = numpy.deg2rad([4.0, 9.0, 13.0, 17.0])
+        rng = numpy.random.RandomState(0)
+        image = rng.poisson(10, shape).astype(numpy.float32)
+        for i, tth in enumerate(cls.tth):
+            ring = 1000.0 * numpy.exp(-((cls.ttha - tth) / 0.002) ** 2)
+            image += ring * (1 + numpy.cos((10 + 3 * i) * chia)) / 2
+        cls.image = image
+        cls.mask = numpy.zeros(shape, dtype=numpy.int8)
+        cls.mask[90:95, :] = 1
+        delta = (cls.tth[1:] - cls.tth[:-1]) / 4.0
+        cls.tth_min = cls.tth - numpy.concatenate(([delta[0]], delta))
+        cls.tth_max = cls.tth + numpy.concatenate((delta, [delta[-1]]))
+        cls.massif = Massif(image, cls.mask)
+        cls.massif.get_labeled_massif()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestRingExtraction, cls).tearDownClass()
+        cls.ttha = cls.tth = cls.image = cls.mask = cls.massif = None
+        cls.tth_min = cls.tth_max = None
+
+    def ring_masks(self):
+        "Masks of the rings as calculated historically by the calibration"
+        for i in range(self.tth.size):
+            mask = numpy.logical_and(self.ttha >= self.tth_min[i], self.ttha < self.tth_max[i])
+            yield numpy.logical_and(mask, numpy.logical_not(self.mask))
+
+    def test_ring_pixels(self):
+        extraction = RingExtraction(self.image, self.ttha, self.tth_min, self.tth_max, mask=self.mask)
+        for i, mask in enumerate(self.ring_masks()):
+            pixels = extraction.ring_pixels(i)
+            self.assertEqual(extraction.ring_size(i), mask.sum())
+            self.assertTrue(numpy.array_equal(pixels, numpy.where(mask.ravel())[0]), "ring %s" % i)
+            self.assertTrue(numpy.array_equal(extraction.ring_mask(pixels), mask), "ring %s" % i)
+
+    def test_find_peaks(self):
+        extraction = RingExtraction(self.image, self.ttha, self.tth_min, self.tth_max, mask=self.mask)
+
+        def parameters(mask):
+            sub_data = self.image[mask]
+            upper_limit = sub_data.mean(dtype=numpy.float64) + sub_data.std(dtype=numpy.float64)
+            mask2 = numpy.logical_and(self.image > upper_limit, mask)
+            pixels = numpy.where(mask2.ravel())[0]
+            seeds = set((p // mask.shape[1], p % mask.shape[1]) for p in pixels[::50])
+            return mask2, pixels, upper_limit, seeds
+
+        numpy.random.seed(0)
+        ref = []
+        for mask in self.ring_masks():
+            mask2, _, upper_limit, seeds = parameters(mask)
+            ref.append(self.massif.peaks_from_area(mask2, Imin=upper_limit, keep=30, dmin=5, seed=seeds))
+
+        numpy.random.seed(0)
+        jobs = []
+        for i, mask in enumerate(self.ring_masks()):
+            _, pixels, upper_limit, seeds = parameters(mask)
+            jobs.append(extraction.make_job(i, pixels, upper_limit, 30, 5, seeds, shuffle=True))
+        for njobs, start_method in ((1, None), (2, None), (2, "spawn")):
+            res = extraction.find_peaks(self.massif, jobs, njobs, start_method=start_method)
+            self.assertEqual(len(res), len(ref))
+            for i, (obt, exp) in enumerate(zip(res, ref)):
+                self.assertGreater(len(exp), 0, "ring %s has peaks" % i)
+                self.assertEqual(obt, exp, "ring %s with %s jobs (%s)" % (i, njobs, start_method))
+
+    def test_pickle(self):
+        "Detectors of peaks are pickled to the workers with the spawn start method"
+        from ..ext.watershed import InverseWatershed
+        massif = pickle.loads(pickle.dumps(self.massif))
+        self.assertEqual(massif.nearest_peak((50, 60)), self.massif.nearest_peak((50, 60)))
+        watershed = InverseWatershed(self.image)
+        watershed.init()
+        clone = pickle.loads(pickle.dumps(watershed))
+        self.assertEqual(sorted(clone.regions), sorted(watershed.regions))
+        mask = self.image > 500
+        self.assertEqual(clone.peaks_from_area(mask, Imin=500, keep=10),
+                         watershed.peaks_from_area(mask, Imin=500, keep=10))
+
+
+def suite():
+    testsuite = unittest.TestSuite()
+    loader = unittest.defaultTestLoader.loadTestsFromTestCase
+    testsuite.addTest(loader(TestRingExtraction))
+    return testsuite
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
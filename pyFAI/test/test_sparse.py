@@ -34,7 +34,7 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "06/12/2018"
+__date__ = "18/02/2019"
 
 
 import unittest
@@ -125,6 +125,44 @@ class TestSparseUtils(unittest.TestCase):
         self.assertTrue(numpy.allclose(csr_out[1], csr_ref[1]), "coef are the same in CSR")
         self.assertTrue(numpy.allclose(csr_out[0], csr_ref[0]), "coef are the same in CSR")
 
+    def test_compact(self):
+        """Round trip to the compact CSR format, with gaps larger than 16 bits"""
+        indptr = numpy.array([0, 3, 3, 7], dtype=numpy.int32)
+        indices = numpy.array([5, 6, 200000, 0, 65534, 65535 + 65534, 300000], dtype=numpy.int32)
+        data = numpy.random.random(indices.size).astype(numpy.float32)
+        vector = numpy.random.random((300001, 4)).astype(numpy.float32)
+
+        compact = sparse_utils.CSR_to_compact(data, indices, indptr)
+        self.assertEqual(compact[1].dtype, numpy.uint16, "deltas are 16 bits")
+        self.assertGreater(compact[1].size, indices.size, "escape values were inserted")
+        self.assertTrue(numpy.array_equal(compact[2], [5, 0, 0]), "row starts")
+        csr_out = sparse_utils.compact_to_CSR(*compact)
+        self.assertTrue(numpy.array_equal(csr_out[0], data), "coef are the same")
+        self.assertTrue(numpy.array_equal(csr_out[1], indices), "indices are the same")
+        self.assertTrue(numpy.array_equal(csr_out[2], indptr), "indptr are the same")
+
+        ref = numpy.zeros((3, 4))
+        for i in range(3):
+            for j in range(indptr[i], indptr[i + 1]):
+                ref[i] += data[j] * vector[indices[j]]
+        self.assertTrue(numpy.allclose(sparse_utils.compact_dot(vector, *compact), ref), "dot is correct")
+        self.assertTrue(numpy.allclose(sparse_utils.compact_dot(vector[:, 0], *compact), ref[:, 0]), "dot is correct on a vector")
+
+        # Without coefficients
+        compact = sparse_utils.CSR_to_compact(None, indices, indptr)
+        self.assertIs(compact[0], None, "no coef")
+        csr_out = sparse_utils.compact_to_CSR(*compact)
+        self.assertTrue(numpy.array_equal(csr_out[0], numpy.ones(indices.size)), "coef are ones")
+        self.assertTrue(numpy.array_equal(csr_out[1], indices), "indices are the same")
+        ref = numpy.array([vector[indices[indptr[i]:indptr[i + 1]]].sum(axis=0) for i in range(3)])
+        self.assertTrue(numpy.allclose(sparse_utils.compact_dot(vector, *compact, nthread=2), ref), "dot is correct")
+
+        # Double precision vectors are not truncated to float32
+        vector = 1.0 + numpy.random.random((300001, 2)) * 1e-9
+        ref = numpy.array([vector[indices[indptr[i]:indptr[i + 1]]].sum(axis=0) for i in range(3)])
+        res = sparse_utils.compact_dot(vector, *compact)
+        self.assertTrue(numpy.allclose(res, ref, rtol=1e-14, atol=0), "dot is in double precision")
+
 
 class TestContainer(unittest.TestCase):
     def test_vector(self):
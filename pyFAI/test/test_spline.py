@@ -37,7 +37,10 @@ __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 __date__ = "03/07/2018"
 
 
+import os
+import shutil
 import unittest
+import numpy
 import logging
 logger = logging.getLogger(__name__)
 import pyFAI.spline
@@ -94,10 +97,64 @@ class TestSpline(utilstest.ParametricTestCase):
         self.assertLess(abs(spline.ySplineCoeff - new_spline.ySplineCoeff).max(), 1e-6, "ySplineCoeff data are OK")
 
 
+class TestSplineArrays(unittest.TestCase):
+    """Synthetic spline: evaluation, cache of the displacement arrays and fit"""
+
+    def setUp(self):
+        self.directory = os.path.join(utilstest.UtilsTest.tempdir, self.id())
+        y, x = numpy.ogrid[:200, :256]
+        self.spline = pyFAI.spline.Spline()
+        self.spline.xDispArray = (2.0 * numpy.sin(x / 50.0) * numpy.cos(y / 70.0)).astype(numpy.float32)
+        self.spline.yDispArray = (1.5 * numpy.cos(x / 60.0 + y / 40.0)).astype(numpy.float32)
+        self.spline.array2spline(smoothing=0.1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.spline = None
+
+    def test_cache(self):
+        ref = pyFAI.spline.Spline()
+        ref.__dict__.update(self.spline.__dict__)
+        ref.xDispArray = ref.yDispArray = None
+        dx, dy = ref.spline2array(cache=self.directory)
+        self.assertLess(abs(dx - self.spline.xDispArray).max(), 0.02, "X displacement")
+        self.assertLess(abs(dy - self.spline.yDispArray).max(), 0.02, "Y displacement")
+
+        other = pyFAI.spline.Spline()
+        other.__dict__.update(ref.__dict__)
+        other.xDispArray = other.yDispArray = None
+        cx, cy = other.spline2array(cache=self.directory)
+        self.assertIsInstance(cx, numpy.memmap, "loaded from the cache")
+        self.assertTrue(numpy.array_equal(cx, dx), "same X displacement")
+        self.assertTrue(numpy.array_equal(cy, dy), "same Y displacement")
+
+        # evaluation at a list of points
+        x = numpy.array([0, 10.5, 255, 100, 37.2])
+        y = numpy.array([199, 3.25, 0, 100, 150])
+        px = ref.splineFuncX(x, y, True)
+        py = ref.splineFuncY(x, y, True)
+        for i in (0, 2, 3):
+            self.assertAlmostEqual(px[i], dx[int(y[i]), int(x[i])], places=5)
+            self.assertAlmostEqual(py[i], dy[int(y[i]), int(x[i])], places=5)
+        self.assertAlmostEqual(px[1], float(ref.splineFuncX(x[1:2], y[1:2])), places=5)
+
+    def test_fit_step(self):
+        fast = pyFAI.spline.Spline()
+        fast.xDispArray = self.spline.xDispArray
+        fast.yDispArray = self.spline.yDispArray
+        fast.array2spline(smoothing=0.1, step=4)
+        self.assertEqual((fast.xmax, fast.ymax), (255, 199), "full detector")
+        fast.xDispArray = fast.yDispArray = None
+        dx, dy = fast.spline2array(cache=self.directory)
+        self.assertLess(abs(dx - self.spline.xDispArray).max(), 0.02, "X displacement")
+        self.assertLess(abs(dy - self.spline.yDispArray).max(), 0.02, "Y displacement")
+
+
 def suite():
     loader = unittest.defaultTestLoader.loadTestsFromTestCase
     testsuite = unittest.TestSuite()
     testsuite.addTest(loader(TestSpline))
+    testsuite.addTest(loader(TestSplineArrays))
     return testsuite
 
 
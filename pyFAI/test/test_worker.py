@@ -34,16 +34,17 @@ __author__ = "Valentin Valls"
 __contact__ = "valentin.valls@esrf.fr"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "04/01/2019"
+__date__ = "18/02/2019"
 
 
 import unittest
 import numpy
 import logging
 import os.path
-from .. import units, worker
+from .. import units, worker, io
 from ..worker import Worker, PixelwiseWorker
 from ..azimuthalIntegrator import AzimuthalIntegrator
+from ..detectors import Detector
 from ..containers import Integrate1dResult
 from ..containers import Integrate2dResult
 from . import utilstest
@@ -251,6 +252,42 @@ class TestWorker(unittest.TestCase):
         result = worker.process(data)
         self.assertIsNone(result)
 
+    def test_process_pipeline(self):
+        detector = Detector(pixel1=1e-4, pixel2=1e-4, max_shape=(64, 48))
+        ai = AzimuthalIntegrator(dist=0.01, detector=detector)
+        worker = Worker(ai, shapeIn=(64, 48), shapeOut=(1, 20))
+        worker.output = "numpy"
+        frames = [numpy.random.random((64, 48)) * i for i in range(20)]
+        expected = [worker.process(frame) for frame in frames]
+
+        received = []
+        writer = MockedAiWriter()
+        statistics = worker.process_pipeline(frames, writer=writer,
+                                             read=lambda frame: {"data": frame, "normalization_factor": 2.0},
+                                             callback=lambda index, frame, result: received.append((index, result)),
+                                             nreader=3, nintegrator=4, queue_size=1)
+        self.assertEqual(writer._write_called, len(frames))
+        self.assertEqual([index for index, _ in received], list(range(len(frames))))
+        for (_, result), ref in zip(received, expected):
+            numpy.testing.assert_allclose(result[:, 0], ref[:, 0])
+            numpy.testing.assert_allclose(result[:, 1], ref[:, 1] / 2.0)
+        for stage in ("read", "integrate", "write"):
+            self.assertEqual(statistics.count[stage], len(frames))
+
+        # errors are raised in the calling thread
+        def read(index):
+            if index == 5:
+                raise IOError("corrupted frame")
+            return frames[index]
+
+        self.assertRaises(IOError, worker.process_pipeline, range(len(frames)), read=read, nreader=2, nintegrator=2)
+
+        # interruption
+        received = []
+        worker.process_pipeline(frames, callback=lambda index, frame, result: received.append(index),
+                                is_interrupted=lambda: len(received) >= 3, nreader=2, nintegrator=2)
+        self.assertEqual(received, [0, 1, 2])
+
     def test_pixelwiseworker(self):
         shape = (5, 7)
         size = numpy.prod(shape)
@@ -334,6 +371,52 @@ class TestWorkerConfig(unittest.TestCase):
         self.assertTrue(numpy.isclose(worker.ai.detector.get_darkcurrent()[0, 0], (1 + 2 + 3) / 3))
         self.assertTrue(numpy.isclose(worker.ai.detector.get_flatfield()[0, 0], (1 + 2 + 4) / 3))
 
+    def test_nthread(self):
+        config = {"version": 2,
+                  "application": "pyfai-integrate",
+                  "dist": 0.1,
+                  "detector": "Detector",
+                  "detector_config": {"pixel1": 1e-4, "pixel2": 1e-4, "max_shape": (2, 2)},
+                  "do_2D": False,
+                  "nbpt_rad": 2,
+                  "method": "csr",
+                  "nthread": 2}
+        worker = Worker()
+        worker.set_config(config)
+        self.assertEqual(worker.ai.nthread, 2)
+        self.assertEqual(worker.get_config()["nthread"], 2)
+        worker.process(data=numpy.ones(shape=self.shape))
+
+    def test_hdf5_options(self):
+        if io.h5py is None:
+            self.skipTest("h5py is missing")
+        config = {"version": 2,
+                  "application": "pyfai-integrate",
+                  "dist": 0.1,
+                  "detector": "Detector",
+                  "detector_config": {"pixel1": 1e-4, "pixel2": 1e-4, "max_shape": (2, 2)},
+                  "do_2D": False,
+                  "nbpt_rad": 2,
+                  "method": "csr",
+                  "chunk_frames": 4,
+                  "compression": "gzip",
+                  "buffer_frames": 2}
+        worker = Worker()
+        worker.set_config(config)
+        worker.output = "raw"
+        self.assertEqual(worker.get_config()["buffer_frames"], 2)
+        filename = os.path.join(self.directory, "options.h5")
+        writer = worker.get_hdf5_writer(filename, append_frames=True)
+        writer.init(fai_cfg=config)
+        for i in range(3):
+            worker.process(data=numpy.ones(shape=self.shape) * i, writer=writer)
+        writer.close()
+        with io.h5py.File(filename, "r") as h5:
+            dataset = h5["data/integrate/results/data"]
+            self.assertEqual(dataset.shape, (3, 2))
+            self.assertEqual(dataset.chunks, (4, 2))
+            self.assertEqual(dataset.compression, "gzip")
+
     @classmethod
     def tearDownClass(cls):
         shutil.rmtree(cls.directory)
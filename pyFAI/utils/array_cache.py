@@ -0,0 +1,216 @@
+# coding: utf-8
+#
+#    Copyright (C) 2019 European Synchrotron Radiation Facility, Grenoble, France
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#  .
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#  .
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+"""Cache of arrays shared between processes via memory-mapped files.
+
+Used by the geometry to share the position arrays (centers, corners, deltas)
+of a detector between all processes working with the same geometry: the first
+process stores the array, all others map it in memory instead of calculating
+it. Pages are shared by the operating system, so the memory is only used once.
+
+Using a directory on a RAM file-system (i.e. `/dev/shm` under linux) makes it
+a shared-memory cache. The default cache is configured with the environment
+variables `PYFAI_ARRAY_CACHE` (directory) and `PYFAI_ARRAY_CACHE_SIZE` (in
+bytes).
+"""
+
+from __future__ import absolute_import, print_function, division
+
+__author__ = "Jerome Kieffer"
+__contact__ = "Jerome.Kieffer@ESRF.eu"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "18/02/2019"
+__status__ = "development"
+
+import os
+import json
+import hashlib
+import tempfile
+import logging
+logger = logging.getLogger(__name__)
+import numpy
+
+DEFAULT_MAX_SIZE = 2 ** 32
+"""Default maximum size of the cache: 4GB"""
+
+EXTENSION = ".npy"
+
+
+class ArrayCache(object):
+    """Size-bounded cache of arrays in a directory, shared between processes.
+
+    Entries are evicted in least recently used order when the total size
+    exceeds `max_size`.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        """Constructor of the cache
+
+        :param directory: directory where the arrays are stored
+        :param max_size: maximum size of the cache in bytes
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_size = int(max_size)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def __repr__(self):
+        return "ArrayCache %s: %i entries, %.3fMB/%.3fMB" % \
+            (self.directory, len(self.keys()), self.nbytes / 1e6, self.max_size / 1e6)
+
+    @staticmethod
+    def get_key(**params):
+        """Calculate the key of an array from all parameters defining it.
+
+        :param params: JSON-serializable description of the array
+        :return: hexadecimal digest
+        """
+        from .. import version
+        params["version"] = version
+        description = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + EXTENSION)
+
+    def keys(self):
+        """List of the entries in the cache
+
+        :return: list of keys, the oldest used first
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(EXTENSION):
+                continue
+            try:
+                entries.append((os.stat(os.path.join(self.directory, name)).st_mtime,
+                                name[:-len(EXTENSION)]))
+            except OSError:
+                # entry removed by another process
+                continue
+        return [key for _, key in sorted(entries)]
+
+    @property
+    def nbytes(self):
+        "Size of the cache"
+        size = 0
+        for key in self.keys():
+            try:
+                size += os.stat(self._path(key)).st_size
+            except OSError:
+                continue
+        return size
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def load(self, key):
+        """Retrieve an array from the cache
+
+        The array is memory-mapped in copy-on-write mode: pages are shared
+        between all processes while Cython code still gets a writable buffer.
+
+        :param key: key of the array, as given by `get_key`
+        :return: array or None if not in the cache
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            array = numpy.load(path, mmap_mode="c")
+            os.utime(path, None)
+        except (IOError, OSError, ValueError) as err:
+            logger.warning("Unable to read entry %s from array cache: %s", key, err)
+            return None
+        return array
+
+    def save(self, key, array):
+        """Store an array in the cache and evict old entries if needed
+
+        :param key: key of the array, as given by `get_key`
+        :param array: numpy array
+        """
+        if key in self:
+            return
+        fd, tmp = tempfile.mkstemp(prefix=key, suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                numpy.save(f, numpy.ascontiguousarray(array))
+            os.rename(tmp, self._path(key))
+        except (IOError, OSError) as err:
+            logger.debug("Unable to store entry %s in array cache: %s", key, err)
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        self.evict()
+
+    def evict(self, max_size=None):
+        """Remove the least recently used entries until the cache fits in max_size
+
+        Processes using an evicted array keep their mapping valid.
+
+        :param max_size: size limit in bytes, by default the one of the cache
+        """
+        if max_size is None:
+            max_size = self.max_size
+        sizes = []
+        for key in self.keys():
+            try:
+                sizes.append((key, os.stat(self._path(key)).st_size))
+            except OSError:
+                continue
+        total = sum(size for _, size in sizes)
+        for key, size in sizes:
+            if total <= max_size:
+                break
+            logger.debug("Evict entry %s from array cache", key)
+            try:
+                os.unlink(self._path(key))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Empty the cache"""
+        self.evict(0)
+
+
+_default_cache = None
+
+
+def get_default_cache():
+    """Array cache defined by the PYFAI_ARRAY_CACHE environment variable
+
+    :return: ArrayCache instance or None if the cache is not configured
+    """
+    global _default_cache
+    directory = os.environ.get("PYFAI_ARRAY_CACHE")
+    if not directory:
+        return None
+    if (_default_cache is None) or (_default_cache.directory != os.path.abspath(directory)):
+        max_size = os.environ.get("PYFAI_ARRAY_CACHE_SIZE", DEFAULT_MAX_SIZE)
+        try:
+            _default_cache = ArrayCache(directory, int(max_size))
+        except (IOError, OSError) as err:
+            logger.error("Unable to use %s as array cache: %s", directory, err)
+            return None
+    return _default_cache
@@ -0,0 +1,106 @@
+# coding: utf-8
+#
+#    Copyright (C) 2019 European Synchrotron Radiation Facility, Grenoble, France
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#  .
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#  .
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+"""Pools of workers sharing a context.
+
+The context (i.e. a configured integrator) is given to each worker by the
+initializer of the pool and retrieved in the jobs with `get_context`:
+
+* with the fork start method, the context is inherited by the processes,
+  pages are shared copy-on-write and nothing is pickled,
+* with spawn or forkserver, the context is pickled once per process,
+* with threads, the context is shared by all threads.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+__author__ = "Jerome Kieffer"
+__contact__ = "Jerome.Kieffer@ESRF.eu"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "18/02/2019"
+__status__ = "development"
+
+import sys
+import threading
+import logging
+import multiprocessing
+import multiprocessing.pool
+logger = logging.getLogger(__name__)
+
+THREAD = "thread"
+"""Start method of pools of threads"""
+
+_local = threading.local()
+
+
+def _initialize(context):
+    """Initializer of the workers of the pool
+
+    :param context: context of the pool
+    """
+    _local.context = context
+
+
+def get_context():
+    """Context of the pool the current worker belongs to
+
+    :return: the context given to `create_pool`, None outside of a pool
+    """
+    return getattr(_local, "context", None)
+
+
+def get_start_method():
+    """Start method of the pools, when not specified
+
+    :return: the start method defined with `multiprocessing.set_start_method`
+        if any, else fork when available and safe (not on MacOS), spawn on
+        MacOS and threads when processes cannot be forked (Windows).
+    """
+    method = multiprocessing.get_start_method(allow_none=True)
+    if method is not None:
+        return method
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return THREAD
+    if sys.platform == "darwin":
+        return "spawn"
+    return "fork"
+
+
+def create_pool(njobs, context, start_method=None):
+    """Create a pool of workers sharing a context
+
+    :param int njobs: number of workers
+    :param context: object retrieved by the jobs with `get_context`. Has to
+        be picklable with the spawn and forkserver start methods.
+    :param str start_method: "fork", "spawn", "forkserver" or "thread",
+        by default the one given by `get_start_method`
+    :return: pool of processes or threads
+    :rtype: multiprocessing.pool.Pool
+    """
+    if start_method is None:
+        start_method = get_start_method()
+    logger.debug("Pool of %s workers started with %s", njobs, start_method)
+    if start_method == THREAD:
+        return multiprocessing.pool.ThreadPool(njobs, initializer=_initialize, initargs=(context,))
+    mp_context = multiprocessing.get_context(start_method)
+    return mp_context.Pool(njobs, initializer=_initialize, initargs=(context,))
@@ -76,6 +76,10 @@ Here are the valid keys:
 - "val_dummy"
 - "do_dummy"
 - "method"
+- "nthread" # number of OpenMP threads of the CSR integrators, 0 for the default
+- "chunk_frames" # number of frames per chunk of the HDF5 outputs
+- "compression" # compression filter of the HDF5 outputs, see `pyFAI.io.get_compression`
+- "buffer_frames" # number of frames written at once in the HDF5 outputs, 0 to write synchronously
 """
 
 
@@ -85,13 +89,14 @@ __author__ = "Jerome Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "23/01/2019"
+__date__ = "18/02/2019"
 __status__ = "development"
 
 import threading
 import os.path
 import logging
 import json
+import time
 import numpy
 import fabio
 
@@ -102,7 +107,9 @@ from .azimuthalIntegrator import AzimuthalIntegrator
 from .distortion import Distortion
 from . import units
 from .io import integration_config
+from .io import HDF5Writer
 from .engines.preproc import preproc as preproc_numpy
+from .third_party import six
 try:
     from .ext.preproc import preproc
 except ImportError as err:
@@ -219,6 +226,72 @@ def _reduce_images(filenames, method="mean"):
         return average.average_images(filenames, filter_=method, fformat=None, threshold=0)
 
 
+class PipelineStatistics(object):
+    """
+    Throughput of the stages of a processing pipeline
+
+    For each stage, counts the number of frames processed and the time spent
+    in it, summed over all the threads of the stage.
+    """
+
+    def __init__(self, stages):
+        """
+        :param stages: list of the names of the stages
+        """
+        self.stages = list(stages)
+        self.count = dict((stage, 0) for stage in self.stages)
+        self.busy = dict((stage, 0.0) for stage in self.stages)
+        self.start_time = self.stop_time = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.start_time = time.time()
+
+    def stop(self):
+        self.stop_time = time.time()
+
+    def record(self, stage, duration):
+        """
+        Account one frame processed by a stage
+
+        :param stage: name of the stage
+        :param duration: time spent on this frame in seconds
+        """
+        with self._lock:
+            self.count[stage] += 1
+            self.busy[stage] += duration
+
+    @property
+    def elapsed(self):
+        "Wall-clock duration of the processing"
+        if self.start_time is None:
+            return 0.0
+        return (self.stop_time or time.time()) - self.start_time
+
+    def throughput(self, stage=None):
+        """
+        Frames processed per second of busy time by a stage.
+
+        :param stage: name of the stage, or None for the overall wall-clock throughput
+        :return: frames per second
+        """
+        if stage is None:
+            count = self.count[self.stages[-1]]
+            duration = self.elapsed
+        else:
+            count = self.count[stage]
+            duration = self.busy[stage]
+        return count / duration if duration > 0 else float("nan")
+
+    def __repr__(self):
+        lines = ["%-10s %6i frames, busy %8.3fs, %8.2f frames/s/thread" %
+                 (stage, self.count[stage], self.busy[stage], self.throughput(stage))
+                 for stage in self.stages]
+        lines.append("%-10s %6i frames in %8.3fs, %8.2f frames/s" %
+                     ("total", self.count[self.stages[-1]], self.elapsed, self.throughput()))
+        return os.linesep.join(lines)
+
+
 class Worker(object):
     def __init__(self, azimuthalIntegrator=None,
                  shapeIn=(2048, 2048), shapeOut=(360, 500),
@@ -277,6 +350,9 @@ class Worker(object):
         self.radial_range = None
         self.azimuth_range = None
         self.safe = True
+        self.chunk_frames = 1  # options of the HDF5 outputs, see get_hdf5_writer
+        self.compression = None
+        self.buffer_frames = 0
 
     def __repr__(self):
         """
@@ -298,6 +374,23 @@ class Worker(object):
                   "Azimuth range: %s" % self.azimuth_range]
         return os.linesep.join(lstout)
 
+    def __getstate__(self):
+        """Helper function for pickling the worker, i.e. for pools of processes
+
+        :return: the state of the object
+        """
+        state = self.__dict__.copy()
+        del state["_sem"]
+        return state
+
+    def __setstate__(self, state):
+        """Helper function for unpickling the worker
+
+        :param state: the state of the object
+        """
+        self.__dict__.update(state)
+        self._sem = threading.Semaphore()
+
     def do_2D(self):
         return self.nbpt_azim > 1
 
@@ -322,16 +415,13 @@ class Worker(object):
         self.ai.reset()
         self.warmup(sync)
 
-    def process(self, data, variance=None, normalization_factor=1.0, writer=None, metadata=None):
+    def _integrate(self, data, variance=None, normalization_factor=1.0, metadata=None):
         """
-        Process a frame
-        #TODO:
-        dark, flat, sa are missing
+        Integrate a frame, without writing nor formatting the result
 
         :param data: numpy array containing the input image
-        :param writer: An open writer in which 'write' will be called with the result of the integration
+        :return: the integration result container
         """
-
         with self._sem:
             monitor = self._normalization_factor * normalization_factor if self._normalization_factor else normalization_factor
         kwarg = {"unit": self.unit,
@@ -376,20 +466,15 @@ class Worker(object):
         if self.azimuth_range is not None:
             kwarg["azimuth_range"] = self.azimuth_range
 
-        error = None
         try:
             if self.do_2D():
                 integrated_result = self.ai.integrate2d(**kwarg)
                 self.radial = integrated_result.radial
                 self.azimuthal = integrated_result.azimuthal
-                result = integrated_result.intensity
-                if variance is not None:
-                    error = integrated_result.sigma
             else:
                 integrated_result = self.ai.integrate1d(**kwarg)
                 self.radial = integrated_result.radial
                 self.azimuthal = None
-                result = numpy.vstack(integrated_result).T
 
         except Exception as err:
             logger.debug("Backtrace", exc_info=True)
@@ -407,17 +492,189 @@ class Worker(object):
                     ]
             logger.error("\n".join(err2))
             raise err
+        return integrated_result
 
-        if writer is not None:
-            writer.write(integrated_result)
-
+    def _format_result(self, integrated_result, variance=None):
+        """
+        Format the integration result according to `self.output`
+        """
         if self.output == "raw":
             return integrated_result
         elif self.output == "numpy":
-            if (variance is not None) and (error is not None):
-                return result, error
-            else:
+            if self.do_2D():
+                result = integrated_result.intensity
+                if variance is not None:
+                    error = integrated_result.sigma
+                    if error is not None:
+                        return result, error
                 return result
+            else:
+                return numpy.vstack(integrated_result).T
+
+    def process(self, data, variance=None, normalization_factor=1.0, writer=None, metadata=None):
+        """
+        Process a frame
+        #TODO:
+        dark, flat, sa are missing
+
+        :param data: numpy array containing the input image
+        :param writer: An open writer in which 'write' will be called with the result of the integration
+        """
+        integrated_result = self._integrate(data, variance=variance,
+                                            normalization_factor=normalization_factor,
+                                            metadata=metadata)
+        if writer is not None:
+            writer.write(integrated_result)
+
+        return self._format_result(integrated_result, variance)
+
+    def process_pipeline(self, frames, writer=None, read=None, callback=None,
+                         nreader=1, nintegrator=1, queue_size=4, is_interrupted=None):
+        """
+        Process a stream of frames with reading, integration and writing
+        overlapping in time.
+
+        Frames are read (decompressed) by a pool of `nreader` threads and
+        integrated by a pool of `nintegrator` threads. A single writer thread
+        re-orders the results, writes them and calls the callback, so the output
+        is in the same order as the input. At most `queue_size` frames per
+        thread are in flight: reading blocks when integration or writing lag
+        behind (back-pressure), which bounds the memory used.
+
+        :param frames: iterable of frames, consumed by the reader threads
+        :param writer: An open writer in which 'write' will be called with the
+            result of each integration, in order
+        :param read: function converting an element of `frames` into a frame:
+            either a numpy array or a dict with the key "data" and optionally
+            "variance", "normalization_factor" and "metadata". By default
+            elements of frames are expected to be frames already.
+        :param callback: function called in order as callback(index, frame, result)
+            after the writing, with the formatted result
+        :param nreader: number of reading threads
+        :param nintegrator: number of integration threads
+        :param queue_size: maximum number of frames in flight per thread
+        :param is_interrupted: function returning True to stop the processing
+        :return: statistics of the processing with the throughput of each stage
+        :rtype: PipelineStatistics
+        """
+        nreader = max(1, int(nreader))
+        nintegrator = max(1, int(nintegrator))
+        queue_size = max(1, int(queue_size))
+        inflight = threading.BoundedSemaphore(queue_size * (nreader + nintegrator + 1))
+        decoded = six.moves.queue.Queue(queue_size * nintegrator)
+        integrated = six.moves.queue.Queue(queue_size)
+        iterator = iter(frames)
+        iterator_lock = threading.Lock()
+        counter = [0]
+        abort = threading.Event()
+        errors = []
+        statistics = PipelineStatistics(("read", "integrate", "write"))
+
+        def fail(err):
+            logger.debug("Backtrace", exc_info=True)
+            errors.append(err)
+            abort.set()
+
+        def reader():
+            while not abort.is_set():
+                inflight.acquire()
+                with iterator_lock:
+                    if abort.is_set():
+                        inflight.release()
+                        return
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        inflight.release()
+                        return
+                    except Exception as err:
+                        inflight.release()
+                        fail(err)
+                        return
+                    index = counter[0]
+                    counter[0] += 1
+                t0 = time.time()
+                try:
+                    frame = read(item) if read is not None else item
+                    if not isinstance(frame, dict):
+                        frame = {"data": frame}
+                except Exception as err:
+                    inflight.release()
+                    fail(err)
+                    return
+                statistics.record("read", time.time() - t0)
+                decoded.put((index, frame))
+
+        def integrator():
+            while True:
+                job = decoded.get()
+                if job is None:
+                    return
+                index, frame = job
+                result = None
+                if not abort.is_set():
+                    t0 = time.time()
+                    try:
+                        result = self._integrate(frame["data"],
+                                                 variance=frame.get("variance"),
+                                                 normalization_factor=frame.get("normalization_factor", 1.0),
+                                                 metadata=frame.get("metadata"))
+                    except Exception as err:
+                        fail(err)
+                    else:
+                        statistics.record("integrate", time.time() - t0)
+                integrated.put((index, frame, result))
+
+        def write():
+            pending = {}
+            next_index = 0
+            while True:
+                job = integrated.get()
+                if job is None:
+                    return
+                pending[job[0]] = job
+                while (next_index in pending) and not abort.is_set():
+                    index, frame, result = pending.pop(next_index)
+                    next_index += 1
+                    t0 = time.time()
+                    try:
+                        if writer is not None:
+                            writer.write(result)
+                        if callback is not None:
+                            callback(index, frame, self._format_result(result, frame.get("variance")))
+                    except Exception as err:
+                        fail(err)
+                    else:
+                        statistics.record("write", time.time() - t0)
+                    inflight.release()
+                    if (is_interrupted is not None) and is_interrupted():
+                        logger.info("Processing interrupted after %i frames", next_index)
+                        abort.set()
+                if abort.is_set():
+                    # drop the results to release the readers
+                    for _ in pending:
+                        inflight.release()
+                    pending.clear()
+
+        readers = [threading.Thread(target=reader, name="reader-%i" % i) for i in range(nreader)]
+        integrators = [threading.Thread(target=integrator, name="integrator-%i" % i) for i in range(nintegrator)]
+        writer_thread = threading.Thread(target=write, name="writer")
+        statistics.start()
+        for thread in readers + integrators + [writer_thread]:
+            thread.start()
+        for thread in readers:
+            thread.join()
+        for thread in integrators:
+            decoded.put(None)
+        for thread in integrators:
+            thread.join()
+        integrated.put(None)
+        writer_thread.join()
+        statistics.stop()
+        logger.debug("Pipeline processing:\n%s", statistics)
+        if errors:
+            raise errors[0]
+        return statistics
 
     def setSubdir(self, path):
         """
@@ -506,6 +763,14 @@ class Worker(object):
         reader = integration_config.ConfigurationReader(config)
         self.method = reader.pop_method("csr")
 
+        value = config.pop("nthread", None)
+        if value is not None:
+            self.ai.nthread = int(value)
+
+        self.chunk_frames = int(config.pop("chunk_frames", None) or 1)
+        self.compression = config.pop("compression", None) or None
+        self.buffer_frames = int(config.pop("buffer_frames", None) or 0)
+
         if self.method.dim == 1:
             self.nbpt_azim = 1
 
@@ -585,14 +850,16 @@ class Worker(object):
         FIXME: The returned dictionary is not exhaustive.
         """
         config = {"unit": str(self.unit)}
-        for key in ["dist", "poni1", "poni2", "rot1", "rot3", "rot2", "pixel1", "pixel2", "splineFile", "wavelength"]:
+        for key in ["dist", "poni1", "poni2", "rot1", "rot3", "rot2", "pixel1", "pixel2", "splineFile", "wavelength",
+                    "nthread"]:
             try:
                 config[key] = self.ai.__getattribute__(key)
             except:
                 pass
         for key in ["nbpt_azim", "nbpt_rad", "polarization_factor", "dummy", "delta_dummy",
                     "correct_solid_angle", "dark_current_image", "flat_field_image",
-                    "mask_image", "do_poisson", "shape", "method"]:
+                    "mask_image", "do_poisson", "shape", "method",
+                    "chunk_frames", "compression", "buffer_frames"]:
             try:
                 config[key] = self.__getattribute__(key)
             except:
@@ -600,6 +867,17 @@ class Worker(object):
 
         return config
 
+    def get_hdf5_writer(self, filename, **kwargs):
+        """HDF5 writer using the options of the worker
+
+        :param str filename: name of the HDF5 file
+        :param kwargs: other parameters of `pyFAI.io.HDF5Writer`
+        :rtype: pyFAI.io.HDF5Writer
+        """
+        return HDF5Writer(filename, chunk_frames=self.chunk_frames,
+                          compression=self.compression,
+                          buffer_frames=self.buffer_frames, **kwargs)
+
     def get_json_config(self):
         """return configuration as a JSON string"""
         pass  # TODO